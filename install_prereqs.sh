@@ -8,6 +8,8 @@ $SUDO apt install -y python3-libcamera libcamera-apps
 $SUDO apt install -y python3-rpi.gpio
 $SUDO apt install -y python3-picamera2
 $SUDO apt install -y ffmpeg
+$SUDO apt install -y python3-av
+$SUDO apt install -y srt-tools
 $SUDO apt install -y python3-opencv
 $SUDO apt install -y python3-numpy
 $SUDO apt install -y libzmq3-dev
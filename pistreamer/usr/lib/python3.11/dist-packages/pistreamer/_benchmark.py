@@ -0,0 +1,1756 @@
+#!/usr/bin/env python3
+
+"""
+Development benchmarks for pistreamer. These run without a camera and are not used at runtime.
+Run `python _benchmark.py --help` for the list of benchmarks.
+"""
+
+import argparse
+import builtins
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import socket
+import statistics
+import struct
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+from time import monotonic, perf_counter_ns, process_time, sleep
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+import cv2
+import numpy as np
+
+from _fake_devices import (
+    DISPATCH_COMMANDS,
+    RECORD_PROFILE_FRAMES,
+    SEGMENT_FRAMES,
+    SOAK_FRAMES,
+    SUPERVISOR_FRAMES,
+    FakeCameraExhausted,
+    FakeFragmentedMp4,
+    FakeTransportStream,
+    LossyLink,
+    RtspClient,
+    StubPiStreamer,
+    capture_fec_relay,
+    count_frames,
+    create_fake_pistreamer,
+    get_growth_per_hour,
+    render_frames,
+    rtp_frames,
+    run_record_profile_switch,
+    run_segments_scenario,
+    run_soak_scenario,
+    run_stream_scenario,
+    run_supervisor_scenario,
+)
+from command_controller import CommandController
+from constants import (
+    ENCODER_READ_SIZE,
+    FRAMERATE,
+    HARDWARE_ENCODER_DEVICE,
+    SRT_PAYLOAD_SIZE,
+    STREAMING_FRAMESIZE,
+    EncoderBackend,
+    EncoderState,
+    FrameStage,
+    MavlinkGPSData,
+    MavlinkMiscData,
+    ProfileMode,
+    StreamingProtocolType,
+)
+from encoder_supervisor import EncoderSupervisor
+from ffmpeg_configs import (
+    get_ffmpeg_command_mpeg_ts,
+    get_ffmpeg_command_record,
+    get_ffmpeg_command_rtp,
+)
+from frame_decimator import FrameDecimator
+from frame_index import FrameIndexWriter, read_frame_index
+from klv_encoder import KLVEncoder, parse_klv
+from mavlink_codec import (
+    decode_gps_values,
+    decode_misc_values,
+    encode_gps_data,
+    encode_misc_data,
+)
+from memory_monitor import PAGE_SIZE, get_rss_kb
+from pre_event_buffer import PreEventBuffer, _FragmentedMp4Splitter
+from profiler import StreamProfiler
+from pyav_encoder import PyAvEncoderProcess
+from rtp_fec import FecDecoder, FecEncoder
+from srt_transmitter import SrtTransmitter
+from stage_stats import StageStats
+from storage_monitor import get_free_bytes
+from telemetry_buffer import TelemetryHistory
+
+DISPATCH_ITERATIONS = 20000
+DECODE_ITERATIONS = 100000
+KLV_ITERATIONS = 100000
+FRAME_INDEX_FRAMES = 30 * 60 * 10  # 10 minutes at 30 fps
+STAGE_STATS_FRAMES = 100000
+STREAM_FRAMES = 300
+PHOTO_ITERATIONS = 3
+PROFILER_FRAMES = 300
+ENCODER_START_DELAY = 0.5  # seconds the fake encoders take to load, like ffmpeg on a Pi
+ENCODER_START_ITERATIONS = 3
+ENCODER_START_PRE_EVENT = 2.0  # seconds
+PRE_EVENT_BITRATES = [2000000, 4000000, 6000000, 8000000, 10000000]
+PRE_EVENT_BENCH_SECONDS = 10.0  # buffered
+PRE_EVENT_BENCH_DURATION = 60.0  # seconds of stream fed
+STATVFS_ITERATIONS = 10000
+RECORD_PROFILE_BITRATE = 8000000  # the pre-event splitting cost scales with it
+RECORD_PROFILE_DURATION = 60.0  # seconds of stream split per profile
+RECORD_PROFILE_FFMPEG_FRAMES = 30 * 10  # encoded per profile when ffmpeg is installed
+# (name, profile, audio), mpegts_audio is the old anullsrc recording
+RECORD_PROFILE_CASES: List[Tuple[str, str, bool]] = [
+    ("mpegts", "mpegts", False),
+    ("mpegts_audio", "mpegts", True),
+    ("fmp4", "fmp4", False),
+    ("fmp4_audio", "fmp4", True),
+]
+SIMULCAST_FRAMES = 300
+SIMULCAST_REPEATS = 3  # the best run of each case is kept
+SIMULCAST_FFMPEG_FRAMES = 30 * 10  # encoded per stream when ffmpeg is installed
+# (name, stream resolution, record resolution, secondary resolution), each simulcast case
+# is compared with the one stream case before it
+SIMULCAST_CASES: List[Tuple[str, str, str, str]] = [
+    ("one_stream", "1280x720", "", ""),
+    ("simulcast", "1280x720", "", "640x360"),
+    ("dual_one_stream", "1280x720", "1920x1080", ""),
+    ("dual_simulcast", "1280x720", "1920x1080", "640x360"),  # scaled on the CPU
+]
+DECIMATION_SECONDS = 600  # of simulated camera time per case
+DECIMATION_FRAMERATES = [30, 15, 10, 5]
+# (name, frame interval ns, timestamp jitter ns, a frame dropped every n frames or 0),
+# 29.97 is a camera running slightly slower than FRAMERATE
+DECIMATION_CAMERAS: List[Tuple[str, int, int, int]] = [
+    ("30fps", 1000000000 // 30, 0, 0),
+    ("29.97fps", 1001000000 // 30, 0, 0),
+    ("29.97fps_jitter", 1001000000 // 30, 2000000, 0),
+    ("30fps_drops", 1000000000 // 30, 0, 150),
+]
+RTSP_IDLE_SECONDS = 1.0  # streaming with no viewer before the first connects
+RTSP_WATCH_SECONDS = 2.0  # both viewers playing
+RTSP_BENCH_IDLE_TIMEOUT = 1.0  # seconds, the server's idle_timeout for the benchmark
+FEC_BENCH_SECONDS = 5.0  # of stream sent through the relay in real time per setting
+# bps of the simulated radio link the capture is sent over
+FEC_BENCH_LINK_RATE = 4000000
+FEC_BENCH_RUNS = 20  # loss patterns per loss model
+# (name, group size, interleave)
+FEC_SETTINGS: List[Tuple[str, int, int]] = [
+    ("off", 0, 1),
+    ("1_in_16", 16, 1),
+    ("1_in_8", 8, 1),
+    ("1_in_4", 4, 1),
+    ("1_in_4_interleave_4", 4, 4),
+]
+# (name, packet loss, mean burst length) of a Gilbert-Elliott channel
+FEC_LOSS_MODELS: List[Tuple[str, float, float]] = [
+    ("random_1_percent", 0.01, 1.0),
+    ("random_5_percent", 0.05, 1.0),
+    ("bursts_2_percent", 0.02, 3.0),
+]
+SRT_BENCH_SECONDS = 10.0  # streamed per protocol and link
+SRT_BENCH_RESOLUTION = "640x360"
+SRT_BENCH_BITRATE = "2000000"
+SRT_BENCH_LATENCY = 200  # ms, SRT's latency for the comparison
+SRT_BENCH_PORT = 5630  # the receivers' ports on loopback, 5630 and 5631
+# (name, delay ms, jitter ms, loss) of the emulated link, each way
+SRT_BENCH_LINKS: List[Tuple[str, float, float, float]] = [
+    ("clean", 10.0, 0.0, 0.0),
+    ("loss_1_percent", 20.0, 5.0, 0.01),
+    ("loss_5_percent", 40.0, 10.0, 0.05),
+]
+FRAME_NUMBER_BLOCK = 16  # pixels per bit of the frame numbers stamped by bench_srt
+KEYFRAME_BENCH_SECONDS = 12.0  # streamed in real time per case
+KEYFRAME_BENCH_BITRATE = 2000000  # bps, the default streaming bitrate
+KEYFRAME_BENCH_BUFFER_BITS = 64000  # the streams' -bufsize
+KEYFRAME_BENCH_PORT = 5634  # the receiver's RTP port on loopback
+KEYFRAME_BENCH_JOIN_INTERVAL = 1.7  # seconds between joins, out of step with the GOP
+KEYFRAME_BENCH_WARMUP = 1.0  # seconds of stream left out, the encoder's first IDR
+# (name, intra refresh, keyframe requested by each join)
+KEYFRAME_CASES: List[Tuple[str, bool, bool]] = [
+    ("gop", False, False),
+    ("on_demand", False, True),
+    ("intra_refresh", True, False),
+]
+ENCODER_BACKEND_BENCH_SECONDS = 10.0  # streamed in real time per case
+ENCODER_BACKEND_BENCH_BITRATE = 2000000  # bps, the default streaming bitrate
+ENCODER_BACKEND_BENCH_PORT = 5636  # the receiver's RTP port on loopback
+# seconds left out of the latency, the encoder loading
+ENCODER_BACKEND_BENCH_WARMUP = 1.0
+# (name, encoder backend, resolution)
+ENCODER_BACKEND_CASES: List[Tuple[str, str, str]] = [
+    ("ffmpeg_720p", "ffmpeg", "1280x720"),
+    ("pyav_720p", "pyav", "1280x720"),
+    ("ffmpeg_1080p", "ffmpeg", "1920x1080"),
+    ("pyav_1080p", "pyav", "1920x1080"),
+]
+
+# The stream() matrix, every scenario runs STREAM_FRAMES frames through the fake camera
+STREAM_SCENARIOS: List[Dict[str, Any]] = [
+    {"name": "rtp_720p", "resolution": "1280x720"},
+    {"name": "rtp_1080p", "resolution": "1920x1080"},
+    {"name": "mpegts_720p", "resolution": "1280x720", "protocol": "mpegts"},
+    {"name": "srt_720p", "resolution": "1280x720", "protocol": "srt"},
+    {"name": "rtp_720p_stabilize", "resolution": "1280x720", "stabilize": True},
+    {"name": "rtp_720p_tracking", "resolution": "1280x720", "tracking": True},
+    {"name": "rtp_720p_zoom_overlay", "resolution": "1280x720", "zoom": True},
+    {"name": "rtp_720p_record", "resolution": "1280x720", "record": True},
+    {
+        "name": "mpegts_720p_record",  # REC overlay and KLV
+        "resolution": "1280x720",
+        "protocol": "mpegts",
+        "record": True,
+    },
+    # recording the ISP's main output while streaming its lores output
+    {
+        "name": "rtp_720p_record_1080p",
+        "resolution": "1280x720",
+        "record_resolution": "1920x1080",
+        "record": True,
+    },
+    {
+        "name": "rtp_360p_record_1080p",
+        "resolution": "640x360",
+        "record_resolution": "1920x1080",
+        "record": True,
+    },
+    {
+        "name": "rtp_720p_record_4k",
+        "resolution": "1280x720",
+        "record_resolution": "3840x2160",
+        "record": True,
+    },
+    {
+        "name": "mpegts_720p_record_1080p",  # the REC overlay converts the lores frames
+        "resolution": "1280x720",
+        "record_resolution": "1920x1080",
+        "protocol": "mpegts",
+        "record": True,
+    },
+    # per-sink frame rates, the camera runs at FRAMERATE
+    {"name": "rtp_720p_15fps", "resolution": "1280x720", "stream_framerate": 15},
+    {
+        "name": "rtp_720p_15fps_record",
+        "resolution": "1280x720",
+        "stream_framerate": 15,
+        "record": True,
+    },
+    {
+        "name": "rtp_720p_record_15fps",  # every sink at 15, half the frames skipped
+        "resolution": "1280x720",
+        "stream_framerate": 15,
+        "record_framerate": 15,
+        "record": True,
+    },
+    {
+        "name": "rtp_360p_10fps_record_1080p",
+        "resolution": "640x360",
+        "record_resolution": "1920x1080",
+        "stream_framerate": 10,
+        "record": True,
+    },
+    # simulcast, the secondary stream is the lores output or the lores stream scaled down
+    {
+        "name": "rtp_720p_secondary_360p",
+        "resolution": "1280x720",
+        "secondary_resolution": "640x360",
+    },
+    {
+        "name": "rtp_720p_record_1080p_secondary_360p",
+        "resolution": "1280x720",
+        "record_resolution": "1920x1080",
+        "secondary_resolution": "640x360",
+        "record": True,
+    },
+    {
+        "name": "rtp_1080p_all",
+        "resolution": "1920x1080",
+        "stabilize": True,
+        "tracking": True,
+        "zoom": True,
+        "record": True,
+    },
+]
+
+
+def _time_ns(func: Callable[[], Any], iterations: int) -> float:
+    start_ns = perf_counter_ns()
+    for _ in range(iterations):
+        func()
+    return (perf_counter_ns() - start_ns) / iterations
+
+
+def bench_dispatch(iterations: int = DISPATCH_ITERATIONS) -> Dict[str, Any]:
+    """
+    Cost per command type of CommandRegistry.dispatch (lookup, parse, handler) against a
+    stubbed PiStreamer2 so only the command layer is measured.
+    """
+
+    controller = CommandController(StubPiStreamer())  # type: ignore
+    _print = builtins.print
+    builtins.print = lambda *args, **kwargs: None  # handlers print on some commands
+    try:
+        results = {}
+        for command_type, command_value in DISPATCH_COMMANDS:
+            name = f"{command_type} {command_value}"[:40]
+            results[name] = round(
+                _time_ns(
+                    lambda: controller.registry.dispatch(command_type, command_value),
+                    iterations,
+                )
+            )
+    finally:
+        builtins.print = _print
+    return {
+        "dispatch_ns": results,
+        "handler_timings": controller.registry.get_timings(),
+    }
+
+
+def bench_telemetry_decode(iterations: int = DECODE_ITERATIONS) -> Dict[str, Any]:
+    """
+    Cost per message of decoding GPS and MISC data from the JSON and the binary commands.
+    """
+
+    controller = CommandController(StubPiStreamer())  # type: ignore
+    gps_json = DISPATCH_COMMANDS[3][1]
+    misc_json = DISPATCH_COMMANDS[4][1]
+    gps_binary = encode_gps_data(MavlinkGPSData(**json.loads(gps_json)))
+    misc_binary = encode_misc_data(MavlinkMiscData(**json.loads(misc_json)))
+    return {
+        "gps_json_ns": round(
+            _time_ns(lambda: controller._parse_gps(gps_json), iterations)
+        ),
+        "gps_binary_ns": round(
+            _time_ns(lambda: decode_gps_values(gps_binary), iterations)
+        ),
+        "misc_json_ns": round(
+            _time_ns(lambda: controller._parse_misc(misc_json), iterations)
+        ),
+        "misc_binary_ns": round(
+            _time_ns(lambda: decode_misc_values(misc_binary), iterations)
+        ),
+        "gps_json_bytes": len(gps_json),
+        "gps_binary_bytes": len(gps_binary),
+    }
+
+
+def bench_klv(iterations: int = KLV_ITERATIONS) -> Dict[str, Any]:
+    """
+    Cost per frame of encoding the MISB ST 0601 packet, and the packet parsed back.
+    """
+
+    gps_data = MavlinkGPSData(**json.loads(DISPATCH_COMMANDS[3][1]))
+    telemetry = TelemetryHistory()
+    telemetry.add_gps(
+        (359686990, -839290440, 276000, 1, 1, 1500, 35950, 3, 10, gps_data.time_usec)
+    )
+    telemetry.add_misc(0.1, -0.02, "IMX477", (50, 1))
+    encoder = KLVEncoder()
+    gps_row = telemetry.gps.latest()
+    attitude_row = telemetry.attitude.latest()
+    timestamp_us = gps_data.time_usec
+
+    parsed = parse_klv(bytes(encoder.encode(timestamp_us, gps_row, attitude_row)))
+    return {
+        "encode_ns": round(
+            _time_ns(
+                lambda: encoder.encode(timestamp_us, gps_row, attitude_row), iterations
+            )
+        ),
+        "packet_bytes": len(encoder.packet),
+        "parsed": parsed,
+    }
+
+
+def bench_frame_index(frames: int = FRAME_INDEX_FRAMES) -> Dict[str, Any]:
+    """
+    Cost per frame of appending to the recording sidecar, and of finding the frames
+    recorded near a location by memory mapping it back.
+    """
+
+    samples = frames // 6 + 2  # ~5 Hz GPS/attitude
+    telemetry = TelemetryHistory(capacity=samples)
+    start_ns = 1000000000
+    for sample in range(samples):
+        timestamp_ns = start_ns + sample * 200000000
+        telemetry.add_gps(
+            (359686990 + sample * 10, -839290440, 276000, 1, 1, 500, 9000, 3, 10, 0),
+            timestamp_ns,
+        )
+        telemetry.add_misc(0.1, 0.02, "IMX477", (50, 1), timestamp_ns)
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "recording.idx")
+        writer = FrameIndexWriter(file_name, 30.0)
+        frame_timestamps = [start_ns + frame * 33333333 for frame in range(frames)]
+        start = perf_counter_ns()
+        for timestamp_ns in frame_timestamps:
+            writer.append(
+                timestamp_ns,
+                telemetry.gps.interpolate(timestamp_ns),
+                telemetry.attitude.interpolate(timestamp_ns),
+                2.0,
+            )
+        writer.close()
+        append_ns = (perf_counter_ns() - start) / frames
+
+        start = perf_counter_ns()
+        framerate, records = read_frame_index(file_name)
+        # frames within ~10 m of a point
+        distance = np.hypot(records["lat"] - 359687500, records["lon"] + 839290440)
+        matches = np.flatnonzero(distance < 900)
+        lookup_ms = (perf_counter_ns() - start) / 1e6
+
+        return {
+            "append_ns": round(append_ns),
+            "lookup_ms": round(lookup_ms, 3),
+            "frames": frames,
+            "file_bytes": os.path.getsize(file_name),
+            "matches": len(matches),
+            "first_match_pts_us": int(records["pts_us"][matches[0]]),
+        }
+
+
+def bench_stage_stats(frames: int = STAGE_STATS_FRAMES) -> Dict[str, Any]:
+    """
+    Instrumentation cost per frame of timing every FrameStage, as a share of the frame time.
+    """
+
+    stage_stats = StageStats()
+    lap = stage_stats.lap
+    stages = list(FrameStage)
+    frame_interval_ns = 1000000000 // FRAMERATE
+    start_ns = perf_counter_ns()
+    for frame in range(frames):
+        stage_ns = frame_start_ns = perf_counter_ns()
+        stage_stats.count_frame(frame * frame_interval_ns)
+        for stage in stages:
+            stage_ns = lap(stage, stage_ns)
+        lap(FrameStage.FRAME, frame_start_ns)
+    frame_ns = (perf_counter_ns() - start_ns) / frames
+    overhead_percent = frame_ns / frame_interval_ns * 100
+    assert overhead_percent < 1.0, overhead_percent
+    return {
+        "per_frame_ns": round(frame_ns),
+        "overhead_percent": round(overhead_percent, 4),
+        "summary_us": round(_time_ns(stage_stats.summary, 1000) / 1000, 1),
+    }
+
+
+def bench_stream(frames: int = STREAM_FRAMES) -> Dict[str, Any]:
+    """
+    Runs PiStreamer2.stream() for each STREAM_SCENARIOS combination against the fake camera
+    and encoders (_fake_devices.py). fps is the unthrottled loop rate, so CPU bound.
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        return {
+            scenario["name"]: run_stream_scenario(scenario, frames, directory)
+            for scenario in STREAM_SCENARIOS
+        }
+
+
+def bench_photo(iterations: int = PHOTO_ITERATIONS) -> Dict[str, Any]:
+    """
+    Cost of take_photo (reconfigure, 12 MP capture to file, EXIF) while RTP streaming.
+    """
+
+    pi_streamer = create_fake_pistreamer("1280x720")
+    pi_streamer.telemetry.add_gps((359686990, -839290440, 276000, 1, 1, 0, 0, 3, 10, 0))
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(
+        io.StringIO()
+    ):
+        pi_streamer.picam2.configure(pi_streamer.streaming_config)
+        pi_streamer.start_rtp_stream("127.0.0.1", "5600")
+        start_ns = perf_counter_ns()
+        for iteration in range(iterations):
+            pi_streamer.take_photo(os.path.join(directory, f"{iteration}.jpg"))
+        photo_ms = (perf_counter_ns() - start_ns) / iterations / 1e6
+        pi_streamer.stop_and_clean_all()
+    pi_streamer.command_controller.audit_log.close()
+    return {"take_photo_ms": round(photo_ms, 1)}
+
+
+def bench_profiler(frames: int = PROFILER_FRAMES) -> Dict[str, Any]:
+    """
+    Slowdown of a stream-like loop (colour conversion and overlays on 720p frames) while
+    profiled in each ProfileMode, and how many stacks the sampling profiler collected.
+    """
+
+    frame = np.random.default_rng(0).integers(0, 255, (720, 1280, 4), dtype=np.uint8)
+
+    def _frame_loop() -> None:
+        for index in range(frames):
+            frame_8bit = cv2.convertScaleAbs(frame)
+            cv2.putText(frame_8bit, f"{index}", (10, 40), 0, 0.75, (255, 255, 255), 2)
+            cv2.cvtColor(frame_8bit, cv2.COLOR_RGB2YUV_I420).tobytes()
+
+    def _best_of_ns(repeats: int = 3) -> float:
+        return min(_time_ns(_frame_loop, 1) for _ in range(repeats))
+
+    _frame_loop()  # warm up
+    baseline_ns = _best_of_ns()
+    results: Dict[str, Any] = {
+        "baseline_ms_per_frame": round(baseline_ns / frames / 1e6, 3)
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        profiler = StreamProfiler(directory=directory)
+        for mode in ProfileMode:
+            profiler.start(mode)
+            profiled_ns = _best_of_ns()
+            file_name = profiler.stop()
+            results[f"{mode.value}_overhead_percent"] = round(
+                (profiled_ns - baseline_ns) / baseline_ns * 100, 2
+            )
+            if mode == ProfileMode.SAMPLE:
+                with open(file_name) as f:
+                    lines = f.read().splitlines()
+                results["samples"] = profiler.sample_count
+                results["unique_stacks"] = len(lines)
+    return results
+
+
+def bench_supervisor(frames: int = SUPERVISOR_FRAMES) -> Dict[str, Any]:
+    """
+    The encoder metrics of run_supervisor_scenario. downtime is the failure detection plus
+    the restart backoff.
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        pi_streamer, record_sizes = run_supervisor_scenario(frames, directory)
+    results: Dict[str, Any] = {"frames_captured": pi_streamer.picam2.frames_captured}
+    for encoder in (pi_streamer.encoder_record, pi_streamer.encoder_rtp):
+        metrics = encoder.metrics()
+        metrics["frames_written_per_process"] = [
+            process.stdin.writes
+            for sink, process in pi_streamer.encoders
+            if sink == encoder.sink
+        ]
+        results[encoder.sink] = metrics
+    results["record"]["file_bytes"] = record_sizes
+    return results
+
+
+def bench_encoder_start(iterations: int = ENCODER_START_ITERATIONS) -> Dict[str, Any]:
+    """
+    Time from `record` to the first recorded data being on disk and how many seconds of
+    video from before the command the recording starts with. cold starts the recording
+    encoder with the command, running is the encoder filling the pre-event buffer during the
+    stream. Fake encoders don't read their stdin for ENCODER_START_DELAY after they are
+    spawned, so the absolute numbers only show the difference the running encoder makes.
+    """
+
+    pi_streamer = create_fake_pistreamer(
+        "1280x720", encoder_startup_delay=ENCODER_START_DELAY
+    )
+    pi_streamer._init_ffmpeg_processes()
+    pi_streamer.set_pre_event_seconds(ENCODER_START_PRE_EVENT)
+    encoder = pi_streamer.encoder_record
+    pre_event_buffer = pi_streamer.pre_event_buffer
+    frame = bytes(1280 * 720 * 3 // 2)  # YUV420
+
+    def _write_frame() -> None:
+        # what the stream loop does
+        if encoder.write(frame):
+            pi_streamer._record_frame_written(0)
+        sleep(1 / FRAMERATE)
+
+    results: Dict[str, Any] = {}
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(
+        io.StringIO()
+    ):
+        for mode in ("cold", "running"):
+            command_ms = []
+            first_data_ms = []
+            pre_event_seconds = []
+            for iteration in range(iterations):
+                if mode == "running":
+                    encoder.start()
+                    for _ in range(int((ENCODER_START_PRE_EVENT + 1) * FRAMERATE)):
+                        _write_frame()
+                start_ns = perf_counter_ns()
+                pi_streamer.start_recording(
+                    os.path.join(directory, f"{mode}_{iteration}.ts")
+                )
+                command_ms.append((perf_counter_ns() - start_ns) / 1e6)
+                frame_index = pi_streamer.frame_index  # holds the buffered frames
+                pre_event_seconds.append(
+                    frame_index.frames / FRAMERATE if frame_index else 0.0
+                )
+                while not pre_event_buffer.flush_latency:
+                    _write_frame()
+                first_data_ms.append(pre_event_buffer.flush_latency * 1000)
+                pi_streamer.stop_recording()
+                encoder.stop()
+            results[mode] = {
+                "command_ms": round(statistics.median(command_ms), 2),
+                "first_data_ms": round(statistics.median(first_data_ms), 1),
+                "pre_event_seconds": round(min(pre_event_seconds), 2),
+            }
+    pi_streamer.command_controller.audit_log.close()
+    return results
+
+
+def bench_pre_event(seconds: float = PRE_EVENT_BENCH_SECONDS) -> Dict[str, Any]:
+    """
+    Feeds PRE_EVENT_BENCH_DURATION seconds of a fake MPEG-TS recording stream through the
+    pre-event buffer at each PRE_EVENT_BITRATES, as the encoder's reader thread does, then
+    flushes it to a file. cpu_percent is of one core at real time, peak_kb is the buffered
+    data and traced_kb everything the buffer allocated, against bitrate x seconds.
+    """
+
+    results: Dict[str, Any] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for bitrate in PRE_EVENT_BITRATES:
+            transport_stream = FakeTransportStream(bitrate)
+            data = b"".join(
+                transport_stream.get_frame(index)
+                for index in range(int(PRE_EVENT_BENCH_DURATION * FRAMERATE))
+            )
+            chunks = [
+                data[offset : offset + ENCODER_READ_SIZE]
+                for offset in range(0, len(data), ENCODER_READ_SIZE)
+            ]
+            byte_rate = bitrate / 8
+
+            def _feed(pre_event_buffer: PreEventBuffer) -> int:
+                peak = 0
+                for index, chunk in enumerate(chunks):
+                    position[0] = index * ENCODER_READ_SIZE / byte_rate
+                    pre_event_buffer.feed(chunk)
+                    peak = max(peak, pre_event_buffer.metrics()["buffered_kb"] * 1024)
+                return peak
+
+            position = [0.0]  # simulated seconds of stream fed
+            pre_event_buffer = PreEventBuffer(seconds, clock=lambda: position[0])
+            start = process_time()
+            peak_bytes = _feed(pre_event_buffer)
+            cpu_seconds = process_time() - start
+
+            tracemalloc.start()
+            _feed(PreEventBuffer(seconds, clock=lambda: position[0]))
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            file_name = os.path.join(directory, f"{bitrate}.ts")
+            start = process_time()
+            pre_event_buffer.start_recording(file_name)
+            pre_event_buffer.stop_recording()
+            pre_event_buffer.wait()
+            flush_ms = (process_time() - start) * 1000
+
+            bound = byte_rate * seconds
+            results[f"{bitrate // 1000000}mbps"] = {
+                "cpu_percent": round(cpu_seconds / PRE_EVENT_BENCH_DURATION * 100, 3),
+                "us_per_mb": round(cpu_seconds * 1e6 / (len(data) / 1e6), 1),
+                "bound_kb": int(bound // 1024),
+                "peak_kb": peak_bytes // 1024,
+                "traced_kb": traced_peak // 1024,
+                "flush_ms": round(flush_ms, 1),
+                "file_kb": os.path.getsize(file_name) // 1024,
+            }
+    return results
+
+
+def bench_segments(frames: int = SEGMENT_FRAMES) -> Dict[str, Any]:
+    """
+    The segments run_segments_scenario creates and deletes and the frames in the ones
+    kept. statvfs_us is the cost of one free space check here.
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        pi_streamer = run_segments_scenario(frames, directory)
+        segments = pi_streamer.segment_index.segments
+        frames_per_segment = [count_frames(segment["file"])[0] for segment in segments]
+        created = pi_streamer.record_segment + 1
+
+    start = perf_counter_ns()
+    for _ in range(STATVFS_ITERATIONS):
+        get_free_bytes("/")
+    return {
+        "segments_created": created,
+        "segments_deleted": created - len(segments),
+        "frames_per_segment": frames_per_segment,
+        "statvfs_us": round((perf_counter_ns() - start) / STATVFS_ITERATIONS / 1000, 2),
+    }
+
+
+def _run_ffmpeg_record(command: List[str], frames: List[bytes], count: int) -> Any:
+    """
+    Feeds count frames to an encoder command, returns (CPU seconds, stdout bytes).
+    """
+
+    output_bytes = [0]
+
+    def _read(stdout: Any) -> None:
+        while data := stdout.read(65536):
+            output_bytes[0] += len(data)
+
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    reader = threading.Thread(target=_read, args=(process.stdout,))
+    reader.start()
+    for index in range(count):
+        process.stdin.write(frames[index % len(frames)])  # type: ignore
+    process.stdin.close()  # type: ignore
+    process.wait()
+    reader.join()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_seconds = after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime
+    return cpu_seconds, output_bytes[0]
+
+
+def bench_record_profiles(frames: int = RECORD_PROFILE_FRAMES) -> Dict[str, Any]:
+    """
+    For each RECORD_PROFILE_CASES: the CPU of splitting the recording stream into GOPs for
+    the pre-event buffer, and when ffmpeg is installed the CPU of the recording ffmpeg
+    itself (libx264 instead of the Pi's hardware encoder elsewhere, so only the differences
+    between the profiles carry over). Then the frames in each segment of
+    run_record_profile_switch. cpu_percent is of one core at real time.
+    """
+
+    results: Dict[str, Any] = {}
+    resolution = (1280, 720)
+    ffmpeg_frames = []
+    if shutil.which("ffmpeg"):
+        ffmpeg_frames = [
+            cv2.cvtColor(frame, cv2.COLOR_BGRA2YUV_I420).tobytes()
+            for frame in render_frames(resolution, 8)
+        ]
+    for name, profile, audio in RECORD_PROFILE_CASES:
+        stream: Union[FakeFragmentedMp4, FakeTransportStream] = (
+            FakeFragmentedMp4(RECORD_PROFILE_BITRATE)
+            if profile == "fmp4"
+            else FakeTransportStream(RECORD_PROFILE_BITRATE)
+        )
+        data = b"".join(
+            stream.get_frame(index)
+            for index in range(int(RECORD_PROFILE_DURATION * FRAMERATE))
+        )
+        pre_event_buffer = PreEventBuffer()
+        pre_event_buffer.container = profile
+        pre_event_buffer.reset()
+        start = process_time()
+        for offset in range(0, len(data), ENCODER_READ_SIZE):
+            pre_event_buffer.feed(data[offset : offset + ENCODER_READ_SIZE])
+        cpu_seconds = process_time() - start
+        result: Dict[str, Any] = {
+            "split_cpu_percent": round(cpu_seconds / RECORD_PROFILE_DURATION * 100, 3),
+        }
+        command = get_ffmpeg_command_record(
+            resolution, str(FRAMERATE), str(RECORD_PROFILE_BITRATE), profile, audio
+        )
+        if ffmpeg_frames:
+            if not os.path.exists(HARDWARE_ENCODER_DEVICE):
+                command[command.index("h264_v4l2m2m")] = "libx264"
+            ffmpeg_cpu_seconds, output_bytes = _run_ffmpeg_record(
+                command, ffmpeg_frames, RECORD_PROFILE_FFMPEG_FRAMES
+            )
+            duration = RECORD_PROFILE_FFMPEG_FRAMES / FRAMERATE
+            result["ffmpeg_cpu_percent"] = round(ffmpeg_cpu_seconds / duration * 100, 1)
+            result["output_kbps"] = int(output_bytes * 8 / duration / 1000)
+        else:
+            result["ffmpeg_cpu_percent"] = "ffmpeg not installed"
+        result["ffmpeg_inputs"] = command.count("-i")
+        results[name] = result
+
+    with tempfile.TemporaryDirectory() as directory:
+        pi_streamer = run_record_profile_switch(frames, directory)
+        segments = [segment["file"] for segment in pi_streamer.segment_index.segments]
+        ts_frames = count_frames(segments[0])[0]
+        with open(segments[-1], "rb") as f:
+            splitter = _FragmentedMp4Splitter()
+            splitter.split(f.read())
+        results["switch"] = {"ts_frames": ts_frames, "fmp4_frames": splitter.frames}
+    return results
+
+
+def bench_simulcast(frames: int = SIMULCAST_FRAMES) -> Dict[str, Any]:
+    """
+    The cost of the secondary stream for each SIMULCAST_CASES: the stream loop's CPU per
+    frame and the raw video piped to each encoder, and when ffmpeg is installed the CPU of
+    each stream's ffmpeg (libx264 rather than the Pi's hardware encoder, so only the ratio
+    carries over). cpu_percent is of one core at FRAMERATE.
+    """
+
+    def _cpu_seconds() -> float:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    ffmpeg_cpu_percent: Dict[str, Any] = {}
+    for resolution in {case[1] for case in SIMULCAST_CASES} | {
+        case[3] for case in SIMULCAST_CASES if case[3]
+    }:
+        if not shutil.which("ffmpeg"):
+            ffmpeg_cpu_percent[resolution] = "ffmpeg not installed"
+            continue
+        width, height = map(int, resolution.split("x"))
+        size = (width, height)
+        command = get_ffmpeg_command_rtp(
+            size, str(FRAMERATE), "127.0.0.1", "5604", "2000000"
+        )
+        if not os.path.exists(HARDWARE_ENCODER_DEVICE):
+            command[command.index("h264_v4l2m2m")] = "libx264"
+        ffmpeg_frames = [
+            cv2.cvtColor(frame, cv2.COLOR_BGRA2YUV_I420).tobytes()
+            for frame in render_frames(size, 8)
+        ]
+        cpu_seconds, _ = _run_ffmpeg_record(
+            command, ffmpeg_frames, SIMULCAST_FFMPEG_FRAMES
+        )
+        duration = SIMULCAST_FFMPEG_FRAMES / FRAMERATE
+        ffmpeg_cpu_percent[resolution] = round(cpu_seconds / duration * 100, 1)
+
+    results: Dict[str, Any] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for (
+            name,
+            resolution,
+            record_resolution,
+            secondary_resolution,
+        ) in SIMULCAST_CASES:
+            scenario = {
+                "name": name,
+                "resolution": resolution,
+                "record_resolution": record_resolution,
+                "secondary_resolution": secondary_resolution,
+            }
+            cpu_ms = float("inf")
+            for _ in range(SIMULCAST_REPEATS):
+                start = _cpu_seconds()
+                result = run_stream_scenario(scenario, frames, directory)
+                cpu_ms = min(cpu_ms, (_cpu_seconds() - start) / frames * 1000)
+            streams = [resolution] + (
+                [secondary_resolution] if secondary_resolution else []
+            )
+            results[name] = {
+                "loop_cpu_ms_per_frame": round(cpu_ms, 3),
+                "loop_cpu_percent": round(cpu_ms * FRAMERATE / 10, 1),
+                "pipe_mb_per_second": {
+                    sink: round(sink_bytes / frames * FRAMERATE / 1e6, 1)
+                    for sink, sink_bytes in result["sink_bytes"].items()
+                },
+                "ffmpeg_cpu_percent": [ffmpeg_cpu_percent[size] for size in streams],
+                "secondary_us": result["stage_mean_us"].get("write_secondary", 0.0),
+            }
+        for name, one_stream in (
+            ("simulcast", "one_stream"),
+            ("dual_simulcast", "dual_one_stream"),
+        ):
+            results[name]["loop_cpu_vs_one_stream"] = round(
+                results[name]["loop_cpu_ms_per_frame"]
+                / results[one_stream]["loop_cpu_ms_per_frame"],
+                2,
+            )
+    return results
+
+
+def bench_decimation(seconds: int = DECIMATION_SECONDS) -> Dict[str, Any]:
+    """
+    Frames a FrameDecimator gives a sink over `seconds` of each DECIMATION_CAMERAS camera,
+    against the frames the sink's ffmpeg expects at its `-r`. drift_frames staying within
+    a frame means the recording or stream keeps the camera's time, however long it runs.
+    """
+
+    results: Dict[str, Any] = {}
+    for name, interval_ns, jitter_ns, drop_interval in DECIMATION_CAMERAS:
+        frames = seconds * 1000000000 // interval_ns
+        timestamps = np.arange(frames, dtype=np.int64) * interval_ns
+        if jitter_ns:
+            rng = np.random.default_rng(0)
+            timestamps += rng.integers(-jitter_ns, jitter_ns, frames)
+        if drop_interval:
+            timestamps = np.delete(timestamps, np.s_[::drop_interval])
+        sensor_timestamps = (timestamps + 1000000000).tolist()
+        elapsed_ns = sensor_timestamps[-1] - sensor_timestamps[0]
+        for framerate in DECIMATION_FRAMERATES:
+            decimator = FrameDecimator(framerate)
+            take = decimator.take
+            start_ns = perf_counter_ns()
+            frames_out = sum(take(timestamp) for timestamp in sensor_timestamps)
+            take_ns = (perf_counter_ns() - start_ns) / len(sensor_timestamps)
+            expected = elapsed_ns * framerate // 1000000000 + 1
+            results[f"{name}_to_{framerate}"] = {
+                "frames": frames_out,
+                "expected_frames": expected,
+                "drift_frames": frames_out - expected,
+                **decimator.metrics(),
+                "take_ns": round(take_ns, 1),
+            }
+    return results
+
+
+def bench_rtsp(watch_seconds: float = RTSP_WATCH_SECONDS) -> Dict[str, Any]:
+    """
+    Streams with `streaming_protocol rtsp` in real time and plays it with a loopback client
+    over UDP and another over TCP, with the encoders started before the first viewer, for
+    the two viewers and until the encoder idled after they left. join_ms is from the first request to the first RTP packet, so it includes
+    the encoder starting (the fake encoders start instantly, ffmpeg takes ~0.5 s on a Pi).
+    """
+
+    pi_streamer = create_fake_pistreamer(
+        "1280x720", protocol=StreamingProtocolType.RTSP.value
+    )
+    pi_streamer.picam2.realtime = True
+    server = pi_streamer.rtsp_server
+    server.idle_timeout = RTSP_BENCH_IDLE_TIMEOUT
+    url = f"rtsp://127.0.0.1:{server.port}/stream"
+
+    def _stream() -> None:
+        try:
+            pi_streamer.stream()
+        except FakeCameraExhausted:
+            pass
+
+    def _rtsp_encoders() -> List[Any]:
+        return [process for sink, process in pi_streamer.encoders if sink == "rtsp"]
+
+    results: Dict[str, Any] = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        thread = threading.Thread(target=_stream, daemon=True)
+        thread.start()
+        sleep(RTSP_IDLE_SECONDS)
+        results["idle_frames_captured"] = pi_streamer.picam2.frames_captured
+        results["idle_encoders_started"] = len(_rtsp_encoders())
+
+        viewers = []
+        for name, tcp in (("udp", False), ("tcp", True)):
+            start = monotonic()
+            client = RtspClient(url, tcp)
+            client.play()
+            client.receive()
+            results[f"{name}_join_ms"] = round((monotonic() - start) * 1000, 1)
+            viewers.append(client)
+
+        packets = [0, 0]
+        watch_end = monotonic() + watch_seconds
+        while monotonic() < watch_end:
+            for index, client in enumerate(viewers):
+                client.receive()
+                packets[index] += 1
+        results["viewers"] = server.viewers
+        results["packets_per_second"] = {
+            name: round(count / watch_seconds, 1)
+            for name, count in zip(("udp", "tcp"), packets)
+        }
+
+        for client in viewers:
+            client.close()
+        left = monotonic()
+        while pi_streamer.encoder_rtsp.state != EncoderState.STOPPED:
+            if monotonic() - left > RTSP_BENCH_IDLE_TIMEOUT + 2.0:
+                break  # still encoding
+            sleep(0.01)
+        results["idle_after_last_viewer_s"] = round(monotonic() - left, 2)
+
+        pi_streamer.picam2.frame_limit = pi_streamer.picam2.frames_captured
+        thread.join(5.0)
+    pi_streamer.command_controller.audit_log.close()
+
+    encoders = _rtsp_encoders()
+    results["encoders_started"] = len(encoders)
+    results["frames_encoded"] = sum(encoder.stdin.writes for encoder in encoders)
+    results["server"] = server.metrics()
+    return results
+
+
+def bench_fec(seconds: float = FEC_BENCH_SECONDS) -> Dict[str, Any]:
+    """
+    Sends an RTP stream through the FEC relay on loopback for each FEC_SETTINGS, then plays
+    the capture over a simulated FEC_BENCH_LINK_RATE radio link that loses packets like
+    each FEC_LOSS_MODELS, FEC_BENCH_RUNS times, through a FecDecoder. broken_frames_percent
+    counts every frame from one missing a packet to the next keyframe, what a player
+    shows corrupted. recovery_ms is how much later a recovered packet is delivered than
+    the lost one would have been, link_delay_ms the mean delay the parity packets add to
+    the others on the link.
+    """
+
+    frames = rtp_frames(seconds)
+    frame_of_packet = {
+        struct.unpack_from(">H", packet, 2)[0]: index
+        for index, packets in enumerate(frames)
+        for packet in packets
+    }
+    media_count = len(frame_of_packet)
+    results: Dict[str, Any] = {}
+    for name, group_size, interleave in FEC_SETTINGS:
+        encoder = FecEncoder(group_size, interleave)
+        start_ns = perf_counter_ns()
+        for packets in frames:
+            for packet in packets:
+                encoder.protect(packet)
+        encode_ns = (perf_counter_ns() - start_ns) / media_count
+
+        capture, relay_metrics = capture_fec_relay(frames, group_size, interleave)
+        # over the link, a packet queues behind the ones before it
+        link_ns = 0.0
+        media_link_ns = 0.0  # the same without the parity packets
+        arrivals = []
+        delays = []
+        for received_ns, packet, is_parity in capture:
+            serialize_ns = (len(packet) + 28) * 8 / FEC_BENCH_LINK_RATE * 1e9
+            link_ns = max(link_ns, received_ns) + serialize_ns
+            arrivals.append(link_ns)
+            if not is_parity:
+                media_link_ns = max(media_link_ns, received_ns) + serialize_ns
+                delays.append(link_ns - media_link_ns)
+
+        setting: Dict[str, Any] = {
+            "overhead_percent": relay_metrics["overhead_percent"],
+            "parity_packets": relay_metrics["parity_packets"],
+            "relay_us_per_packet": relay_metrics["relay_us"],
+            "encode_us_per_packet": round(encode_ns / 1000, 2),
+            "link_delay_ms": round(statistics.mean(delays) / 1e6, 2),
+            "media_received_percent": round(len(delays) / media_count * 100, 2),
+        }
+        decode_ns = 0
+        decoded = 0
+        for model, loss, burst in FEC_LOSS_MODELS:
+            # Gilbert-Elliott, every packet of a burst is lost
+            leave_burst = 1 / burst
+            enter_burst = loss * leave_burst / (1 - loss)
+            lost_count = 0
+            missing_count = 0
+            broken_frames = 0
+            recovery_ms: List[float] = []
+            for run in range(FEC_BENCH_RUNS):
+                rng = random.Random(run)
+                is_burst = False
+                decoder = FecDecoder()
+                arrived_ns: Dict[int, float] = {}
+                delivered: Set[int] = set()
+                start_ns = perf_counter_ns()
+                for (_, packet, is_parity), arrival_ns in zip(capture, arrivals):
+                    if not is_parity:
+                        arrived_ns[struct.unpack_from(">H", packet, 2)[0]] = arrival_ns
+                    is_burst = rng.random() < (
+                        1 - leave_burst if is_burst else enter_burst
+                    )
+                    if is_burst:
+                        lost_count += not is_parity
+                        continue
+                    if not is_parity:
+                        packets = decoder.receive(packet)
+                    else:
+                        packets = decoder.receive_parity(packet)
+                        for recovered in packets:
+                            sequence_number = struct.unpack_from(">H", recovered, 2)[0]
+                            recovery_ms.append(
+                                (arrival_ns - arrived_ns[sequence_number]) / 1e6
+                            )
+                    delivered.update(
+                        struct.unpack_from(">H", delivered_packet, 2)[0]
+                        for delivered_packet in packets
+                    )
+                decode_ns += perf_counter_ns() - start_ns
+                decoded += len(capture)
+                missing_frames = {
+                    frame_of_packet[sequence_number]
+                    for sequence_number in frame_of_packet
+                    if sequence_number not in delivered
+                }
+                missing_count += media_count - len(delivered)
+                is_broken = False
+                for index in range(len(frames)):
+                    if index % FRAMERATE == 0:
+                        is_broken = False  # a keyframe
+                    is_broken |= index in missing_frames
+                    broken_frames += is_broken
+            packets_sent = media_count * FEC_BENCH_RUNS
+            setting[model] = {
+                "lost_percent": round(lost_count / packets_sent * 100, 2),
+                "residual_loss_percent": round(missing_count / packets_sent * 100, 2),
+                "recovered_percent": round(
+                    (lost_count - missing_count) / max(lost_count, 1) * 100, 1
+                ),
+                "broken_frames_percent": round(
+                    broken_frames / (len(frames) * FEC_BENCH_RUNS) * 100, 1
+                ),
+                "recovery_ms_mean": round(statistics.mean(recovery_ms or [0.0]), 1),
+                "recovery_ms_max": round(max(recovery_ms or [0.0]), 1),
+            }
+        setting["decode_us_per_packet"] = round(decode_ns / decoded / 1000, 2)
+        results[name] = setting
+    return results
+
+
+def _stamp_frame_number(luma: Any, number: int) -> None:
+    """
+    Stamps a 16 bit number and its complement along the top of a frame's luma as black and
+    white blocks, so a stamp damaged by a lost packet can be told apart.
+    """
+    bits = number & 0xFFFF | (~number & 0xFFFF) << 16
+    for bit in range(32):
+        start = bit * FRAME_NUMBER_BLOCK
+        luma[:FRAME_NUMBER_BLOCK, start : start + FRAME_NUMBER_BLOCK] = (
+            235 if bits >> bit & 1 else 16
+        )
+
+
+def _read_frame_number(luma: Any) -> Optional[int]:
+    """
+    The number stamped by _stamp_frame_number, None if the stamp is damaged.
+    """
+    edge = FRAME_NUMBER_BLOCK // 4  # the encoder blurs the edges of the blocks
+    blocks = luma[edge : FRAME_NUMBER_BLOCK - edge, : 32 * FRAME_NUMBER_BLOCK].reshape(
+        FRAME_NUMBER_BLOCK - 2 * edge, 32, FRAME_NUMBER_BLOCK
+    )
+    means = blocks[:, :, edge : FRAME_NUMBER_BLOCK - edge].mean(axis=(0, 2))
+    bits = sum(1 << bit for bit in range(32) if means[bit] > 128)
+    number = bits & 0xFFFF
+    if bits >> 16 != ~number & 0xFFFF:
+        return None
+    return number
+
+
+def _use_software_encoder(command: List[str]) -> None:
+    """
+    Swaps the Pi's hardware encoder for libx264 without lookahead when it is missing.
+    -bufsize is dropped as the hardware encoder doesn't keep to it, libx264 would.
+    """
+
+    if "h264_v4l2m2m" in command and not os.path.exists(HARDWARE_ENCODER_DEVICE):
+        index = command.index("h264_v4l2m2m")
+        command[index : index + 1] = [
+            "libx264",
+            "-preset",
+            "ultrafast",
+            "-tune",
+            "zerolatency",
+        ]
+        if "-bufsize" in command:
+            index = command.index("-bufsize")
+            del command[index : index + 2]
+
+
+def _run_glass_to_glass(
+    protocol: str, seconds: float, delay_ms: float, jitter_ms: float, loss: float
+) -> Dict[str, Any]:
+    """
+    Streams stamped frames over a LossyLink with RTP or SRT (see bench_srt) and times each
+    from being written to the encoder until the receiving ffmpeg has decoded it.
+    """
+
+    width, height = map(int, SRT_BENCH_RESOLUTION.split("x"))
+    frames = [
+        cv2.cvtColor(frame, cv2.COLOR_BGRA2YUV_I420)
+        for frame in render_frames((width, height), 8)
+    ]
+    link = LossyLink(("127.0.0.1", SRT_BENCH_PORT), delay_ms, jitter_ms, loss)
+    transmitter: Optional[SrtTransmitter] = None
+    processes: List[Any] = []
+    written: Dict[int, float] = {}
+    latencies: Dict[int, float] = {}
+    corrupted_frames = 0
+    frame_count = int(seconds * FRAMERATE)
+
+    def _write(sender: Any) -> None:
+        start = monotonic()
+        for number in range(frame_count):
+            delay = start + number / FRAMERATE - monotonic()
+            if delay > 0:
+                sleep(delay)
+            frame = frames[number % len(frames)].copy()
+            _stamp_frame_number(frame, number)
+            written[number] = monotonic()
+            sender.stdin.write(frame.tobytes())
+            sender.stdin.flush()
+        sender.stdin.close()
+
+    def _read(receiver: Any) -> None:
+        nonlocal corrupted_frames
+        frame_size = width * height * 3 // 2
+        while True:
+            data = receiver.stdout.read(frame_size)
+            if len(data) < frame_size:
+                return
+            now = monotonic()
+            luma = np.frombuffer(data, np.uint8, width * height).reshape(height, width)
+            number = _read_frame_number(luma)
+            if number is None or number not in written:
+                corrupted_frames += bool(latencies)  # not while joining the stream
+            elif number not in latencies:
+                latencies[number] = now - written[number]
+
+    with tempfile.TemporaryDirectory() as directory:
+        if protocol == StreamingProtocolType.RTP.value:
+            sdp_file = os.path.join(directory, "sender.sdp")
+            command = get_ffmpeg_command_rtp(
+                (width, height),
+                str(FRAMERATE),
+                "127.0.0.1",
+                str(link.port),
+                SRT_BENCH_BITRATE,
+            )
+            command[-1:-1] = ["-sdp_file", sdp_file]
+        else:
+            transmitter = SrtTransmitter(SRT_BENCH_LATENCY)
+            command = get_ffmpeg_command_mpeg_ts(
+                (width, height),
+                str(FRAMERATE),
+                "127.0.0.1",
+                str(transmitter.relay_port),
+                SRT_BENCH_BITRATE,
+                packet_size=SRT_PAYLOAD_SIZE,
+            )
+        _use_software_encoder(command)
+        link.start()
+        if transmitter:
+            transmitter.start("127.0.0.1", link.port)
+            processes.append(
+                subprocess.Popen(
+                    [
+                        "srt-live-transmit",
+                        f"srt://:{SRT_BENCH_PORT}?mode=listener"
+                        f"&latency={SRT_BENCH_LATENCY}",
+                        f"udp://127.0.0.1:{SRT_BENCH_PORT + 1}",
+                    ],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            )
+        sender = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        processes.append(sender)
+        writer = threading.Thread(target=_write, args=(sender,), daemon=True)
+        writer.start()
+        if protocol == StreamingProtocolType.RTP.value:
+            # written once the encoder is running, for the receiver's port
+            timeout = monotonic() + 5.0
+            while not os.path.exists(sdp_file) and monotonic() < timeout:
+                sleep(0.01)
+            with open(sdp_file) as f:
+                sdp = re.sub(r"m=video \d+", f"m=video {SRT_BENCH_PORT}", f.read())
+            receive_url = os.path.join(directory, "receiver.sdp")
+            with open(receive_url, "w") as f:
+                f.write(sdp)
+            input_args = ["-protocol_whitelist", "file,udp,rtp", "-i", receive_url]
+        else:
+            input_args = ["-i", f"udp://127.0.0.1:{SRT_BENCH_PORT + 1}"]
+        receiver = subprocess.Popen(
+            [
+                "ffmpeg",
+                "-fflags",
+                "nobuffer",
+                "-flags",
+                "low_delay",
+                *input_args,
+                "-f",
+                "rawvideo",
+                "-pix_fmt",
+                "yuv420p",
+                "-fps_mode",
+                "passthrough",
+                "pipe:1",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        processes.append(receiver)
+        reader = threading.Thread(target=_read, args=(receiver,), daemon=True)
+        reader.start()
+        writer.join()
+        sleep(1.0 + SRT_BENCH_LATENCY / 1000)  # the frames still on their way
+        for process in processes:
+            process.terminate()
+            process.wait()
+        reader.join()
+        link.stop()
+        if transmitter:
+            transmitter.stop()
+
+    # the first second is the receiver joining the stream
+    received = sorted(
+        latency * 1000 for number, latency in latencies.items() if number >= FRAMERATE
+    )
+    result: Dict[str, Any] = {
+        "latency_ms_median": round(statistics.median(received), 1)
+        if received
+        else None,
+        "latency_ms_p95": (
+            round(received[int(len(received) * 0.95)], 1) if received else None
+        ),
+        "delivered_percent": round(
+            len(received) / max(frame_count - FRAMERATE, 1) * 100, 1
+        ),
+        "corrupted_frames": corrupted_frames,
+        "link_lost_packets": link.lost,
+    }
+    if transmitter:
+        result["srt"] = transmitter.metrics()
+    return result
+
+
+def bench_srt(seconds: float = SRT_BENCH_SECONDS) -> Dict[str, Any]:
+    """
+    Glass to glass latency and frame loss of RTP and of SRT over each SRT_BENCH_LINKS link,
+    emulated on loopback by _fake_devices.LossyLink. Each frame is stamped with its number,
+    encoded and sent by ffmpeg with the stream's commands (libx264 rather than the Pi's
+    hardware encoder), then received and decoded by a second ffmpeg. delivered_percent is
+    of the frames sent after the first second, corrupted_frames are decoded frames with a
+    damaged stamp. Needs ffmpeg and srt-live-transmit.
+    """
+
+    if not (shutil.which("ffmpeg") and shutil.which("srt-live-transmit")):
+        return {"skipped": "ffmpeg and srt-live-transmit (srt-tools) are not installed"}
+    return {
+        name: {
+            protocol: _run_glass_to_glass(protocol, seconds, delay_ms, jitter_ms, loss)
+            for protocol in (
+                StreamingProtocolType.RTP.value,
+                StreamingProtocolType.SRT.value,
+            )
+        }
+        for name, delay_ms, jitter_ms, loss in SRT_BENCH_LINKS
+    }
+
+
+def _h264_nal_units(payload: bytes) -> List[bytes]:
+    """
+    The NAL units of an H.264 RTP payload (RFC 6184), only the start of a fragmented one.
+    """
+    nal_type = payload[0] & 0x1F
+    if nal_type == 24:  # STAP-A, NAL units each after their 16 bit size
+        units = []
+        offset = 1
+        while offset + 2 <= len(payload):
+            size = int.from_bytes(payload[offset : offset + 2], "big")
+            units.append(payload[offset + 2 : offset + 2 + size])
+            offset += 2 + size
+        return units
+    if nal_type == 28:  # FU-A, the NAL unit header is split over two bytes
+        if not payload[1] & 0x80:
+            return []  # not the first fragment
+        return [bytes(((payload[0] & 0xE0) | (payload[1] & 0x1F),)) + payload[2:]]
+    return [payload]
+
+
+def _recovery_frame_count(sei: bytes) -> Optional[int]:
+    """
+    The frames a recovery point SEI (intra refresh) takes to give a whole picture, None
+    if the SEI NAL unit has no recovery point.
+    """
+    data = sei[1:].replace(b"\x00\x00\x03", b"\x00\x00")  # emulation prevention
+    offset = 0
+    try:
+        while data[offset] != 0x80:  # the RBSP trailing bits
+            values = []
+            for _ in range(2):  # the payload type then its size, in 255s and the rest
+                value = 0
+                while data[offset] == 0xFF:
+                    value += 255
+                    offset += 1
+                values.append(value + data[offset])
+                offset += 1
+            payload_type, size = values
+            if payload_type == 6:  # recovery point, recovery_frame_cnt first as ue(v)
+                bits = int.from_bytes(data[offset : offset + size], "big")
+                length = size * 8
+                zeros = 0
+                while not bits >> (length - 1 - zeros) & 1:
+                    zeros += 1
+                return (bits >> (length - 1 - 2 * zeros) & ((2 << zeros) - 1)) - 1
+            offset += size
+    except IndexError:
+        pass  # cut short, i.e. the rest is in the next fragment
+    return None
+
+
+def _keyframe_stream_stats(
+    packets: List[Tuple[float, bytes]], joins: List[float], start: float
+) -> Dict[str, Any]:
+    """
+    Frames are told apart by their RTP timestamp. A viewer joining at a time has a whole
+    picture once it has received the next IDR, or the frame an intra refresh recovery
+    point leads to.
+    """
+
+    frames: List[Dict[str, Any]] = []
+    frame_key = b""
+    for arrival, packet in packets:
+        if len(packet) < 13:
+            continue
+        if packet[4:12] != frame_key:  # the timestamp and SSRC
+            frame_key = packet[4:12]
+            frames.append({"first": arrival, "last": arrival, "bytes": 0, "idr": False})
+        frame = frames[-1]
+        frame["last"] = arrival
+        frame["bytes"] += len(packet)
+        for nal in _h264_nal_units(packet[12 + 4 * (packet[0] & 0x0F) :]):
+            nal_type = nal[0] & 0x1F
+            if nal_type == 5:
+                frame["idr"] = True
+            elif nal_type == 6 and "recovery" not in frame:
+                recovery = _recovery_frame_count(nal)
+                if recovery is not None:
+                    frame["recovery"] = recovery
+
+    def _join_latency(join: float) -> Optional[float]:
+        for index, frame in enumerate(frames):
+            if frame["first"] < join:
+                continue
+            if frame["idr"]:
+                return frame["last"] - join
+            recovered = index + frame.get("recovery", len(frames))
+            if recovered < len(frames):
+                return frames[recovered]["last"] - join
+        return None
+
+    latencies = sorted(
+        latency * 1000 for latency in map(_join_latency, joins) if latency is not None
+    )
+    steady = [
+        frame["bytes"] * 8
+        for frame in frames
+        if frame["first"] >= start + KEYFRAME_BENCH_WARMUP
+    ]
+    # the radio's buffer, drained at the bitrate
+    level = 0.0
+    overflows = 0
+    overflow_bits = 0.0
+    for bits in steady:
+        level = max(level - KEYFRAME_BENCH_BITRATE / FRAMERATE, 0.0) + bits
+        if level > KEYFRAME_BENCH_BUFFER_BITS:
+            overflows += 1
+            overflow_bits += level - KEYFRAME_BENCH_BUFFER_BITS
+            level = KEYFRAME_BENCH_BUFFER_BITS
+    average = statistics.mean(steady) if steady else 0.0
+    return {
+        "joins": len(joins),
+        "join_ms_median": (
+            round(statistics.median(latencies), 1) if latencies else None
+        ),
+        "join_ms_max": round(latencies[-1], 1) if latencies else None,
+        "bitrate_kbps": round(average * FRAMERATE / 1000),
+        "peak_frame_kbits": round(max(steady, default=0) / 1000, 1),
+        "peak_to_average": round(max(steady) / average, 1) if average else None,
+        "buffer_overflow_frames": overflows,
+        "buffer_overflow_kbits": round(overflow_bits / 1000),
+    }
+
+
+def _run_keyframe_case(
+    intra_refresh: bool, on_demand: bool, seconds: float
+) -> Dict[str, Any]:
+    """
+    Streams the rendered scene in real time through an EncoderSupervisor to a receiver on
+    loopback, see bench_keyframe.
+    """
+
+    width, height = map(int, STREAMING_FRAMESIZE.split("x"))
+    size = (width, height)
+    frames = [
+        cv2.cvtColor(frame, cv2.COLOR_BGRA2YUV_I420).tobytes()
+        for frame in render_frames(size, FRAMERATE)
+    ]
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.bind(("127.0.0.1", KEYFRAME_BENCH_PORT))
+    receiver.settimeout(0.2)
+    packets: List[Tuple[float, bytes]] = []
+    is_receiving = True
+
+    def _receive() -> None:
+        while is_receiving:
+            try:
+                packet = receiver.recv(65536)
+            except socket.timeout:
+                continue
+            packets.append((monotonic(), packet))
+
+    command = get_ffmpeg_command_rtp(
+        size,
+        str(FRAMERATE),
+        "127.0.0.1",
+        str(KEYFRAME_BENCH_PORT),
+        str(KEYFRAME_BENCH_BITRATE),
+        intra_refresh=intra_refresh,
+    )
+    _use_software_encoder(command)
+    encoder = EncoderSupervisor(
+        "rtp",
+        lambda: subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ),
+    )
+    thread = threading.Thread(target=_receive, daemon=True)
+    thread.start()
+    start = monotonic()
+    encoder.start()
+    joins: List[float] = []
+    for index in range(int(seconds * FRAMERATE)):
+        delay = start + index / FRAMERATE - monotonic()
+        if delay > 0:
+            sleep(delay)
+        encoder.write(frames[index % len(frames)])
+        encoder.check()
+        now = monotonic()
+        if on_demand and now - start >= (len(joins) + 1) * KEYFRAME_BENCH_JOIN_INTERVAL:
+            joins.append(now)
+            encoder.request_keyframe()
+    end = monotonic()
+    encoder.stop()
+    sleep(0.5)  # the last packets
+    is_receiving = False
+    thread.join()
+    receiver.close()
+    if not on_demand:
+        # viewers joining throughout the stream, none need the encoder
+        step = 1 / (FRAMERATE / 4 + 0.5)  # out of step with the frames
+        joins = [
+            start + KEYFRAME_BENCH_WARMUP + n * step
+            for n in range(int((end - start - KEYFRAME_BENCH_WARMUP - 2.5) / step))
+        ]
+    result = _keyframe_stream_stats(packets, joins, start)
+    result["keyframe_restarts"] = encoder.keyframe_restarts
+    result["launch_latency_ms"] = round(encoder.launch_latency * 1000, 1)
+    return result
+
+
+def bench_keyframe(seconds: float = KEYFRAME_BENCH_SECONDS) -> Dict[str, Any]:
+    """
+    How long a viewer joining the RTP stream waits for a whole picture, and how far the
+    biggest frames exceed the average and overrun the 64k radio buffer, for the GOP's IDRs
+    alone, an IDR forced by each join (request_keyframe, the joins every
+    KEYFRAME_BENCH_JOIN_INTERVAL) and intra refresh. Streams with ffmpeg in real time,
+    libx264 rather than the Pi's hardware encoder off the Pi.
+    """
+
+    if not shutil.which("ffmpeg"):
+        return {"skipped": "ffmpeg not installed"}
+    return {
+        name: _run_keyframe_case(intra_refresh, on_demand, seconds)
+        for name, intra_refresh, on_demand in KEYFRAME_CASES
+    }
+
+
+def _run_encoder_backend_case(
+    backend: str, resolution: str, seconds: float
+) -> Dict[str, Any]:
+    """
+    Streams the rendered scene in real time through an EncoderSupervisor with one encoder
+    backend to a receiver on loopback, see bench_encoder_backends.
+    """
+
+    width, height = map(int, resolution.split("x"))
+    size = (width, height)
+    # handed over as views like stream() does, each backend copies what it needs
+    frames = [
+        cv2.cvtColor(frame, cv2.COLOR_BGRA2YUV_I420)
+        for frame in render_frames(size, FRAMERATE)
+    ]
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.bind(("127.0.0.1", ENCODER_BACKEND_BENCH_PORT))
+    receiver.settimeout(0.2)
+    frame_arrivals: List[float] = []  # when the last packet of each frame arrived
+    is_receiving = True
+
+    def _receive() -> None:
+        while is_receiving:
+            try:
+                packet = receiver.recv(65536)
+            except socket.timeout:
+                continue
+            if packet[1] & 0x80:  # the RTP marker, set on a frame's last packet
+                frame_arrivals.append(monotonic())
+
+    command = get_ffmpeg_command_rtp(
+        size,
+        str(FRAMERATE),
+        "127.0.0.1",
+        str(ENCODER_BACKEND_BENCH_PORT),
+        str(ENCODER_BACKEND_BENCH_BITRATE),
+    )
+    _use_software_encoder(command)  # the same libx264 settings for both off the Pi
+
+    def _spawn() -> Any:
+        if backend == EncoderBackend.PYAV.value:
+            return PyAvEncoderProcess(command)
+        return subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def _process_rss_kb(pid: int) -> int:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                return int(f.read().split()[1]) * PAGE_SIZE // 1024
+        except OSError:
+            return 0
+
+    encoder = EncoderSupervisor("rtp", _spawn)
+    thread = threading.Thread(target=_receive, daemon=True)
+    thread.start()
+    base_rss_kb = get_rss_kb()
+    peak_rss_kb = 0
+    before = os.times()
+    start = monotonic()
+    encoder.start()
+    write_times: List[float] = []  # of the frames queued, dropped ones aren't encoded
+    for index in range(int(seconds * FRAMERATE)):
+        delay = start + index / FRAMERATE - monotonic()
+        if delay > 0:
+            sleep(delay)
+        now = monotonic()
+        if encoder.write(frames[index % len(frames)].data):
+            write_times.append(now)
+        encoder.check()
+        if index % FRAMERATE == 0:
+            rss_kb = get_rss_kb() - base_rss_kb
+            if backend == EncoderBackend.FFMPEG.value and encoder.process:
+                rss_kb += _process_rss_kb(encoder.process.pid)
+            peak_rss_kb = max(peak_rss_kb, rss_kb)
+    end = monotonic()
+    encoder.stop()
+    encoder.wait()  # so ffmpeg's CPU time is in os.times()
+    after = os.times()
+    sleep(0.5)  # the last packets
+    is_receiving = False
+    thread.join()
+    receiver.close()
+    duration = end - start
+    own_cpu = after.user - before.user + after.system - before.system
+    encoder_cpu = (
+        after.children_user
+        - before.children_user
+        + after.children_system
+        - before.children_system
+    )
+    warmup = int(ENCODER_BACKEND_BENCH_WARMUP * FRAMERATE)
+    latencies_ms = [
+        (arrival - written) * 1000
+        for written, arrival in list(zip(write_times, frame_arrivals))[warmup:]
+    ]
+    frame_bytes = frames[0].nbytes
+    return {
+        "cpu_percent": round((own_cpu + encoder_cpu) / duration * 100, 1),
+        "encoder_process_cpu_percent": round(encoder_cpu / duration * 100, 1),
+        "latency_median_ms": round(float(np.median(latencies_ms)), 1),
+        "latency_p95_ms": round(float(np.percentile(latencies_ms, 95)), 1),
+        "peak_rss_mb": round(peak_rss_kb / 1024, 1),
+        "pipe_mb_per_s": (
+            round(len(write_times) * frame_bytes / duration / 1e6, 1)
+            if backend == EncoderBackend.FFMPEG.value
+            else 0
+        ),
+        "frames_received": len(frame_arrivals),
+        "dropped_frames": encoder.dropped_frames,
+        "restarts": encoder.restarts,
+    }
+
+
+def bench_encoder_backends(
+    seconds: float = ENCODER_BACKEND_BENCH_SECONDS,
+) -> Dict[str, Any]:
+    """
+    CPU (pistreamer and the ffmpeg process), latency from a frame being written to its last
+    RTP packet arriving, and peak memory (pistreamer's growth and ffmpeg's RSS) of the
+    ffmpeg and pyav encoder backends at 30 fps in real time, libx264 rather than the Pi's
+    hardware encoder off the Pi. The pyav cases run without ffmpeg installed.
+    """
+
+    results: Dict[str, Any] = {}
+    for name, backend, resolution in ENCODER_BACKEND_CASES:
+        if backend == "ffmpeg" and not shutil.which("ffmpeg"):
+            results[name] = {"skipped": "ffmpeg not installed"}
+            continue
+        results[name] = _run_encoder_backend_case(backend, resolution, seconds)
+    return results
+
+
+def bench_soak(frames: int = SOAK_FRAMES) -> Dict[str, Any]:
+    """
+    The memory samples of run_soak_scenario and their growth per simulated hour, fitted
+    over the last SOAK_SLOPE_SAMPLES (tests/test_memory_monitor.py asserts on it). The
+    allocation sites that grew the most over the run are reported from a
+    `memory snapshot` / `memory diff` pair.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        samples, diff = run_soak_scenario(frames, directory)
+    return {
+        "frames": frames,
+        "rss_kb": [sample["rss_kb"] for sample in samples],
+        "python_blocks": [sample["python_blocks"] for sample in samples],
+        "ndarrays": [sample["ndarrays"] for sample in samples],
+        "rss_kb_per_hour": round(get_growth_per_hour(samples, "rss_kb")),
+        "python_blocks_per_hour": round(get_growth_per_hour(samples, "python_blocks")),
+        "ndarrays_per_hour": round(get_growth_per_hour(samples, "ndarrays"), 1),
+        "sample_ms": max(sample["sample_ms"] for sample in samples),
+        "top_growth": diff,
+    }
+
+
+BENCHMARKS: Dict[str, Callable[[], Dict[str, Any]]] = {
+    "dispatch": bench_dispatch,
+    "telemetry_decode": bench_telemetry_decode,
+    "klv": bench_klv,
+    "frame_index": bench_frame_index,
+    "stage_stats": bench_stage_stats,
+    "stream": bench_stream,
+    "photo": bench_photo,
+    "profiler": bench_profiler,
+    "supervisor": bench_supervisor,
+    "encoder_start": bench_encoder_start,
+    "pre_event": bench_pre_event,
+    "segments": bench_segments,
+    "record_profiles": bench_record_profiles,
+    "simulcast": bench_simulcast,
+    "decimation": bench_decimation,
+    "rtsp": bench_rtsp,
+    "fec": bench_fec,
+    "srt": bench_srt,
+    "keyframe": bench_keyframe,
+    "encoder_backends": bench_encoder_backends,
+    "soak": bench_soak,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="pistreamer development benchmarks.")
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        default=list(BENCHMARKS),
+        help=f"Benchmarks to run: {', '.join(BENCHMARKS)} (default all)",
+    )
+    parser.add_argument(
+        "--output", type=str, default="", help="Write the report to this json file"
+    )
+    args = parser.parse_args()
+
+    report = {name: BENCHMARKS[name]() for name in args.benchmarks}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        # sorted so reports from different releases diff cleanly
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
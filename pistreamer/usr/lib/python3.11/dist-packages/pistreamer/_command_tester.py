@@ -2,7 +2,14 @@
 
 import json
 from typing import Any, List, Tuple
-from constants import CMD_SOCKET_PORT, CMD_SOCKET_HOST, CommandType, CommandProtocolType
+from constants import (
+    CMD_SOCKET_PORT,
+    CMD_SOCKET_HOST,
+    CommandType,
+    CommandProtocolType,
+    MavlinkGPSData,
+)
+from mavlink_codec import encode_gps_data
 import time
 import socket
 import zmq
@@ -99,6 +106,16 @@ if __name__ == "__main__":
     #     )
     # )
 
+    # The binary form of the above is cheaper for pistreamer to decode
+    # commands.append(
+    #     (
+    #         CommandType.GPS_DATA_BIN,
+    #         encode_gps_data(
+    #             MavlinkGPSData(lat=359686990, lon=-839290440, alt=276, fix_type=2)
+    #         ),
+    #     )
+    # )
+
     #######-####### PHOTO #######-#######
     commands.append((CommandType.TAKE_PHOTO, "/mnt/external_sd/DCIM/testimage.jpg"))
     # commands.append((CommandType.TAKE_PHOTO, ""))
@@ -123,4 +140,7 @@ if __name__ == "__main__":
     #######-####### TRACKING #######-#######
     # commands.append((CommandType.INIT_TRACKING_POI,"560,290"))
 
+    #######-####### DIAGNOSTICS #######-#######
+    # commands.append((CommandType.COMMAND_LOG,"20"))
+
     _send_data(commands)
@@ -0,0 +1,1265 @@
+#!/usr/bin/env python3
+
+"""
+Fake camera, GPIO and encoder processes so PiStreamer2 can run on a machine without a camera
+(i.e. an x86 dev box) for the development benchmarks and the tests, a lossy network link,
+and the scenarios both run against the fakes. These are not used at runtime. Call
+install_fake_modules() before importing pistreamer.
+"""
+
+import contextlib
+import heapq
+import io
+import json
+import os
+import random
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import types
+from collections import deque
+from time import CLOCK_BOOTTIME, clock_gettime_ns, monotonic, perf_counter, sleep
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+import cv2
+import numpy as np
+
+from audit_log import CommandAuditLog
+from command_controller import CommandController
+from command_service import Command, CommandService
+from constants import (
+    FEC_PORT_OFFSET,
+    FRAMERATE,
+    STILL_FRAMESIZE,
+    CommandType,
+    OutputCommandType,
+    StreamingProtocolType,
+)
+from rtp_fec import RtpFecRelay
+from segment_index import SegmentIndex
+from srt_transmitter import SrtTransmitter
+from telemetry_buffer import TelemetryHistory
+
+FAKE_FRAME_COUNT = 8  # distinct frames rendered per configuration, then repeated
+FAKE_SENSOR_SIZE = tuple(map(int, STILL_FRAMESIZE.split("x")))
+FAKE_KEYFRAME_WEIGHT = 4  # a keyframe is this many times the size of the other frames
+FAKE_RTP_PAYLOAD_SIZE = 1200  # bytes, one packet per frame
+SUPERVISOR_FRAMES = 30 * 10  # 10 seconds at 30 fps, in real time
+SUPERVISOR_FAULTS = {"rtp": ("crash", 60), "record": ("hang", 90)}
+SEGMENT_FRAMES = 30 * 16  # in real time
+SEGMENT_SECONDS = 2.0
+SEGMENT_CARD_BYTES = 2 * 1024 * 1024  # a simulated SD card
+SEGMENT_MIN_FREE_BYTES = 1024 * 1024
+SEGMENT_RESERVED_BYTES = 256 * 1024
+RECORD_PROFILE_FRAMES = 30 * 4  # in real time, the profile changes while recording
+RTP_FRAMES_BITRATE = 2000000  # bps, the default streaming bitrate
+RTP_FRAMES_PAYLOAD_SIZE = 1400  # bytes of video per RTP packet
+FEC_CAPTURE_PORT = 5616  # the receiver's RTP port on loopback, parity on 5618
+SOAK_FRAMES = 30 * 60 * 60  # one simulated hour at 30 fps
+SOAK_RESOLUTION = "640x360"  # memory growth doesn't depend on the frame size
+SOAK_COMMAND_LOG_RING_SIZE = 50  # so the ring is full by the end of the warm-up
+SOAK_SAMPLE_MINUTES = 2  # simulated minutes between memory samples
+# fitted for the growth, the last half hour as RSS levels off over the first 20 minutes
+SOAK_SLOPE_SAMPLES = 15
+
+
+class FakeCameraExhausted(Exception):
+    """
+    Raised by FakePicamera2 once frame_limit frames have been captured, which ends
+    PiStreamer2.stream() the same way a camera error would.
+    """
+
+
+def render_frames(size: Tuple[int, int], count: int) -> List[np.ndarray]:
+    """
+    A textured scene with a few solid objects that drifts by a few pixels each frame so
+    stabilization, tracking and the encoders see realistic content.
+    """
+    width, height = size
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    rng = np.random.default_rng(0)
+    noise = rng.normal(0, 4, (height, width))  # sensor noise
+    base = np.zeros((height, width, 4), dtype=np.uint8)  # XBGR8888 like the camera
+    base[..., 0] = np.clip(x * 0.5 + 64 + noise, 0, 255)
+    base[..., 1] = np.clip(y * 0.5 + 64 + noise, 0, 255)
+    base[..., 2] = np.clip((x + y) / 4 + 64 + noise, 0, 255)
+    for index in range(6):
+        top_left = (width * (index + 1) // 8, height * (index % 3 + 1) // 5)
+        bottom_right = (top_left[0] + width // 16, top_left[1] + height // 10)
+        cv2.rectangle(base, top_left, bottom_right, (240, 240, 240, 255), -1)
+    frames = []
+    for index in range(count):
+        shift = np.array(
+            [[1, 0, (index % 4) * 2], [0, 1, (index % 3) * 2]], dtype=np.float32
+        )
+        frames.append(
+            cv2.warpAffine(
+                base, shift, (width, height), borderMode=cv2.BORDER_REPLICATE
+            )
+        )
+    return frames
+
+
+class FakeCompletedRequest:
+    def __init__(self, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any]) -> None:
+        self.arrays = arrays  # by stream name, main and optionally lores
+        self.metadata = metadata
+
+    def make_array(self, name: str) -> np.ndarray:
+        # Picamera2 copies the buffer out of the request as well
+        return self.arrays[name].copy()
+
+    def get_metadata(self) -> Dict[str, Any]:
+        return self.metadata
+
+    def release(self) -> None:
+        pass
+
+
+class FakePicamera2:
+    """
+    Implements the parts of Picamera2 that PiStreamer2 uses. Frames are returned as fast as
+    they are requested unless realtime is set, then every frame_interval_ns. Either way their
+    sensor timestamps are frame_interval_ns apart. A lores stream and YUV420
+    streams are rendered like the ISP outputs them.
+    """
+
+    def __init__(self, tuning: Any = None) -> None:
+        self.tuning = tuning
+        self.started = False
+        self.frame_limit = 0  # 0 for no limit
+        self.frames_captured = 0
+        self.realtime = False
+        self.camera_controls = {
+            "ScalerCrop": ((0, 0, 64, 64), (0, 0, *FAKE_SENSOR_SIZE), (0, 0, 0, 0))
+        }
+        self.controls: Dict[str, Any] = {}
+        self.frames: List[Dict[str, np.ndarray]] = []
+        self.config: Dict[str, Any] = {}
+        self._next_frame_ns = 0
+        self.frame_interval_ns = 1000000000 // FRAMERATE
+        self.sensor_timestamp_ns = clock_gettime_ns(CLOCK_BOOTTIME)
+
+    @staticmethod
+    def load_tuning_file(tuning_file: Any) -> Dict[str, Any]:
+        return {}
+
+    def create_video_configuration(
+        self, main: Dict[str, Any], lores: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        config = {"main": {"format": "XBGR8888", **main}, "lores": None}
+        if lores is not None:
+            config["lores"] = {"format": "YUV420", **lores}
+        return config
+
+    def create_still_configuration(self, main: Dict[str, Any]) -> Dict[str, Any]:
+        return {"main": {"format": "BGR888", **main}}
+
+    def configure(self, config: Dict[str, Any]) -> None:
+        if config == self.config:
+            return
+        self.config = config
+        streams: Dict[str, List[np.ndarray]] = {}
+        for name in ("main", "lores"):
+            stream = config.get(name)
+            if not stream:
+                continue
+            frames = render_frames(tuple(stream["size"]), FAKE_FRAME_COUNT)
+            if stream["format"] == "YUV420":
+                frames = [cv2.cvtColor(f, cv2.COLOR_BGRA2YUV_I420) for f in frames]
+            streams[name] = frames
+        self.frames = [
+            {name: frames[index] for name, frames in streams.items()}
+            for index in range(FAKE_FRAME_COUNT)
+        ]
+
+    def start(self) -> None:
+        self.started = True
+
+    def stop(self) -> None:
+        self.started = False
+
+    def set_controls(self, controls: Dict[str, Any]) -> None:
+        self.controls.update(controls)
+
+    def capture_metadata(self) -> Dict[str, Any]:
+        return {
+            "ScalerCrop": self.controls.get("ScalerCrop", (0, 0, *FAKE_SENSOR_SIZE)),
+            "SensorTimestamp": self.sensor_timestamp_ns,
+        }
+
+    def capture_request(self) -> FakeCompletedRequest:
+        if self.frame_limit and self.frames_captured >= self.frame_limit:
+            raise FakeCameraExhausted(f"Captured {self.frames_captured} frames")
+        if self.realtime:
+            now_ns = clock_gettime_ns(CLOCK_BOOTTIME)
+            if self._next_frame_ns > now_ns:
+                threading.Event().wait((self._next_frame_ns - now_ns) / 1e9)
+            self._next_frame_ns = (
+                max(self._next_frame_ns, now_ns) + self.frame_interval_ns
+            )
+            self.sensor_timestamp_ns = clock_gettime_ns(CLOCK_BOOTTIME)
+        else:
+            self.sensor_timestamp_ns += self.frame_interval_ns
+        frame = self.frames[self.frames_captured % len(self.frames)]
+        self.frames_captured += 1
+        return FakeCompletedRequest(frame, self.capture_metadata())
+
+    def capture_array(self) -> np.ndarray:
+        request = self.capture_request()
+        try:
+            return request.make_array("main")
+        finally:
+            request.release()
+
+    def capture_file(self, file_name: str) -> Dict[str, Any]:
+        request = self.capture_request()
+        cv2.imwrite(file_name, request.make_array("main")[..., :3])
+        return request.get_metadata()
+
+
+class FakeGPIO(types.ModuleType):
+    BCM = 11
+    OUT = 0
+    IN = 1
+
+    def __init__(self) -> None:
+        super().__init__("RPi.GPIO")
+        self.pins: Dict[int, int] = {}
+
+    def setmode(self, mode: int) -> None:
+        pass
+
+    def setwarnings(self, warnings: bool) -> None:
+        pass
+
+    def setup(self, pin: int, direction: int) -> None:
+        self.pins[pin] = 0
+
+    def output(self, pin: int, value: int) -> None:
+        self.pins[pin] = value
+
+    def cleanup(self) -> None:
+        self.pins.clear()
+
+
+class FakeTransportStream:
+    """
+    MPEG-TS laid out the way ffmpeg's muxer writes it: a PAT and PMT before every keyframe and
+    a PES per frame on the video PID, with the random access indicator set on keyframes. The
+    payloads are zeros, frames are sized for bitrate (bits per second).
+    """
+
+    PMT_PID = 0x1000
+    VIDEO_PID = 0x100
+
+    def __init__(
+        self, bitrate: int, framerate: int = FRAMERATE, gop: int = FRAMERATE
+    ) -> None:
+        self.gop = gop
+        frame_size = bitrate // 8 * gop // framerate // (gop - 1 + FAKE_KEYFRAME_WEIGHT)
+        self.keyframe = (
+            self._packet(0, b"\0" + self._pat(), start=True)
+            + self._packet(self.PMT_PID, b"\0" + self._pmt(), start=True)
+            + self._pes(frame_size * FAKE_KEYFRAME_WEIGHT, keyframe=True)
+        )
+        self.frame = self._pes(frame_size, keyframe=False)
+
+    def get_frame(self, index: int) -> bytes:
+        return self.keyframe if index % self.gop == 0 else self.frame
+
+    def _pat(self) -> bytes:
+        program = struct.pack(">HH", 1, 0xE000 | self.PMT_PID)
+        return self._section(0, 1, program)
+
+    def _pmt(self) -> bytes:
+        header = struct.pack(">HH", 0xE000 | self.VIDEO_PID, 0xF000)
+        stream = struct.pack(">BHH", 0x1B, 0xE000 | self.VIDEO_PID, 0xF000)  # H.264
+        return self._section(2, 1, header + stream)
+
+    @staticmethod
+    def _section(table_id: int, table_id_extension: int, data: bytes) -> bytes:
+        length = 5 + len(data) + 4  # the CRC isn't checked, it is left as zeros
+        return (
+            struct.pack(
+                ">BHHBBB", table_id, 0xB000 | length, table_id_extension, 0xC1, 0, 0
+            )
+            + data
+            + bytes(4)
+        )
+
+    @staticmethod
+    def _packet(
+        pid: int, payload: bytes, start: bool = False, random_access: bool = False
+    ) -> bytes:
+        header = struct.pack(">BH", 0x47, (0x4000 if start else 0) | pid)
+        if random_access:
+            return header + b"\x30\x01\x40" + payload.ljust(182, b"\xff")
+        return header + b"\x10" + payload.ljust(184, b"\xff")
+
+    def _pes(self, size: int, keyframe: bool) -> bytes:
+        packets = [
+            self._packet(self.VIDEO_PID, bytes(182), start=True, random_access=keyframe)
+        ]
+        packets += [self._packet(self.VIDEO_PID, bytes(184))] * max(
+            0, (size - 182 + 183) // 184
+        )
+        return b"".join(packets)
+
+
+class FakeFragmentedMp4:
+    """
+    Fragmented MP4 laid out the way ffmpeg's muxer writes it with frag_keyframe: a ftyp and
+    moov with one video track at the start, then a moof and mdat per GOP, written once the
+    next keyframe is encoded. The mdat payloads are zeros, sized for bitrate.
+    """
+
+    VIDEO_TRACK = 1
+
+    def __init__(
+        self, bitrate: int, framerate: int = FRAMERATE, gop: int = FRAMERATE
+    ) -> None:
+        self.gop = gop
+        frame_size = bitrate // 8 * gop // framerate // (gop - 1 + FAKE_KEYFRAME_WEIGHT)
+        self.init = self._box(b"ftyp", b"isom" + bytes(4) + b"isomiso6") + self._box(
+            b"moov", self._trak()
+        )
+        gop_size = frame_size * (gop - 1 + FAKE_KEYFRAME_WEIGHT)
+        traf = self._box(
+            b"traf",
+            self._box(b"tfhd", struct.pack(">II", 0x020000, self.VIDEO_TRACK))
+            + self._box(b"trun", struct.pack(">II", 0, gop)),
+        )
+        self.fragment = (
+            self._box(b"moof", self._box(b"mfhd", bytes(8)) + traf)
+            + struct.pack(">I4s", 8 + gop_size, b"mdat")
+            + bytes(gop_size)
+        )
+
+    def get_frame(self, index: int) -> bytes:
+        if index == 0:
+            return self.init
+        return self.fragment if index % self.gop == 0 else b""
+
+    def _trak(self) -> bytes:
+        tkhd = struct.pack(">I8xI", 0, self.VIDEO_TRACK) + bytes(68)
+        hdlr = struct.pack(">I4x4s", 0, b"vide") + bytes(13)
+        return self._box(
+            b"trak",
+            self._box(b"tkhd", tkhd) + self._box(b"mdia", self._box(b"hdlr", hdlr)),
+        )
+
+    @staticmethod
+    def _box(box_type: bytes, payload: bytes) -> bytes:
+        return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def _parse_bitrate(bitrate: str) -> int:
+    """
+    An ffmpeg bitrate, i.e. 1000000 or 1M.
+    """
+    scale = {"k": 1000, "M": 1000000}.get(bitrate[-1], 1)
+    return int(float(bitrate.rstrip("kM")) * scale)
+
+
+class _CountingPipe:
+    """
+    Stands in for an encoder's stdin, frames are counted and discarded. A fault (i.e.
+    FakeEncoderProcess.crash) can be set to run once fault_after_writes frames are written.
+    """
+
+    def __init__(self, startup_delay: float = 0.0) -> None:
+        self.output: Optional[
+            Callable[[int], None]
+        ] = None  # called with each frame number
+        self.bytes_written = 0
+        self.writes = 0
+        self.closed = False
+        self.ready_time = monotonic() + startup_delay
+        self.fault: Optional[Callable[[], None]] = None
+        self.fault_after_writes = 0
+        self._unblocked = threading.Event()
+        self._unblocked.set()
+        self._closed = threading.Event()
+
+    def write(self, data: Any) -> int:
+        if self.fault and self.writes >= self.fault_after_writes:
+            fault, self.fault = self.fault, None
+            fault()
+        delay = self.ready_time - monotonic()
+        if delay > 0:
+            self._closed.wait(delay)  # ffmpeg doesn't read stdin until it has loaded
+        self._unblocked.wait()  # a hung encoder blocks writes until it is killed
+        if self.closed:
+            raise BrokenPipeError("Fake encoder stdin is closed")
+        size = memoryview(data).nbytes
+        if self.output:
+            self.output(self.writes)
+        self.bytes_written += size
+        self.writes += 1
+        return size
+
+    def flush(self) -> None:
+        pass
+
+    def block(self) -> None:
+        self._unblocked.clear()
+
+    def close(self) -> None:
+        self.closed = True
+        self._closed.set()
+        self._unblocked.set()
+
+
+class FakeEncoderProcess:
+    """
+    Stands in for the ffmpeg subprocess.Popen. Bytes written to stdin are counted, extra
+    input pipes (pass_fds, i.e. the KLV pipe) are drained and counted on a thread. With
+    stdout=PIPE every frame written is "encoded" at -b:v on stdout, to a FakeFragmentedMp4
+    with `-f mp4` and a FakeTransportStream otherwise. With an rtp:// output each frame is
+    sent as one RTP packet to it over UDP, so an RTSP server relaying it can be tested.
+    fault is a (method, writes) pair, i.e. ("crash", 100) makes the encoder crash after
+    100 frames and ("hang", 100) makes it stop reading its stdin until it is killed.
+    stdin isn't read for startup_delay seconds, like ffmpeg loading.
+    """
+
+    def __init__(
+        self,
+        args: Sequence[str],
+        pass_fds: Sequence[int] = (),
+        fault: Optional[Tuple[str, int]] = None,
+        startup_delay: float = 0.0,
+        stdout: Optional[int] = None,
+        **kwargs: Any,
+    ) -> None:
+        self.args = list(args)
+        self.stdin = _CountingPipe(startup_delay)
+        self.stdout: Any = None
+        self._output_fd = -1
+        self._output_lock = threading.Lock()
+        if stdout == subprocess.PIPE:
+            bitrate = _parse_bitrate(self._get_arg("-b:v", "0"))
+            framerate = int(self._get_arg("-r", str(FRAMERATE)))
+            gop = int(self._get_arg("-g", str(framerate)))
+            stream_type = (
+                FakeFragmentedMp4 if "mp4" in self.args else FakeTransportStream
+            )
+            self.output_stream: Any = stream_type(bitrate, framerate, gop)
+            read_fd, self._output_fd = os.pipe()
+            self.stdout = os.fdopen(read_fd, "rb")
+            self.stdin.output = self._write_output
+        self._rtp_socket: Optional[socket.socket] = None
+        if self.args and self.args[-1].startswith("rtp://"):
+            host, port = self.args[-1][len("rtp://") :].rsplit(":", 1)
+            self._rtp_address = (host, int(port))
+            self._rtp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._rtp_period = 90000 // int(self._get_arg("-r", str(FRAMERATE)))
+            self.stdin.output = self._send_rtp
+        if fault:
+            method, self.stdin.fault_after_writes = fault
+            self.stdin.fault = getattr(self, method)
+        self.returncode: Optional[int] = None
+        self.extra_bytes_read = 0
+        self._readers = []
+        for fd in pass_fds:
+            # The caller closes its copy of the read end once the process is started
+            reader = threading.Thread(target=self._drain, args=(os.dup(fd),))
+            reader.daemon = True
+            reader.start()
+            self._readers.append(reader)
+
+    def _get_arg(self, name: str, default: str) -> str:
+        return self.args[self.args.index(name) + 1] if name in self.args else default
+
+    def _drain(self, fd: int) -> None:
+        with os.fdopen(fd, "rb", buffering=0) as f:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    return
+                self.extra_bytes_read += len(data)
+
+    def _write_output(self, frame: int) -> None:
+        with self._output_lock:
+            if self._output_fd < 0:
+                raise BrokenPipeError("Fake encoder has exited")
+            data = memoryview(self.output_stream.get_frame(frame))
+            while data:  # blocks while stdout isn't read, like ffmpeg
+                data = data[os.write(self._output_fd, data) :]
+
+    def _send_rtp(self, frame: int) -> None:
+        """
+        A 12 byte RTP header (payload type 96, marker set, the frame's 90 kHz timestamp)
+        and a filler payload.
+        """
+        with self._output_lock:
+            if not self._rtp_socket:
+                raise BrokenPipeError("Fake encoder has exited")
+            header = struct.pack(
+                ">BBHII",
+                0x80,
+                0x80 | 96,
+                frame & 0xFFFF,
+                (frame * self._rtp_period) & 0xFFFFFFFF,
+                0x50495354,
+            )
+            self._rtp_socket.sendto(
+                header + bytes(FAKE_RTP_PAYLOAD_SIZE), self._rtp_address
+            )
+
+    def _close_output(self) -> None:
+        with self._output_lock:
+            if self._output_fd >= 0:
+                os.close(self._output_fd)
+                self._output_fd = -1
+            if self._rtp_socket:
+                self._rtp_socket.close()
+                self._rtp_socket = None
+
+    def poll(self) -> Optional[int]:
+        return self.returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        self._close_output()  # stdin is closed, so ffmpeg flushes and exits
+        for reader in self._readers:
+            reader.join(timeout)
+        if self.returncode is None:
+            self.returncode = 0
+        return self.returncode
+
+    def crash(self, returncode: int = 1) -> None:
+        self.stdin.close()
+        self._close_output()
+        self.returncode = returncode
+
+    def hang(self) -> None:
+        self.stdin.block()
+
+    def terminate(self) -> None:
+        self.stdin.close()
+        self._close_output()
+        self.returncode = -15
+
+    def kill(self) -> None:
+        self.stdin.close()
+        self._close_output()
+        self.returncode = -9
+
+
+class FakeCommandService(CommandService):
+    """
+    Replays a script of commands, keyed by how many times the commands have been polled
+    (the stream loop polls every other frame), and keeps everything sent out, or only the
+    replies starting with sent_prefixes so long runs don't grow the list.
+    """
+
+    def __init__(
+        self,
+        script: Optional[Dict[int, List[Tuple[str, str]]]] = None,
+        sent_prefixes: Tuple[str, ...] = (),
+    ) -> None:
+        super().__init__()
+        self.script = script or {}
+        self.sent_prefixes = sent_prefixes
+        self.polls = 0
+        self.sent: List[str] = []
+        self.published: Dict[str, str] = {}
+
+    def get_pending_commands(self) -> List[Command]:
+        commands = self.script.get(self.polls, [])
+        self.polls += 1
+        received_ns = clock_gettime_ns(CLOCK_BOOTTIME)
+        return [(command_type, value, received_ns) for command_type, value in commands]
+
+    def send_data_out(self, data: str) -> None:
+        if not self.sent_prefixes or data.startswith(self.sent_prefixes):
+            self.sent.append(data)
+
+    def publish(self, topic: str, data: str) -> None:
+        self.published[topic] = data
+
+
+class FakeSrtTransmitter(SrtTransmitter):
+    """
+    An SrtTransmitter without srt-live-transmit, the MPEG-TS encoder still streams to its
+    relay port. No stats are reported.
+    """
+
+    def _spawn(self) -> None:
+        command = self.get_command(self.ip, self.port)
+        self.started_time = monotonic()
+        self.process = FakeEncoderProcess(command)
+
+
+class LossyLink:
+    """
+    A netem-like UDP link on loopback: datagrams sent to `port` are forwarded to destination
+    delay_ms +/- jitter_ms later and lost with probability loss, and replies from
+    destination are sent back to the sender the same way (i.e. SRT's ACKs and NAKs). Unlike
+    netem the jitter doesn't reorder, like a radio sending one packet at a time.
+    """
+
+    def __init__(
+        self,
+        destination: Tuple[str, int],
+        delay_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        loss: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.destination = destination
+        self.delay = delay_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.inbound = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.inbound.bind(("127.0.0.1", 0))
+        self.port = self.inbound.getsockname()[1]
+        self.outbound = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.outbound.bind(("127.0.0.1", 0))
+        self.sender: Optional[Tuple[str, int]] = None
+        self.forwarded = 0
+        self.lost = 0
+        self.is_running = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.is_running = True
+        self._thread = threading.Thread(
+            target=self._run, name="lossy-link", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.is_running = False
+        if self._thread:
+            self._thread.join()
+        self.inbound.close()
+        self.outbound.close()
+
+    def _run(self) -> None:
+        queue: List[Tuple[float, int, socket.socket, bytes, Tuple[str, int]]] = []
+        last_due = {id(self.inbound): 0.0, id(self.outbound): 0.0}
+        count = 0
+        while self.is_running:
+            timeout = max(queue[0][0] - monotonic(), 0.0) if queue else 0.1
+            readable, _, _ = select.select(
+                [self.inbound, self.outbound], [], [], timeout
+            )
+            for sock in readable:
+                data, address = sock.recvfrom(65536)
+                if sock is self.inbound:
+                    self.sender = address
+                    send_sock, target = self.outbound, self.destination
+                elif self.sender:
+                    send_sock, target = self.inbound, self.sender
+                else:
+                    continue
+                if self.random.random() < self.loss:
+                    self.lost += 1
+                    continue
+                jitter = self.random.uniform(-self.jitter, self.jitter)
+                due = max(last_due[id(send_sock)], monotonic() + self.delay + jitter)
+                last_due[id(send_sock)] = due
+                count += 1
+                heapq.heappush(queue, (due, count, send_sock, data, target))
+            now = monotonic()
+            while queue and queue[0][0] <= now:
+                _, _, send_sock, data, target = heapq.heappop(queue)
+                send_sock.sendto(data, target)
+                self.forwarded += 1
+
+
+def install_fake_modules() -> None:
+    """
+    Replaces the camera and GPIO modules so pistreamer can be imported without them.
+    """
+    picamera2 = types.ModuleType("picamera2")
+    picamera2.Picamera2 = FakePicamera2  # type: ignore
+    sys.modules["picamera2"] = picamera2
+
+    rpi = types.ModuleType("RPi")
+    gpio = FakeGPIO()
+    rpi.GPIO = gpio  # type: ignore
+    sys.modules["RPi"] = rpi
+    sys.modules["RPi.GPIO"] = gpio
+
+
+class _StubCommandService:
+    def send_data_out(self, data: str) -> None:
+        pass
+
+    def publish(self, topic: str, data: str) -> None:
+        pass
+
+
+class _StubPicamera2:
+    camera_controls = {"ScalerCrop": ((0, 0, 0, 0), (0, 0, 4056, 3040), (0, 0, 0, 0))}
+
+    def set_controls(self, controls: Dict[str, Any]) -> None:
+        pass
+
+
+class _StubTracker:
+    def _init_tracking_poi(self, x_center: int, y_center: int) -> None:
+        pass
+
+
+class StubPiStreamer:
+    """
+    Only has what the CommandController touches so dispatch is measured without camera work.
+    """
+
+    def __init__(self) -> None:
+        self.command_service = _StubCommandService()
+        self.picam2 = _StubPicamera2()
+        self.tracker = _StubTracker()
+        self.telemetry = TelemetryHistory()
+        self.max_zoom = 16.0
+        self.verbose = False
+        self.gcs_ip = "192.168.1.124"
+        self.gcs_port = "5600"
+        self.streaming_protocol = StreamingProtocolType.RTP.value
+
+    def _set_command_controller(self, command_controller: Any) -> None:
+        self.command_controller = command_controller
+
+    def __getattr__(self, name: str) -> Callable[..., None]:
+        # start_*/stop_*, take_photo etc. are no-ops
+        return lambda *args, **kwargs: None
+
+
+DISPATCH_COMMANDS: List[Tuple[str, str]] = [
+    (CommandType.ZOOM.value, "2.0"),
+    (CommandType.ZOOM.value, "in"),
+    (CommandType.MAX_ZOOM.value, "8.0"),
+    (
+        CommandType.GPS_DATA.value,
+        json.dumps(
+            {
+                "lat": 359686990,
+                "lon": -839290440,
+                "alt": 276,
+                "eph": 1,
+                "epv": 1,
+                "vel": 0,
+                "cog": 0,
+                "fix_type": 2,
+                "satellites_visible": 10,
+                "time_usec": 1730920262680000,
+            }
+        ),
+    ),
+    (
+        CommandType.MISC_DATA.value,
+        json.dumps(
+            {
+                "pitch": 0.1,
+                "roll": 0.02,
+                "camera_model": "IMX477",
+                "focal_length": (50, 1),
+            }
+        ),
+    ),
+    (CommandType.STABILIZE.value, "stop"),
+    (CommandType.INIT_TRACKING_POI.value, "560,290"),
+    (CommandType.GCS_HOST.value, "192.168.1.124:5600"),
+    (CommandType.GCS_IP.value, "192.168.1.124"),
+    (CommandType.GCS_PORT.value, "5600"),
+    (CommandType.STREAMING_PROTOCOL.value, "rtp"),
+    (CommandType.BITRATE.value, "2000"),
+    (CommandType.START_GCS_STREAM.value, ""),
+    (CommandType.STOP_GCS_STREAM.value, ""),
+]
+
+
+def create_fake_pistreamer(
+    resolution: str,
+    stabilize: bool = False,
+    protocol: str = StreamingProtocolType.RTP.value,
+    script: Optional[Dict[int, List[Tuple[str, str]]]] = None,
+    sent_prefixes: Tuple[str, ...] = (),
+    keep_encoders: int = 0,
+    encoder_faults: Optional[Dict[str, Tuple[str, int]]] = None,
+    encoder_startup_delay: float = 0.0,
+    record_resolution: str = "",
+    stream_framerate: int = FRAMERATE,
+    record_framerate: int = FRAMERATE,
+    secondary_resolution: str = "",
+) -> Any:
+    """
+    A PiStreamer2 running on the fake camera, command service, encoders and SRT transmitter.
+    Only the last keep_encoders encoders are kept in `encoders` if set, otherwise all of
+    them. encoder_faults are FakeEncoderProcess faults by sink, for the first encoder of a
+    sink.
+    The fake encoders don't read their stdin for encoder_startup_delay after they start.
+    """
+
+    install_fake_modules()
+    from pistreamer import PiStreamer2
+
+    class _FakePiStreamer(PiStreamer2):
+        encoders: Deque[Tuple[str, Any]]  # (sink, FakeEncoderProcess)
+        encoder_faults: Dict[str, Tuple[str, int]]
+
+        def _spawn_encoder(self, command: List[str], **kwargs: Any) -> Any:
+            # named by the output url, the recording writes to a file
+            sink = {"rtp": "rtp", "udp": "mpegts"}.get(
+                command[-1].split("://")[0], "record"
+            )
+            if command[-1] == f"rtp://{self.secondary_ip}:{self.secondary_port}":
+                sink = "secondary"
+            elif command[-1].endswith(f":{self.rtsp_server.relay_port}"):
+                sink = "rtsp"
+            encoder = FakeEncoderProcess(
+                command,
+                fault=self.encoder_faults.pop(sink, None),
+                startup_delay=encoder_startup_delay,
+                **kwargs,
+            )
+            self.encoders.append((sink, encoder))
+            return encoder
+
+    pi_streamer = _FakePiStreamer(
+        stabilize=stabilize,
+        resolution=resolution,
+        streaming_bitrate=2000000,
+        gcs_ip="127.0.0.1",
+        gcs_port="5600",
+        streaming_protocol=protocol,
+        command_service=FakeCommandService(script, sent_prefixes),
+        record_resolution=record_resolution,
+        stream_framerate=stream_framerate,
+        record_framerate=record_framerate,
+        secondary_resolution=secondary_resolution,
+    )
+    pi_streamer.srt_transmitter = FakeSrtTransmitter(
+        pi_streamer.srt_transmitter.latency_ms,
+        pi_streamer.srt_transmitter.overhead_percent,
+    )
+    pi_streamer.encoders = deque(maxlen=keep_encoders or None)
+    pi_streamer.encoder_faults = dict(encoder_faults or {})
+    controller = CommandController(pi_streamer)
+    controller.__dict__["is_sd_card_available"] = True  # skip the lsblk check
+    return pi_streamer
+
+
+def run_stream_scenario(
+    scenario: Dict[str, Any], frames: int, directory: str
+) -> Dict[str, Any]:
+    width, height = map(int, scenario["resolution"].split("x"))
+    script: Dict[int, List[Tuple[str, str]]] = {}
+    if scenario.get("record"):
+        record_file = os.path.join(directory, f"{scenario['name']}.ts")
+        script.setdefault(1, []).append((CommandType.RECORD.value, record_file))
+    if scenario.get("zoom"):
+        script.setdefault(1, []).append((CommandType.ZOOM.value, "in"))
+    if scenario.get("secondary_resolution"):
+        script.setdefault(1, []).append(
+            (CommandType.START_SECONDARY_STREAM.value, "127.0.0.1:5602")
+        )
+    if scenario.get("tracking"):
+        # The first object in the fake scene, re-initialised as the tracker has no
+        # continuous tracking yet
+        point = f"{width // 8 + width // 32},{height // 5 + height // 20}"
+        for poll in range(2, frames // 2, 15):
+            script.setdefault(poll, []).append(
+                (CommandType.INIT_TRACKING_POI.value, point)
+            )
+
+    pi_streamer = create_fake_pistreamer(
+        scenario["resolution"],
+        stabilize=scenario.get("stabilize", False),
+        protocol=scenario.get("protocol", StreamingProtocolType.RTP.value),
+        script=script,
+        record_resolution=scenario.get("record_resolution", ""),
+        stream_framerate=scenario.get("stream_framerate", FRAMERATE),
+        record_framerate=scenario.get("record_framerate", FRAMERATE),
+        secondary_resolution=scenario.get("secondary_resolution", ""),
+    )
+    pi_streamer.picam2.frame_limit = frames
+    start = perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            pi_streamer.stream()
+        except FakeCameraExhausted:
+            pass
+    elapsed = perf_counter() - start
+    pi_streamer.command_controller.audit_log.close()
+
+    summary = pi_streamer.stage_stats.summary()
+    sink_bytes: Dict[str, int] = {}
+    for sink, encoder in pi_streamer.encoders:
+        sink_bytes[sink] = sink_bytes.get(sink, 0) + encoder.stdin.bytes_written
+        if encoder.extra_bytes_read:
+            sink_bytes["klv"] = sink_bytes.get("klv", 0) + encoder.extra_bytes_read
+    return {
+        "fps": round(frames / elapsed, 1),
+        "stage_mean_us": {
+            stage: values["mean_us"] for stage, values in summary["stages"].items()
+        },
+        "stage_p99_us": {
+            stage: values["p99_us"] for stage, values in summary["stages"].items()
+        },
+        "counters": summary["counters"],
+        "sink_bytes": sink_bytes,
+    }
+
+
+def run_supervisor_scenario(frames: int, directory: str) -> Tuple[Any, List[int]]:
+    """
+    Streams RTP and records to directory in real time while SUPERVISOR_FAULTS crash and
+    hang the first encoder of each sink. Returns the PiStreamer2 and the sizes of the
+    recording files made before and after the restart.
+    """
+
+    record_file = os.path.join(directory, "flight.ts")
+    pi_streamer = create_fake_pistreamer(
+        "1280x720",
+        script={1: [(CommandType.RECORD.value, record_file)]},
+        encoder_faults=SUPERVISOR_FAULTS,
+    )
+    pi_streamer.picam2.frame_limit = frames
+    pi_streamer.picam2.realtime = True
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            pi_streamer.stream()
+    except FakeCameraExhausted:
+        pass
+    finally:
+        pi_streamer.command_controller.audit_log.close()
+    # the restarted encoder records to a new file
+    record_sizes = [
+        os.path.getsize(name) if os.path.exists(name) else 0
+        for name in (record_file, record_file.replace(".ts", "_1.ts"))
+    ]
+    return pi_streamer, record_sizes
+
+
+def count_frames(file_name: str) -> Tuple[int, bool]:
+    """
+    Video PES packets in a recording made from FakeTransportStream, and whether it starts
+    with the PAT, the PMT and a keyframe.
+    """
+
+    packets = np.fromfile(file_name, np.uint8).reshape(-1, 188)
+    pids = ((packets[:, 1] & 0x1F).astype(np.int32) << 8) | packets[:, 2]
+    video = pids == FakeTransportStream.VIDEO_PID
+    starts_on_keyframe = (
+        list(pids[:3])
+        == [0, FakeTransportStream.PMT_PID, FakeTransportStream.VIDEO_PID]
+        and packets[2, 5] & 0x40 != 0
+    )
+    return (
+        int(np.count_nonzero(video & (packets[:, 1] & 0x40 != 0))),
+        starts_on_keyframe,
+    )
+
+
+def run_segments_scenario(frames: int, directory: str) -> Any:
+    """
+    Records to directory in real time with SEGMENT_SECONDS segments onto a simulated
+    SEGMENT_CARD_BYTES card, so the retention deletes the oldest segments to keep
+    SEGMENT_MIN_FREE_BYTES free. A photo.jpg in directory is not a segment and is kept.
+    Returns the PiStreamer2.
+    """
+
+    with open(os.path.join(directory, "photo.jpg"), "wb") as f:
+        f.write(bytes(1024))
+    pi_streamer = create_fake_pistreamer(
+        "640x360",
+        script={1: [(CommandType.RECORD.value, os.path.join(directory, "f.ts"))]},
+    )
+    import pistreamer as pistreamer_module  # imported by create_fake_pistreamer
+
+    def _get_simulated_free_bytes() -> int:
+        used = sum(
+            os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory)
+        )
+        return SEGMENT_CARD_BYTES - used
+
+    pi_streamer.segment_index = SegmentIndex(os.path.join(directory, "index.json"))
+    pi_streamer.storage_monitor.interval = 0
+    pi_streamer.storage_monitor.check = _get_simulated_free_bytes
+    pi_streamer.picam2.frame_limit = frames
+    pi_streamer.picam2.realtime = True
+    patched = {
+        "RECORD_SEGMENT_SECONDS": SEGMENT_SECONDS,
+        "STORAGE_MIN_FREE_BYTES": SEGMENT_MIN_FREE_BYTES,
+        "STORAGE_RESERVED_BYTES": SEGMENT_RESERVED_BYTES,
+    }
+    originals = {name: getattr(pistreamer_module, name) for name in patched}
+    for name, value in patched.items():
+        setattr(pistreamer_module, name, value)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            pi_streamer.stream()
+    except FakeCameraExhausted:
+        pass
+    finally:
+        for name, value in originals.items():
+            setattr(pistreamer_module, name, value)
+        pi_streamer.command_controller.audit_log.close()
+    return pi_streamer
+
+
+def run_record_profile_switch(frames: int, directory: str) -> Any:
+    """
+    Records to directory in real time, switching from mpegts to fmp4 mid-recording.
+    Returns the PiStreamer2.
+    """
+
+    pi_streamer = create_fake_pistreamer(
+        "640x360",
+        script={  # commands are polled every other frame
+            1: [(CommandType.RECORD.value, os.path.join(directory, "f.ts"))],
+            FRAMERATE: [(CommandType.RECORD_PROFILE.value, "fmp4")],
+            frames // 2 - 5: [(CommandType.STOP_RECORDING.value, "")],
+        },
+    )
+    pi_streamer.segment_index = SegmentIndex(os.path.join(directory, "index.json"))
+    pi_streamer.picam2.frame_limit = frames
+    pi_streamer.picam2.realtime = True
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            pi_streamer.stream()
+    except FakeCameraExhausted:
+        pass
+    finally:
+        pi_streamer.command_controller.audit_log.close()
+    return pi_streamer
+
+
+class RtspClient:
+    """
+    A minimal RTSP client for the RTSP benchmark and tests, over UDP or interleaved TCP
+    like VLC or ffplay with `-rtsp_transport tcp`.
+    """
+
+    def __init__(self, url: str, tcp: bool) -> None:
+        self.url = url
+        self.tcp = tcp
+        host, port = url.split("/")[2].split(":")
+        self.connection = socket.create_connection((host, int(port)), timeout=2.0)
+        self.rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rtp.bind(("127.0.0.1", 0))
+        self.rtp.settimeout(2.0)
+        self.cseq = 0
+        self.session = ""
+        self.buffer = b""
+
+    def request(self, method: str, headers: Optional[Dict[str, str]] = None) -> str:
+        self.cseq += 1
+        lines = [f"{method} {self.url} RTSP/1.0", f"CSeq: {self.cseq}"]
+        if self.session:
+            lines.append(f"Session: {self.session}")
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        self.connection.sendall(("\r\n".join(lines) + "\r\n\r\n").encode())
+        while b"\r\n\r\n" not in self.buffer:
+            self.buffer += self.connection.recv(4096)
+        head, _, self.buffer = self.buffer.partition(b"\r\n\r\n")
+        response = head.decode()
+        assert response.startswith("RTSP/1.0 200"), response
+        for line in response.split("\r\n"):
+            name, _, value = line.partition(":")
+            if name.lower() == "content-length":
+                while len(self.buffer) < int(value):
+                    self.buffer += self.connection.recv(4096)
+                body, self.buffer = self.buffer[: int(value)], self.buffer[int(value) :]
+                response += "\r\n\r\n" + body.decode()
+            elif name.lower() == "session":
+                self.session = value.strip().partition(";")[0]
+        return response
+
+    def play(self) -> None:
+        self.request("OPTIONS")
+        self.request("DESCRIBE", {"Accept": "application/sdp"})
+        if self.tcp:
+            transport = "RTP/AVP/TCP;unicast;interleaved=0-1"
+        else:
+            port = self.rtp.getsockname()[1]
+            transport = f"RTP/AVP;unicast;client_port={port}-{port + 1}"
+        self.request("SETUP", {"Transport": transport})
+        self.request("PLAY", {"Range": "npt=0.000-"})
+
+    def receive(self) -> bytes:
+        """
+        The next RTP packet.
+        """
+        if not self.tcp:
+            return self.rtp.recv(65536)
+        while True:
+            while len(self.buffer) < 4:
+                self.buffer += self.connection.recv(65536)
+            assert self.buffer[:1] == b"$", self.buffer[:16]
+            size = 4 + int.from_bytes(self.buffer[2:4], "big")
+            while len(self.buffer) < size:
+                self.buffer += self.connection.recv(65536)
+            packet, self.buffer = self.buffer[4:size], self.buffer[size:]
+            return packet
+
+    def close(self) -> None:
+        self.request("TEARDOWN")
+        self.connection.close()
+        self.rtp.close()
+
+
+def rtp_frames(seconds: float) -> List[List[bytes]]:
+    """
+    The RTP packets of each frame of a RTP_FRAMES_BITRATE stream, keyframes every second
+    sized like the fake encoders'.
+    """
+
+    rng = random.Random(0)
+    frame_size = RTP_FRAMES_BITRATE // 8 // (FRAMERATE - 1 + FAKE_KEYFRAME_WEIGHT)
+    frames = []
+    sequence_number = 0
+    for index in range(int(seconds * FRAMERATE)):
+        size = frame_size * (FAKE_KEYFRAME_WEIGHT if index % FRAMERATE == 0 else 1)
+        count = -(-size // RTP_FRAMES_PAYLOAD_SIZE)
+        packets = []
+        for n in range(count):
+            header = struct.pack(
+                ">BBHII",
+                0x80,
+                (0x80 if n == count - 1 else 0) | 96,  # the marker ends the frame
+                sequence_number & 0xFFFF,
+                index * 90000 // FRAMERATE,
+                0x50495354,
+            )
+            payload_size = min(
+                RTP_FRAMES_PAYLOAD_SIZE, size - n * RTP_FRAMES_PAYLOAD_SIZE
+            )
+            packets.append(header + rng.randbytes(payload_size))
+            sequence_number += 1
+        frames.append(packets)
+    return frames
+
+
+def capture_fec_relay(
+    frames: List[List[bytes]], group_size: int, interleave: int
+) -> Tuple[List[Tuple[int, bytes, bool]], Dict[str, Any]]:
+    """
+    Sends the frames through an RtpFecRelay in real time and returns what the receiver got,
+    as (kernel receive time ns, packet, is_parity) in the order it arrived, with the relay's
+    metrics.
+    """
+
+    receivers = []
+    for port in (FEC_CAPTURE_PORT, FEC_CAPTURE_PORT + FEC_PORT_OFFSET):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # the kernel's receive time, as the two sockets are read in turn
+        receiver.setsockopt(
+            socket.SOL_SOCKET, getattr(socket, "SO_TIMESTAMPNS", 35), 1  # 35 on Linux
+        )
+        receiver.bind(("127.0.0.1", port))
+        receivers.append(receiver)
+    capture: List[Tuple[int, bytes, bool]] = []
+    is_receiving = True
+
+    def _receive() -> None:
+        while is_receiving:
+            readable, _, _ = select.select(receivers, [], [], 0.1)
+            for receiver in readable:
+                packet, ancillary, _, _ = receiver.recvmsg(65536, 64)
+                seconds, nanoseconds = struct.unpack("qq", ancillary[0][2][:16])
+                received_ns = seconds * 1000000000 + nanoseconds
+                capture.append((received_ns, packet, receiver is receivers[1]))
+
+    thread = threading.Thread(target=_receive, daemon=True)
+    thread.start()
+    relay = RtpFecRelay(group_size, interleave)
+    relay.start("127.0.0.1", FEC_CAPTURE_PORT)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    start = perf_counter()
+    for index, packets in enumerate(frames):
+        delay = start + index / FRAMERATE - perf_counter()
+        if delay > 0:
+            sleep(delay)
+        for packet in packets:  # in a burst, like ffmpeg
+            sender.sendto(packet, ("127.0.0.1", relay.relay_port))
+    sleep(relay.max_delay + 0.2)
+    relay.stop()
+    is_receiving = False
+    thread.join()
+    for sock in [sender, *receivers]:
+        sock.close()
+    return sorted(capture, key=lambda received: received[0]), relay.metrics()
+
+
+def run_soak_scenario(
+    frames: int, directory: str
+) -> Tuple[List[Dict[str, Any]], List[Any]]:
+    """
+    Runs stream() for a simulated flight with a 30 second recording every minute and zoom,
+    tracking and stats requests during it. Memory is sampled with the `memory` command
+    every SOAK_SAMPLE_MINUTES, halfway between two recordings so the samples are alike.
+    Returns the samples and the allocation sites that grew the most from the first sample
+    to the last, from a `memory snapshot` / `memory diff` pair.
+    """
+    width, height = map(int, SOAK_RESOLUTION.split("x"))
+    polls = frames // 2  # commands are read every other frame
+    minute = 30 * 60 // 2  # polls per simulated minute
+    script: Dict[int, List[Tuple[str, str]]] = {}
+
+    def _add(poll: int, command_type: CommandType, value: str = "") -> None:
+        script.setdefault(poll, []).append((command_type.value, value))
+
+    for poll in range(minute // 2, polls, minute):
+        # a 30 second recording every minute, zooming in and back out during it
+        _add(poll, CommandType.RECORD, os.path.join(directory, f"{poll}.ts"))
+        _add(poll + 10, CommandType.ZOOM, "in")
+        _add(poll + 60, CommandType.ZOOM, "out")
+        _add(poll + 120, CommandType.ZOOM, "stop")
+        _add(poll + 200, CommandType.INIT_TRACKING_POI, f"{width // 6},{height // 4}")
+        _add(poll + 300, CommandType.STOP_TRACKING)
+        _add(poll + 400, CommandType.STATS)
+        _add(poll + minute // 2, CommandType.STOP_RECORDING)
+    # the reply to a `memory` is the sample the one before it asked for
+    sample_polls = list(range(minute // 4, polls, minute * SOAK_SAMPLE_MINUTES))
+    for poll in sample_polls:
+        _add(poll, CommandType.MEMORY)
+    _add(sample_polls[0] + 1, CommandType.MEMORY, "snapshot")
+    _add(sample_polls[-1] + 1, CommandType.MEMORY, "diff 5")
+    _add(sample_polls[-1] + 2, CommandType.MEMORY, "stop")
+
+    pi_streamer = create_fake_pistreamer(
+        SOAK_RESOLUTION,
+        script=script,
+        sent_prefixes=(f"{OutputCommandType.MEMORY.value} ",),
+        keep_encoders=4,  # the running encoders, not every recording
+    )
+    controller = pi_streamer.command_controller
+    controller.audit_log.close()
+    controller.audit_log = CommandAuditLog(
+        file_name=os.path.join(directory, "command.log"),
+        ring_size=SOAK_COMMAND_LOG_RING_SIZE,
+    )
+    pi_streamer.picam2.frame_limit = frames
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            pi_streamer.stream()
+        except FakeCameraExhausted:
+            pass
+    controller.audit_log.close()
+
+    replies = [
+        json.loads(data.split(" ", 1)[1]) for data in pi_streamer.command_service.sent
+    ]
+    samples = [reply for reply in replies if reply and "rss_kb" in reply]
+    diff = next(reply["diff"] for reply in replies if reply and "diff" in reply)
+    return samples, diff
+
+
+def get_growth_per_hour(samples: List[Dict[str, Any]], key: str) -> float:
+    """
+    The least squares slope of a memory sample value over the last SOAK_SLOPE_SAMPLES
+    samples, per simulated hour, so a steady leak shows however the samples scatter.
+    """
+    values = [sample[key] for sample in samples[-SOAK_SLOPE_SAMPLES:]]
+    slope = np.polyfit(np.arange(len(values)), values, 1)[0]
+    return float(slope) * 60 / SOAK_SAMPLE_MINUTES
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+from collections import deque
+from datetime import datetime
+import os
+import threading
+from time import time
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from constants import (
+    COMMAND_LOG_BACKUP_COUNT,
+    COMMAND_LOG_FILE,
+    COMMAND_LOG_FLUSH_INTERVAL,
+    COMMAND_LOG_MAX_BYTES,
+    COMMAND_LOG_PENDING_SIZE,
+    COMMAND_LOG_RING_SIZE,
+)
+
+"""
+Every handled command is recorded with its latency and outcome. Recording only appends to
+in-memory deques, the file on /tmp (tmpfs) is written in batches by a background thread and
+rotated by size so it can't grow without limit.
+"""
+
+# (time, command_type, command_value, latency_ns, outcome, error)
+AuditEntry = Tuple[float, str, str, int, str, str]
+
+
+class CommandAuditLog:
+    def __init__(
+        self,
+        file_name: str = COMMAND_LOG_FILE,
+        max_bytes: int = COMMAND_LOG_MAX_BYTES,
+        backup_count: int = COMMAND_LOG_BACKUP_COUNT,
+        ring_size: int = COMMAND_LOG_RING_SIZE,
+        flush_interval: float = COMMAND_LOG_FLUSH_INTERVAL,
+    ) -> None:
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        # deque appends and pops are atomic so no lock is needed between the two threads
+        self.recent: Deque[AuditEntry] = deque(maxlen=ring_size)
+        self.pending: Deque[AuditEntry] = deque(maxlen=COMMAND_LOG_PENDING_SIZE)
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._flush_loop, name="command-audit-log", daemon=True
+        )
+        self._thread.start()
+
+    def record(
+        self,
+        command_type: str,
+        command_value: str,
+        latency_ns: int,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        """
+        Called on the stream loop so this must only touch memory.
+        """
+        entry = (
+            time(),
+            command_type,
+            command_value,
+            latency_ns,
+            "error" if error else "ok",
+            str(error) if error else "",
+        )
+        self.recent.append(entry)
+        self.pending.append(entry)
+
+    def get_recent(self, count: int) -> List[Dict[str, Any]]:
+        """
+        Returns up to the last `count` entries, oldest first.
+        """
+        entries = list(self.recent)[-count:] if count > 0 else []
+        return [
+            {
+                "time": entry[0],
+                "command_type": entry[1],
+                "command_value": entry[2],
+                "latency_us": round(entry[3] / 1000, 1),
+                "outcome": entry[4],
+                "error": entry[5],
+            }
+            for entry in entries
+        ]
+
+    def _format_entry(self, entry: AuditEntry) -> str:
+        formatted_time = datetime.fromtimestamp(entry[0]).strftime(
+            "%Y-%m-%d %H:%M:%S.%f"
+        )[:-3]
+        line = f"{formatted_time}: {entry[1]} {entry[2]} ({entry[3] / 1e6:.3f} ms) {entry[4]}"
+        if entry[5]:
+            line += f" {entry[5]}"
+        return line + "\n"
+
+    def _rotate(self) -> None:
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.file_name}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.file_name}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.file_name, f"{self.file_name}.1")
+        else:
+            os.remove(self.file_name)
+
+    def flush(self) -> None:
+        """
+        Writes all pending entries in one batch, rotating the file first if it would
+        exceed max_bytes.
+        """
+        with self._flush_lock:
+            lines = []
+            while self.pending:
+                lines.append(self._format_entry(self.pending.popleft()))
+            if not lines:
+                return
+            data = "".join(lines)
+            try:
+                if (
+                    os.path.exists(self.file_name)
+                    and os.path.getsize(self.file_name) + len(data) > self.max_bytes
+                ):
+                    self._rotate()
+                with open(self.file_name, "a") as f:
+                    f.write(data)
+            except Exception as e:
+                print(f"Error writing command log {self.file_name}: {e}")
+
+    def _flush_loop(self) -> None:
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def close(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
+        self.flush()
@@ -1,36 +1,66 @@
 #!/usr/bin/env python3
 
-from datetime import datetime
 import json
+import re
 import subprocess
-from time import time
-from typing import Union
+from time import perf_counter_ns, time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple, Union
+from audit_log import CommandAuditLog
+from command_registry import CommandRegistry
+from mavlink_codec import decode_gps_values, decode_misc_values
+from profiler import StreamProfiler
 from constants import (
+    FEC_MAX_INTERLEAVE,
+    FEC_MAX_SPAN,
+    FRAMERATE,
+    MEMORY_DIFF_COUNT,
     MIN_ZOOM,
+    PRE_EVENT_MEMORY_BUDGET,
+    RECORD_BITRATE_MAX,
+    RECORD_BITRATE_MIN,
     SD_CARD_LOCATION,
+    SECONDARY_BITRATE_MIN,
+    SRT_LATENCY_MAX,
+    SRT_LATENCY_MIN,
+    SRT_OVERHEAD_MAX,
+    SRT_OVERHEAD_MIN,
     ZOOM_RATE,
     CommandType,
-    MavlinkGPSData,
     MavlinkMiscData,
+    MemoryAction,
     StreamingProtocolType,
     OutputCommandType,
+    ProfileMode,
+    RecordProfile,
+    SinkType,
+    TelemetryTopic,
     ZoomStatus,
     TrackStatus,
 )
+from telemetry_buffer import GPS_FIELDS
 from validator import Validator
 from functools import cached_property
 
-
-class CommandController:
+if TYPE_CHECKING:
     from pistreamer import PiStreamer2
 
-    def __init__(self, pi_streamer: PiStreamer2) -> None:
+GCS_HOST_PATTERN = re.compile(r"^\s*([^\s:]+)\s*:\s*([^\s:]+)")
+
+
+class CommandController:
+    def __init__(self, pi_streamer: "PiStreamer2") -> None:
         self.pi_streamer = pi_streamer
         self.validator = Validator()
         self.pi_streamer._set_command_controller(self)
         self.zoom_status = ZoomStatus.STOP.value
         self.current_zoom = MIN_ZOOM
         self.last_zoom_time = 0
+        self.registry = CommandRegistry()
+        self._register_handlers()
+        self.audit_log = CommandAuditLog()
+        # when the command being handled was received, or 0 for now
+        self.received_ns = 0
+        self.profiler = StreamProfiler()
 
     @cached_property
     def is_sd_card_available(self) -> bool:
@@ -56,174 +86,606 @@ class CommandController:
             print(f"Error occurred: {e}")
             return False
 
-    def handle_command(self, command_type: str, command_value: str = "") -> None:
+    def handle_command(
+        self, command_type: str, command_value: str = "", received_ns: int = 0
+    ) -> None:
         """
         Attempts to handle the GCS commands for PiStreamer. If an exception occurs it is
-        raised so PiStreamer can update the db row with the error.
+        raised so PiStreamer can update the db row with the error. received_ns is the
+        CLOCK_BOOTTIME the command arrived at, GPS and MISC data are timestamped with it.
         """
-        # Higher priority commands should come first in if/elif/else for minor performance improvements
-        with open("/tmp/command.log", "a") as f:
-            formatted_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            f.write(f"{formatted_time}: {command_type} {command_value}\n")
-        if command_type == CommandType.TAKE_PHOTO.value:
-            print(
-                f"Received photo command {self.is_sd_card_available=} {command_value=}"
+        start_ns = perf_counter_ns()
+        self.received_ns = received_ns
+        try:
+            self.registry.dispatch(command_type, command_value)
+        except Exception as e:
+            self.audit_log.record(
+                command_type, command_value, perf_counter_ns() - start_ns, e
             )
-            if self.is_sd_card_available:
-                self.pi_streamer.take_photo(file_name=command_value)
-        elif command_type == CommandType.RECORD.value:
-            print(
-                f"Received record command {self.is_sd_card_available=} {command_value=}"
+            raise
+        self.audit_log.record(command_type, command_value, perf_counter_ns() - start_ns)
+
+    def _register_handlers(self) -> None:
+        """
+        Each command type maps to a handler and, for commands with a value, the parser that
+        converts and validates that value before the handler is called.
+        """
+        register = self.registry.register
+        register(CommandType.TAKE_PHOTO.value, self._handle_take_photo)
+        register(CommandType.RECORD.value, self._handle_record)
+        register(CommandType.STOP_RECORDING.value, self._handle_stop_recording)
+        register(CommandType.ZOOM.value, self._handle_zoom, self._parse_zoom)
+        register(
+            CommandType.MAX_ZOOM.value, self._handle_max_zoom, self._parse_max_zoom
+        )
+        register(
+            CommandType.INIT_TRACKING_POI.value,
+            self._handle_init_tracking_poi,
+            self._parse_point,
+        )
+        register(CommandType.GPS_DATA.value, self._handle_gps_data, self._parse_gps)
+        register(CommandType.MISC_DATA.value, self._handle_misc_data, self._parse_misc)
+        register(
+            CommandType.GPS_DATA_BIN.value, self._handle_gps_data, decode_gps_values
+        )
+        register(
+            CommandType.MISC_DATA_BIN.value, self._handle_misc_data, decode_misc_values
+        )
+        register(
+            CommandType.STABILIZE.value, self._handle_stabilize, self._parse_stabilize
+        )
+        register(
+            CommandType.GCS_HOST.value, self._handle_gcs_host, self._parse_gcs_host
+        )
+        register(CommandType.GCS_PORT.value, self._handle_gcs_port, self._parse_port)
+        register(CommandType.GCS_IP.value, self._handle_gcs_ip, self._parse_ip)
+        register(CommandType.START_GCS_STREAM.value, self._handle_start_gcs_stream)
+        register(CommandType.STOP_GCS_STREAM.value, self._handle_stop_gcs_stream)
+        register(
+            CommandType.STREAMING_PROTOCOL.value,
+            self._handle_streaming_protocol,
+            self._parse_streaming_protocol,
+        )
+        register(CommandType.BITRATE.value, self._reset_bitrate, self._parse_bitrate)
+        register(
+            CommandType.COMMAND_LOG.value, self._handle_command_log, self._parse_count
+        )
+        register(CommandType.STATS.value, self._handle_stats, self._parse_stats)
+        register(CommandType.PROFILE.value, self._handle_profile, self._parse_profile)
+        register(CommandType.MEMORY.value, self._handle_memory, self._parse_memory)
+        register(
+            CommandType.PRE_EVENT.value, self._handle_pre_event, self._parse_pre_event
+        )
+        register(CommandType.SEGMENTS.value, self._handle_segments, self._parse_count)
+        register(
+            CommandType.RECORD_BITRATE.value,
+            self._handle_record_bitrate,
+            self._parse_record_bitrate,
+        )
+        register(
+            CommandType.RECORD_PROFILE.value,
+            self._handle_record_profile,
+            self._parse_record_profile,
+        )
+        register(
+            CommandType.FRAMERATE.value, self._handle_framerate, self._parse_framerate
+        )
+        register(
+            CommandType.START_SECONDARY_STREAM.value,
+            self._handle_start_secondary_stream,
+            self._parse_secondary_stream,
+        )
+        register(
+            CommandType.STOP_SECONDARY_STREAM.value,
+            self._handle_stop_secondary_stream,
+        )
+        register(CommandType.FEC.value, self._handle_fec, self._parse_fec)
+        register(CommandType.SRT.value, self._handle_srt, self._parse_srt)
+        register(
+            CommandType.KEYFRAME.value, self._handle_keyframe, self._parse_keyframe
+        )
+        register(
+            CommandType.INTRA_REFRESH.value,
+            self._handle_intra_refresh,
+            self._parse_intra_refresh,
+        )
+
+    ### vvvv Parsers, these raise the error returned to the command sender
+
+    def _parse_zoom(self, command_value: str) -> Union[str, float]:
+        zoom_status = str(command_value).lower().strip()
+        if zoom_status in (
+            ZoomStatus.IN.value,
+            ZoomStatus.OUT.value,
+            ZoomStatus.STOP.value,
+        ):
+            return zoom_status
+        try:
+            return float(zoom_status)
+        except ValueError:
+            raise Exception(
+                "Invalid zoom command. Use 'zoom <factor>' where factor is a float otherwise 'in' or 'out'."
             )
-            if self.is_sd_card_available:
-                self.pi_streamer.start_recording(file_name=command_value)
-        elif command_type == CommandType.ZOOM.value:
-            try:
-                zoom_status = str(command_value).lower().strip()
-                if zoom_status in [
-                    ZoomStatus.IN.value,
-                    ZoomStatus.OUT.value,
-                    ZoomStatus.STOP.value,
-                ]:
-                    self.zoom_status = zoom_status
-                    if zoom_status == ZoomStatus.STOP.value:
-                        self.last_zoom_time = 0
-                else:
-                    zoom_factor = float(zoom_status)
-                    self.set_zoom(zoom_factor)
-            except (IndexError, ValueError):
-                raise Exception(
-                    "Invalid zoom command. Use 'zoom <factor>' where factor is a float otherwise 'in' or 'out'."
-                )
-        elif command_type == CommandType.MAX_ZOOM.value:
-            max_zoom = float(command_value)
-            if not self.validator.validate_max_zoom(max_zoom):
-                raise Exception(
-                    f"Error: {max_zoom} is not a valid max_zoom. It must be between 8.0 and 16.0 inclusive."
-                )
-            self.pi_streamer.max_zoom = max_zoom
-            self.set_zoom(MIN_ZOOM)  # reset the zoom back to the original
-        elif command_type == CommandType.INIT_TRACKING_POI.value:
-            x_center, y_center = command_value.split(",")
-            self.pi_streamer.tracker._init_tracking_poi(
-                x_center=int(x_center), y_center=int(y_center)
+
+    def _parse_max_zoom(self, command_value: str) -> float:
+        max_zoom = float(command_value)
+        if not self.validator.validate_max_zoom(max_zoom):
+            raise Exception(
+                f"Error: {max_zoom} is not a valid max_zoom. It must be between 8.0 and 16.0 inclusive."
             )
-            self.pi_streamer.track_status = TrackStatus.INIT.value
-        elif command_type == CommandType.GPS_DATA.value:
-            try:
-                self.pi_streamer.gps_data = MavlinkGPSData(**json.loads(command_value))
-            except Exception as e:
-                raise Exception(f"Invalid GPS data command : {e}")
-        elif command_type == CommandType.MISC_DATA.value:
-            try:
-                self.pi_streamer.misc_data = MavlinkMiscData(
-                    **json.loads(command_value)
-                )
-            except Exception as e:
-                raise Exception(f"Invalid MISC data command : {e}")
-        elif command_type == CommandType.STABILIZE.value:
-            try:
-                stab_value = (
-                    True if str(command_value).lower().strip() == "start" else False
-                )
-                self.pi_streamer.stabilize = stab_value
-            except Exception:
-                raise Exception("Invalid stabilization command.")
-        elif command_type == CommandType.STOP_RECORDING.value:
-            self.pi_streamer.stop_recording()
-        elif command_type == CommandType.GCS_HOST.value:
-            ip, port = map(str.strip, command_value.split(" ")[0].split(":"))
-            print(f"Setting new GCS host {ip}:{port}")
-            self._reset_gcs_host(ip=ip, port=port)
-        elif command_type == CommandType.GCS_PORT.value:
-            try:
-                new_port = str(command_value)
-                if not self.validator.validate_port(new_port):
-                    raise Exception(
-                        f"Error: {new_port} is not a valid port. It must be between 1 and 65535."
-                    )
-                print(f"Setting new GCS port {new_port}")
-                self._reset_gcs_host(
-                    ip=str(self.pi_streamer.gcs_ip),
-                    port=new_port,
-                )
-            except (IndexError, ValueError):
-                raise Exception(
-                    "Invalid port command. Use 'port <value>' where value is an int between 1 and 65535."
-                )
-        elif command_type == CommandType.GCS_IP.value:
-            try:
-                new_ip = str(command_value)
-                if not self.validator.validate_ip(new_ip):
-                    raise Exception(f"Error: {new_ip} is not a valid IP Address.")
-                print(f"Setting new GCS IP {new_ip}")
-                self._reset_gcs_host(
-                    ip=new_ip,
-                    port=str(self.pi_streamer.gcs_port),
-                )
-            except (IndexError, ValueError):
-                raise Exception(
-                    "Invalid ip command. Use 'ip <value>' where value is a valid ip address."
-                )
-        elif command_type == CommandType.START_GCS_STREAM.value:
-            if self.pi_streamer.streaming_protocol == StreamingProtocolType.RTP.value:
-                start_func = self.pi_streamer.start_rtp_stream
-            elif (
-                self.pi_streamer.streaming_protocol
-                == StreamingProtocolType.MPEG_TS.value
-            ):
-                start_func = self.pi_streamer.start_mpeg_ts_stream
-            else:
-                raise Exception(
-                    f"Unsupported GCS type {self.pi_streamer.streaming_protocol}."
-                )
-            start_func(
-                ip=str(self.pi_streamer.gcs_ip),
-                port=str(self.pi_streamer.gcs_port),
+        return max_zoom
+
+    def _parse_point(self, command_value: str) -> Tuple[int, int]:
+        x_center, y_center = command_value.split(",")
+        return int(x_center), int(y_center)
+
+    def _parse_gps(self, command_value: str) -> List[int]:
+        """
+        Returns the values in GPS_FIELDS order, missing fields default to 0.
+        """
+        try:
+            gps_data = json.loads(command_value)
+            values = [gps_data.pop(field, 0) for field in GPS_FIELDS]
+            if gps_data:
+                raise Exception(f"unexpected fields {list(gps_data)}")
+            return values
+        except Exception as e:
+            raise Exception(f"Invalid GPS data command : {e}")
+
+    def _parse_misc(
+        self, command_value: str
+    ) -> Tuple[float, float, str, Tuple[int, int]]:
+        try:
+            misc_data = json.loads(command_value)
+            values = (
+                float(misc_data.pop("pitch", MavlinkMiscData.pitch)),
+                float(misc_data.pop("roll", MavlinkMiscData.roll)),
+                str(misc_data.pop("camera_model", MavlinkMiscData.camera_model)),
+                tuple(misc_data.pop("focal_length", MavlinkMiscData.focal_length)),
             )
-        elif command_type == CommandType.STOP_GCS_STREAM.value:
-            if self.pi_streamer.streaming_protocol == StreamingProtocolType.RTP.value:
-                stop_func = self.pi_streamer.stop_rtp_stream
-            elif (
-                self.pi_streamer.streaming_protocol
-                == StreamingProtocolType.MPEG_TS.value
-            ):
-                stop_func = self.pi_streamer.stop_mpeg_ts_stream
-            else:
-                raise Exception(
-                    f"Unsupported GCS type {self.pi_streamer.streaming_protocol}."
-                )
-            stop_func()
-        elif command_type == CommandType.STREAMING_PROTOCOL.value:
-            command_value = command_value.lower().strip()
-            if command_value not in [
-                StreamingProtocolType.RTP.value,
-                StreamingProtocolType.MPEG_TS.value,
-            ]:
-                raise Exception(
-                    f"Unsupported GCS type {self.pi_streamer.streaming_protocol}."
-                )
-            self._reset_gcs_host(
-                ip=str(self.pi_streamer.gcs_ip),
-                port=str(self.pi_streamer.gcs_port),
-                streaming_protocol=command_value,
+            if misc_data:
+                raise Exception(f"unexpected fields {list(misc_data)}")
+            return values  # type: ignore
+        except Exception as e:
+            raise Exception(f"Invalid MISC data command : {e}")
+
+    def _parse_stabilize(self, command_value: str) -> bool:
+        return str(command_value).lower().strip() == "start"
+
+    def _parse_gcs_host(self, command_value: str) -> Tuple[str, str]:
+        match = GCS_HOST_PATTERN.match(command_value)
+        if not match:
+            raise Exception("Invalid ip:port host command.")
+        return match.group(1), match.group(2)
+
+    def _parse_port(self, command_value: str) -> str:
+        new_port = str(command_value)
+        if not self.validator.validate_port(new_port):
+            raise Exception(
+                f"Error: {new_port} is not a valid port. It must be between 1 and 65535."
+            )
+        return new_port
+
+    def _parse_ip(self, command_value: str) -> str:
+        new_ip = str(command_value)
+        if not self.validator.validate_ip(new_ip):
+            raise Exception(f"Error: {new_ip} is not a valid IP Address.")
+        return new_ip
+
+    def _parse_streaming_protocol(self, command_value: str) -> str:
+        streaming_protocol = command_value.lower().strip()
+        if not self.validator.validate_streaming_protocol(streaming_protocol):
+            raise Exception(f"Unsupported GCS type {streaming_protocol}.")
+        return streaming_protocol
+
+    def _parse_bitrate(self, command_value: str) -> int:
+        try:
+            bitrate = int(command_value)
+        except ValueError:
+            raise Exception(
+                "Invalid bitrate command. Use 'bitrate <value>' where value is an int 500-10000 kbps."
             )
-        elif command_type == CommandType.BITRATE.value:
+        if not self.validator.validate_bitrate(bitrate):
+            raise Exception(
+                f"Error: {bitrate} is not a valid bitrate. It must be between 500 and 10000 kbps."
+            )
+        print(f"Setting new bitrate: {bitrate} kbps")
+        return bitrate * 1000
+
+    def _parse_count(self, command_value: str) -> int:
+        try:
+            return int(command_value) if command_value else 20
+        except ValueError:
+            raise Exception(
+                f"Invalid count {command_value}. It must be an int, i.e. `command_log 20`."
+            )
+
+    def _parse_stats(self, command_value: str) -> bool:
+        """
+        Returns whether the stats should be reset after they are sent.
+        """
+        action = str(command_value).lower().strip()
+        if action not in ("", "reset"):
+            raise Exception(
+                f"Invalid stats command {command_value}. Use `stats` or `stats reset`."
+            )
+        return action == "reset"
+
+    def _parse_profile(self, command_value: str) -> Optional[ProfileMode]:
+        """
+        Returns the mode to start profiling in, None to stop.
+        """
+        action, _, mode = str(command_value).lower().strip().partition(" ")
+        if action == "stop" and not mode:
+            return None
+        if action == "start":
             try:
-                bitrate = int(command_value)
-                if not self.validator.validate_bitrate(bitrate):
-                    raise Exception(
-                        f"Error: {bitrate} is not a valid bitrate. It must be between 500 and 10000 kbps."
-                    )
-                print(f"Setting new bitrate: {bitrate} kbps")
-                bitrate = bitrate * 1000
-                self._reset_bitrate(bitrate)
-            except (IndexError, ValueError):
-                raise Exception(
-                    "Invalid bitrate command. Use 'bitrate <value>' where value is an int 500-10000 kbps."
-                )
+                return ProfileMode(mode.strip() or ProfileMode.SAMPLE.value)
+            except ValueError:
+                pass
+        raise Exception(
+            f"Invalid profile command {command_value}. Use `profile start`, `profile start cprofile` or `profile stop`."
+        )
+
+    def _parse_memory(self, command_value: str) -> Tuple[MemoryAction, int]:
+        """
+        Returns the action and, for `memory diff`, how many allocation sites to send back.
+        """
+        action, _, count = str(command_value).lower().strip().partition(" ")
+        try:
+            memory_action = MemoryAction(action or MemoryAction.SAMPLE.value)
+            if count and memory_action != MemoryAction.DIFF:
+                raise ValueError
+            return memory_action, int(count) if count else MEMORY_DIFF_COUNT
+        except ValueError:
+            raise Exception(
+                f"Invalid memory command {command_value}. Use `memory`, `memory snapshot`, `memory diff <Optional: count>` or `memory stop`."
+            )
+
+    def _parse_pre_event(self, command_value: str) -> float:
+        try:
+            seconds = float(command_value)
+        except ValueError:
+            raise Exception(
+                f"Invalid pre_event command {command_value}. Use `pre_event <seconds>`, 0 to only keep the current GOP."
+            )
+        record_bitrate = self.pi_streamer.record_bitrate
+        if not self.validator.validate_pre_event(seconds, record_bitrate):
+            max_seconds = PRE_EVENT_MEMORY_BUDGET * 8 / record_bitrate
+            raise Exception(
+                f"Error: {seconds} is not a valid pre_event. It must be between 0 and {max_seconds:.0f} seconds at the recording bitrate."
+            )
+        return seconds
+
+    def _parse_record_bitrate(self, command_value: str) -> int:
+        try:
+            bitrate = int(command_value) * 1000
+        except ValueError:
+            raise Exception(
+                f"Invalid record_bitrate command {command_value}. Use `record_bitrate <kbps>`, i.e. `record_bitrate 8000`."
+            )
+        if not self.validator.validate_record_bitrate(bitrate):
+            raise Exception(
+                f"Error: {command_value} is not a valid record_bitrate. It must be between {RECORD_BITRATE_MIN // 1000} and {RECORD_BITRATE_MAX // 1000} kbps."
+            )
+        seconds = self.pi_streamer.pre_event_buffer.seconds
+        if not self.validator.validate_pre_event(seconds, bitrate):
+            raise Exception(
+                f"Error: {seconds}s of pre_event doesn't fit in memory at {command_value} kbps, lower pre_event first."
+            )
+        return bitrate
+
+    def _parse_record_profile(self, command_value: str) -> Tuple[str, bool]:
+        """
+        Returns the profile and whether to add a silent audio track.
+        """
+        profile, _, audio = str(command_value).lower().strip().partition(" ")
+        if not self.validator.validate_record_profile(profile) or audio.strip() not in (
+            "",
+            "audio",
+        ):
+            raise Exception(
+                f"Invalid record_profile command {command_value}. Use `record_profile <{RecordProfile.MPEG_TS.value}|{RecordProfile.FMP4.value}> <Optional: audio>`."
+            )
+        return profile, bool(audio.strip())
+
+    def _parse_framerate(self, command_value: str) -> Tuple[str, int]:
+        """
+        Returns the sink and its frame rate.
+        """
+        sink, _, framerate = str(command_value).lower().strip().partition(" ")
+        try:
+            fps = int(framerate)
+        except ValueError:
+            fps = 0
+        if not (
+            self.validator.validate_sink(sink)
+            and self.validator.validate_framerate(fps)
+        ):
+            sinks = "|".join(sink_type.value for sink_type in SinkType)
+            raise Exception(
+                f"Invalid framerate command {command_value}. Use `framerate <{sinks}> <fps>` where fps is 1-{FRAMERATE}."
+            )
+        return sink, fps
+
+    def _parse_secondary_stream(self, command_value: str) -> Tuple[str, str, int]:
+        """
+        Returns the ip, port and bitrate, the bitrate is optional in kbps.
+        """
+        match = GCS_HOST_PATTERN.match(command_value)
+        if not match:
+            raise Exception(
+                f"Invalid start_secondary_stream command {command_value}. Use `start_secondary_stream <ip>:<port> <Optional: kbps>`."
+            )
+        ip, port = match.group(1), self._parse_port(match.group(2))
+        if not self.validator.validate_ip(ip):
+            raise Exception(f"Error: {ip} is not a valid IP Address.")
+        kbps = command_value[match.end() :].strip()
+        try:
+            bitrate = int(kbps) * 1000 if kbps else self.pi_streamer.secondary_bitrate
+        except ValueError:
+            bitrate = 0
+        if not self.validator.validate_secondary_bitrate(bitrate):
+            raise Exception(
+                f"Error: {kbps} is not a valid secondary stream bitrate. It must be between {SECONDARY_BITRATE_MIN // 1000} and 10000 kbps."
+            )
+        return ip, port, bitrate
+
+    def _parse_fec(self, command_value: str) -> Tuple[int, int]:
+        """
+        Returns the group size and the interleave, which is optional.
+        """
+        values = str(command_value).split()
+        try:
+            group_size = int(values[0])
+            interleave = int(values[1]) if len(values) > 1 else 1
+        except (IndexError, ValueError):
+            group_size, interleave = -1, 1
+        if len(values) > 2 or not self.validator.validate_fec(group_size, interleave):
+            raise Exception(
+                f"Invalid fec command {command_value}. Use `fec <group_size> <Optional: interleave>` where interleave is 1-{FEC_MAX_INTERLEAVE}, a group spans under {FEC_MAX_SPAN} packets and 0 turns FEC off."
+            )
+        return group_size, interleave
+
+    def _parse_srt(self, command_value: str) -> Tuple[int, int]:
+        """
+        Returns the latency in ms and the retransmission overhead, which is optional.
+        """
+        values = str(command_value).split()
+        try:
+            latency = int(values[0])
+            overhead = (
+                int(values[1])
+                if len(values) > 1
+                else self.pi_streamer.srt_transmitter.overhead_percent
+            )
+        except (IndexError, ValueError):
+            latency, overhead = 0, 0
+        if len(values) > 2 or not self.validator.validate_srt(latency, overhead):
+            raise Exception(
+                f"Invalid srt command {command_value}. Use `srt <latency ms> <Optional: overhead %>` where the latency is {SRT_LATENCY_MIN}-{SRT_LATENCY_MAX} and the overhead {SRT_OVERHEAD_MIN}-{SRT_OVERHEAD_MAX}."
+            )
+        return latency, overhead
+
+    def _parse_keyframe(self, command_value: str) -> bool:
+        """
+        Returns whether the keyframe is for the secondary stream rather than the GCS's.
+        """
+        value = str(command_value).lower().strip()
+        if value not in ("", SinkType.SECONDARY.value):
+            raise Exception(
+                f"Invalid keyframe command {command_value}. Use `keyframe` or `keyframe secondary`."
+            )
+        return value == SinkType.SECONDARY.value
+
+    def _parse_intra_refresh(self, command_value: str) -> bool:
+        value = str(command_value).lower().strip()
+        if value not in ("on", "off"):
+            raise Exception(
+                f"Invalid intra_refresh command {command_value}. Use `intra_refresh on` or `intra_refresh off`."
+            )
+        return value == "on"
+
+    ### ^^^^
+    ### vvvv Handlers
+
+    def _handle_take_photo(self, file_name: str) -> None:
+        print(f"Received photo command {self.is_sd_card_available=} {file_name=}")
+        if self.is_sd_card_available:
+            self.pi_streamer.take_photo(file_name=file_name)
+
+    def _handle_record(self, file_name: str) -> None:
+        print(f"Received record command {self.is_sd_card_available=} {file_name=}")
+        if self.is_sd_card_available:
+            self.pi_streamer.start_recording(file_name=file_name)
+
+    def _handle_stop_recording(self, _: str) -> None:
+        self.pi_streamer.stop_recording()
+
+    def _handle_zoom(self, zoom: Union[str, float]) -> None:
+        if isinstance(zoom, str):
+            self.zoom_status = zoom
+            if zoom == ZoomStatus.STOP.value:
+                self.last_zoom_time = 0
+        else:
+            self.set_zoom(zoom)
+
+    def _handle_max_zoom(self, max_zoom: float) -> None:
+        self.pi_streamer.max_zoom = max_zoom
+        self.set_zoom(MIN_ZOOM)  # reset the zoom back to the original
+
+    def _handle_init_tracking_poi(self, point: Tuple[int, int]) -> None:
+        self.pi_streamer.tracker._init_tracking_poi(
+            x_center=point[0], y_center=point[1]
+        )
+        self.pi_streamer.track_status = TrackStatus.INIT.value
+
+    def _handle_gps_data(self, values: Sequence[int]) -> None:
+        self.pi_streamer.telemetry.add_gps(values, self.received_ns)
+
+    def _handle_misc_data(
+        self, values: Tuple[float, float, str, Tuple[int, int]]
+    ) -> None:
+        self.pi_streamer.telemetry.add_misc(*values, timestamp_ns=self.received_ns)
+
+    def _handle_stabilize(self, stabilize: bool) -> None:
+        self.pi_streamer.stabilize = stabilize
+
+    def _handle_gcs_host(self, host: Tuple[str, str]) -> None:
+        ip, port = host
+        print(f"Setting new GCS host {ip}:{port}")
+        self._reset_gcs_host(ip=ip, port=port)
+
+    def _handle_gcs_port(self, new_port: str) -> None:
+        print(f"Setting new GCS port {new_port}")
+        self._reset_gcs_host(ip=str(self.pi_streamer.gcs_ip), port=new_port)
+
+    def _handle_gcs_ip(self, new_ip: str) -> None:
+        print(f"Setting new GCS IP {new_ip}")
+        self._reset_gcs_host(ip=new_ip, port=str(self.pi_streamer.gcs_port))
+
+    def _handle_start_gcs_stream(self, _: str) -> None:
+        if self.pi_streamer.streaming_protocol == StreamingProtocolType.RTP.value:
+            start_func = self.pi_streamer.start_rtp_stream
+        elif self.pi_streamer.streaming_protocol == StreamingProtocolType.MPEG_TS.value:
+            start_func = self.pi_streamer.start_mpeg_ts_stream
+        elif self.pi_streamer.streaming_protocol == StreamingProtocolType.RTSP.value:
+            start_func = self.pi_streamer.start_rtsp_stream
+        elif self.pi_streamer.streaming_protocol == StreamingProtocolType.SRT.value:
+            start_func = self.pi_streamer.start_srt_stream
         else:
-            raise Exception(f"Unknown command_type: `{command_type}`")
+            raise Exception(
+                f"Unsupported GCS type {self.pi_streamer.streaming_protocol}."
+            )
+        start_func(
+            ip=str(self.pi_streamer.gcs_ip),
+            port=str(self.pi_streamer.gcs_port),
+        )
+
+    def _handle_stop_gcs_stream(self, _: str) -> None:
+        if self.pi_streamer.streaming_protocol == StreamingProtocolType.RTP.value:
+            stop_func = self.pi_streamer.stop_rtp_stream
+        elif self.pi_streamer.streaming_protocol == StreamingProtocolType.MPEG_TS.value:
+            stop_func = self.pi_streamer.stop_mpeg_ts_stream
+        elif self.pi_streamer.streaming_protocol == StreamingProtocolType.RTSP.value:
+            stop_func = self.pi_streamer.stop_rtsp_stream
+        elif self.pi_streamer.streaming_protocol == StreamingProtocolType.SRT.value:
+            stop_func = self.pi_streamer.stop_srt_stream
+        else:
+            raise Exception(
+                f"Unsupported GCS type {self.pi_streamer.streaming_protocol}."
+            )
+        stop_func()
+
+    def _handle_streaming_protocol(self, streaming_protocol: str) -> None:
+        self._reset_gcs_host(
+            ip=str(self.pi_streamer.gcs_ip),
+            port=str(self.pi_streamer.gcs_port),
+            streaming_protocol=streaming_protocol,
+        )
+
+    def _handle_command_log(self, count: int) -> None:
+        self.pi_streamer.command_service.send_data_out(
+            data=f"{OutputCommandType.COMMAND_LOG.value} {json.dumps(self.audit_log.get_recent(count))}"
+        )
+
+    def _handle_stats(self, reset: bool) -> None:
+        stage_stats = self.pi_streamer.stage_stats
+        self.pi_streamer.command_service.send_data_out(
+            data=f"{OutputCommandType.STATS.value} {json.dumps(stage_stats.summary())}"
+        )
+        if reset:
+            stage_stats.reset()
+
+    def _handle_profile(self, mode: Optional[ProfileMode]) -> None:
+        if mode is None:
+            self.send_profile(self.profiler.stop())
+        else:
+            self.profiler.start(mode)
+            print(f"Profiling the stream loop in {mode.value} mode")
+
+    def _handle_memory(self, action_and_count: Tuple[MemoryAction, int]) -> None:
+        action, count = action_and_count
+        memory_monitor = self.pi_streamer.memory_monitor
+        data: Dict[str, Any]
+        if action == MemoryAction.SNAPSHOT:
+            data = {"traced_blocks": memory_monitor.take_snapshot()}
+        elif action == MemoryAction.DIFF:
+            data = {"diff": memory_monitor.diff_snapshot(count)}
+        elif action == MemoryAction.STOP:
+            memory_monitor.stop_tracing()
+            data = {"tracing": False}
+        else:
+            # a sample walks every object, so it is taken on the monitor's thread and
+            # published on the memory topic, the reply is the last finished one
+            memory_monitor.request_sample()
+            data = memory_monitor.latest()
+        self.pi_streamer.command_service.send_data_out(
+            data=f"{OutputCommandType.MEMORY.value} {json.dumps(data)}"
+        )
+
+    def _handle_pre_event(self, seconds: float) -> None:
+        print(f"Buffering {seconds}s before recordings")
+        self.pi_streamer.set_pre_event_seconds(seconds)
+
+    def _handle_record_bitrate(self, bitrate: int) -> None:
+        print(f"Setting new recording bitrate: {bitrate // 1000} kbps")
+        pi_streamer = self.pi_streamer
+        pi_streamer.set_record_settings(
+            bitrate, pi_streamer.record_profile, pi_streamer.record_audio
+        )
+
+    def _handle_record_profile(self, profile_and_audio: Tuple[str, bool]) -> None:
+        profile, audio = profile_and_audio
+        print(f"Recording to {profile} {'with' if audio else 'without'} audio")
+        pi_streamer = self.pi_streamer
+        pi_streamer.set_record_settings(pi_streamer.record_bitrate, profile, audio)
+
+    def _handle_framerate(self, sink_and_framerate: Tuple[str, int]) -> None:
+        sink, framerate = sink_and_framerate
+        print(f"Setting the {sink} frame rate to {framerate} fps")
+        self.pi_streamer.set_sink_framerate(sink, framerate)
+
+    def _handle_fec(self, fec: Tuple[int, int]) -> None:
+        group_size, interleave = fec
+        print(
+            f"Setting RTP FEC to 1 parity packet per {group_size}, interleave {interleave}"
+        )
+        self.pi_streamer.set_fec(group_size, interleave)
+
+    def _handle_srt(self, srt: Tuple[int, int]) -> None:
+        latency, overhead = srt
+        print(f"Setting the SRT latency to {latency} ms, overhead {overhead}%")
+        self.pi_streamer.set_srt(latency, overhead)
+
+    def _handle_keyframe(self, secondary: bool) -> None:
+        self.pi_streamer.request_keyframe(secondary)
+
+    def _handle_intra_refresh(self, intra_refresh: bool) -> None:
+        print(f"Setting intra refresh {'on' if intra_refresh else 'off'}")
+        self.pi_streamer.set_intra_refresh(intra_refresh)
+
+    def _handle_start_secondary_stream(self, host: Tuple[str, str, int]) -> None:
+        ip, port, bitrate = host
+        print(f"Starting secondary stream to {ip}:{port} at {bitrate // 1000} kbps")
+        self.pi_streamer.start_secondary_stream(ip, port, bitrate)
+
+    def _handle_stop_secondary_stream(self, _: str) -> None:
+        self.pi_streamer.stop_secondary_stream()
+
+    def _handle_segments(self, count: int) -> None:
+        segments = self.pi_streamer.segment_index.get_recent(count)
+        self.pi_streamer.command_service.send_data_out(
+            data=f"{OutputCommandType.SEGMENTS.value} {json.dumps(segments)}"
+        )
+
+    def send_profile(self, file_name: str) -> None:
+        print(f"Wrote profile to {file_name}")
+        self.pi_streamer.command_service.send_data_out(
+            data=f"{OutputCommandType.PROFILE.value} {file_name}"
+        )
+
+    ### ^^^^
 
     def _reset_gcs_host(self, ip: str, port: str, streaming_protocol: str = "") -> None:
         """
@@ -254,8 +716,15 @@ class CommandController:
                 == StreamingProtocolType.MPEG_TS.value
             ):
                 self.pi_streamer.start_mpeg_ts_stream(ip=ip, port=port)
+            elif (
+                self.pi_streamer.streaming_protocol == StreamingProtocolType.RTSP.value
+            ):
+                self.pi_streamer.start_rtsp_stream(ip=ip, port=port)
+            elif self.pi_streamer.streaming_protocol == StreamingProtocolType.SRT.value:
+                self.pi_streamer.start_srt_stream(ip=ip, port=port)
             else:
                 raise Exception("Invalid GCS type.")
+            self.pi_streamer.resume_secondary_stream()
 
         except (IndexError, ValueError):
             raise Exception("Invalid ip:port host command.")
@@ -274,11 +743,16 @@ class CommandController:
             start_func = self.pi_streamer.start_rtp_stream
         elif self.pi_streamer.streaming_protocol == StreamingProtocolType.MPEG_TS.value:
             start_func = self.pi_streamer.start_mpeg_ts_stream
+        elif self.pi_streamer.streaming_protocol == StreamingProtocolType.RTSP.value:
+            start_func = self.pi_streamer.start_rtsp_stream
+        elif self.pi_streamer.streaming_protocol == StreamingProtocolType.SRT.value:
+            start_func = self.pi_streamer.start_srt_stream
 
         start_func(
             ip=str(self.pi_streamer.gcs_ip),
             port=str(self.pi_streamer.gcs_port),
         )
+        self.pi_streamer.resume_secondary_stream()
 
     def set_zoom(self, zoom_factor: Union[int, float]) -> None:
         # Adjust the zoom by setting the crop rectangle
@@ -307,6 +781,9 @@ class CommandController:
         self.pi_streamer.command_service.send_data_out(
             data=f"{OutputCommandType.ZOOM_LEVEL.value} {self.current_zoom}"
         )
+        self.pi_streamer.command_service.publish(
+            TelemetryTopic.ZOOM.value, str(self.current_zoom)
+        )
 
         if self.pi_streamer.verbose:
             print(f"Zoom set to {self.current_zoom}x {new_crop}")
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+from time import perf_counter_ns
+from typing import Any, Callable, Dict, List
+
+"""
+Maps each command type to the handler that executes it so the CommandController dispatches a
+command with a single dict lookup. New command types are added by registering a handler.
+"""
+
+
+def _no_parse(command_value: str) -> str:
+    return command_value
+
+
+class CommandHandler:
+    """
+    Binds a command type to its handler. `parse` converts and validates the raw command value
+    and is built once when the handler is registered so the handler only receives typed values.
+    """
+
+    def __init__(
+        self,
+        command_type: str,
+        handle: Callable[[Any], None],
+        parse: Callable[[str], Any] = _no_parse,
+    ) -> None:
+        self.command_type = command_type
+        self.handle = handle
+        self.parse = parse
+        # timing
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def __call__(self, command_value: str) -> None:
+        start_ns = perf_counter_ns()
+        try:
+            self.handle(self.parse(command_value))
+        finally:
+            elapsed_ns = perf_counter_ns() - start_ns
+            self.count += 1
+            self.total_ns += elapsed_ns
+            if elapsed_ns > self.max_ns:
+                self.max_ns = elapsed_ns
+
+    def get_timing(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean_us": round(self.total_ns / self.count / 1000, 1) if self.count else 0,
+            "max_us": round(self.max_ns / 1000, 1),
+        }
+
+
+class CommandRegistry:
+    def __init__(self) -> None:
+        self.handlers: Dict[str, CommandHandler] = {}
+
+    def register(
+        self,
+        command_type: str,
+        handle: Callable[[Any], None],
+        parse: Callable[[str], Any] = _no_parse,
+    ) -> CommandHandler:
+        if command_type in self.handlers:
+            raise Exception(f"A handler is already registered for `{command_type}`")
+        handler = CommandHandler(command_type, handle, parse)
+        self.handlers[command_type] = handler
+        return handler
+
+    def dispatch(self, command_type: str, command_value: str = "") -> None:
+        handler = self.handlers.get(command_type)
+        if handler is None:
+            raise Exception(f"Unknown command_type: `{command_type}`")
+        handler(command_value)
+
+    def get_command_types(self) -> List[str]:
+        return list(self.handlers)
+
+    def get_timings(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the per handler timings of every command type that has been dispatched.
+        """
+        return {
+            command_type: handler.get_timing()
+            for command_type, handler in self.handlers.items()
+            if handler.count
+        }
@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
 
-from typing import Tuple, List, Any
+from typing import Dict, Optional, Tuple, List
+
+from constants import (
+    COALESCED_COMMAND_TYPES,
+    TELEMETRY_COMMAND_TYPES,
+    CommandType,
+    ZoomStatus,
+)
+from telemetry_buffer import get_telemetry_timestamp_ns
 
 """
 Commands are communicated to the pistreamer app through either through a dedicated socket host:port
@@ -8,13 +16,23 @@ or a similar process called ZeroMQ. Status and other data is returned back to th
 through the same protocol but a different connection.
 """
 
+# (command_type, command_value, when it was received), the time is CLOCK_BOOTTIME ns so
+# GPS and MISC data are placed in the telemetry history when they arrived
+Command = Tuple[str, str, int]
+
 
 class CommandService:
-    def _get_commands_from_data(self, data: str) -> List[Any]:
-        commands: List[Any] = []
+    def __init__(self) -> None:
+        # Counters for the latest-wins coalescing of command batches
+        self.commands_received = 0
+        self.commands_collapsed = 0
+
+    def _get_commands_from_data(self, data: str, received_ns: int = 0) -> List[Command]:
+        commands: List[Command] = []
 
         if not data:
             return commands
+        received_ns = received_ns or get_telemetry_timestamp_ns()
 
         decoded_data = str(data).split("\n")
         decoded_data = [str(item).strip() for item in decoded_data if item]
@@ -40,12 +58,78 @@ class CommandService:
                 (
                     command_type,
                     command_value,
+                    received_ns,
                 )
             )
         return commands
 
+    def _get_coalesce_key(self, command_type: str, command_value: str) -> Optional[str]:
+        """
+        Returns the key under which a command is coalesced or None if the command must be
+        handled in order. Zoom directions and absolute zoom factors are separate state so
+        `zoom in` followed by `zoom 2.0` keeps both, like the two streams' keyframes.
+        """
+        if command_type not in COALESCED_COMMAND_TYPES:
+            return None
+        if command_type == CommandType.ZOOM.value and command_value.lower() in (
+            ZoomStatus.IN.value,
+            ZoomStatus.OUT.value,
+            ZoomStatus.STOP.value,
+        ):
+            return f"{command_type}_status"
+        if command_type == CommandType.KEYFRAME.value:
+            return f"{command_type}_{command_value.lower()}"  # the GCS's or the secondary's
+        return command_type
+
+    def _coalesce_commands(self, commands: List[Command]) -> List[Command]:
+        """
+        Collapses a batch so that each state-setting command only keeps its newest value,
+        at the position of that newest value. Any other command (i.e. take_photo, record)
+        is a barrier that nothing is coalesced across, so a zoom sent before a photo is
+        still applied before the photo is taken. GPS and MISC data are neither, every
+        sample is kept for the telemetry history.
+        """
+        self.commands_received += len(commands)
+        if len(commands) < 2:
+            return commands
+
+        coalesced: List[Optional[Command]] = []
+        latest_index: Dict[str, int] = {}
+        for command in commands:
+            if command[0] in TELEMETRY_COMMAND_TYPES:
+                coalesced.append(command)
+                continue
+            key = self._get_coalesce_key(command[0], command[1])
+            if key is None:
+                latest_index.clear()
+            else:
+                previous_index = latest_index.get(key)
+                if previous_index is not None:
+                    coalesced[previous_index] = None
+                    self.commands_collapsed += 1
+                latest_index[key] = len(coalesced)
+            coalesced.append(command)
+
+        return [command for command in coalesced if command is not None]
+
+    def get_coalesced_commands(self) -> List[Command]:
+        """
+        Returns the pending commands with superseded state-setting commands removed.
+        """
+        return self._coalesce_commands(self.get_pending_commands())
+
     def send_data_out(self, data: str) -> None:
         raise NotImplementedError()
 
-    def get_pending_commands(self) -> List[Tuple[str, str]]:
+    def publish(self, topic: str, data: str) -> None:
+        """
+        Queues high-rate telemetry (see TelemetryTopic) for the dedicated output channel.
+        Services without such a channel drop it so the stream loop never has to check.
+        """
+        pass
+
+    def flush_telemetry(self) -> None:
+        pass
+
+    def get_pending_commands(self) -> List[Command]:
         raise NotImplementedError()
@@ -15,6 +15,7 @@ CMD_SOCKET_HOST = "0.0.0.0"
 OUTPUT_SOCKET_HOST = "localhost"
 CMD_SOCKET_PORT = 54321
 OUTPUT_SOCKET_PORT = 54322
+TELEMETRY_SEND_HWM = 100  # per subscriber, telemetry is dropped rather than blocking
 MAX_SOCKET_CONNECTIONS = 3
 INIT_BBOX_COLOR = (128, 128, 128)  # Grey color in BGR
 ACTIVE_BBOX_COLOR = (0, 0, 255)  # Red color in BGR
@@ -29,6 +30,99 @@ SD_CARD_MOUNTED_LOCATION: Final = "/mnt/external_sd"
 MEDIA_FILES_DIRECTORY: Final = f"{SD_CARD_MOUNTED_LOCATION}/DCIM"
 MICROHARD_DEFAULT_IP: Final = "192.168.168.1"
 GPIO_LOW: Final = 1  # the SBX board inverts this logic
+TELEMETRY_BUFFER_SIZE: Final = 512  # GPS/attitude samples kept, ~10s at 50 Hz
+# seconds past the newest GPS/attitude sample the telemetry is extrapolated, then held
+TELEMETRY_MAX_EXTRAPOLATION: Final = 1.0
+PHOTO_GEOTAG_TIMEOUT: Final = 2.0  # seconds a photo waits for telemetry after it
+# received commands waiting for the stream loop
+COMMAND_RECEIVE_QUEUE_SIZE: Final = 1000
+COMMAND_LOG_FILE: Final = "/tmp/command.log"
+COMMAND_LOG_MAX_BYTES: Final = 256 * 1024  # rotate before the log takes up more tmpfs
+COMMAND_LOG_BACKUP_COUNT: Final = 1
+COMMAND_LOG_RING_SIZE: Final = 500  # most recent commands kept in memory
+COMMAND_LOG_PENDING_SIZE: Final = 5000  # commands waiting to be written to the file
+COMMAND_LOG_FLUSH_INTERVAL: Final = 1.0  # seconds
+FRAME_INDEX_EXTENSION: Final = ".idx"  # per-frame sidecar written next to recordings
+FRAME_INDEX_BUFFER_FRAMES: Final = 64  # records buffered between writes, ~2s at 30 fps
+# Upper bounds (microseconds) of the frame stage timing histogram buckets, the last bucket
+# counts everything slower
+STAGE_HISTOGRAM_BUCKETS_US: Final = (
+    100,
+    250,
+    500,
+    1000,
+    2500,
+    5000,
+    10000,
+    20000,
+    33333,  # one frame at 30 fps
+    50000,
+    100000,
+)
+STATS_PUBLISH_INTERVAL: Final = 5.0  # seconds between stats telemetry messages
+PROFILE_DIRECTORY: Final = "/tmp"
+PROFILE_SAMPLE_INTERVAL: Final = 0.01  # seconds, 100 Hz
+PROFILE_MAX_DURATION: Final = 300.0  # seconds, a forgotten profile stops by itself
+MEMORY_SAMPLE_INTERVAL: Final = 60.0  # seconds, a sample walks every Python object
+MEMORY_HISTORY_SIZE: Final = 120  # samples kept, 2 hours at the default interval
+MEMORY_REFERENTS_CHUNK: Final = 10000  # objects whose referents are fetched at a time
+# traceback depth, deeper costs more memory and CPU
+MEMORY_TRACEMALLOC_FRAMES: Final = 1
+MEMORY_DIFF_COUNT: Final = 10  # allocation sites sent back by `memory diff`
+ENCODER_QUEUE_FRAMES: Final = 8  # frames queued per encoder before frames are dropped
+ENCODER_STALL_TIMEOUT: Final = 2.0  # seconds a pipe write may block before a restart
+ENCODER_RESTART_BACKOFF: Final = 0.5  # seconds, doubled for each consecutive failure
+ENCODER_RESTART_BACKOFF_MAX: Final = 30.0  # seconds
+ENCODER_HEALTHY_TIME: Final = 10.0  # seconds running before the backoff is reset
+ENCODER_STOP_TIMEOUT: Final = 5.0  # seconds ffmpeg gets to flush on stop before a kill
+ENCODER_READ_SIZE: Final = 65536  # bytes read at a time from an encoder's stdout
+ENCODER_KEYFRAME_INTERVAL: Final = 1.0  # seconds, the encoders' GOP is their frame rate
+KEYFRAME_REQUEST_INTERVAL: Final = 0.5  # seconds between keyframes forced for joiners
+HARDWARE_ENCODER_DEVICE: Final = "/dev/video11"  # the Pi's H.264 encoder, h264_v4l2m2m
+RECORD_BITRATE: Final = 1000000  # bits per second of the recording, `record_bitrate`
+RECORD_BITRATE_MIN: Final = 500000  # bits per second
+RECORD_BITRATE_MAX: Final = 25000000  # bits per second, the encoder's level 4.1 limit
+YUV420_WIDTH_ALIGNMENT: Final = 64  # so the ISP's YUV420 rows have no padding
+SECONDARY_BITRATE: Final = 500000  # bits per second of the simulcast stream
+SECONDARY_BITRATE_MIN: Final = 100000  # bits per second, below `bitrate` for slow links
+RTSP_PORT: Final = 8554  # `streaming_protocol rtsp` serves rtsp://<pi>:8554/stream
+RTSP_RELAY_PORT: Final = 5610  # loopback port the encoder sends its RTP to
+RTSP_SERVER_RTP_PORT: Final = 5612  # and 5613 for RTCP, the source of UDP viewers' RTP
+RTSP_MAX_CLIENTS: Final = 8  # RTSP connections served at once, more are closed
+RTSP_IDLE_TIMEOUT: Final = 5.0  # seconds the encoder keeps running without viewers
+RTSP_SESSION_TIMEOUT: Final = 60.0  # seconds a UDP viewer is kept without a keep-alive
+RTSP_SEND_TIMEOUT: Final = 0.5  # seconds a TCP viewer may block before it is dropped
+RTSP_TCP_QUEUE_PACKETS: Final = 256  # queued for a TCP viewer before it is dropped
+FEC_RELAY_PORT: Final = 5614  # loopback port the RTP encoder sends to with `fec` on
+FEC_PORT_OFFSET: Final = 2  # parity goes to gcs_port + 2, gcs_port + 1 is RTCP
+FEC_PAYLOAD_TYPE: Final = 127  # of the parity packets, the video's is 96
+FEC_MAX_SPAN: Final = 48  # packets a parity packet can cover, the long ULPFEC mask
+FEC_MAX_INTERLEAVE: Final = 8
+# seconds a parity group stays open, about a frame at 30 fps
+FEC_MAX_DELAY: Final = 0.035
+FEC_DECODER_HISTORY: Final = 1024  # packets the receiver keeps for recovery
+SRT_RELAY_PORT: Final = 5620  # loopback port the MPEG-TS encoder sends to over SRT
+SRT_PAYLOAD_SIZE: Final = 1316  # 7 TS packets, the most an SRT packet carries
+SRT_LATENCY: Final = 120  # ms to retransmit in, libsrt's default, ~4 x the link's RTT
+SRT_LATENCY_MIN: Final = 20
+SRT_LATENCY_MAX: Final = 8000
+SRT_OVERHEAD: Final = 25  # % of the bitrate retransmissions may add, libsrt's default
+SRT_OVERHEAD_MIN: Final = 5
+SRT_OVERHEAD_MAX: Final = 100
+SRT_STATS_PACKETS: Final = 200  # srt-live-transmit reports its stats every 200 packets
+SRT_STATS_TIMEOUT: Final = 5.0  # seconds without stats before SRT is disconnected
+SRT_RESTART_BACKOFF: Final = 2.0  # seconds before srt-live-transmit is restarted
+SINK_FRAME_REPEAT_LIMIT: Final = 1  # frames repeated to fill missed slots, then resync
+PRE_EVENT_SECONDS: Final = 5.0  # seconds from before `record` that are recorded too
+PRE_EVENT_MEMORY_BUDGET: Final = 16 * 1024 * 1024  # bytes, 13s at 10 Mbps
+# bytes waiting for the SD card before the recording encoder's output is held back
+PRE_EVENT_WRITE_BACKLOG: Final = 32 * 1024 * 1024
+RECORD_SEGMENT_SECONDS: Final = 300.0  # recordings roll to a new file after this long
+RECORD_SEGMENT_BYTES: Final = 512 * 1024 * 1024  # or this size, well under FAT32's 4 GB
+SEGMENT_INDEX_FILE: Final = f"{MEDIA_FILES_DIRECTORY}/segments.json"
+STORAGE_CHECK_INTERVAL: Final = 5.0  # seconds between free space checks
+STORAGE_MIN_FREE_BYTES: Final = 512 * 1024 * 1024  # the oldest segments go below this
+STORAGE_RESERVED_BYTES: Final = 64 * 1024 * 1024  # recording stops below this
 
 
 class CommandType(Enum):
@@ -56,6 +150,53 @@ class CommandType(Enum):
     STOP_TRACKING = "stop_tracking"
     GPS_DATA = "gps_data"  # `gps_data '{"lat": 359686990, "lon": -839290440, "alt": 276, "eph": 1, "epv": 1, "vel": 0, "cog": 0, "fix_type": 2, "satellites_visible": 10, "time_usec": 1730920262680000}'` is an example
     MISC_DATA = "misc_data"  # `misc_data '{"pitch": 0.1, "roll": 0.02, "camera_model": "IMX477", "focal_length": [50, 1]}'` is an example
+    GPS_DATA_BIN = "gps_data_bin"  # base64 packed GPS_DATA, see mavlink_codec.py
+    MISC_DATA_BIN = "misc_data_bin"  # base64 packed MISC_DATA, see mavlink_codec.py
+    COMMAND_LOG = "command_log"  # `command_log 20` sends back the last 20 commands
+    STATS = "stats"  # `stats` sends back frame timings, `stats reset` clears them
+    PROFILE = "profile"  # `profile start`, `profile start cprofile`, `profile stop`
+    MEMORY = "memory"  # `memory`, `memory snapshot`, `memory diff 10`, `memory stop`
+    PRE_EVENT = "pre_event"  # `pre_event 10` records the 10 seconds before `record`
+    SEGMENTS = "segments"  # `segments 20` sends back the 20 newest recording segments
+    # `record_bitrate 8000` in kbps, apart from `bitrate`
+    RECORD_BITRATE = "record_bitrate"
+    RECORD_PROFILE = "record_profile"  # `record_profile fmp4`, add ` audio` for audio
+    FRAMERATE = "framerate"  # `framerate rtp 15` sets the frame rate of one sink
+    START_SECONDARY_STREAM = "start_secondary_stream"  # `... 192.168.1.51:5602 300`
+    STOP_SECONDARY_STREAM = "stop_secondary_stream"
+    FEC = "fec"  # `fec 8` a parity packet per 8 RTP packets, `fec 8 4` interleaved, `fec 0`
+    # `srt 250` latency in ms, `srt 250 50` with 50% retransmission overhead
+    SRT = "srt"
+    KEYFRAME = "keyframe"  # sent by a GCS joining the stream, for an IDR now
+    INTRA_REFRESH = "intra_refresh"  # `intra_refresh on` or `intra_refresh off`
+
+
+# State-setting commands where only the newest value of a batch needs to be handled. Every
+# other command type is handled strictly in order (see CommandService._coalesce_commands).
+COALESCED_COMMAND_TYPES: Final = frozenset(
+    {
+        CommandType.ZOOM.value,
+        CommandType.MAX_ZOOM.value,
+        CommandType.STABILIZE.value,
+        CommandType.BITRATE.value,
+        CommandType.PRE_EVENT.value,
+        CommandType.RECORD_BITRATE.value,
+        CommandType.RECORD_PROFILE.value,
+        CommandType.FEC.value,
+        CommandType.SRT.value,
+        CommandType.INTRA_REFRESH.value,
+        CommandType.KEYFRAME.value,
+    }
+)
+# Samples for the telemetry history, each one is kept but they don't order the others
+TELEMETRY_COMMAND_TYPES: Final = frozenset(
+    {
+        CommandType.GPS_DATA.value,
+        CommandType.MISC_DATA.value,
+        CommandType.GPS_DATA_BIN.value,
+        CommandType.MISC_DATA_BIN.value,
+    }
+)
 
 
 class OutputCommandType(Enum):
@@ -64,6 +205,113 @@ class OutputCommandType(Enum):
     """
 
     ZOOM_LEVEL = "zoomLevel"  # defined at https://mavlink.io/en/messages/common.html#CAMERA_SETTINGS
+    COMMAND_LOG = "commandLog"  # json list of the last handled commands
+    STATS = "stats"  # json of the frame stage timings and counters
+    PROFILE = "profile"  # path of the written profile when profiling stops
+    MEMORY = "memory"  # json of a memory sample, snapshot or snapshot diff
+    SEGMENTS = "segments"  # json list of recording segments, oldest first
+
+
+class TelemetryTopic(Enum):
+    """
+    Topics pistreamer publishes on the ZeroMQ telemetry (PUB) socket bound to OUTPUT_SOCKET_PORT.
+    Each message is a single frame `<topic> <value>` so subscribers can filter by topic prefix
+    and set ZMQ_CONFLATE to only ever receive the latest value.
+    """
+
+    ZOOM = "zoom"  # `zoom 2.5`
+    FPS = "fps"  # `fps 29.8`
+    ENCODER = "encoder"  # `encoder {"protocol": "rtp", "bitrate": 2000000, ...}`
+    RECORDING = "recording"  # `recording {"active": true, "duration": 12}`
+    TRACKING = "tracking"  # `tracking 560,290,40,32` or `tracking ` when not tracking
+    COMMANDS = "commands"  # `commands {"received": 120, "collapsed": 95}`
+    STATS = "stats"  # `stats {"stages": {...}, "counters": {...}}` every few seconds
+    MEMORY = "memory"  # `memory {"rss_kb": 81234, "ndarrays": 12, ...}` every minute
+    ENCODER_HEALTH = "encoder_health"  # `encoder_health {"rtp": {"restarts": 1, ...}}`
+    STORAGE = "storage"  # `storage {"free_mb": 1024, "segments": 12, "deleted": 0}`
+    SRT = "srt"  # `srt {"rtt_ms": 42.5, "retransmitted": 12, ...}` while streaming SRT
+
+
+class FrameStage(Enum):
+    """
+    The stages of the stream loop that are timed for each frame, see stage_stats.py
+    """
+
+    CAPTURE = "capture"
+    COMMANDS = "commands"
+    TRACKING = "tracking"
+    STABILIZE = "stabilize"
+    CONVERT = "convert"  # colour conversion to YUV420
+    OVERLAY = "overlay"  # zoom level and REC overlays
+    WRITE_RECORD = "write_record"
+    WRITE_RTP = "write_rtp"
+    WRITE_MPEG_TS = "write_mpeg_ts"
+    WRITE_SECONDARY = "write_secondary"  # the simulcast stream, scaling included
+    WRITE_RTSP = "write_rtsp"
+    FRAME = "frame"  # the whole loop iteration
+
+
+class ProfileMode(Enum):
+    """
+    How `profile start` profiles the stream loop, see profiler.py
+    """
+
+    SAMPLE = "sample"  # stack sampling, collapsed stacks for flame graphs
+    CPROFILE = "cprofile"  # deterministic, for short windows only
+
+
+class MemoryAction(Enum):
+    """
+    What the `memory` command does, see memory_monitor.py
+    """
+
+    SAMPLE = "sample"  # the default, sends back a sample taken now
+    SNAPSHOT = "snapshot"  # starts tracemalloc and takes the snapshot to diff against
+    DIFF = "diff"  # the allocation sites that grew since the last snapshot
+    STOP = "stop"  # stops tracemalloc
+
+
+class SinkType(Enum):
+    """
+    The encoders each frame is fanned out to, each at its own frame rate (see
+    frame_decimator.py)
+    """
+
+    RECORD = "record"
+    RTP = "rtp"
+    MPEG_TS = "mpegts"
+    SECONDARY = "secondary"  # the low bitrate simulcast stream
+    RTSP = "rtsp"  # only running while there are RTSP viewers
+
+
+class EncoderState(Enum):
+    """
+    State of an ffmpeg process owned by an EncoderSupervisor, see encoder_supervisor.py
+    """
+
+    STOPPED = "stopped"
+    STARTING = "starting"  # being spawned on the supervisor's thread
+    RUNNING = "running"
+    RESTARTING = "restarting"  # failed, waiting for the backoff to restart it
+
+
+class EncoderBackend(Enum):
+    """
+    What runs the encoder commands of ffmpeg_configs.py, `encoder_backend`
+    """
+
+    FFMPEG = "ffmpeg"  # an ffmpeg process per sink, fed through a pipe
+    PYAV = "pyav"  # encoded and muxed in this process, see pyav_encoder.py
+
+
+class RecordProfile(Enum):
+    """
+    The container recordings are written in, see get_ffmpeg_command_record. Both can be
+    played up to the last keyframe when the power is cut mid-recording.
+    """
+
+    MPEG_TS = "mpegts"  # .ts, the default
+    FMP4 = "fmp4"  # .mp4, fragmented at every keyframe
 
 
 class ZoomStatus(Enum):
@@ -86,6 +334,8 @@ class StreamingProtocolType(Enum):
 
     RTP = "rtp"  # Used for QGroundControl
     MPEG_TS = "mpegts"  # Used for Android (Tactical Assault/Team Awareness) Kit
+    RTSP = "rtsp"  # Pulled by any number of viewers, see rtsp_server.py
+    SRT = "srt"  # MPEG-TS over SRT for lossy links, see srt_transmitter.py
 
 
 class CommandProtocolType(Enum):
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+
+import queue
+import subprocess
+import threading
+from time import monotonic
+from typing import Any, Callable, Dict, Optional, Union
+from constants import (
+    ENCODER_HEALTHY_TIME,
+    ENCODER_KEYFRAME_INTERVAL,
+    ENCODER_READ_SIZE,
+    ENCODER_QUEUE_FRAMES,
+    ENCODER_RESTART_BACKOFF,
+    ENCODER_RESTART_BACKOFF_MAX,
+    ENCODER_STALL_TIMEOUT,
+    ENCODER_STOP_TIMEOUT,
+    KEYFRAME_REQUEST_INTERVAL,
+    EncoderState,
+)
+
+"""
+Owns the ffmpeg process of one sink (recording, RTP or MPEG-TS). Frames are handed to a
+writer thread through a short queue so a slow or hung encoder drops frames instead of
+blocking the stream loop, and a dead or hung encoder is restarted with an exponential
+backoff while capture and the other sinks keep running. An encoder writing to its stdout
+(the recording) is read on another thread. Spawning, stopping and killing a process (which
+waits for it to flush and exit) run in order on the supervisor's own thread, so the stream
+loop never waits for an encoder. With the pyav backend the process is a PyAvEncoderProcess
+encoding in this process instead, which request_keyframe asks for an IDR in place. ffmpeg
+can't be asked for one while it runs, so it is restarted as a new encoder opens with an IDR.
+"""
+
+# a raw YUV420 frame, or a view of an array that isn't changed once written
+Frame = Union[bytes, memoryview]
+
+
+class EncoderSupervisor:
+    def __init__(
+        self,
+        sink: str,
+        spawn: Callable[[], Any],
+        on_stop: Optional[Callable[[], None]] = None,
+        on_output: Optional[Callable[[bytes], None]] = None,
+        queue_frames: int = ENCODER_QUEUE_FRAMES,
+        stall_timeout: float = ENCODER_STALL_TIMEOUT,
+        restart_backoff: float = ENCODER_RESTART_BACKOFF,
+        restart_backoff_max: float = ENCODER_RESTART_BACKOFF_MAX,
+        healthy_time: float = ENCODER_HEALTHY_TIME,
+        stop_timeout: float = ENCODER_STOP_TIMEOUT,
+        keyframe_interval: float = ENCODER_KEYFRAME_INTERVAL,
+        keyframe_request_interval: float = KEYFRAME_REQUEST_INTERVAL,
+    ) -> None:
+        """
+        spawn starts the process (a Popen with stdin=PIPE) and is called again for every
+        restart. on_stop is called once stdin is closed, to close any other inputs so
+        ffmpeg can exit. If on_output is set the process has stdout=PIPE, what it writes
+        is passed to on_output from a reader thread.
+        """
+        self.sink = sink
+        self.spawn = spawn
+        self.on_stop = on_stop
+        self.on_output = on_output
+        self.queue_frames = queue_frames
+        self.stall_timeout = stall_timeout
+        self.restart_backoff = restart_backoff
+        self.restart_backoff_max = restart_backoff_max
+        self.healthy_time = healthy_time
+        self.stop_timeout = stop_timeout
+        self.keyframe_interval = keyframe_interval
+        self.keyframe_request_interval = keyframe_request_interval
+        self.state = EncoderState.STOPPED
+        self.process: Any = None
+        # counted over the life of pistreamer, not per start
+        self.restarts = 0
+        self.consecutive_failures = 0
+        self.last_failure = ""
+        self.downtime = 0.0  # seconds spent restarting
+        self.dropped_frames = 0
+        self.frames_written = 0
+        self.started_time = 0.0
+        self.failed_time = 0.0
+        self.restart_time = 0.0
+        self.start_time = 0.0
+        self.first_frame_latency = 0.0  # seconds from start() to ffmpeg reading a frame
+        self.keyframe_restarts = 0
+        self.launches = 0  # processes spawned, counted before the spawn
+        self.keyframes_forced = 0  # IDRs forced in place, by a PyAvEncoderProcess
+        self.intra_refresh = False  # no scheduled IDRs, see get_stream_encoder_args
+        self.launch_time = 0.0
+        self.launch_latency = 0.0  # seconds from the last launch to its first frame
+        self.keyframe_time = (
+            0.0  # when the process read its first frame or an IDR was forced
+        )
+        self._keyframe_wanted = (
+            False  # requested, forced once KEYFRAME_REQUEST_INTERVAL passed
+        )
+        self._keyframe_restart = True  # whether the request may restart ffmpeg
+        self._frames: "queue.Queue[Optional[Frame]]" = queue.Queue(queue_frames)
+        self._writer: Optional[threading.Thread] = None
+        self._reader: Optional[threading.Thread] = None
+        self._write_started = 0.0  # when the write in progress started, 0 if idle
+        # held for the state changes made on the supervisor's thread
+        self._lock = threading.Lock()
+        self._tasks: "queue.Queue[Callable[[], None]]" = queue.Queue()
+        self._control: Optional[threading.Thread] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self.state == EncoderState.RUNNING
+
+    def start(self) -> None:
+        if self.state != EncoderState.STOPPED:
+            raise Exception(f"The {self.sink} encoder is already started")
+        self.consecutive_failures = 0
+        self.start_time = monotonic()
+        self.first_frame_latency = 0.0
+        self.state = EncoderState.STARTING
+        self._submit(self._launch)
+
+    def _submit(self, task: Callable[[], None]) -> None:
+        """
+        Runs task on the supervisor's thread after the tasks before it, so a process is
+        stopped, with its output read and its pipes closed, before the next is spawned.
+        """
+        if self._control is None:
+            self._control = threading.Thread(
+                target=self._control_loop,
+                name=f"{self.sink}-encoder-control",
+                daemon=True,
+            )
+            self._control.start()
+        self._tasks.put(task)
+
+    def _control_loop(self) -> None:
+        while True:
+            task = self._tasks.get()
+            try:
+                task()
+            except Exception as e:
+                print(f"The {self.sink} encoder supervisor failed: {e}")
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits for the starts and stops queued so far, i.e. for ffmpeg to exit after stop().
+        Returns False if they didn't finish within timeout.
+        """
+        if self._control is None:
+            return True
+        done = threading.Event()
+        self._submit(done.set)
+        return done.wait(timeout)
+
+    def _launch(self) -> None:
+        """
+        On the supervisor's thread, unless the encoder was stopped since it was queued.
+        """
+        if self.state != EncoderState.STARTING:
+            return
+        self.launch_time = monotonic()
+        self.keyframe_time = 0.0
+        self.launches += 1
+        try:
+            self.process = self.spawn()
+        except Exception as e:
+            with self._lock:
+                if self.state == EncoderState.STARTING:
+                    self._fail(f"failed to start: {e}", monotonic())
+            return
+        # A queue per process so frames queued for a failed process are discarded
+        self._frames = queue.Queue(self.queue_frames)
+        self._write_started = 0.0
+        self._writer = threading.Thread(
+            target=self._write_loop,
+            args=(self.process.stdin, self._frames),
+            name=f"{self.sink}-encoder-writer",
+            daemon=True,
+        )
+        self._writer.start()
+        if self.on_output:
+            self._reader = threading.Thread(
+                target=self._read_loop,
+                args=(self.process.stdout, self.on_output),
+                name=f"{self.sink}-encoder-reader",
+                daemon=True,
+            )
+            self._reader.start()
+        self.started_time = monotonic()
+        with self._lock:
+            # if it was stopped meanwhile, the stop queued after this closes the process
+            if self.state == EncoderState.STARTING:
+                self.state = EncoderState.RUNNING
+
+    def _write_loop(self, stdin: Any, frames: "queue.Queue[Optional[Frame]]") -> None:
+        while True:
+            frame = frames.get()
+            if frame is None:
+                return
+            self._write_started = monotonic()
+            try:
+                stdin.write(frame)
+            except (OSError, ValueError):
+                return  # the process exited or was killed, check() restarts it
+            finally:
+                self._write_started = 0.0
+            self.frames_written += 1
+            if not self.keyframe_time:
+                self.keyframe_time = monotonic()
+                self.launch_latency = self.keyframe_time - self.launch_time
+            if not self.first_frame_latency:
+                self.first_frame_latency = monotonic() - self.start_time
+
+    def _read_loop(self, stdout: Any, on_output: Callable[[bytes], None]) -> None:
+        while True:
+            try:
+                data = stdout.read1(ENCODER_READ_SIZE)
+            except (OSError, ValueError):
+                return
+            if not data:
+                return  # the process exited
+            on_output(data)
+
+    def write(self, frame: Frame) -> bool:
+        """
+        Queues a frame without blocking. Returns False if it was dropped, either because
+        the encoder is restarting or because it is behind.
+        """
+        if self.state == EncoderState.STOPPED:
+            return False
+        if self._keyframe_wanted:
+            self._force_keyframe()
+        if self.state == EncoderState.RUNNING:
+            try:
+                self._frames.put_nowait(frame)
+                return True
+            except queue.Full:
+                pass
+        self.dropped_frames += 1
+        return False
+
+    def request_keyframe(self, restart: bool = True) -> None:
+        """
+        For a receiver joining the stream, which can't decode it until the next IDR.
+        Requests within keyframe_request_interval of the last IDR are coalesced into one
+        forced once the interval has passed, by the next write(). ffmpeg is only restarted
+        if restart is set, i.e. no other viewer would see the gap, and unless its next
+        scheduled IDR comes sooner than the last launch took.
+        """
+        self._keyframe_wanted = True
+        self._keyframe_restart = restart
+        self._force_keyframe()
+
+    def _force_keyframe(self) -> None:
+        if self.state != EncoderState.RUNNING or not self.keyframe_time:
+            # starting or restarting, its first frame is an IDR
+            self._keyframe_wanted = False
+            return
+        now = monotonic()
+        since_keyframe = now - self.keyframe_time
+        if since_keyframe < self.keyframe_request_interval:
+            return  # still wanted
+        self._keyframe_wanted = False
+        force = getattr(self.process, "request_keyframe", None)
+        if force is not None:
+            force()
+            self.keyframes_forced += 1
+            self.keyframe_time = now  # the GOP starts again from it
+            return
+        if not self._keyframe_restart:
+            return  # the joiner waits for the next scheduled IDR or intra refresh
+        # with intra refresh there are no scheduled IDRs to wait for
+        if not self.intra_refresh:
+            until_keyframe = (
+                self.keyframe_interval - since_keyframe % self.keyframe_interval
+            )
+            if until_keyframe <= self.launch_latency:
+                return
+        print(f"Restarting the {self.sink} encoder for a keyframe")
+        self.keyframe_restarts += 1
+        self.state = EncoderState.STARTING
+        self._submit(lambda: self._close_process(kill=True))
+        self._submit(self._launch)
+
+    def check(self) -> Optional[str]:
+        """
+        Called from the stream loop. Restarts the encoder once its backoff has passed and
+        returns why it failed if it has just failed.
+        """
+        now = monotonic()
+        if self.state == EncoderState.RESTARTING:
+            if now >= self.restart_time:
+                self.downtime += now - self.failed_time
+                self.restarts += 1
+                print(f"Restarting the {self.sink} encoder ({self.restarts})")
+                self.state = EncoderState.STARTING
+                self._submit(self._launch)
+            return None
+        if self.state != EncoderState.RUNNING:
+            return None
+
+        write_started = self._write_started
+        failed_time = now
+        if self.process.poll() is not None:
+            reason = f"exited with {self.process.returncode}"
+        elif write_started and now - write_started > self.stall_timeout:
+            reason = f"stalled, a write blocked for over {self.stall_timeout}s"
+            failed_time = write_started  # the downtime includes the stall
+        elif not self._writer.is_alive():  # type: ignore
+            reason = "stdin closed"
+        else:
+            if (
+                self.consecutive_failures
+                and now - self.started_time > self.healthy_time
+            ):
+                self.consecutive_failures = 0
+            return None
+        return self._fail(reason, failed_time)
+
+    def _fail(self, reason: str, failed_time: float) -> str:
+        backoff = min(
+            self.restart_backoff * 2**self.consecutive_failures,
+            self.restart_backoff_max,
+        )
+        print(f"The {self.sink} encoder {reason}, restarting in {backoff}s")
+        if self.state == EncoderState.RUNNING:
+            self._submit(lambda: self._close_process(kill=True))
+        self.consecutive_failures += 1
+        self.last_failure = reason
+        self.failed_time = failed_time
+        self.restart_time = monotonic() + backoff
+        self.state = EncoderState.RESTARTING
+        return reason
+
+    def _close_process(self, kill: bool = False) -> None:
+        """
+        Closes stdin so ffmpeg flushes and exits, or kills it first if it failed or the
+        writer is stuck in a write. On the supervisor's thread.
+        """
+        process = self.process
+        if process is None:
+            return  # it failed to start, or stop() came before it was spawned
+        if kill or (self._writer and self._writer.is_alive()):
+            try:
+                process.kill()
+            except OSError:
+                pass  # already exited
+            try:
+                self._frames.put_nowait(None)  # wakes a writer waiting for a frame
+            except queue.Full:
+                pass  # it is in a write, which fails now the process is dead
+        if self._writer:
+            self._writer.join(self.stop_timeout)
+            self._writer = None
+        try:
+            if process.stdin:
+                process.stdin.close()
+        except OSError:
+            pass  # the unflushed part of a frame can't be written to a dead process
+        if self.on_stop:
+            self.on_stop()
+        try:
+            process.wait(timeout=self.stop_timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        if self._reader:
+            # the rest of the output is read before a restarted process writes
+            self._reader.join(self.stop_timeout)
+            self._reader = None
+            process.stdout.close()
+        self.process = None
+
+    def stop(self) -> None:
+        """
+        Lets the writer finish the queued frames and ffmpeg exit on the supervisor's thread
+        without waiting for them, see wait(). It can be started again straight away.
+        """
+        with self._lock:
+            state, self.state = self.state, EncoderState.STOPPED
+        if state == EncoderState.RESTARTING:
+            self.downtime += monotonic() - self.failed_time
+        elif state != EncoderState.STOPPED:
+            self._submit(self._finish)
+
+    def _finish(self) -> None:
+        if self.process is None:
+            return
+        try:
+            self._frames.put(None, timeout=self.stop_timeout)
+        except queue.Full:
+            pass  # the writer is stuck, _close_process kills the process
+        if self._writer:
+            self._writer.join(self.stop_timeout)
+        self._close_process()
+
+    def metrics(self) -> Dict[str, Any]:
+        downtime = self.downtime
+        if self.state == EncoderState.RESTARTING:
+            downtime += monotonic() - self.failed_time
+        return {
+            "state": self.state.value,
+            "restarts": self.restarts,
+            "downtime": round(downtime, 2),
+            "dropped_frames": self.dropped_frames,
+            "frames_written": self.frames_written,
+            "last_failure": self.last_failure,
+            "first_frame_latency": round(self.first_frame_latency, 3),
+            "keyframe_restarts": self.keyframe_restarts,
+            "keyframes_forced": self.keyframes_forced,
+        }
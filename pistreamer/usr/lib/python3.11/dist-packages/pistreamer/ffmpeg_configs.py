@@ -1,11 +1,82 @@
 #!/usr/bin/env python3
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
+from constants import RecordProfile
+
+
+# The muxer and the recording file extension of each RecordProfile
+RECORD_PROFILES: Dict[str, Tuple[List[str], str]] = {
+    RecordProfile.MPEG_TS.value: (
+        [
+            "-f",
+            "mpegts",  # Save to mpegts
+        ],
+        ".ts",
+    ),
+    RecordProfile.FMP4.value: (
+        [
+            "-movflags",
+            "+frag_keyframe+empty_moov+default_base_moof",  # A fragment per keyframe
+            "-f",
+            "mp4",
+        ],
+        ".mp4",
+    ),
+}
+
+
+def get_stream_encoder_args(streaming_bitrate: str, intra_refresh: bool) -> List[str]:
+    """
+    The Pi's hardware encoder, or with intra_refresh libx264 as ffmpeg can't set the
+    hardware encoder's intra refresh. Its refresh sweeps a column of intra coded blocks
+    across the frame once per GOP instead of sending an IDR, so no frame is much bigger than
+    the others and the 64k buffer isn't overrun. It costs CPU, and a receiver joining the
+    stream has a whole picture once a sweep completes, up to two GOPs later.
+    """
+    if not intra_refresh:
+        return [
+            "-c:v",
+            "h264_v4l2m2m",  # Hardware acceleration
+        ]
+    return [
+        "-c:v",
+        "libx264",
+        "-preset",
+        "ultrafast",  # The least CPU
+        "-tune",
+        "zerolatency",  # No frame lookahead
+        "-intra-refresh",
+        "1",  # Periodic intra refresh instead of IDR frames
+        "-maxrate",
+        streaming_bitrate,  # With -bufsize, caps the size of each frame
+    ]
+
+
+def get_record_extension(profile: str) -> str:
+    return RECORD_PROFILES[profile][1]
 
 
 def get_ffmpeg_command_record(
-    resolution: Tuple[int, ...], framerate: str, file_name: str
+    resolution: Tuple[int, ...],
+    framerate: str,
+    bitrate: str,
+    profile: str = RecordProfile.MPEG_TS.value,
+    audio: bool = False,
 ) -> List[str]:
-    # Used for saving data to disk
+    """
+    Used for saving data to disk, pistreamer keeps the output in its pre-event buffer and
+    writes it to the recording file (see pre_event_buffer.py). A silent audio track is only
+    added for players that need one, it costs an extra encoder and -shortest to end it.
+    """
+    if audio:
+        audio_args = [
+            "-f",
+            "lavfi",
+            "-i",
+            "anullsrc=r=44100:cl=stereo",  # Add silent audio track
+            "-shortest",  # Ensure the shortest stream ends the output
+        ]
+    else:
+        audio_args = []
     return [
         "ffmpeg",
         "-y",  # Overwrite output files without asking
@@ -19,20 +90,17 @@ def get_ffmpeg_command_record(
         framerate,  # Frame rate
         "-i",
         "-",  # Input from stdin
-        "-f",
-        "lavfi",
-        "-i",
-        "anullsrc=r=44100:cl=stereo",  # Add silent audio track
-        "-shortest",  # Ensure the shortest stream ends the output
+        *audio_args,
         "-c:v",
         "h264_v4l2m2m",  # Hardware acceleration
         "-b:v",
-        "1M",  # Video bitrate
-        "-movflags",
-        "+faststart",  # Prepare the file for playback
-        "-f",
-        "mpegts",  # Save to mpegts
-        file_name,  # Output file pattern
+        bitrate,  # Video bitrate
+        "-g",
+        framerate,  # A keyframe every second, recordings start on one
+        *RECORD_PROFILES[profile][0],
+        "-flush_packets",
+        "1",  # Pass every packet on as soon as it is muxed
+        "pipe:1",  # Output to stdout
     ]
 
 
@@ -42,6 +110,7 @@ def get_ffmpeg_command_rtp(
     gcs_ip: str,
     gcs_port: str,
     streaming_bitrate: str,
+    intra_refresh: bool = False,
 ) -> List[str]:
     """
     Generally used for streaming video to QGroundControl as the GCS
@@ -59,8 +128,7 @@ def get_ffmpeg_command_rtp(
         framerate,  # Frame rate
         "-i",
         "-",  # Input from stdin
-        "-c:v",
-        "h264_v4l2m2m",  # Hardware acceleration
+        *get_stream_encoder_args(streaming_bitrate, intra_refresh),
         "-bufsize",
         "64k",  # Reduce buffer size
         "-b:v",
@@ -72,7 +140,7 @@ def get_ffmpeg_command_rtp(
         "-bf",
         "0",  # Disable B-frames
         "-g",
-        "30",  # Set GOP size (keyframe interval)
+        framerate,  # Set GOP size (keyframe interval), a keyframe every second
         "-f",
         "rtp",  # Output format for RTP
         f"rtp://{gcs_ip}:{gcs_port}",
@@ -85,25 +153,66 @@ def get_ffmpeg_command_mpeg_ts(
     gcs_ip: str,
     gcs_port: str,
     streaming_bitrate: str,
+    klv_fd: Optional[int] = None,
+    packet_size: Optional[int] = None,
+    intra_refresh: bool = False,
 ) -> List[str]:
     """
-    Generally used for streaming video to ATAK as the GCS
+    Generally used for streaming video to ATAK as the GCS.
+    If klv_fd is given, the KLV packets written to that pipe are muxed as a data stream.
+    packet_size sets the UDP payload size, i.e. for SRT which carries at most 1316 bytes.
     """
+    url = f"udp://{gcs_ip}:{gcs_port}"
+    if packet_size:
+        url += f"?pkt_size={packet_size}"
+    if klv_fd is None:
+        input_args = [
+            "-f",
+            "rawvideo",  # Input format
+            "-pix_fmt",
+            "yuv420p",  # Pixel format
+            "-s",
+            f"{resolution[0]}x{resolution[1]}",  # Frame size
+            "-r",
+            framerate,  # Frame rate
+            "-i",
+            "-",  # Input from stdin
+        ]
+    else:
+        # Both inputs are stamped with the wall clock on arrival so the KLV packets line
+        # up with the frame they were written next to
+        input_args = [
+            "-use_wallclock_as_timestamps",
+            "1",
+            "-f",
+            "rawvideo",  # Input format
+            "-pix_fmt",
+            "yuv420p",  # Pixel format
+            "-s",
+            f"{resolution[0]}x{resolution[1]}",  # Frame size
+            "-i",
+            "-",  # Input from stdin
+            "-use_wallclock_as_timestamps",
+            "1",
+            "-f",
+            "data",  # Raw KLV packets
+            "-i",
+            f"pipe:{klv_fd}",
+            "-copyts",  # Keep the shared wall clock time base
+            "-map",
+            "0:v",
+            "-map",
+            "1:0",
+            "-c:d",
+            "copy",
+            "-fps_mode",
+            "passthrough",  # Keep the arrival timestamps, don't resample to a rate
+        ]
     return [
         "ffmpeg",
         "-y",  # Overwrite output files without asking
-        "-f",
-        "rawvideo",  # Input format
-        "-pix_fmt",
-        "yuv420p",  # Pixel format
-        "-s",
-        f"{resolution[0]}x{resolution[1]}",  # Frame size
-        "-r",
-        framerate,  # Frame rate
-        "-i",
-        "-",  # Input from stdin
-        "-c:v",
-        "h264_v4l2m2m",  # Hardware acceleration
+        *input_args,
+        *get_stream_encoder_args(streaming_bitrate, intra_refresh),
         "-bufsize",
         "64k",  # Reduce buffer size
         "-b:v",
@@ -115,8 +224,8 @@ def get_ffmpeg_command_mpeg_ts(
         "-bf",
         "0",  # Disable B-frames
         "-g",
-        "30",  # Set GOP size (keyframe interval)
+        framerate,  # Set GOP size (keyframe interval), a keyframe every second
         "-f",
         "mpegts",  # Output format for MPEG-TS
-        f"udp://{gcs_ip}:{gcs_port}",
+        url,
     ]
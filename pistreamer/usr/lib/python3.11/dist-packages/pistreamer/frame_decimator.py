@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+from typing import Any, Dict
+from constants import FRAMERATE, SINK_FRAME_REPEAT_LIMIT
+
+"""
+Each sink's ffmpeg reads raw frames at a constant `-r`, so the frames it is given decide its
+timing. A FrameDecimator picks a sink's frames by their sensor timestamps: a sink at 15 fps
+gets every other frame of a 30 fps camera, and a frame is repeated when a slot was missed
+(the camera running slightly slow, or a capture dropped), so a sink gets `framerate` frames
+per second of the camera's clock and players don't drift. It runs before any processing so
+the frames no sink takes cost nothing past the capture.
+"""
+
+
+class FrameDecimator:
+    def __init__(self, framerate: int = FRAMERATE) -> None:
+        # a frame up to half a camera frame early is taken for its slot, for jitter
+        self.tolerance_ns = 1000000000 // FRAMERATE // 2
+        self.set_framerate(framerate)
+
+    def set_framerate(self, framerate: int) -> None:
+        self.framerate = framerate
+        self.period_ns = 1000000000 // framerate
+        self.next_ns = 0  # the sensor timestamp of the next slot, 0 to start
+        self.skipped = 0
+        self.repeated = 0
+        self.resyncs = 0
+
+    def take(self, sensor_timestamp_ns: int) -> int:
+        """
+        Returns how many times the sink gets this frame, 0 to skip it.
+        """
+        if not self.next_ns:
+            self.next_ns = sensor_timestamp_ns
+        late_ns = sensor_timestamp_ns - self.next_ns
+        if late_ns < -self.tolerance_ns:
+            self.skipped += 1
+            return 0
+        # repeated only once a whole slot late, so jitter around a slot's edge doesn't
+        # skip and repeat in turn
+        count = 1 + max(late_ns, 0) // self.period_ns
+        if count > 1 + SINK_FRAME_REPEAT_LIMIT:
+            # a gap (i.e. the camera was reconfigured for a photo), start from this frame
+            self.resyncs += 1
+            self.next_ns = sensor_timestamp_ns
+            count = 1
+        self.repeated += count - 1
+        self.next_ns += count * self.period_ns
+        return count
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "framerate": self.framerate,
+            "skipped_frames": self.skipped,
+            "repeated_frames": self.repeated,
+            "resyncs": self.resyncs,
+        }
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import struct
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+import numpy as np
+from constants import FRAME_INDEX_BUFFER_FRAMES, FRAME_INDEX_EXTENSION
+from telemetry_buffer import ATTITUDE_FIELDS, GPS_FIELDS
+
+"""
+Binary sidecar written next to each recording with one fixed width record per frame, so
+post-flight tools can find the frames recorded at a location (or the telemetry of a frame)
+without decoding the video. The file is a 16 byte header followed by FRAME_INDEX_DTYPE
+records and can be opened with `read_frame_index`, which memory maps the records.
+"""
+
+FRAME_INDEX_MAGIC = b"PSFI"
+FRAME_INDEX_VERSION = 1
+# magic, version, record size, frame rate (frames per second), 4 reserved bytes
+FRAME_INDEX_HEADER = struct.Struct("<4sHHf4x")
+
+# Little endian and packed so the layout is the same on every reader
+FRAME_INDEX_DTYPE = np.dtype(
+    [
+        ("pts_us", "<i8"),  # presentation time in the recording
+        ("sensor_timestamp_ns", "<i8"),  # libcamera SensorTimestamp (CLOCK_BOOTTIME)
+        ("lat", "<i4"),  # 1e-7 degrees
+        ("lon", "<i4"),  # 1e-7 degrees
+        ("alt", "<i4"),  # mm above mean sea level
+        ("cog", "<u2"),  # centi-degrees
+        ("vel", "<u2"),  # cm/s
+        ("pitch", "<f4"),  # radians
+        ("roll", "<f4"),  # radians
+        ("zoom", "<f4"),
+        ("bbox", "<i2", (4,)),  # x, y, w, h of the tracking box, all -1 if not tracking
+    ]
+)
+
+_GPS_COLUMNS = [GPS_FIELDS.index(name) for name in ("lat", "lon", "alt", "cog", "vel")]
+_ATTITUDE_COLUMNS = [ATTITUDE_FIELDS.index(name) for name in ("pitch", "roll")]
+NO_BBOX: Tuple[int, int, int, int] = (-1, -1, -1, -1)
+
+
+def get_frame_index_path(recording_file_name: str) -> str:
+    return str(Path(recording_file_name).with_suffix(FRAME_INDEX_EXTENSION))
+
+
+class FrameIndexWriter:
+    """
+    Records are filled in place in a preallocated block and the block is written once it
+    is full, so appending a frame doesn't allocate or touch the SD card.
+    """
+
+    def __init__(
+        self,
+        file_name: str,
+        framerate: float,
+        buffer_frames: int = FRAME_INDEX_BUFFER_FRAMES,
+    ) -> None:
+        self.file_name = file_name
+        self.framerate = framerate
+        self.records = np.zeros(buffer_frames, dtype=FRAME_INDEX_DTYPE)
+        self.count = 0  # records waiting in the block
+        self.frames = 0  # records appended in total
+        self._file: Optional[BinaryIO] = open(file_name, "wb")
+        self._file.write(
+            FRAME_INDEX_HEADER.pack(
+                FRAME_INDEX_MAGIC,
+                FRAME_INDEX_VERSION,
+                FRAME_INDEX_DTYPE.itemsize,
+                framerate,
+            )
+        )
+        # Views of each column so appends are plain item assignments
+        self._pts = self.records["pts_us"]
+        self._sensor_timestamp = self.records["sensor_timestamp_ns"]
+        self._gps = [self.records[name] for name in ("lat", "lon", "alt", "cog", "vel")]
+        self._attitude = [self.records[name] for name in ("pitch", "roll")]
+        self._zoom = self.records["zoom"]
+        self._bbox = self.records["bbox"]
+
+    def append(
+        self,
+        sensor_timestamp_ns: int,
+        gps_row: Optional[np.ndarray],
+        attitude_row: Optional[np.ndarray],
+        zoom: float,
+        bbox: Tuple[int, int, int, int] = NO_BBOX,
+    ) -> None:
+        """
+        gps_row and attitude_row are telemetry ring buffer rows (GPS_FIELDS and
+        ATTITUDE_FIELDS order), i.e. interpolated at the frame's sensor timestamp.
+        """
+        row = self.count
+        # The recording is encoded at a constant frame rate so the PTS is the frame number
+        self._pts[row] = int(self.frames * 1000000 / self.framerate)
+        self._sensor_timestamp[row] = sensor_timestamp_ns
+        if gps_row is not None:
+            for column, field in zip(_GPS_COLUMNS, self._gps):
+                field[row] = round(gps_row.item(column))
+        if attitude_row is not None:
+            for column, field in zip(_ATTITUDE_COLUMNS, self._attitude):
+                field[row] = attitude_row.item(column)
+        self._zoom[row] = zoom
+        self._bbox[row] = bbox
+        self.count += 1
+        self.frames += 1
+        if self.count == len(self.records):
+            self.flush()
+
+    def flush(self) -> None:
+        if self._file is None or not self.count:
+            return
+        self._file.write(self.records[: self.count].data)
+        self._file.flush()
+        self.records[: self.count] = 0
+        self.count = 0
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._file = None
+
+
+def read_frame_index(file_name: str) -> Tuple[float, np.ndarray]:
+    """
+    Returns the frame rate and a read-only memory map of the records.
+    """
+    with open(file_name, "rb") as f:
+        header = f.read(FRAME_INDEX_HEADER.size)
+    if len(header) < FRAME_INDEX_HEADER.size:
+        raise Exception(f"{file_name} is not a frame index")
+    magic, version, record_size, framerate = FRAME_INDEX_HEADER.unpack(header)
+    if magic != FRAME_INDEX_MAGIC:
+        raise Exception(f"{file_name} is not a frame index")
+    if version != FRAME_INDEX_VERSION or record_size != FRAME_INDEX_DTYPE.itemsize:
+        raise Exception(f"Unsupported frame index version {version}")
+
+    record_count = (Path(file_name).stat().st_size - FRAME_INDEX_HEADER.size) // (
+        record_size
+    )
+    if not record_count:
+        return framerate, np.zeros(0, dtype=FRAME_INDEX_DTYPE)
+    return framerate, np.memmap(
+        file_name,
+        dtype=FRAME_INDEX_DTYPE,
+        mode="r",
+        offset=FRAME_INDEX_HEADER.size,
+        shape=(record_count,),
+    )
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+import math
+import struct
+from typing import Any, Dict, Optional
+import numpy as np
+from telemetry_buffer import ATTITUDE_FIELDS, GPS_FIELDS
+
+"""
+Builds MISB ST 0601 (UAS Datalink Local Set) KLV packets from the telemetry history so ATAK
+and other STANAG 4609 players can show the sensor position on a map. The packet layout is
+fixed, so a template with every key, tag and length is built once and each encode only packs
+the values and checksum into the same buffer.
+See https://nsgreg.nga.mil/misb.jsp (ST 0601)
+"""
+
+UAS_LOCAL_SET_KEY = bytes.fromhex("060E2B34020B01010E01030101000000")
+UAS_LS_VERSION = 17
+
+TAG_CHECKSUM = 1
+TAG_PRECISION_TIME_STAMP = 2
+TAG_PLATFORM_HEADING_ANGLE = 5
+TAG_PLATFORM_PITCH_ANGLE = 6
+TAG_PLATFORM_ROLL_ANGLE = 7
+TAG_SENSOR_LATITUDE = 13
+TAG_SENSOR_LONGITUDE = 14
+TAG_SENSOR_TRUE_ALTITUDE = 15
+TAG_PLATFORM_GROUND_SPEED = 56
+TAG_UAS_LS_VERSION = 65
+
+# Packed in this order, Precision Time Stamp must be first and the checksum last
+KLV_TAGS: Dict[int, struct.Struct] = {
+    TAG_PRECISION_TIME_STAMP: struct.Struct(">Q"),
+    TAG_PLATFORM_HEADING_ANGLE: struct.Struct(">H"),
+    TAG_PLATFORM_PITCH_ANGLE: struct.Struct(">h"),
+    TAG_PLATFORM_ROLL_ANGLE: struct.Struct(">h"),
+    TAG_SENSOR_LATITUDE: struct.Struct(">i"),
+    TAG_SENSOR_LONGITUDE: struct.Struct(">i"),
+    TAG_SENSOR_TRUE_ALTITUDE: struct.Struct(">H"),
+    TAG_PLATFORM_GROUND_SPEED: struct.Struct(">B"),
+    TAG_UAS_LS_VERSION: struct.Struct(">B"),
+    TAG_CHECKSUM: struct.Struct(">H"),
+}
+
+# Signed values outside of their range are reported with the ST 0601 "out of range" value
+INT16_ERROR = -0x8000
+INT32_ERROR = -0x80000000
+
+# Column indexes into the telemetry ring buffer rows
+_LAT = GPS_FIELDS.index("lat")
+_LON = GPS_FIELDS.index("lon")
+_ALT = GPS_FIELDS.index("alt")
+_VEL = GPS_FIELDS.index("vel")
+_COG = GPS_FIELDS.index("cog")
+_PITCH = ATTITUDE_FIELDS.index("pitch")
+_ROLL = ATTITUDE_FIELDS.index("roll")
+
+
+def _map_signed(value: float, limit: float, max_int: int, error: int) -> int:
+    if not -limit <= value <= limit:
+        return error
+    return int(round(value * max_int / limit))
+
+
+def klv_checksum(packet: Any, length: int) -> int:
+    """
+    16-bit sum of the packet with even bytes as the high byte (ST 0601 section 6.5.3).
+    """
+    data = memoryview(packet)[:length]
+    return ((sum(data[0::2]) << 8) + sum(data[1::2])) & 0xFFFF
+
+
+class KLVEncoder:
+    def __init__(self) -> None:
+        value_length = sum(2 + packer.size for packer in KLV_TAGS.values())
+        if value_length > 127:
+            raise Exception("The local set must fit a short form BER length")
+
+        self.packet = bytearray(len(UAS_LOCAL_SET_KEY) + 1 + value_length)
+        self.packet[: len(UAS_LOCAL_SET_KEY)] = UAS_LOCAL_SET_KEY
+        offset = len(UAS_LOCAL_SET_KEY)
+        self.packet[offset] = value_length
+        offset += 1
+
+        # Write the tags and lengths once, only the values change per packet
+        self.offsets: Dict[int, int] = {}
+        for tag, packer in KLV_TAGS.items():
+            self.packet[offset] = tag
+            self.packet[offset + 1] = packer.size
+            self.offsets[tag] = offset + 2
+            offset += 2 + packer.size
+        KLV_TAGS[TAG_UAS_LS_VERSION].pack_into(
+            self.packet, self.offsets[TAG_UAS_LS_VERSION], UAS_LS_VERSION
+        )
+
+        # The checksum covers everything up to and including the checksum tag and length
+        self._view = memoryview(self.packet)
+        checksum_data = self._view[: self.offsets[TAG_CHECKSUM]]
+        self._high_bytes = checksum_data[0::2]
+        self._low_bytes = checksum_data[1::2]
+
+        # Pack straight into the template, no intermediate buffers
+        self._pack_time = KLV_TAGS[TAG_PRECISION_TIME_STAMP].pack_into
+        self._pack_heading = KLV_TAGS[TAG_PLATFORM_HEADING_ANGLE].pack_into
+        self._pack_pitch = KLV_TAGS[TAG_PLATFORM_PITCH_ANGLE].pack_into
+        self._pack_roll = KLV_TAGS[TAG_PLATFORM_ROLL_ANGLE].pack_into
+        self._pack_latitude = KLV_TAGS[TAG_SENSOR_LATITUDE].pack_into
+        self._pack_longitude = KLV_TAGS[TAG_SENSOR_LONGITUDE].pack_into
+        self._pack_altitude = KLV_TAGS[TAG_SENSOR_TRUE_ALTITUDE].pack_into
+        self._pack_speed = KLV_TAGS[TAG_PLATFORM_GROUND_SPEED].pack_into
+        self._pack_checksum = KLV_TAGS[TAG_CHECKSUM].pack_into
+
+    def encode(
+        self,
+        timestamp_us: int,
+        gps_row: Optional[np.ndarray],
+        attitude_row: Optional[np.ndarray],
+    ) -> memoryview:
+        """
+        Packs a ring buffer GPS row (GPS_FIELDS order) and attitude row (ATTITUDE_FIELDS
+        order) into the template. The returned view is only valid until the next encode.
+        """
+        packet = self.packet
+        offsets = self.offsets
+        self._pack_time(packet, offsets[TAG_PRECISION_TIME_STAMP], timestamp_us)
+
+        if gps_row is not None:
+            # .item() returns python floats, NumPy scalar math is several times slower
+            latitude = gps_row.item(_LAT) / 1e7
+            longitude = gps_row.item(_LON) / 1e7
+            altitude = gps_row.item(_ALT) / 1000.0  # mm to m
+            self._pack_latitude(
+                packet,
+                offsets[TAG_SENSOR_LATITUDE],
+                _map_signed(latitude, 90.0, 0x7FFFFFFF, INT32_ERROR),
+            )
+            self._pack_longitude(
+                packet,
+                offsets[TAG_SENSOR_LONGITUDE],
+                _map_signed(longitude, 180.0, 0x7FFFFFFF, INT32_ERROR),
+            )
+            self._pack_altitude(
+                packet,
+                offsets[TAG_SENSOR_TRUE_ALTITUDE],
+                int(
+                    round((min(max(altitude, -900.0), 19000.0) + 900.0) * 65535 / 19900)
+                ),
+            )
+            self._pack_heading(
+                packet,
+                offsets[TAG_PLATFORM_HEADING_ANGLE],
+                int(round((gps_row.item(_COG) / 100.0 % 360.0) * 65535 / 360.0)),
+            )
+            self._pack_speed(
+                packet,
+                offsets[TAG_PLATFORM_GROUND_SPEED],
+                min(int(gps_row.item(_VEL) / 100.0), 255),  # cm/s to m/s
+            )
+
+        if attitude_row is not None:
+            self._pack_pitch(
+                packet,
+                offsets[TAG_PLATFORM_PITCH_ANGLE],
+                _map_signed(
+                    math.degrees(attitude_row.item(_PITCH)), 20.0, 0x7FFF, INT16_ERROR
+                ),
+            )
+            roll = math.degrees(attitude_row.item(_ROLL))
+            self._pack_roll(
+                packet,
+                offsets[TAG_PLATFORM_ROLL_ANGLE],
+                _map_signed(
+                    roll - 360.0 if roll > 180.0 else roll, 50.0, 0x7FFF, INT16_ERROR
+                ),
+            )
+
+        checksum = ((sum(self._high_bytes) << 8) + sum(self._low_bytes)) & 0xFFFF
+        self._pack_checksum(packet, offsets[TAG_CHECKSUM], checksum)
+        return self._view
+
+
+def parse_klv(packet: bytes) -> Dict[str, Any]:
+    """
+    Parses a UAS Datalink Local Set back into engineering units. Used to validate the
+    encoder locally, raises if the key, length or checksum is wrong.
+    """
+    key_length = len(UAS_LOCAL_SET_KEY)
+    if bytes(packet[:key_length]) != UAS_LOCAL_SET_KEY:
+        raise Exception("Not a UAS Datalink Local Set")
+    value_length = packet[key_length]
+    if value_length > 127:
+        raise Exception("Only short form BER lengths are supported")
+    end = key_length + 1 + value_length
+    if len(packet) < end:
+        raise Exception("Truncated packet")
+
+    values: Dict[int, Any] = {}
+    offset = key_length + 1
+    while offset < end:
+        tag, length = packet[offset], packet[offset + 1]
+        offset += 2
+        packer = KLV_TAGS.get(tag)
+        if packer is not None and packer.size == length:
+            values[tag] = packer.unpack_from(packet, offset)[0]
+        offset += length
+
+    if TAG_CHECKSUM not in values:
+        raise Exception("Missing checksum")
+    if klv_checksum(packet, end - 2) != values[TAG_CHECKSUM]:
+        raise Exception("Invalid checksum")
+
+    def _unmap(tag: int, limit: float, max_int: int, error: int) -> Optional[float]:
+        if tag not in values or values[tag] == error:
+            return None
+        return values[tag] * limit / max_int
+
+    return {
+        "timestamp_us": values.get(TAG_PRECISION_TIME_STAMP),
+        "heading": values.get(TAG_PLATFORM_HEADING_ANGLE, 0) * 360.0 / 65535,
+        "pitch": _unmap(TAG_PLATFORM_PITCH_ANGLE, 20.0, 0x7FFF, INT16_ERROR),
+        "roll": _unmap(TAG_PLATFORM_ROLL_ANGLE, 50.0, 0x7FFF, INT16_ERROR),
+        "latitude": _unmap(TAG_SENSOR_LATITUDE, 90.0, 0x7FFFFFFF, INT32_ERROR),
+        "longitude": _unmap(TAG_SENSOR_LONGITUDE, 180.0, 0x7FFFFFFF, INT32_ERROR),
+        "altitude": values.get(TAG_SENSOR_TRUE_ALTITUDE, 0) * 19900 / 65535 - 900.0,
+        "ground_speed": values.get(TAG_PLATFORM_GROUND_SPEED),
+        "version": values.get(TAG_UAS_LS_VERSION),
+    }
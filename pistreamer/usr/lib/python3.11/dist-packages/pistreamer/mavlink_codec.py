@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+from binascii import a2b_base64, b2a_base64
+import struct
+from typing import Tuple
+from constants import MavlinkGPSData, MavlinkMiscData
+
+"""
+Compact binary form of the MAVLink data commands. The fields are packed with a fixed struct
+layout in the same order as the MavlinkGPSData/MavlinkMiscData fields and sent base64 encoded
+as the value of `gps_data_bin`/`misc_data_bin` so they travel over the existing text command
+channels. Decoding is a single struct unpack instead of json.loads + keyword construction.
+"""
+
+# lat, lon, alt (int32), eph, epv, vel, cog (uint16), fix_type, satellites_visible (uint8),
+# time_usec (uint64). 30 bytes, little endian and unpadded.
+GPS_DATA_STRUCT = struct.Struct("<iiiHHHHBBQ")
+# pitch, roll (float32), camera_model (16 byte NUL padded ascii), focal_length (uint16, uint16).
+# 28 bytes, little endian and unpadded.
+MISC_DATA_STRUCT = struct.Struct("<ff16sHH")
+
+
+def encode_gps_data(gps_data: MavlinkGPSData) -> str:
+    return b2a_base64(
+        GPS_DATA_STRUCT.pack(
+            gps_data.lat,
+            gps_data.lon,
+            gps_data.alt,
+            gps_data.eph,
+            gps_data.epv,
+            gps_data.vel,
+            gps_data.cog,
+            gps_data.fix_type,
+            gps_data.satellites_visible,
+            gps_data.time_usec,
+        ),
+        newline=False,
+    ).decode()
+
+
+def decode_gps_values(command_value: str) -> Tuple[int, ...]:
+    """
+    Returns the GPS values in MavlinkGPSData field order without building the dataclass.
+    """
+    try:
+        return GPS_DATA_STRUCT.unpack(a2b_base64(command_value))
+    except Exception as e:
+        raise Exception(f"Invalid GPS data command : {e}")
+
+
+def decode_gps_data(command_value: str) -> MavlinkGPSData:
+    return MavlinkGPSData(*decode_gps_values(command_value))
+
+
+def encode_misc_data(misc_data: MavlinkMiscData) -> str:
+    return b2a_base64(
+        MISC_DATA_STRUCT.pack(
+            misc_data.pitch,
+            misc_data.roll,
+            misc_data.camera_model.encode(),
+            misc_data.focal_length[0],
+            misc_data.focal_length[1],
+        ),
+        newline=False,
+    ).decode()
+
+
+def decode_misc_values(command_value: str) -> Tuple[float, float, str, Tuple[int, int]]:
+    """
+    Returns the MISC values in MavlinkMiscData field order without building the dataclass.
+    """
+    try:
+        (
+            pitch,
+            roll,
+            camera_model,
+            focal_length,
+            focal_length_divisor,
+        ) = MISC_DATA_STRUCT.unpack(a2b_base64(command_value))
+        return (
+            pitch,
+            roll,
+            camera_model.rstrip(b"\0").decode(),
+            (focal_length, focal_length_divisor),
+        )
+    except Exception as e:
+        raise Exception(f"Invalid MISC data command : {e}")
+
+
+def decode_misc_data(command_value: str) -> MavlinkMiscData:
+    return MavlinkMiscData(*decode_misc_values(command_value))
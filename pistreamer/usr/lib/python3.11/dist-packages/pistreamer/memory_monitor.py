@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+from collections import deque
+import gc
+import os
+import sys
+import threading
+import tracemalloc
+from time import monotonic, perf_counter
+from typing import Any, Deque, Dict, List, Optional
+import numpy as np
+from constants import (
+    MEMORY_HISTORY_SIZE,
+    MEMORY_REFERENTS_CHUNK,
+    MEMORY_SAMPLE_INTERVAL,
+    MEMORY_TRACEMALLOC_FRAMES,
+)
+
+"""
+Tracks the memory footprint over long flights: resident set size, Python heap blocks and the
+NumPy arrays still referenced by Python objects. A sample walks every Python object, so it is
+taken on a thread every MEMORY_SAMPLE_INTERVAL and the stream loop only publishes the samples
+it finished. They are kept in a short history. When growth shows up, tracemalloc
+snapshots can be taken and diffed at runtime with the `memory` command to find where it is
+allocated.
+"""
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def get_rss_kb() -> int:
+    """
+    Current resident set size, /proc/self/statm is much cheaper than psutil or ps.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE // 1024
+    except OSError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # peak, in kB
+
+
+def count_ndarrays(objects: Optional[List[Any]] = None) -> Dict[str, int]:
+    """
+    NumPy arrays aren't tracked by the garbage collector, so they are found through the
+    containers and objects that reference them (gc.get_objects() unless given). Arrays only
+    referenced from C (i.e. OpenCV internals) or the stack are not counted. The referents
+    are fetched in chunks as gc.get_referents holds the GIL, so other threads run between.
+    """
+    if objects is None:
+        objects = gc.get_objects()
+    seen = set()
+    total_bytes = 0
+    for start in range(0, len(objects), MEMORY_REFERENTS_CHUNK):
+        chunk = objects[start : start + MEMORY_REFERENTS_CHUNK]
+        for referent in gc.get_referents(*chunk):
+            if isinstance(referent, np.ndarray) and id(referent) not in seen:
+                seen.add(id(referent))
+                # views share the base's buffer so only count arrays owning their data
+                if referent.base is None:
+                    total_bytes += referent.nbytes
+    return {"ndarrays": len(seen), "ndarray_kb": total_bytes // 1024}
+
+
+class MemoryMonitor:
+    def __init__(
+        self,
+        interval: float = MEMORY_SAMPLE_INTERVAL,
+        history_size: int = MEMORY_HISTORY_SIZE,
+    ) -> None:
+        self.interval = interval
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=history_size)
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self._lock = threading.Lock()
+        self._finished: Optional[Dict[str, Any]] = None  # not yet returned by poll()
+        self._wake = threading.Event()
+        self._is_running = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread:
+            return
+        self._is_running = True
+        self._thread = threading.Thread(
+            target=self._sample_loop, name="memory-monitor", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._is_running = False
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._wake.clear()
+
+    def _sample_loop(self) -> None:
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if not self._is_running:
+                return
+            sample = self.sample()
+            with self._lock:
+                self._finished = sample
+
+    def request_sample(self) -> None:
+        """
+        Takes a sample now rather than at the next interval, poll() returns it once done.
+        """
+        self._wake.set()
+
+    def sample(self) -> Dict[str, Any]:
+        start = perf_counter()
+        objects = gc.get_objects()  # walked once for both counts
+        sample: Dict[str, Any] = {
+            "time": round(monotonic(), 1),
+            "rss_kb": get_rss_kb(),
+            "python_blocks": sys.getallocatedblocks(),
+            "gc_objects": len(objects),
+            **count_ndarrays(objects),
+        }
+        del objects
+        if tracemalloc.is_tracing():
+            sample["traced_kb"] = tracemalloc.get_traced_memory()[0] // 1024
+        sample["sample_ms"] = round((perf_counter() - start) * 1000, 1)
+        self.history.append(sample)
+        return sample
+
+    def latest(self) -> Dict[str, Any]:
+        """
+        The last finished sample, empty before the first one.
+        """
+        return self.history[-1] if self.history else {}
+
+    def poll(self) -> Optional[Dict[str, Any]]:
+        """
+        Called from the stream loop, returns each sample the thread finished once.
+        """
+        with self._lock:
+            sample, self._finished = self._finished, None
+        return sample
+
+    def take_snapshot(self) -> int:
+        """
+        Starts tracemalloc if needed and keeps a snapshot to diff against.
+        Returns the number of traced blocks.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(MEMORY_TRACEMALLOC_FRAMES)
+        self.snapshot = tracemalloc.take_snapshot()
+        return len(self.snapshot.traces)
+
+    def diff_snapshot(self, count: int) -> List[Dict[str, Any]]:
+        """
+        The count allocation sites that grew the most since the last snapshot, which is then
+        replaced so consecutive diffs show the growth in between.
+        """
+        if self.snapshot is None or not tracemalloc.is_tracing():
+            raise Exception("Take a snapshot first with `memory snapshot`")
+        snapshot = tracemalloc.take_snapshot()
+        stats = snapshot.compare_to(self.snapshot, "lineno")
+        self.snapshot = snapshot
+        return [
+            {
+                "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                "size_diff_kb": round(stat.size_diff / 1024, 1),
+                "count_diff": stat.count_diff,
+                "size_kb": round(stat.size / 1024, 1),
+            }
+            for stat in stats[:count]
+        ]
+
+    def stop_tracing(self) -> None:
+        self.snapshot = None
+        tracemalloc.stop()
@@ -3,16 +3,20 @@
 # We need to modify the path so pistreamer can be run from any location on the pi
 import sys
 import os
-from typing import Any, Final, Optional
+from typing import Any, Deque, Final, List, Optional, Tuple
 
 INSTALL_PATH: Final = "/usr/lib/python3.11/dist-packages/pistreamer/"
 sys.path.insert(0, INSTALL_PATH)
 
 import signal
+import json
+import itertools
+from collections import deque
 from exif_service import EXIFService
 from ffmpeg_configs import (
     get_ffmpeg_command_mpeg_ts,
     get_ffmpeg_command_record,
+    get_record_extension,
     get_ffmpeg_command_rtp,
 )
 from pathlib import Path
@@ -22,6 +26,7 @@ import cv2
 import numpy as np
 import time
 import subprocess
+import threading
 import argparse
 from pathlib import Path
 from constants import (
@@ -30,6 +35,8 @@ from constants import (
     CONFIGURED_RPI_IP_PREFIX,
     DEFAULT_CONFIG_PATH,
     DEFAULT_MAX_ZOOM,
+    ENCODER_QUEUE_FRAMES,
+    ENCODER_STOP_TIMEOUT,
     INIT_BBOX_COLOR,
     MEDIA_FILES_DIRECTORY,
     MICROHARD_DEFAULT_IP,
@@ -37,21 +44,54 @@ from constants import (
     MONARK_ID_FILE_NAME,
     NAMESPACE_PREFIX,
     NAMESPACE_URI,
+    PHOTO_GEOTAG_TIMEOUT,
     QR_CODE_FRAMESIZE,
+    RECORD_BITRATE,
+    RECORD_SEGMENT_BYTES,
+    RECORD_SEGMENT_SECONDS,
+    RTSP_RELAY_PORT,
+    SECONDARY_BITRATE,
+    SRT_LATENCY,
+    SRT_OVERHEAD,
+    SRT_PAYLOAD_SIZE,
     STREAMING_FRAMESIZE,
+    STATS_PUBLISH_INTERVAL,
     STILL_FRAMESIZE,
+    STORAGE_MIN_FREE_BYTES,
+    STORAGE_RESERVED_BYTES,
     FRAMERATE,
     CommandProtocolType,
+    EncoderBackend,
+    EncoderState,
+    FrameStage,
     MavlinkGPSData,
     MavlinkMiscData,
     RadioType,
+    RecordProfile,
+    SinkType,
     StreamingProtocolType,
+    TelemetryTopic,
     TrackStatus,
     ZoomStatus,
 )
+from frame_decimator import FrameDecimator
+from frame_index import NO_BBOX, FrameIndexWriter, get_frame_index_path
+from encoder_supervisor import EncoderSupervisor
+from pyav_encoder import PyAvEncoderProcess
+from klv_encoder import KLVEncoder
+from memory_monitor import MemoryMonitor
+from pre_event_buffer import PreEventBuffer
+from rtp_fec import RtpFecRelay
+from rtsp_server import RtspServer
+from srt_transmitter import SrtTransmitter
+from segment_index import SegmentIndex
+from storage_monitor import StorageMonitor
+from stage_stats import StageStats
 from object_tracker import ObjectTracker
+from telemetry_buffer import TelemetryHistory
 from cam_utils import get_timestamp
 from qr_utill import detect_qr_code
+from command_service import CommandService
 from socket_service import SocketService
 from validator import Validator
 from zeromq_service import ZeroMQService
@@ -72,20 +112,38 @@ class PiStreamer2:
         streaming_protocol: str = StreamingProtocolType.RTP.value,
         radio_type: str = RadioType.MICROHARD.value,
         command_protocol: str = CommandProtocolType.ZEROMQ.value,
+        command_service: Optional[CommandService] = None,
+        record_bitrate: int = RECORD_BITRATE,
+        record_profile: str = RecordProfile.MPEG_TS.value,
+        record_audio: bool = False,
+        record_resolution: str = "",
+        stream_framerate: int = FRAMERATE,
+        record_framerate: int = FRAMERATE,
+        secondary_resolution: str = "",
+        secondary_bitrate: int = SECONDARY_BITRATE,
+        fec_group_size: int = 0,
+        fec_interleave: int = 1,
+        srt_latency: int = SRT_LATENCY,
+        srt_overhead: int = SRT_OVERHEAD,
+        intra_refresh: bool = False,
+        encoder_backend: str = EncoderBackend.FFMPEG.value,
     ) -> None:
         # utilities
         from command_controller import CommandController
 
         self.command_controller: CommandController = None  # type: ignore # this is set later in _set_command_controller
 
-        if command_protocol == CommandProtocolType.ZEROMQ.value:
-            self.command_service: ZeroMQService = ZeroMQService()
-        elif command_protocol == CommandProtocolType.SOCKET.value:
-            self.command_service: SocketService = SocketService()  # type: ignore
-        else:
-            raise NotImplementedError(
-                "Only ZEROMQ and SOCKET message protocols are supported"
-            )
+        # command_service can be passed in, i.e. a fake service for the benchmarks
+        if command_service is None:
+            if command_protocol == CommandProtocolType.ZEROMQ.value:
+                command_service = ZeroMQService()
+            elif command_protocol == CommandProtocolType.SOCKET.value:
+                command_service = SocketService()
+            else:
+                raise NotImplementedError(
+                    "Only ZEROMQ and SOCKET message protocols are supported"
+                )
+        self.command_service: CommandService = command_service
 
         self.pid = 0
         self.verbose = verbose
@@ -102,8 +160,13 @@ class PiStreamer2:
         self.zoom_y_pos = 0
         self.has_zoomed = False
         # video metadata
-        self.gps_data = MavlinkGPSData()
-        self.misc_data = MavlinkMiscData()
+        self.telemetry = TelemetryHistory()
+        # (file name, sensor timestamp, deadline) of photos waiting for telemetry
+        self.pending_geotags: List[Tuple[str, int, float]] = []
+        self.klv_encoder = KLVEncoder()
+        self.klv_fd: Optional[int] = None  # write end of the MPEG-TS KLV pipe
+        # the pipe is replaced on the MPEG-TS supervisor's thread while frames are written
+        self.klv_lock = threading.Lock()
         pyexiv2.xmp.register_namespace(
             NAMESPACE_URI, NAMESPACE_PREFIX
         )  # Register the custom namespace for XMP
@@ -112,11 +175,40 @@ class PiStreamer2:
         self.prev_gray = None
         # picamera config
         self.resolution = tuple(map(int, resolution.split("x")))
+        # recordings are at the stream resolution unless record_resolution is set, then the
+        # ISP scales the same capture to both and each output goes to its own encoder
+        self.record_resolution = (
+            tuple(map(int, record_resolution.split("x")))
+            if record_resolution
+            else self.resolution
+        )
+        self.is_dual_resolution = self.record_resolution != self.resolution
+        # the simulcast stream is the ISP's lores output too, unless that is the stream
+        self.secondary_resolution = (
+            tuple(map(int, secondary_resolution.split("x")))
+            if secondary_resolution
+            else ()
+        )
+        self.is_secondary_lores = bool(
+            self.secondary_resolution and not self.is_dual_resolution
+        )
         tuning = Picamera2.load_tuning_file(Path(config_file).resolve())
         self.picam2 = Picamera2(tuning=tuning)
-        self.streaming_config = self.picam2.create_video_configuration(
-            main={"size": self.resolution}
-        )
+        if self.is_dual_resolution:
+            # YUV420 is what the encoders take, lores can only be YUV420 on the Pi
+            self.streaming_config = self.picam2.create_video_configuration(
+                main={"size": self.record_resolution, "format": "YUV420"},
+                lores={"size": self.resolution, "format": "YUV420"},
+            )
+        elif self.is_secondary_lores:
+            self.streaming_config = self.picam2.create_video_configuration(
+                main={"size": self.resolution},
+                lores={"size": self.secondary_resolution, "format": "YUV420"},
+            )
+        else:
+            self.streaming_config = self.picam2.create_video_configuration(
+                main={"size": self.resolution}
+            )
         self.photo_config = self.picam2.create_still_configuration(
             main={"size": tuple(map(int, STILL_FRAMESIZE.split("x")))}
         )
@@ -124,13 +216,88 @@ class PiStreamer2:
         self.is_recording = False
         self.is_rtp_streaming = False
         self.is_mpeg_ts_streaming = False
-        self.ffmpeg_process_record = None
-        self.ffmpeg_process_rtp = None
-        self.ffmpeg_process_mpeg_ts = None
+        self.is_secondary_streaming = False
+        self.is_rtsp_streaming = False  # the server is running, the encoder on demand
+        self.rtsp_server = RtspServer()
+        # with FEC the RTP encoder sends to the relay, which adds the parity packets
+        self.fec_relay = RtpFecRelay(fec_group_size, fec_interleave)
+        # SRT carries the MPEG-TS stream, the encoder sends it to the transmitter
+        self.is_srt_streaming = False
+        self.srt_transmitter = SrtTransmitter(srt_latency, srt_overhead)
+        # the streams' encoders, see get_stream_encoder_args
+        self.intra_refresh = intra_refresh
+        # the encoder commands run as ffmpeg processes or in this process, see pyav_encoder.py
+        self.encoder_backend = encoder_backend
+        # each sink's ffmpeg is restarted by its supervisor if it dies or hangs
+        self.pre_event_buffer = PreEventBuffer()
+        self.encoder_record = EncoderSupervisor(
+            SinkType.RECORD.value,
+            self._spawn_record,
+            on_output=self.pre_event_buffer.feed,
+        )
+        self.encoder_rtp = EncoderSupervisor(SinkType.RTP.value, self._spawn_rtp)
+        self.encoder_mpeg_ts = EncoderSupervisor(
+            SinkType.MPEG_TS.value, self._spawn_mpeg_ts, on_stop=self._close_klv_pipe
+        )
+        self.encoder_secondary = EncoderSupervisor(
+            SinkType.SECONDARY.value, self._spawn_secondary
+        )
+        self.encoder_rtsp = EncoderSupervisor(SinkType.RTSP.value, self._spawn_rtsp)
+        for encoder in (
+            self.encoder_rtp,
+            self.encoder_mpeg_ts,
+            self.encoder_secondary,
+            self.encoder_rtsp,
+        ):
+            encoder.intra_refresh = intra_refresh
+        # the simulcast stream's destination is set by `start_secondary_stream`
+        self.secondary_ip = ""
+        self.secondary_port = ""
+        self.secondary_bitrate = secondary_bitrate
+        # the frame rate of each sink, see frame_decimator.py
+        self.decimators = {
+            SinkType.RECORD.value: FrameDecimator(record_framerate),
+            SinkType.RTP.value: FrameDecimator(stream_framerate),
+            SinkType.MPEG_TS.value: FrameDecimator(stream_framerate),
+            SinkType.SECONDARY.value: FrameDecimator(stream_framerate),
+            SinkType.RTSP.value: FrameDecimator(stream_framerate),
+        }
+        # recordings are split into segments, an encoder restart also starts a new one
+        self.record_segment = 0
+        self.record_base_name = ""
+        self.record_file_name = ""
+        self.record_next_file_name = ""
+        self.record_roll_frame = -1  # the frame the next segment starts on, if rolling
+        self.segment_start_time = 0.0
+        self.segment_index = SegmentIndex()
+        self.storage_monitor = StorageMonitor()
+        # frames written to the recording encoder since it started, and the sensor
+        # timestamps of the ones in the pre-event buffer for the frame index
+        self.record_frames = 0
+        self.record_timestamps: Deque[int] = deque()
+        self.record_launches = 0  # the recording encoder's launches counted so far
+        self.record_bitrate = record_bitrate
+        self.record_profile = record_profile
+        self.record_audio = record_audio
+        self.pre_event_buffer.container = record_profile
+        self.set_pre_event_seconds(self.pre_event_buffer.seconds)
+        self.frame_index: Optional[FrameIndexWriter] = None
+        # instrumentation
+        self.stage_stats = StageStats()
+        self.last_stats_publish_time = 0.0
+        self.memory_monitor = MemoryMonitor()
         # tracking
         self.tracker = ObjectTracker()
         self.track_status = TrackStatus.NONE.value
 
+    @property
+    def gps_data(self) -> MavlinkGPSData:
+        return self.telemetry.get_gps_data()
+
+    @property
+    def misc_data(self) -> MavlinkMiscData:
+        return self.telemetry.get_misc_data()
+
     def _init_ffmpeg_processes(self) -> None:
         """
         Only needs to be done once at the start of the stream.
@@ -141,24 +308,47 @@ class PiStreamer2:
         if not self.gcs_ip and not self.gcs_port:
             raise Exception("GCS IP and port must be set to stream to a GCS.")
 
-        self.ffmpeg_command_record = get_ffmpeg_command_record(
-            self.resolution,
-            str(FRAMERATE),
-            f"{MEDIA_FILES_DIRECTORY}/{get_timestamp()}.ts",
-        )
-        self.ffmpeg_command_rtp = get_ffmpeg_command_rtp(
+        self.ffmpeg_command_record = self._get_ffmpeg_command_record()
+        self.ffmpeg_command_rtp = self._get_ffmpeg_command_rtp()
+        self.ffmpeg_command_mpeg_ts = get_ffmpeg_command_mpeg_ts(
             self.resolution,
-            str(FRAMERATE),
+            str(self.decimators[SinkType.MPEG_TS.value].framerate),
             str(self.gcs_ip),
             str(self.gcs_port),
             str(self.streaming_bitrate),
+            intra_refresh=self.intra_refresh,
         )
-        self.ffmpeg_command_mpeg_ts = get_ffmpeg_command_mpeg_ts(
+
+    def _get_ffmpeg_command_record(self) -> List[str]:
+        return get_ffmpeg_command_record(
+            self.record_resolution,
+            str(self.decimators[SinkType.RECORD.value].framerate),
+            str(self.record_bitrate),
+            self.record_profile,
+            self.record_audio,
+        )
+
+    def _get_ffmpeg_command_rtp(self) -> List[str]:
+        ip, port = str(self.gcs_ip), str(self.gcs_port)
+        if self.fec_relay.group_size:
+            ip, port = "127.0.0.1", str(self.fec_relay.relay_port)
+        return get_ffmpeg_command_rtp(
             self.resolution,
-            str(FRAMERATE),
-            str(self.gcs_ip),
-            str(self.gcs_port),
+            str(self.decimators[SinkType.RTP.value].framerate),
+            ip,
+            port,
             str(self.streaming_bitrate),
+            intra_refresh=self.intra_refresh,
+        )
+
+    def _get_ffmpeg_command_secondary(self) -> List[str]:
+        return get_ffmpeg_command_rtp(
+            self.secondary_resolution,
+            str(self.decimators[SinkType.SECONDARY.value].framerate),
+            self.secondary_ip,
+            self.secondary_port,
+            str(self.secondary_bitrate),
+            intra_refresh=self.intra_refresh,
         )
 
     def __del__(self):
@@ -218,92 +408,492 @@ class PiStreamer2:
         return stabilized_frame
 
     def start_recording(self, file_name: str = "") -> None:
+        """
+        The recording encoder runs for the whole stream, so recording only starts writing its
+        output to a file, beginning with the pre-event buffer. Recordings are split into
+        segments of RECORD_SEGMENT_SECONDS or RECORD_SEGMENT_BYTES.
+        """
         if self.is_recording:
             print("Already recording...")
             return
 
         self.recording_start_time = int(time.time())
+        if self.encoder_record.state == EncoderState.STOPPED:
+            self.encoder_record.start()  # nothing is buffered, it starts on the next keyframe
 
-        if file_name:
-            self.ffmpeg_command_record = get_ffmpeg_command_record(
-                self.resolution, str(FRAMERATE), file_name
-            )
-
-        self.ffmpeg_process_record = subprocess.Popen(  # type: ignore
-            self.ffmpeg_command_record, stdin=subprocess.PIPE
+        extension = get_record_extension(self.record_profile)
+        self.record_base_name = (
+            file_name or f"{MEDIA_FILES_DIRECTORY}/{get_timestamp()}{extension}"
         )
+        self.record_segment = 0
+        self._start_segment(self.record_base_name)
+        first_frame = self.pre_event_buffer.start_recording(self.record_file_name)
         self.is_recording = True
+        # index the buffered frames, frames dropped from the timestamps are left out
+        skipped = first_frame - (self.record_frames - len(self.record_timestamps))
+        for sensor_timestamp_ns in itertools.islice(
+            self.record_timestamps, max(skipped, 0), None
+        ):
+            self._append_frame_index(sensor_timestamp_ns)
+        self._publish_recording_state()
+
+    def set_pre_event_seconds(self, seconds: float) -> None:
+        self.pre_event_buffer.seconds = seconds
+        # covers the buffer, its newest GOP and the frames still in the encoder
+        self.record_timestamps = deque(
+            self.record_timestamps,
+            maxlen=int((seconds + 2) * FRAMERATE) + ENCODER_QUEUE_FRAMES,
+        )
+
+    def set_record_settings(self, bitrate: int, profile: str, audio: bool) -> None:
+        """
+        The recording encoder is restarted with the new settings, which empties the pre-event
+        buffer. A recording continues in the next segment.
+        """
+        self.record_bitrate = bitrate
+        self.record_profile = profile
+        self.record_audio = audio
+        self.pre_event_buffer.container = profile
+        self.ffmpeg_command_record = self._get_ffmpeg_command_record()
+        self._restart_encoder(self.encoder_record)
+
+    def set_sink_framerate(self, sink: str, framerate: int) -> None:
+        """
+        The sink's encoder is restarted at the new rate, so like set_record_settings a
+        recording continues in the next segment.
+        """
+        self.decimators[sink].set_framerate(framerate)
+        if sink == SinkType.RECORD.value:
+            self.ffmpeg_command_record = self._get_ffmpeg_command_record()
+            self._restart_encoder(self.encoder_record)
+        elif sink == SinkType.RTP.value:
+            self.ffmpeg_command_rtp = self._get_ffmpeg_command_rtp()
+            self._restart_encoder(self.encoder_rtp)
+        elif sink == SinkType.SECONDARY.value:
+            self._restart_encoder(self.encoder_secondary)
+        elif sink == SinkType.RTSP.value:
+            self.rtsp_server.framerate = framerate
+            self._restart_encoder(self.encoder_rtsp)
+        else:  # the MPEG-TS command is made when it is spawned
+            self._restart_encoder(self.encoder_mpeg_ts)
+
+    def set_intra_refresh(self, intra_refresh: bool) -> None:
+        """
+        Restarts the streams' encoders, see get_stream_encoder_args.
+        """
+        self.intra_refresh = intra_refresh
+        self.ffmpeg_command_rtp = self._get_ffmpeg_command_rtp()
+        for encoder in (
+            self.encoder_rtp,
+            self.encoder_mpeg_ts,
+            self.encoder_secondary,
+            self.encoder_rtsp,
+        ):
+            encoder.intra_refresh = intra_refresh
+            self._restart_encoder(encoder)
+
+    def request_keyframe(self, secondary: bool = False) -> None:
+        """
+        For a GCS joining the stream, the GCS stream's encoder or the secondary's. A new
+        destination needs none as the encoders are started again for it. The pushed streams
+        have the GCS as their only receiver, the RTSP encoder is only restarted for it if
+        no viewer is playing.
+        """
+        if secondary:
+            self.encoder_secondary.request_keyframe()
+            return
+        self.encoder_rtp.request_keyframe()
+        self.encoder_mpeg_ts.request_keyframe()
+        self.encoder_rtsp.request_keyframe(restart=not self.rtsp_server.viewers)
+
+    def _restart_encoder(self, encoder: EncoderSupervisor) -> None:
+        if encoder.state != EncoderState.STOPPED:
+            encoder.stop()
+            encoder.start()
+
+    def _get_segment_name(self, segment: int) -> str:
+        if not segment:
+            return self.record_base_name
+        path = Path(self.record_base_name)
+        # the profile may have changed since the recording started
+        extension = get_record_extension(self.record_profile)
+        return str(path.with_name(f"{path.stem}_{segment}{extension}"))
+
+    def _start_segment(self, file_name: str) -> None:
+        """
+        Starts the frame index and segment index entry of a new recording file.
+        """
+        if self.frame_index:
+            self.frame_index.close()
+            self.frame_index = None  # opened with the first frame
+        self.record_file_name = file_name
+        self.record_roll_frame = -1
+        self.segment_start_time = time.monotonic()
+        self.segment_index.add(file_name)
+
+    def _roll_segment(self) -> None:
+        """
+        Continues the recording in the next segment from the next keyframe. The recording
+        has a keyframe every second, so the frame index rolls on that frame too.
+        """
+        self.record_segment += 1
+        self.record_next_file_name = self._get_segment_name(self.record_segment)
+        framerate = self.decimators[SinkType.RECORD.value].framerate
+        self.record_roll_frame = -(-self.record_frames // framerate) * framerate
+        self.pre_event_buffer.roll(self.record_next_file_name, self.record_roll_frame)
+
+    def _check_recording(self) -> None:
+        """
+        Called from the stream loop, indexes the closed segments and rolls the segment.
+        """
+        while self.pre_event_buffer.closed_files:
+            self.segment_index.close(*self.pre_event_buffer.closed_files.popleft())
+        if not self.is_recording:
+            return
+        if not self.pre_event_buffer.is_recording:
+            if self.pre_event_buffer.write_error:
+                print(f"Recording failed: {self.pre_event_buffer.write_error}")
+                self.stop_recording()
+            return  # or the encoder is restarting, see _on_record_launch
+        if self.record_roll_frame >= 0 or self.pre_event_buffer.is_rolling:
+            return  # the last roll hasn't reached the frame index or the file yet
+        if (
+            time.monotonic() - self.segment_start_time >= RECORD_SEGMENT_SECONDS
+            or self.pre_event_buffer.bytes_written >= RECORD_SEGMENT_BYTES
+        ):
+            self._roll_segment()
+
+    def _check_storage(self) -> None:
+        """
+        Deletes the oldest segments when the SD card runs low and stops the recording
+        before it fills up, rather than letting ffmpeg fail mid-flight.
+        """
+        polled_bytes = self.storage_monitor.poll()
+        if polled_bytes is None:
+            return
+        free_bytes: int = polled_bytes
+        deleted = 0
+        while free_bytes < STORAGE_MIN_FREE_BYTES:
+            segment = self.segment_index.pop_oldest()
+            if segment is None:
+                break
+            print(f"Low on storage, deleting {segment['file']}")
+            for file_name in (segment["file"], get_frame_index_path(segment["file"])):
+                try:
+                    os.remove(file_name)
+                except FileNotFoundError:
+                    pass
+            free_bytes += segment["bytes"]
+            deleted += 1
+        if free_bytes < STORAGE_RESERVED_BYTES and self.is_recording:
+            print("The SD card is full, stopping the recording")
+            self.stop_recording()
+        self.command_service.publish(
+            TelemetryTopic.STORAGE.value,
+            json.dumps(
+                {
+                    "free_mb": free_bytes // (1024 * 1024),
+                    "segments": len(self.segment_index.segments),
+                    "deleted": deleted,
+                }
+            ),
+        )
+
+    def _spawn_record(self) -> Any:
+        """
+        On the supervisor's thread. The encoder starts a new stream, so its output stops
+        going to the file until _on_record_launch picks the file for it.
+        """
+        self.pre_event_buffer.stop_recording()
+        self.pre_event_buffer.reset()
+        return self._spawn_encoder(self.ffmpeg_command_record, stdout=subprocess.PIPE)
+
+    def _on_record_launch(self) -> None:
+        """
+        From the stream loop, with the first frame the new recording encoder took. A
+        restart while recording continues in the next segment.
+        """
+        self.record_launches = self.encoder_record.launches
+        self.record_frames = 0
+        self.record_timestamps.clear()
+        if self.is_recording:
+            if self.frame_index:  # the segment has frames from the last encoder
+                self.record_segment += 1
+                self._start_segment(self._get_segment_name(self.record_segment))
+            self.pre_event_buffer.start_recording(self.record_file_name)
+
+    def _record_frame_written(self, sensor_timestamp: int) -> None:
+        """
+        Counts a frame the recording encoder took, from the stream loop.
+        """
+        if self.encoder_record.launches != self.record_launches:
+            self._on_record_launch()
+        if self.record_frames == self.record_roll_frame:
+            self._start_segment(self.record_next_file_name)
+        self.record_frames += 1
+        self.record_timestamps.append(sensor_timestamp)
+        if self.is_recording:
+            self._append_frame_index(sensor_timestamp)
 
     def stop_recording(self) -> None:
-        if self.is_recording and self.ffmpeg_process_record:
+        """
+        The pre-event buffer's writer finishes the file and syncs it to the SD card, the
+        stream loop indexes it once it is closed.
+        """
+        if self.is_recording:
             print("Stopping recording...")
-            if self.ffmpeg_process_record.stdin:
-                self.ffmpeg_process_record.stdin.close()
-            self.ffmpeg_process_record.wait()
+        if self.frame_index:
+            self.frame_index.close()
+            self.frame_index = None
+        self.pre_event_buffer.stop_recording()
         self.is_recording = False
-        os.sync()  # type: ignore
+        self._check_recording()
+        self._publish_recording_state()
 
     def start_rtp_stream(self, ip: str, port: str) -> None:
+        self.stop_srt_stream()
         self.stop_mpeg_ts_stream()
+        self.stop_rtsp_stream()
         if self.is_rtp_streaming:
             print("Already RTP streaming...")
             return
         self.gcs_ip = ip
         self.gcs_port = port
         self.streaming_protocol = StreamingProtocolType.RTP.value
-        self.ffmpeg_command_rtp = get_ffmpeg_command_rtp(
-            self.resolution,
-            str(FRAMERATE),
-            self.gcs_ip,
-            str(self.gcs_port),
-            str(self.streaming_bitrate),
-        )
+        self.ffmpeg_command_rtp = self._get_ffmpeg_command_rtp()
         print(f"Starting RTP stream {self.ffmpeg_command_rtp}")
-        self.ffmpeg_process_rtp = subprocess.Popen(  # type: ignore
-            self.ffmpeg_command_rtp, stdin=subprocess.PIPE
-        )
+        if self.fec_relay.group_size:
+            self.fec_relay.start(ip, int(port))
+        self.encoder_rtp.start()
         if not self.picam2.started:
             self.picam2.start()
         self.is_rtp_streaming = True
 
+    def _spawn_rtp(self) -> Any:
+        return self._spawn_encoder(self.ffmpeg_command_rtp)
+
     def stop_rtp_stream(self) -> None:
         self.is_rtp_streaming = False
-        if self.ffmpeg_process_rtp:
+        if self.encoder_rtp.state != EncoderState.STOPPED:
             print("Stopping RTP stream...")
-            if self.ffmpeg_process_rtp.stdin:
-                self.ffmpeg_process_rtp.stdin.close()
-            self.ffmpeg_process_rtp.wait()
+        self.encoder_rtp.stop()
+        self.fec_relay.stop()
+
+    def set_fec(self, group_size: int, interleave: int) -> None:
+        """
+        A parity packet per group_size RTP packets, 0 to send plain RTP. Restarts the RTP
+        stream as the encoder's destination changes, the relay is stopped before its
+        protection is changed as its thread is using the parity groups.
+        """
+        is_rtp_streaming = self.is_rtp_streaming
+        if is_rtp_streaming:
+            self.stop_rtp_stream()
+        self.fec_relay.set_protection(group_size, interleave)
+        if is_rtp_streaming:
+            self.start_rtp_stream(str(self.gcs_ip), str(self.gcs_port))
 
     def start_mpeg_ts_stream(self, ip: str, port: str) -> None:
+        self.stop_srt_stream()
         self.stop_rtp_stream()
+        self.stop_rtsp_stream()
         if self.is_mpeg_ts_streaming:
             print("Already MPEG-TS streaming...")
             return
         self.gcs_ip = ip
         self.gcs_port = port
         self.streaming_protocol = StreamingProtocolType.MPEG_TS.value
+        self.encoder_mpeg_ts.start()
+        if not self.picam2.started:
+            self.picam2.start()
+        self.is_mpeg_ts_streaming = True
+
+    def _spawn_mpeg_ts(self) -> Any:
+        # KLV metadata goes to ffmpeg over its own pipe, the write end is non-blocking so
+        # a slow ffmpeg drops metadata rather than stalling the frame loop
+        klv_read_fd, klv_fd = os.pipe()
+        os.set_blocking(klv_fd, False)
+        with self.klv_lock:
+            self.klv_fd = klv_fd
+        ip, port, packet_size = str(self.gcs_ip), str(self.gcs_port), None
+        if self.is_srt_streaming:
+            ip, port = "127.0.0.1", str(self.srt_transmitter.relay_port)
+            packet_size = SRT_PAYLOAD_SIZE
         self.ffmpeg_command_mpeg_ts = get_ffmpeg_command_mpeg_ts(
             self.resolution,
-            str(FRAMERATE),
-            self.gcs_ip,
-            str(self.gcs_port),
+            str(self.decimators[SinkType.MPEG_TS.value].framerate),
+            ip,
+            port,
             str(self.streaming_bitrate),
+            klv_fd=klv_read_fd,
+            packet_size=packet_size,
+            intra_refresh=self.intra_refresh,
         )
         print(f"Starting MPEG-TS stream {self.ffmpeg_command_mpeg_ts}")
-        self.ffmpeg_process_mpeg_ts = subprocess.Popen(  # type: ignore
-            self.ffmpeg_command_mpeg_ts, stdin=subprocess.PIPE
-        )
-        if not self.picam2.started:
-            self.picam2.start()
-        self.is_mpeg_ts_streaming = True
+        try:
+            return self._spawn_encoder(
+                self.ffmpeg_command_mpeg_ts, pass_fds=(klv_read_fd,)
+            )
+        except Exception:
+            self._close_klv_pipe()
+            raise
+        finally:
+            os.close(klv_read_fd)
+
+    def _close_klv_pipe(self) -> None:
+        with self.klv_lock:
+            if self.klv_fd is not None:
+                os.close(self.klv_fd)
+                self.klv_fd = None
 
     def stop_mpeg_ts_stream(self) -> None:
         self.is_mpeg_ts_streaming = False
-        if self.ffmpeg_process_mpeg_ts:
+        if self.encoder_mpeg_ts.state != EncoderState.STOPPED:
             print("Stopping MPEG-TS streaming...")
-            if self.ffmpeg_process_mpeg_ts.stdin:
-                self.ffmpeg_process_mpeg_ts.stdin.close()
-            self.ffmpeg_process_mpeg_ts.wait()
+        self.encoder_mpeg_ts.stop()
+
+    def start_srt_stream(self, ip: str, port: str) -> None:
+        """
+        The MPEG-TS stream over SRT, see srt_transmitter.py.
+        """
+        self.stop_rtp_stream()
+        self.stop_rtsp_stream()
+        if self.is_srt_streaming:
+            print("Already SRT streaming...")
+            return
+        self.stop_mpeg_ts_stream()  # its destination changes
+        self.gcs_ip = ip
+        self.gcs_port = port
+        self.streaming_protocol = StreamingProtocolType.SRT.value
+        self.srt_transmitter.start(ip, int(port))
+        self.is_srt_streaming = True
+        self.encoder_mpeg_ts.start()
+        if not self.picam2.started:
+            self.picam2.start()
+        self.is_mpeg_ts_streaming = True
+
+    def stop_srt_stream(self) -> None:
+        if self.is_srt_streaming:
+            self.stop_mpeg_ts_stream()
+        self.is_srt_streaming = False
+        self.srt_transmitter.stop()
+
+    def set_srt(self, latency_ms: int, overhead_percent: int) -> None:
+        """
+        SRT's receive buffer and retransmission bandwidth, restarts the SRT stream.
+        """
+        self.srt_transmitter.set_arq(latency_ms, overhead_percent)
+        if self.is_srt_streaming:
+            self.stop_srt_stream()
+            self.start_srt_stream(str(self.gcs_ip), str(self.gcs_port))
+
+    def start_rtsp_stream(self, ip: str, port: str) -> None:
+        """
+        Serves the stream to RTSP viewers instead of sending it to the GCS, the ip and port
+        are kept for switching back. The encoder is started and stopped by
+        _check_rtsp_viewers.
+        """
+        self.stop_srt_stream()
+        self.stop_rtp_stream()
+        self.stop_mpeg_ts_stream()
+        if self.is_rtsp_streaming:
+            print("Already serving RTSP...")
+            return
+        self.gcs_ip = ip
+        self.gcs_port = port
+        self.streaming_protocol = StreamingProtocolType.RTSP.value
+        self.rtsp_server.framerate = self.decimators[SinkType.RTSP.value].framerate
+        self.rtsp_server.start()
+        if not self.picam2.started:
+            self.picam2.start()
+        self.is_rtsp_streaming = True
+
+    def _spawn_rtsp(self) -> Any:
+        command = get_ffmpeg_command_rtp(
+            self.resolution,
+            str(self.decimators[SinkType.RTSP.value].framerate),
+            "127.0.0.1",
+            str(RTSP_RELAY_PORT),
+            str(self.streaming_bitrate),
+            intra_refresh=self.intra_refresh,
+        )
+        print(f"Starting RTSP encoder {command}")
+        return self._spawn_encoder(command)
+
+    def _check_rtsp_viewers(self) -> None:
+        """
+        Called from the stream loop, runs the encoder only while the server has viewers.
+        """
+        is_wanted = self.rtsp_server.is_wanted()
+        is_stopped = self.encoder_rtsp.state == EncoderState.STOPPED
+        if is_wanted and is_stopped:
+            print("RTSP viewer connecting, starting the encoder")
+            self.encoder_rtsp.start()
+        elif not is_wanted and not is_stopped:
+            print("No RTSP viewers, stopping the encoder")
+            self.encoder_rtsp.stop()
+        if self.rtsp_server.take_keyframe_request():
+            # the viewers already playing would see a restart
+            self.encoder_rtsp.request_keyframe(restart=self.rtsp_server.viewers <= 1)
+
+    def stop_rtsp_stream(self) -> None:
+        self.is_rtsp_streaming = False
+        if self.rtsp_server.is_running:
+            print("Stopping RTSP server...")
+        self.encoder_rtsp.stop()
+        self.rtsp_server.stop()
+
+    def start_secondary_stream(self, ip: str, port: str, bitrate: int) -> None:
+        """
+        Simulcasts the same capture at secondary_resolution over RTP to a second GCS, at a
+        bitrate for its own link. Starting it again moves it to the new destination.
+        """
+        if not self.secondary_resolution:
+            raise Exception(
+                "No secondary stream is configured, pistreamer must be started with --secondary_resolution."
+            )
+        self.secondary_ip = ip
+        self.secondary_port = port
+        self.secondary_bitrate = bitrate
+        self.encoder_secondary.stop()
+        print(f"Starting secondary stream {self._get_ffmpeg_command_secondary()}")
+        self.encoder_secondary.start()
+        self.is_secondary_streaming = True
+
+    def resume_secondary_stream(self) -> None:
+        """
+        Restarts the secondary encoder after stop_and_clean_all, i.e. when the GCS stream
+        is moved, so it keeps streaming to its own destination.
+        """
+        if self.is_secondary_streaming and (
+            self.encoder_secondary.state == EncoderState.STOPPED
+        ):
+            self.encoder_secondary.start()
+
+    def _spawn_secondary(self) -> Any:
+        # made on each spawn so a restart picks up a new frame rate
+        return self._spawn_encoder(self._get_ffmpeg_command_secondary())
+
+    def stop_secondary_stream(self) -> None:
+        self.is_secondary_streaming = False
+        if self.encoder_secondary.state != EncoderState.STOPPED:
+            print("Stopping secondary stream...")
+        self.encoder_secondary.stop()
+
+    def _scale_secondary(self, frame: np.ndarray) -> bytes:
+        """
+        Scales a YUV420 stream frame to secondary_resolution, plane by plane, for when the
+        ISP's lores output is already the stream.
+        """
+        width, height = self.resolution
+        secondary_width, secondary_height = self.secondary_resolution
+        chroma = frame[height:].reshape(2, height // 2, width // 2)
+        planes = [(frame[:height], (secondary_width, secondary_height))] + [
+            (plane, (secondary_width // 2, secondary_height // 2)) for plane in chroma
+        ]
+        return b"".join(
+            cv2.resize(plane, size, interpolation=cv2.INTER_AREA).tobytes()
+            for plane, size in planes
+        )
 
     def take_photo(self, file_name: str = "") -> None:
         """
@@ -331,8 +921,10 @@ class PiStreamer2:
 
         if not file_name:
             file_name = str(f"{get_timestamp()}.jpg")
-        self.picam2.capture_file(file_name)
+        metadata = self.picam2.capture_file(file_name)
         os.sync()  # type: ignore
+        # Geotag with the telemetry at the moment of exposure rather than the latest message
+        sensor_timestamp = (metadata or {}).get("SensorTimestamp") or 0
 
         if not is_same_resolution:
             self.picam2.stop()
@@ -340,8 +932,38 @@ class PiStreamer2:
             self.command_controller.set_zoom(_original_zoom)
             self.picam2.start()
 
-        # Lastly update the photo with the exif data
-        EXIFService(self.gps_data, self.misc_data, file_name).add_metadata()
+        # Lastly update the photo with the exif data, once the telemetry from after the
+        # exposure has arrived so it is interpolated
+        self.pending_geotags.append(
+            (file_name, sensor_timestamp, time.monotonic() + PHOTO_GEOTAG_TIMEOUT)
+        )
+        self._write_geotags()
+
+    def _write_geotags(self, force: bool = False) -> None:
+        """
+        Writes the EXIF data of the photos the telemetry history covers, and of those that
+        waited for it for PHOTO_GEOTAG_TIMEOUT, with the telemetry extrapolated. Called
+        after the commands are handled, as the GPS and MISC data are commands.
+        """
+        while self.pending_geotags:
+            file_name, sensor_timestamp, deadline = self.pending_geotags[0]
+            if not (
+                force
+                or not sensor_timestamp
+                or self.telemetry.covers(sensor_timestamp)
+                or time.monotonic() >= deadline
+            ):
+                return  # the photos after it were taken later
+            del self.pending_geotags[0]
+            timestamp_ns = sensor_timestamp or None  # the latest without a timestamp
+            try:
+                EXIFService(
+                    self.telemetry.get_gps_data(timestamp_ns),
+                    self.telemetry.get_misc_data(timestamp_ns),
+                    file_name,
+                ).add_metadata()
+            except Exception as e:
+                print(f"Failed to geotag {file_name}: {e}")
 
     def _format_duration(self, seconds: int) -> str:
         """Convert a duration in seconds to a minutes:seconds format."""
@@ -349,7 +971,7 @@ class PiStreamer2:
         remaining_seconds = seconds % 60
         return str(f"{minutes}:{remaining_seconds:02d}")
 
-    def _draw_zoom_level(self, frame: np.ndarray) -> np.ndarray:
+    def _draw_zoom_level(self, frame: np.ndarray) -> memoryview:
         """
         Paints zoom level near the center of the frame while zoom is changing.
         """
@@ -376,9 +998,9 @@ class PiStreamer2:
             line_type,
         )
         frame_yuv = cv2.cvtColor(frame, cv2.COLOR_RGB2YUV_I420)
-        return frame_yuv.tobytes()
+        return frame_yuv.data
 
-    def _draw_rec(self, frame: np.ndarray) -> bytes:
+    def _draw_rec(self, frame: np.ndarray) -> memoryview:
         """
         Paints "REC" on the top of streams (but not the saved video).
         """
@@ -397,28 +1019,227 @@ class PiStreamer2:
             frame, text, (text_x, text_y), font, font_scale, color, thickness, line_type
         )
         frame_yuv = cv2.cvtColor(frame, cv2.COLOR_RGB2YUV_I420)
-        return frame_yuv.tobytes()
+        return frame_yuv.data
+
+    def _append_frame_index(self, sensor_timestamp_ns: int) -> None:
+        """
+        Adds the telemetry at the time the recorded frame was exposed to the sidecar.
+        """
+        if self.frame_index is None:
+            self.frame_index = FrameIndexWriter(
+                get_frame_index_path(self.record_file_name),
+                self.decimators[SinkType.RECORD.value].framerate,
+            )
+        bbox = NO_BBOX
+        if self.track_status == TrackStatus.ACTIVE.value:
+            x, y, w, h = self.tracker.bounding_box
+            # tracked on the stream, indexed in the recording's pixels
+            scale_x = self.record_resolution[0] / self.resolution[0]
+            scale_y = self.record_resolution[1] / self.resolution[1]
+            bbox = (
+                int(x * scale_x),
+                int(y * scale_y),
+                int(w * scale_x),
+                int(h * scale_y),
+            )
+        self.frame_index.append(
+            sensor_timestamp_ns,
+            self.telemetry.gps.interpolate(sensor_timestamp_ns),
+            self.telemetry.attitude.interpolate(sensor_timestamp_ns),
+            self.command_controller.current_zoom,
+            bbox,
+        )
+
+    def _write_klv(self, sensor_timestamp: int) -> None:
+        """
+        Sends the telemetry at the frame's exposure as a MISB ST 0601 packet next to it.
+        """
+        packet = self.klv_encoder.encode(
+            time.time_ns() // 1000,
+            self.telemetry.gps.interpolate(sensor_timestamp),
+            self.telemetry.attitude.interpolate(sensor_timestamp),
+        )
+        try:
+            with self.klv_lock:
+                if self.klv_fd is None:
+                    return  # the encoder is being restarted
+                os.write(self.klv_fd, packet)
+        except BlockingIOError:
+            # the pipe is full, skip this frame's packet
+            self.stage_stats.increment("klv_dropped")
+        except BrokenPipeError:
+            # ffmpeg has exited, its supervisor restarts it and the pipe
+            self.stage_stats.increment("klv_dropped")
+
+    def _publish_recording_state(self) -> None:
+        duration = (
+            int(time.time() - self.recording_start_time) if self.is_recording else 0
+        )
+        self.command_service.publish(
+            TelemetryTopic.RECORDING.value,
+            json.dumps({"active": self.is_recording, "duration": duration}),
+        )
+
+    def _publish_status(self, fps: float) -> None:
+        """
+        State topics are republished with every fps update so late subscribers catch up.
+        """
+        self.command_service.publish(TelemetryTopic.FPS.value, f"{fps:.1f}")
+        self.command_service.publish(
+            TelemetryTopic.ENCODER.value,
+            json.dumps(
+                {
+                    "protocol": self.streaming_protocol,
+                    "bitrate": self.streaming_bitrate,
+                    "resolution": f"{self.resolution[0]}x{self.resolution[1]}",
+                    "rtp": self.is_rtp_streaming,
+                    "mpegts": self.is_mpeg_ts_streaming,
+                    "record": self.is_recording,
+                    "secondary": self.is_secondary_streaming,
+                    "rtsp": self.is_rtsp_streaming,
+                    "rtsp_viewers": self.rtsp_server.viewers,
+                    "srt": self.is_srt_streaming,
+                    "intra_refresh": self.intra_refresh,
+                    "encoder_backend": self.encoder_backend,
+                }
+            ),
+        )
+        if self.is_srt_streaming:
+            self.command_service.publish(
+                TelemetryTopic.SRT.value, json.dumps(self.srt_transmitter.metrics())
+            )
+        self._publish_recording_state()
+        self.command_service.publish(
+            TelemetryTopic.ENCODER_HEALTH.value,
+            json.dumps(
+                {
+                    encoder.sink: encoder.metrics()
+                    | self.decimators[encoder.sink].metrics()
+                    for encoder in (
+                        self.encoder_record,
+                        self.encoder_rtp,
+                        self.encoder_mpeg_ts,
+                        self.encoder_secondary,
+                        self.encoder_rtsp,
+                    )
+                }
+                | {
+                    "pre_event": self.pre_event_buffer.metrics(),
+                    "rtsp_server": self.rtsp_server.metrics(),
+                    "fec": self.fec_relay.metrics(),
+                }
+            ),
+        )
+        self.command_service.publish(
+            TelemetryTopic.COMMANDS.value,
+            json.dumps(
+                {
+                    "received": self.command_service.commands_received,
+                    "collapsed": self.command_service.commands_collapsed,
+                }
+            ),
+        )
+
+    def _check_encoders(self) -> None:
+        """
+        Restarts failed encoders, the health is published with the status.
+        """
+        for encoder in (
+            self.encoder_record,
+            self.encoder_rtp,
+            self.encoder_mpeg_ts,
+            self.encoder_secondary,
+            self.encoder_rtsp,
+        ):
+            encoder.check()
+        self.srt_transmitter.check()
+
+    def _publish_stats(self) -> None:
+        now = time.monotonic()
+        if now - self.last_stats_publish_time < STATS_PUBLISH_INTERVAL:
+            return
+        self.last_stats_publish_time = now
+        self.command_service.publish(
+            TelemetryTopic.STATS.value, json.dumps(self.stage_stats.summary())
+        )
+
+    def _publish_memory(self) -> None:
+        sample = self.memory_monitor.poll()
+        if sample:
+            self.command_service.publish(
+                TelemetryTopic.MEMORY.value, json.dumps(sample)
+            )
+
+    def _publish_tracking_box(self) -> None:
+        if self.track_status == TrackStatus.ACTIVE.value:
+            x, y, w, h = [int(v) for v in self.tracker.bounding_box]
+            self.command_service.publish(
+                TelemetryTopic.TRACKING.value, f"{x},{y},{w},{h}"
+            )
+        else:
+            self.command_service.publish(TelemetryTopic.TRACKING.value, "")
+
+    def _spawn_encoder(self, command: List[str], **kwargs: Any) -> Any:
+        """
+        Starts an ffmpeg process that reads raw frames from stdin, or with the pyav backend
+        runs the same command in this process. Overridden by the benchmarks to run without
+        ffmpeg, see _fake_devices.py.
+        """
+        if self.encoder_backend == EncoderBackend.PYAV.value:
+            if PyAvEncoderProcess.supports(command):
+                return PyAvEncoderProcess(command, **kwargs)
+            print(f"The pyav encoder backend can't run {command}, starting ffmpeg")
+        return subprocess.Popen(command, stdin=subprocess.PIPE, **kwargs)
+
+    def _wait_for_encoders(self) -> None:
+        """
+        The encoders are stopped on their supervisors' threads, this waits for them to
+        exit before pistreamer does.
+        """
+        for encoder in (
+            self.encoder_record,
+            self.encoder_rtp,
+            self.encoder_mpeg_ts,
+            self.encoder_secondary,
+            self.encoder_rtsp,
+        ):
+            if not encoder.wait(ENCODER_STOP_TIMEOUT * 3):
+                print(f"The {encoder.sink} encoder didn't stop")
 
     def _close_ffmpeg_processes(self) -> None:
         self.stop_recording()
+        self.encoder_record.stop()
         self.stop_rtp_stream()
+        self.stop_srt_stream()
         self.stop_mpeg_ts_stream()
+        self.stop_rtsp_stream()
+        self.encoder_secondary.stop()  # see resume_secondary_stream
 
     def stop_and_clean_all(self) -> None:
         print("Stopping and cleaning camera resources...")
+        self._write_geotags(force=True)
         if self.picam2:
             self.picam2.stop()
-        cv2.destroyAllWindows()
+        try:
+            cv2.destroyAllWindows()
+        except cv2.error:
+            pass  # headless OpenCV builds have no window support
         self._close_ffmpeg_processes()
 
     def _read_and_process_commands(self) -> None:
-        commands = self.command_service.get_pending_commands()
+        received = self.command_service.commands_received
+        commands = self.command_service.get_coalesced_commands()
+        self.stage_stats.set_queue_depth(
+            self.command_service.commands_received - received
+        )
         for command in commands:
             if self.verbose:
                 print(f"Processing command `{command}`")
             try:
                 self.command_controller.handle_command(
-                    command_type=command[0], command_value=command[1]
+                    command_type=command[0],
+                    command_value=command[1],
+                    received_ns=command[2],
                 )
             except Exception as e:
                 print(f"Error processing command: {e}")
@@ -644,90 +1465,239 @@ class PiStreamer2:
             self.start_rtp_stream(ip=str(self.gcs_ip), port=str(self.gcs_port))
         elif self.streaming_protocol == StreamingProtocolType.MPEG_TS.value:
             self.start_mpeg_ts_stream(ip=str(self.gcs_ip), port=str(self.gcs_port))
+        elif self.streaming_protocol == StreamingProtocolType.RTSP.value:
+            self.start_rtsp_stream(ip=str(self.gcs_ip), port=str(self.gcs_port))
+        elif self.streaming_protocol == StreamingProtocolType.SRT.value:
+            self.start_srt_stream(ip=str(self.gcs_ip), port=str(self.gcs_port))
         else:
             raise Exception("Invalid active GCS type")
 
         self.command_controller.set_zoom(MIN_ZOOM)
+        if self.command_controller.is_sd_card_available:
+            self.encoder_record.start()  # fills the pre-event buffer
+        self.memory_monitor.start()
 
         # Main loop
         fps_counter = 20
+        stage_stats = self.stage_stats
+        lap = stage_stats.lap
         try:
             i = 0
             startt = time.perf_counter()
             while True:
-                frame = self.picam2.capture_array()
+                frame_start_ns = stage_ns = time.perf_counter_ns()
+                # Capture the request rather than just the array to get the frame metadata
+                request = self.picam2.capture_request()
+                try:
+                    if self.is_dual_resolution:
+                        record_frame = request.make_array("main")
+                        frame = secondary_frame = request.make_array("lores")
+                    else:
+                        frame = request.make_array("main")
+                        if self.is_secondary_lores:
+                            secondary_frame = request.make_array("lores")
+                    sensor_timestamp = request.get_metadata().get("SensorTimestamp", 0)
+                finally:
+                    request.release()
+                stage_ns = lap(FrameStage.CAPTURE, stage_ns)
 
                 if frame is None or frame.size == 0:
                     print("Empty frame captured, skipping...")
+                    stage_stats.increment("empty_frames")
                     continue
+                stage_stats.count_frame(sensor_timestamp)
 
                 i += 1
                 if i % 2 == 0:
                     self._read_and_process_commands()
+                    if self.pending_geotags:
+                        self._write_geotags()
+                    stage_ns = lap(FrameStage.COMMANDS, stage_ns)
 
                 # Calculate fps
                 if i == fps_counter:
                     i = 0
+                    elapsed_time = time.perf_counter() - startt
+                    startt = time.perf_counter()
+                    self._publish_status(fps_counter / elapsed_time)
+                    self._publish_stats()
+                    self._publish_memory()
+                    self._check_encoders()
+                    self._check_recording()
+                    self._check_storage()
+                    profile_file = self.command_controller.profiler.check_duration()
+                    if profile_file:
+                        self.command_controller.send_profile(profile_file)
                     if self.verbose:
-                        elapsed_time = time.perf_counter() - startt
-                        startt = time.perf_counter()
                         fps.append(fps_counter / elapsed_time)
                         print(f"fps={fps_counter/elapsed_time} | ")
+                    stage_ns = time.perf_counter_ns()
 
-                if self.track_status == TrackStatus.INIT.value:
-                    ret = self.tracker._init_bounding_box(frame)
-                    if ret:
-                        frame = self.tracker.draw_bounding_box(frame, INIT_BBOX_COLOR)
-                        self.track_status = TrackStatus.ACTIVE.value
-
-                if self.track_status == TrackStatus.ACTIVE.value:
-                    frame = self.tracker.draw_bounding_box(frame, INIT_BBOX_COLOR)
-                    ret, frame = self.tracker.track_object(frame)
-                    if not ret:
-                        print("Tracking has been lost")
-                        self.track_status = TrackStatus.STOP.value
-
-                if self.stabilize:
-                    if self.prev_gray is None:
-                        self.prev_gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-                    frame = self._stabilize(frame)
+                if self.is_rtsp_streaming:
+                    self._check_rtsp_viewers()
 
                 if (
                     self.command_controller
                     and self.command_controller.zoom_status != ZoomStatus.STOP.value
                 ):
                     self.command_controller.do_continuous_zoom()
+                    stage_ns = lap(FrameStage.COMMANDS, stage_ns)
+
+                # Each sink takes the frames for its own frame rate, frames no sink takes
+                # are dropped here before they are processed
+                record_count = 0
+                if self.encoder_record.state != EncoderState.STOPPED:
+                    record_count = self.decimators[SinkType.RECORD.value].take(
+                        sensor_timestamp
+                    )
+                stream_sink = self.streaming_protocol
+                if stream_sink == StreamingProtocolType.SRT.value:
+                    # SRT relays the MPEG-TS encoder
+                    stream_sink = SinkType.MPEG_TS.value
+                stream_decimator = self.decimators[stream_sink]
+                stream_count = 0
+                if (
+                    self.is_rtp_streaming
+                    or self.is_mpeg_ts_streaming
+                    or self.encoder_rtsp.state != EncoderState.STOPPED
+                ):
+                    stream_count = stream_decimator.take(sensor_timestamp)
+                secondary_count = 0
+                if self.is_secondary_streaming:
+                    secondary_count = self.decimators[SinkType.SECONDARY.value].take(
+                        sensor_timestamp
+                    )
+                if not record_count and not stream_count and not secondary_count:
+                    stage_stats.increment("decimated_frames")
+                    self.command_service.flush_telemetry()
+                    lap(FrameStage.FRAME, frame_start_ns)
+                    continue
 
-                # Convert the frame back to YUV format before sending to FFmpeg
-                frame_8bit = cv2.convertScaleAbs(frame)
-                frame_yuv = cv2.cvtColor(frame_8bit, cv2.COLOR_RGB2YUV_I420)
-                frame_yuv_bytes = frame_yuv.tobytes()
-
-                if self.is_recording:
+                # the recording is the processed stream frame unless it has its own output
+                if stream_count or (record_count and not self.is_dual_resolution):
+                    is_tracking = self.track_status in (
+                        TrackStatus.INIT.value,
+                        TrackStatus.ACTIVE.value,
+                    )
+                    if self.is_dual_resolution and (
+                        is_tracking
+                        or self.stabilize
+                        or self.has_zoomed
+                        or self.command_controller.zoom_status != ZoomStatus.STOP.value
+                        or (self.is_mpeg_ts_streaming and self.is_recording)
+                    ):
+                        # the lores YUV420 is only converted when it is drawn on or analysed
+                        frame = cv2.cvtColor(frame, cv2.COLOR_YUV2RGB_I420)
+                        stage_ns = lap(FrameStage.CONVERT, stage_ns)
+                    if self.track_status == TrackStatus.INIT.value:
+                        ret = self.tracker._init_bounding_box(frame)
+                        if ret:
+                            frame = self.tracker.draw_bounding_box(
+                                frame, INIT_BBOX_COLOR
+                            )
+                            self.track_status = TrackStatus.ACTIVE.value
+
+                    if self.track_status == TrackStatus.ACTIVE.value:
+                        frame = self.tracker.draw_bounding_box(frame, INIT_BBOX_COLOR)
+                        ret, frame = self.tracker.track_object(frame)
+                        if not ret:
+                            print("Tracking has been lost")
+                            self.track_status = TrackStatus.STOP.value
+                        # Published at frame rate for GCS side overlays
+                        self._publish_tracking_box()
+                    if is_tracking:
+                        stage_ns = lap(FrameStage.TRACKING, stage_ns)
+
+                    if self.stabilize:
+                        if self.prev_gray is None:
+                            self.prev_gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+                        frame = self._stabilize(frame)
+                        stage_ns = lap(FrameStage.STABILIZE, stage_ns)
+
+                    # Convert the frame back to YUV format before sending to FFmpeg. The
+                    # encoders get a view of the new array rather than a copy, it isn't
+                    # changed after it is written
+                    if frame.ndim == 3:
+                        frame_8bit = cv2.convertScaleAbs(frame)
+                        frame_yuv = cv2.cvtColor(frame_8bit, cv2.COLOR_RGB2YUV_I420)
+                        frame_yuv_bytes = frame_yuv.data
+                        stage_ns = lap(FrameStage.CONVERT, stage_ns)
+                    else:  # the lores YUV420 as it came from the ISP
+                        frame_yuv_bytes = frame.data
+
+                for _ in range(record_count):
                     # The raw video that is saved should not have 'REC' appearing in the frame
-                    self.ffmpeg_process_record.stdin.write(frame_yuv_bytes)  # type: ignore
-
-                # Draw zoom level on the streaming frame
-                if not self.command_controller.zoom_status == ZoomStatus.STOP.value:
-                    frame_yuv_bytes = self._draw_zoom_level(frame_8bit)
-                    self.has_zoomed = True
-                    self.zoom_count = 0
-                # the below code makes it so that when the zooming stops, the current zoom level is displayed for a few frames
-                elif self.has_zoomed and self.zoom_count < FRAMERATE:
-                    frame_yuv_bytes = self._draw_zoom_level(frame_8bit)
-                    self.zoom_count += 1
-                elif self.has_zoomed and self.zoom_count >= FRAMERATE:
-                    self.has_zoomed = False
-
-                if self.is_rtp_streaming:
-                    self.ffmpeg_process_rtp.stdin.write(frame_yuv_bytes)  # type: ignore
-                elif self.is_mpeg_ts_streaming:
+                    if self.encoder_record.write(
+                        record_frame.data
+                        if self.is_dual_resolution
+                        else frame_yuv_bytes
+                    ):
+                        self._record_frame_written(sensor_timestamp)
+                if record_count:
+                    stage_ns = lap(FrameStage.WRITE_RECORD, stage_ns)
+
+                if stream_count:
+                    # Draw zoom level on the streaming frame
+                    if not self.command_controller.zoom_status == ZoomStatus.STOP.value:
+                        frame_yuv_bytes = self._draw_zoom_level(frame_8bit)
+                        self.has_zoomed = True
+                        self.zoom_count = 0
+                    # the below code makes it so that when the zooming stops, the current zoom level is displayed for a few frames
+                    elif (
+                        self.has_zoomed and self.zoom_count < stream_decimator.framerate
+                    ):
+                        frame_yuv_bytes = self._draw_zoom_level(frame_8bit)
+                        self.zoom_count += 1
+                    elif (
+                        self.has_zoomed
+                        and self.zoom_count >= stream_decimator.framerate
+                    ):
+                        self.has_zoomed = False
+                    if self.has_zoomed:
+                        stage_ns = lap(FrameStage.OVERLAY, stage_ns)
+
+                if self.is_rtp_streaming and stream_count:
+                    for _ in range(stream_count):
+                        self.encoder_rtp.write(frame_yuv_bytes)
+                    stage_ns = lap(FrameStage.WRITE_RTP, stage_ns)
+                elif self.is_mpeg_ts_streaming and stream_count:
                     if self.is_recording:
                         frame_yuv_bytes = self._draw_rec(frame_8bit)
-                    self.ffmpeg_process_mpeg_ts.stdin.write(frame_yuv_bytes)  # type: ignore
+                        stage_ns = lap(FrameStage.OVERLAY, stage_ns)
+                    # timestamped by the wall clock for the KLV, so a frame isn't repeated
+                    if self.encoder_mpeg_ts.write(frame_yuv_bytes):
+                        self._write_klv(sensor_timestamp)
+                    stage_ns = lap(FrameStage.WRITE_MPEG_TS, stage_ns)
+                elif self.is_rtsp_streaming and stream_count:
+                    for _ in range(stream_count):
+                        self.encoder_rtsp.write(frame_yuv_bytes)
+                    stage_ns = lap(FrameStage.WRITE_RTSP, stage_ns)
+
+                if secondary_count:
+                    # the frame as it came from the ISP, without overlays or stabilization
+                    secondary_data = (
+                        secondary_frame.data
+                        if self.is_secondary_lores
+                        else self._scale_secondary(secondary_frame)
+                    )
+                    for _ in range(secondary_count):
+                        self.encoder_secondary.write(secondary_data)
+                    stage_ns = lap(FrameStage.WRITE_SECONDARY, stage_ns)
+
+                self.command_service.flush_telemetry()
+                lap(FrameStage.FRAME, frame_start_ns)
 
         finally:
+            self.memory_monitor.stop()
             self.stop_and_clean_all()
+            self._wait_for_encoders()
+            if self.pre_event_buffer.wait(ENCODER_STOP_TIMEOUT * 3):
+                self._check_recording()  # indexes the last segment
+            else:
+                print("The recording wasn't written before stopping")
+            self.command_controller.audit_log.flush()
+            if self.command_controller.profiler.is_running:
+                self.command_controller.profiler.stop()
             if self.verbose:
                 print(f"\n\nAverage FPS = {sum(fps)/len(fps)}\n\n")
 
@@ -757,6 +1727,88 @@ def main():
     parser.add_argument(
         "--bitrate", type=int, default=2000000, help="Streaming bitrate in bps"
     )
+    parser.add_argument(
+        "--stream_framerate",
+        type=int,
+        default=FRAMERATE,
+        help="Frame rate of the GCS stream, i.e. 15 over a congested link",
+    )
+    parser.add_argument(
+        "--record_framerate",
+        type=int,
+        default=FRAMERATE,
+        help="Frame rate of the recording",
+    )
+    parser.add_argument(
+        "--secondary_resolution",
+        type=str,
+        default="",
+        help="Resolution of the simulcast stream (e.g., 640x360), none if empty",
+    )
+    parser.add_argument(
+        "--secondary_bitrate",
+        type=int,
+        default=SECONDARY_BITRATE,
+        help="Simulcast stream bitrate in bps, `start_secondary_stream` can change it",
+    )
+    parser.add_argument(
+        "--fec_group_size",
+        type=int,
+        default=0,
+        help="Send an RTP parity packet per this many packets to gcs_port + 2, 0 for none",
+    )
+    parser.add_argument(
+        "--fec_interleave",
+        type=int,
+        default=1,
+        help="Parity over every nth RTP packet, to recover bursts of up to n lost packets",
+    )
+    parser.add_argument(
+        "--srt_latency",
+        type=int,
+        default=SRT_LATENCY,
+        help="SRT latency in ms, lost packets are retransmitted within it",
+    )
+    parser.add_argument(
+        "--srt_overhead",
+        type=int,
+        default=SRT_OVERHEAD,
+        help="Bandwidth SRT retransmissions may add, in percent of the bitrate",
+    )
+    parser.add_argument(
+        "--record_resolution",
+        type=str,
+        default="",
+        help="Resolution to record at (e.g., 1920x1080), the stream resolution if empty",
+    )
+    parser.add_argument(
+        "--record_bitrate",
+        type=int,
+        default=RECORD_BITRATE,
+        help="Recording bitrate in bps, independent of the streaming bitrate",
+    )
+    parser.add_argument(
+        "--record_profile",
+        type=str,
+        default=RecordProfile.MPEG_TS.value,
+        help="Recording container (mpegts or fmp4)",
+    )
+    parser.add_argument(
+        "--record_audio",
+        action="store_true",
+        help="Whether to add a silent audio track to recordings",
+    )
+    parser.add_argument(
+        "--intra_refresh",
+        action="store_true",
+        help="Stream with libx264's intra refresh instead of IDR frames",
+    )
+    parser.add_argument(
+        "--encoder_backend",
+        type=str,
+        default=EncoderBackend.FFMPEG.value,
+        help="Encode with ffmpeg processes or in process with PyAV (ffmpeg or pyav)",
+    )
     parser.add_argument(
         "--config_file",
         type=str,
@@ -776,7 +1828,7 @@ def main():
         "--streaming_protocol",
         type=str,
         default=StreamingProtocolType.RTP.value,
-        help="Streaming protocol to use (RTP or MPEGTS)",
+        help="Streaming protocol to use (rtp, mpegts, rtsp or srt)",
     )
     parser.add_argument(
         "--radio_type",
@@ -808,6 +1860,20 @@ def main():
         streaming_protocol=args.streaming_protocol.lower(),
         radio_type=args.radio_type.lower(),
         command_protocol=args.command_protocol.lower(),
+        record_bitrate=args.record_bitrate,
+        record_profile=args.record_profile.lower(),
+        record_audio=args.record_audio,
+        record_resolution=args.record_resolution.lower(),
+        stream_framerate=args.stream_framerate,
+        record_framerate=args.record_framerate,
+        secondary_resolution=args.secondary_resolution.lower(),
+        secondary_bitrate=args.secondary_bitrate,
+        fec_group_size=args.fec_group_size,
+        fec_interleave=args.fec_interleave,
+        srt_latency=args.srt_latency,
+        srt_overhead=args.srt_overhead,
+        intra_refresh=args.intra_refresh,
+        encoder_backend=args.encoder_backend.lower(),
     )
     from command_controller import CommandController
 
@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import threading
+from collections import deque
+from time import monotonic
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+import numpy as np
+from constants import (
+    PRE_EVENT_MEMORY_BUDGET,
+    PRE_EVENT_SECONDS,
+    PRE_EVENT_WRITE_BACKLOG,
+    RecordProfile,
+)
+
+"""
+Keeps the last seconds of the encoded recording stream (MPEG-TS or fragmented MP4 from the
+recording ffmpeg's stdout) in memory so `record` can start the file before the command
+arrived. The stream is split into GOPs at the video keyframes (the packets with the random
+access indicator, or the moof boxes) and whole GOPs are dropped once they are older than
+`seconds` or the memory budget is used, so memory stays at about bitrate x seconds and a
+recording always starts on a keyframe. Fed from the encoder's reader thread. The recording
+is written on a thread of its own, rolling to the next segment file on the keyframe of the
+frame given to roll(), and the reader thread only waits for it once more than
+PRE_EVENT_WRITE_BACKLOG is waiting to be written.
+"""
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+PAT_PID = 0
+VIDEO_STREAM_TYPES = frozenset({0x01, 0x02, 0x1B, 0x24})  # MPEG-1/2, H.264, H.265
+
+
+def _get_section(packet: bytes) -> bytes:
+    """
+    The PSI section starting in a packet, ffmpeg's PAT and PMT fit in one packet.
+    """
+    offset = 4
+    if packet[3] & 0x20:  # adaptation field
+        offset += 1 + packet[4]
+    offset += 1 + packet[offset]  # pointer field
+    section = packet[offset:]
+    return section[: 3 + (((section[1] & 0x0F) << 8) | section[2])]
+
+
+def parse_pat(packet: bytes) -> int:
+    """
+    Returns the PMT PID of the first program, -1 if there is none.
+    """
+    section = _get_section(packet)
+    for offset in range(8, len(section) - 4, 4):
+        program_number = (section[offset] << 8) | section[offset + 1]
+        if program_number:  # 0 is the network PID
+            return ((section[offset + 2] & 0x1F) << 8) | section[offset + 3]
+    return -1
+
+
+def parse_pmt(packet: bytes) -> int:
+    """
+    Returns the PID of the first video stream, -1 if there is none.
+    """
+    section = _get_section(packet)
+    offset = 12 + (((section[10] & 0x0F) << 8) | section[11])
+    while offset + 5 <= len(section) - 4:
+        stream_type = section[offset]
+        pid = ((section[offset + 1] & 0x1F) << 8) | section[offset + 2]
+        if stream_type in VIDEO_STREAM_TYPES:
+            return pid
+        offset += 5 + (((section[offset + 3] & 0x0F) << 8) | section[offset + 4])
+    return -1
+
+
+def iter_boxes(data: bytes, start: int, end: int) -> Iterator[Tuple[bytes, int, int]]:
+    """
+    The (type, payload start, end) of the ISO BMFF boxes in data[start:end].
+    """
+    while start + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, start)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, start + 8)[0]
+            header_size = 16
+        elif size == 0:  # to the end
+            size = end - start
+        if size < header_size or start + size > end:
+            return
+        yield box_type, start + header_size, start + size
+        start += size
+
+
+# A stream split at keyframes, each piece is (data, the keyframe's frame number or -1 if
+# the data continues the GOP)
+Pieces = List[Tuple[bytes, int]]
+
+
+class _TransportStreamSplitter:
+    """
+    Splits MPEG-TS at the video packets with the random access indicator, frames are counted
+    by the video PES starts.
+    """
+
+    def __init__(self) -> None:
+        self.errors = 0
+        self.frames = 0  # video PES packets seen, one per frame
+        self._remainder = b""
+        self._pat = b""
+        self._pmt = b""
+        self._pmt_pid = -1
+        self._video_pid = -1
+
+    @property
+    def header(self) -> bytes:
+        """
+        The latest PAT and PMT to start files with.
+        """
+        return self._pat + self._pmt
+
+    def split(self, data: bytes) -> Pieces:
+        if self._remainder:
+            data = self._remainder + data
+        if data and data[0] != TS_SYNC_BYTE:
+            self.errors += 1
+            offset = data.find(TS_SYNC_BYTE)
+            data = data[offset:] if offset > 0 else b""
+        size = len(data) - len(data) % TS_PACKET_SIZE
+        self._remainder = data[size:]
+        if not size:
+            return []
+        packets = np.frombuffer(data, np.uint8, size).reshape(-1, TS_PACKET_SIZE)
+        pids = ((packets[:, 1] & 0x1F).astype(np.int32) << 8) | packets[:, 2]
+        pmt_pid = self._pmt_pid
+        self._read_psi(data, pids, (pids == PAT_PID) | (pids == pmt_pid))
+        if self._pmt_pid != pmt_pid:  # the PMT follows the new PAT
+            self._read_psi(data, pids, pids == self._pmt_pid)
+
+        video = pids == self._video_pid
+        keyframes = np.flatnonzero(
+            video
+            & (packets[:, 3] & 0x20 != 0)  # adaptation field
+            & (packets[:, 4] > 0)
+            & (packets[:, 5] & 0x40 != 0)  # random access indicator
+        )
+        frame_starts = np.cumsum(video & (packets[:, 1] & 0x40 != 0))
+        pieces: Pieces = []
+        start = 0
+        first_frame = -1
+        for end in [*keyframes.tolist(), len(packets)]:
+            if end > start:
+                chunk = data[start * TS_PACKET_SIZE : end * TS_PACKET_SIZE]
+                pieces.append((chunk, first_frame))
+            if end < len(packets):
+                first_frame = self.frames + int(frame_starts[end]) - 1
+            start = end
+        self.frames += int(frame_starts[-1])
+        return pieces
+
+    def _read_psi(self, data: bytes, pids: np.ndarray, mask: np.ndarray) -> None:
+        for index in np.flatnonzero(mask):
+            start = index * TS_PACKET_SIZE
+            packet = data[start : start + TS_PACKET_SIZE]
+            if not packet[1] & 0x40:  # not the start of a section
+                continue
+            try:
+                if pids[index] == PAT_PID:
+                    self._pat = packet
+                    self._pmt_pid = parse_pat(packet)
+                else:
+                    self._pmt = packet
+                    self._video_pid = parse_pmt(packet)
+            except IndexError:
+                self.errors += 1  # a truncated section
+
+
+class _FragmentedMp4Splitter:
+    """
+    Splits fragmented MP4 written with frag_keyframe, where every moof starts a keyframe.
+    The ftyp and moov only come at the start of the stream, they are kept as the header
+    rather than passed on. Frames are counted by the video samples in each moof. The mdat
+    boxes are passed on as they arrive without being buffered.
+    """
+
+    def __init__(self) -> None:
+        self.errors = 0
+        self.frames = 0
+        self.header = b""
+        self._remainder = b""
+        self._box_remaining = 0  # bytes still to come of the box being passed on
+        self._video_track = 1  # ffmpeg's first track, until the moov says otherwise
+
+    def split(self, data: bytes) -> Pieces:
+        if self._remainder:
+            data = self._remainder + data
+        pieces: Pieces = []
+        offset = start = 0
+        first_frame = -1
+        while offset < len(data):
+            if self._box_remaining:
+                size = min(self._box_remaining, len(data) - offset)
+                self._box_remaining -= size
+                offset += size
+                continue
+            if len(data) - offset < 16:
+                break
+            size, box_type = struct.unpack_from(">I4s", data, offset)
+            if size == 1:
+                size = struct.unpack_from(">Q", data, offset + 8)[0]
+            elif size == 0:  # to the end of the stream
+                size = 1 << 62
+            elif size < 8:
+                # the box boundaries are lost until the encoder restarts
+                self.errors += 1
+                self._remainder = b""
+                return pieces
+            if box_type not in (b"ftyp", b"moov", b"moof"):
+                self._box_remaining = size
+                continue
+            if len(data) - offset < size:
+                break  # read the whole box
+            if offset > start:
+                pieces.append((data[start:offset], first_frame))
+            first_frame = -1
+            if box_type == b"moof":
+                start = offset
+                first_frame = self.frames
+                self.frames += self._count_samples(data, offset + 8, offset + size)
+            else:
+                start = offset + size
+                if box_type == b"ftyp":  # a new stream
+                    self.header = b""
+                self.header += data[offset:start]
+                if box_type == b"moov":
+                    self._read_moov(data, offset + 8, start)
+            offset += size
+        if offset > start:
+            pieces.append((data[start:offset], first_frame))
+        self._remainder = data[offset:]
+        return pieces
+
+    def _read_moov(self, data: bytes, start: int, end: int) -> None:
+        """
+        Finds the video track's ID.
+        """
+        for box_type, trak_start, trak_end in iter_boxes(data, start, end):
+            if box_type != b"trak":
+                continue
+            track_id = -1
+            is_video = False
+            for trak_box, payload, box_end in iter_boxes(data, trak_start, trak_end):
+                if trak_box == b"tkhd":
+                    id_offset = 20 if data[payload] == 1 else 12  # after the times
+                    track_id = struct.unpack_from(">I", data, payload + id_offset)[0]
+                elif trak_box == b"mdia":
+                    for mdia_box, hdlr, _ in iter_boxes(data, payload, box_end):
+                        if (
+                            mdia_box == b"hdlr"
+                            and data[hdlr + 8 : hdlr + 12] == b"vide"
+                        ):
+                            is_video = True
+            if is_video and track_id >= 0:
+                self._video_track = track_id
+                return
+
+    def _count_samples(self, data: bytes, start: int, end: int) -> int:
+        """
+        The video samples in a moof.
+        """
+        samples = 0
+        for box_type, traf_start, traf_end in iter_boxes(data, start, end):
+            if box_type != b"traf":
+                continue
+            track_id = -1
+            for traf_box, payload, _ in iter_boxes(data, traf_start, traf_end):
+                if traf_box == b"tfhd":
+                    track_id = struct.unpack_from(">I", data, payload + 4)[0]
+                elif traf_box == b"trun" and track_id == self._video_track:
+                    samples += struct.unpack_from(">I", data, payload + 4)[0]
+        return samples
+
+
+class _Gop:
+    """
+    The packets from one video keyframe to the next.
+    """
+
+    def __init__(self, start_time: float, first_frame: int) -> None:
+        self.start_time = start_time
+        self.first_frame = first_frame  # the keyframe's number in the stream
+        self.chunks: List[bytes] = []
+        self.size = 0
+
+
+class PreEventBuffer:
+    def __init__(
+        self,
+        seconds: float = PRE_EVENT_SECONDS,
+        memory_budget: int = PRE_EVENT_MEMORY_BUDGET,
+        clock: Callable[[], float] = monotonic,
+        write_backlog: int = PRE_EVENT_WRITE_BACKLOG,
+    ) -> None:
+        self.seconds = seconds
+        self.memory_budget = memory_budget
+        self.write_backlog = write_backlog
+        self.clock = clock
+        self.sync_errors = 0
+        self.write_error = ""
+        self.flush_latency = 0.0  # seconds from start_recording() to the buffer on disk
+        self.bytes_written = 0  # to the current file
+        # (file name, bytes) of the files written and closed, for the segment index
+        self.closed_files: Deque[Tuple[str, int]] = deque()
+        self._lock = threading.Lock()  # the ring and the pending writes
+        # notified when there is something to write and when the writer has written it
+        self._changed = threading.Condition(self._lock)
+        self._writer: Optional[threading.Thread] = None
+        self._is_writing = False  # the writer holds a batch of the pending writes
+        self._file: Optional[BinaryIO] = None  # only used by the writer
+        self._file_name = ""
+        self._recording = False
+        self._waiting_for_keyframe = False
+        # data to write, a file name closes the current file and starts writing to it
+        self._pending: List[Union[bytes, str]] = []
+        self._pending_bytes = 0
+        self._writing_bytes = 0  # of the batch the writer holds
+        self._roll_file_name = ""
+        self._roll_frame = 0
+        self._start_time = 0.0
+        self.container = RecordProfile.MPEG_TS.value  # takes effect on reset()
+        self._splitter: Union[
+            _TransportStreamSplitter, _FragmentedMp4Splitter
+        ] = _TransportStreamSplitter()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Called when the encoder is (re)started as it begins a new stream.
+        """
+        with self._lock:
+            self._gops: Deque[_Gop] = deque()
+            self._buffered_bytes = 0
+            self.sync_errors += self._splitter.errors
+            if self.container == RecordProfile.FMP4.value:
+                self._splitter = _FragmentedMp4Splitter()
+            else:
+                self._splitter = _TransportStreamSplitter()
+            self._waiting_for_keyframe = self._recording
+
+    def feed(self, data: bytes) -> None:
+        """
+        Adds encoder output, called from the encoder's reader thread.
+        """
+        pieces = self._splitter.split(data)
+        if not pieces:
+            return
+        now = self.clock()
+        with self._lock:
+            gops = self._gops
+            for chunk, first_frame in pieces:
+                if first_frame >= 0:
+                    gops.append(_Gop(now, first_frame))
+                    if self._recording:
+                        self._start_gop(first_frame)
+                if gops:  # the data before the first keyframe is dropped
+                    gops[-1].chunks.append(chunk)
+                    gops[-1].size += len(chunk)
+                    self._buffered_bytes += len(chunk)
+                if self._recording and not self._waiting_for_keyframe:
+                    self._pending.append(chunk)
+                    self._pending_bytes += len(chunk)
+            # whole GOPs are dropped, so the oldest keyframe stays just over `seconds` old
+            while len(gops) > 1 and (
+                gops[1].start_time <= now - self.seconds
+                or self._buffered_bytes > self.memory_budget
+            ):
+                self._buffered_bytes -= gops.popleft().size
+            if self._pending:
+                self._changed.notify_all()
+            # holds the encoder's output rather than dropping part of the recording
+            while (
+                self._recording
+                and self._pending_bytes + self._writing_bytes > self.write_backlog
+            ):
+                self._changed.wait()
+
+    def _start_gop(self, first_frame: int) -> None:
+        """
+        A file starts with the container header and a keyframe, so this is where the
+        recording starts after a restart and where it rolls to the next segment.
+        """
+        if self._waiting_for_keyframe:
+            self._waiting_for_keyframe = False
+        elif self._roll_file_name and first_frame >= self._roll_frame:
+            self._pending.append(self._roll_file_name)
+            self._roll_file_name = ""
+        else:
+            return
+        self._pending.append(self._splitter.header)
+
+    def start_recording(self, file_name: str) -> int:
+        """
+        The buffered GOPs and everything after them are written to file_name by the writer
+        thread. Returns the number of the first recorded frame in the encoder's stream.
+        """
+        if self._writer is None:
+            self._writer = threading.Thread(
+                target=self._write_loop, name="record-writer", daemon=True
+            )
+            self._writer.start()
+        with self._lock:
+            self._recording = True
+            self._roll_file_name = ""
+            self._start_time = monotonic()
+            self.flush_latency = 0.0
+            self.write_error = ""
+            # after the end of the last recording if it isn't written yet
+            self._pending.append(file_name)
+            self._changed.notify_all()
+            if not self._gops:
+                self._waiting_for_keyframe = True
+                return self._splitter.frames
+            self._waiting_for_keyframe = False
+            self._pending.append(self._splitter.header)
+            for gop in self._gops:
+                self._pending += gop.chunks
+                self._pending_bytes += gop.size
+            return self._gops[0].first_frame
+
+    def roll(self, file_name: str, first_frame: int) -> None:
+        """
+        Continues the recording in file_name from the first keyframe at or after frame
+        number first_frame.
+        """
+        with self._lock:
+            self._roll_file_name = file_name
+            self._roll_frame = first_frame
+
+    @property
+    def is_rolling(self) -> bool:
+        return bool(self._roll_file_name)
+
+    @property
+    def is_recording(self) -> bool:
+        return self._recording
+
+    def stop_recording(self) -> None:
+        """
+        The writer thread writes what is left and closes the file, see wait().
+        """
+        with self._lock:
+            self._recording = False
+            self._roll_file_name = ""
+            self._changed.notify_all()
+
+    def _is_idle(self) -> bool:
+        return (
+            not self._pending
+            and not self._is_writing
+            and (self._recording or self._file is None)
+        )
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits for the writer to catch up, and to close the file if the recording has
+        stopped. Returns False if it didn't within timeout.
+        """
+        with self._lock:
+            return self._changed.wait_for(self._is_idle, timeout)
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._lock:
+                self._changed.wait_for(lambda: not self._is_idle())
+                pending, self._pending = self._pending, []
+                self._writing_bytes, self._pending_bytes = self._pending_bytes, 0
+                recording = self._recording
+                self._is_writing = True
+            try:
+                for chunk in pending:
+                    if isinstance(chunk, str):
+                        self._close_file()
+                        self._file_name = chunk
+                        continue
+                    if self._file is None:
+                        self._file = open(self._file_name, "wb")
+                    self._file.write(chunk)
+                    self.bytes_written += len(chunk)
+                    if not self.flush_latency:
+                        self.flush_latency = monotonic() - self._start_time
+            except OSError as e:
+                print(f"Error writing {self._file_name}: {e}")
+                self.write_error = str(e)
+                with self._lock:
+                    self._recording = recording = False
+            if not recording and self._file is not None:
+                self._close_file()
+                os.sync()  # the recording is on the SD card if the power is cut
+            with self._lock:
+                self._writing_bytes = 0
+                self._is_writing = False
+                self._changed.notify_all()
+
+    def _close_file(self) -> None:
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+        except OSError as e:
+            self.write_error = str(e)
+        self._file = None
+        self.closed_files.append((self._file_name, self.bytes_written))
+        self.bytes_written = 0
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            buffered_seconds = (
+                self.clock() - self._gops[0].start_time if self._gops else 0.0
+            )
+            return {
+                "seconds": self.seconds,
+                "buffered_seconds": round(buffered_seconds, 2),
+                "buffered_kb": self._buffered_bytes // 1024,
+                "gops": len(self._gops),
+                "flush_latency": round(self.flush_latency, 3),
+                "sync_errors": self.sync_errors + self._splitter.errors,
+                "write_error": self.write_error,
+            }
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import cProfile
+import os
+import sys
+import threading
+from time import monotonic
+from types import FrameType
+from typing import Dict, Optional
+from cam_utils import get_timestamp
+from constants import (
+    PROFILE_DIRECTORY,
+    PROFILE_MAX_DURATION,
+    PROFILE_SAMPLE_INTERVAL,
+    ProfileMode,
+)
+
+"""
+Profiles the running stream loop without restarting pistreamer. The sampling mode reads the
+stream thread's stack from a background thread every PROFILE_SAMPLE_INTERVAL, which is cheap
+enough to leave on in flight, and writes collapsed stacks (`frame;frame;frame count` lines)
+that open in flamegraph.pl, speedscope and inferno. The cprofile mode traces every call on
+the stream thread so it is only for short windows on the ground, it writes a .pstats file
+for snakeviz or flameprof. Both stop by themselves after PROFILE_MAX_DURATION.
+"""
+
+
+def _collapse_stack(frame: Optional[FrameType]) -> str:
+    """
+    Root first, `file:function` per frame as the flame graph tools expect.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class StreamProfiler:
+    def __init__(
+        self,
+        directory: str = PROFILE_DIRECTORY,
+        sample_interval: float = PROFILE_SAMPLE_INTERVAL,
+        max_duration: float = PROFILE_MAX_DURATION,
+    ) -> None:
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.max_duration = max_duration
+        self.mode: Optional[ProfileMode] = None
+        self.start_time = 0.0
+        self.samples: Dict[str, int] = {}
+        self.sample_count = 0
+        self._target_thread_id = 0
+        self._stop_event = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._cprofile: Optional[cProfile.Profile] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self.mode is not None
+
+    def start(self, mode: ProfileMode = ProfileMode.SAMPLE) -> None:
+        """
+        Profiles the calling thread, i.e. the stream loop which handles the commands.
+        """
+        if self.is_running:
+            raise Exception(f"Already profiling in {self.mode.value} mode")  # type: ignore
+        self.mode = mode
+        self.start_time = monotonic()
+        self._target_thread_id = threading.get_ident()
+        if mode == ProfileMode.CPROFILE:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+            return
+
+        self.samples = {}
+        self.sample_count = 0
+        self._stop_event.clear()
+        self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        self._sampler.start()
+
+    def _sample_loop(self) -> None:
+        get_frames = sys._current_frames
+        samples = self.samples
+        while not self._stop_event.wait(self.sample_interval):
+            frame = get_frames().get(self._target_thread_id)
+            if frame is None:
+                return  # the stream thread has exited
+            stack = _collapse_stack(frame)
+            samples[stack] = samples.get(stack, 0) + 1
+            self.sample_count += 1
+            if monotonic() - self.start_time > self.max_duration:
+                return
+
+    def check_duration(self) -> Optional[str]:
+        """
+        Called from the stream loop, stops the profile once it has run for max_duration.
+        Returns the written file if it was stopped.
+        """
+        if self.is_running and monotonic() - self.start_time > self.max_duration:
+            return self.stop()
+        return None
+
+    def stop(self) -> str:
+        """
+        Stops profiling and returns the file the profile was written to.
+        """
+        if not self.is_running:
+            raise Exception("Not profiling")
+        file_name = os.path.join(self.directory, f"profile_{get_timestamp()}")
+        if self.mode == ProfileMode.CPROFILE:
+            self._cprofile.disable()  # type: ignore
+            file_name += ".pstats"
+            self._cprofile.dump_stats(file_name)  # type: ignore
+            self._cprofile = None
+        else:
+            self._stop_event.set()
+            self._sampler.join()  # type: ignore
+            self._sampler = None
+            file_name += ".folded"
+            with open(file_name, "w") as f:
+                for stack, count in sorted(self.samples.items()):
+                    f.write(f"{stack} {count}\n")
+        self.mode = None
+        return file_name
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+import os
+import signal
+import subprocess
+import threading
+from fractions import Fraction
+from time import monotonic
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import av
+import numpy as np
+from constants import ENCODER_READ_SIZE, FRAMERATE, HARDWARE_ENCODER_DEVICE
+
+"""
+Runs the encoder commands of ffmpeg_configs.py in this process with PyAV, the bindings to
+the libraries the ffmpeg CLI is built on, instead of an ffmpeg process per sink. Each frame
+is wrapped as an AVFrame without a copy and encoded and muxed on the EncoderSupervisor's
+writer thread (PyAV releases the GIL while encoding), so it is never copied through a pipe
+into another process. The Pi's hardware encoder is used when it is there and libx264
+otherwise. request_keyframe makes the next frame an IDR without restarting. Unlike a
+process, a hung encoder can't be killed: kill() lets the supervisor restart it and the
+writer thread stuck in it is abandoned.
+"""
+
+WALLCLOCK_TIME_BASE = Fraction(1, 90000)  # MPEG-TS's 90 kHz clock
+try:
+    from av.video.frame import PictureType
+
+    PICTURE_TYPE_I: Any = PictureType.I
+except ImportError:  # older PyAV takes the name
+    PICTURE_TYPE_I = "I"
+# ffmpeg CLI output options and the AVOptions they set on the encoder
+CODEC_OPTIONS: Dict[str, str] = {
+    "-b:v": "b",
+    "-bufsize": "bufsize",
+    "-maxrate": "maxrate",
+    "-g": "g",
+    "-bf": "bf",
+    "-flags": "flags",
+    "-preset": "preset",
+    "-tune": "tune",
+    "-intra-refresh": "intra-refresh",
+}
+# and on the muxer
+FORMAT_OPTIONS: Dict[str, str] = {
+    "-movflags": "movflags",
+    "-flush_packets": "flush_packets",
+}
+# libx264 in place of the hardware encoder, which has no lookahead either
+SOFTWARE_ENCODER_OPTIONS: Dict[str, str] = {
+    "preset": "ultrafast",
+    "tune": "zerolatency",
+}
+
+
+def has_hardware_encoder() -> bool:
+    return "h264_v4l2m2m" in av.codecs_available and os.path.exists(
+        HARDWARE_ENCODER_DEVICE
+    )
+
+
+def _split_args(args: Sequence[str]) -> Tuple[List[str], List[str]]:
+    """
+    The input options (up to the last -i and its value) and the output options, without
+    the output URL.
+    """
+    last_input = len(args) - 1 - list(args)[::-1].index("-i")
+    return list(args[: last_input + 2]), list(args[last_input + 2 : -1])
+
+
+def _get_arg(args: Sequence[str], name: str, default: str = "") -> str:
+    return args[args.index(name) + 1] if name in args else default
+
+
+def _get_options(args: Sequence[str], names: Dict[str, str]) -> Dict[str, str]:
+    options = {}
+    for i, arg in enumerate(args[:-1]):
+        if arg in names:
+            options[names[arg]] = args[i + 1]
+    return options
+
+
+class _FrameInput:
+    """
+    The encoder's stdin, each write is one YUV420 frame.
+    """
+
+    def __init__(self, process: "PyAvEncoderProcess") -> None:
+        self._process = process
+
+    def write(self, data: Any) -> int:
+        return self._process._encode(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self._process._finish()
+
+
+class PyAvEncoderProcess:
+    """
+    Stands in for the ffmpeg subprocess.Popen of an encoder command. With stdout=PIPE the
+    output is muxed into a pipe read from stdout, like ffmpeg's pipe:1. The KLV pipe in
+    pass_fds (the `-f data` input) is read without blocking after each frame and muxed with
+    the wall clock time, like ffmpeg's -use_wallclock_as_timestamps.
+    """
+
+    def __init__(
+        self,
+        args: Sequence[str],
+        pass_fds: Sequence[int] = (),
+        stdout: Optional[int] = None,
+        **kwargs: Any,
+    ) -> None:
+        if not self.supports(args):
+            raise Exception(f"The pyav encoder backend can't run {args}")
+        self.args = list(args)
+        self.returncode: Optional[int] = None
+        self.stdin = _FrameInput(self)
+        self.stdout: Any = None
+        # held while encoding, the container is only freed under it
+        self._lock = threading.Lock()
+        self._exited = threading.Event()
+        self._container: Any = None
+        self._output: Any = None
+        self._klv_fd = -1
+        self._klv_stream: Any = None
+        inputs, outputs = _split_args(self.args)
+        width, height = map(int, _get_arg(inputs, "-s").split("x"))
+        framerate = int(_get_arg(inputs, "-r", str(FRAMERATE)))
+        self._shape = (height * 3 // 2, width)  # the planes one after the other
+        self._is_wallclock = "-use_wallclock_as_timestamps" in inputs
+        self._time_base = (
+            WALLCLOCK_TIME_BASE if self._is_wallclock else Fraction(1, framerate)
+        )
+        self._start_time = monotonic()
+        self._frames = 0
+        self._last_pts = -1
+        self._keyframe_requested = False
+        target: Any = self.args[-1]
+        if target == "pipe:1":
+            read_fd, write_fd = os.pipe()
+            self.stdout = os.fdopen(read_fd, "rb")
+            # unbuffered, so -flush_packets passes each packet on
+            self._output = target = os.fdopen(write_fd, "wb", buffering=0)
+        try:
+            self._container = av.open(
+                target,
+                "w",
+                format=_get_arg(outputs, "-f") or None,
+                options=_get_options(outputs, FORMAT_OPTIONS),
+            )
+            codec_options = _get_options(outputs, CODEC_OPTIONS)
+            codec = _get_arg(outputs, "-c:v", "libx264")
+            if codec == "h264_v4l2m2m" and not has_hardware_encoder():
+                codec = "libx264"
+                for name, value in SOFTWARE_ENCODER_OPTIONS.items():
+                    codec_options.setdefault(name, value)
+            self._stream = self._container.add_stream(codec, rate=framerate)
+            self._stream.width = width
+            self._stream.height = height
+            self._stream.pix_fmt = "yuv420p"
+            self._stream.codec_context.time_base = self._time_base
+            self._stream.codec_context.options = codec_options
+            for fd in pass_fds:
+                # The caller closes its copy of the read end once the process is started
+                self._klv_fd = os.dup(fd)
+                os.set_blocking(self._klv_fd, False)
+                self._klv_stream = self._container.add_data_stream("klv")
+        except Exception:
+            self._close()
+            raise
+
+    @staticmethod
+    def supports(args: Sequence[str]) -> bool:
+        """
+        Only raw frames on stdin and KLV: the recording's silent audio (lavfi) needs
+        ffmpeg, and a KLV data stream needs PyAV 14 or later.
+        """
+        inputs, _ = _split_args(args)
+        formats = [inputs[i + 1] for i, arg in enumerate(inputs[:-1]) if arg == "-f"]
+        if "data" in formats and not hasattr(
+            av.container.OutputContainer, "add_data_stream"
+        ):
+            return False
+        return all(name in ("rawvideo", "data") for name in formats)
+
+    def _get_pts(self) -> int:
+        if not self._is_wallclock:
+            return self._frames
+        pts = int((monotonic() - self._start_time) / self._time_base)
+        self._last_pts = max(pts, self._last_pts + 1)  # two frames can't share a pts
+        return self._last_pts
+
+    def _encode(self, data: Any) -> int:
+        with self._lock:
+            if self._container is None or self.returncode is not None:
+                raise BrokenPipeError("The pyav encoder has exited")
+            try:
+                planes = np.frombuffer(data, np.uint8).reshape(self._shape)
+                try:
+                    frame = av.VideoFrame.from_numpy_buffer(planes, format="yuv420p")
+                except (AttributeError, ValueError):
+                    # a copy, PyAV before 9 can't wrap a YUV420 array
+                    frame = av.VideoFrame.from_ndarray(planes, format="yuv420p")
+                frame.pts = self._get_pts()
+                frame.time_base = self._time_base
+                if self._keyframe_requested:
+                    self._keyframe_requested = False
+                    frame.pict_type = PICTURE_TYPE_I
+                for packet in self._stream.encode(frame):
+                    self._container.mux(packet)
+                if self._klv_stream is not None:
+                    self._mux_klv()
+                self._frames += 1
+            except (av.error.FFmpegError, OSError, ValueError) as e:
+                print(f"The pyav encoder failed: {e}")
+                self._exit(1)
+            if self.returncode is not None:  # failed, or killed while encoding
+                self._close()
+                raise BrokenPipeError("The pyav encoder has exited")
+            return planes.nbytes
+
+    def _mux_klv(self) -> None:
+        while True:
+            try:
+                data = os.read(self._klv_fd, ENCODER_READ_SIZE)
+            except BlockingIOError:
+                return
+            if not data:
+                return  # the write end is closed, the stream is stopping
+            packet = av.Packet(data)
+            packet.stream = self._klv_stream
+            packet.pts = packet.dts = self._get_pts()
+            packet.time_base = self._time_base
+            self._container.mux(packet)
+
+    def _finish(self) -> None:
+        """
+        Flushes the encoder and closes the output, like ffmpeg reaching the end of stdin.
+        """
+        if self.returncode is not None:
+            return  # killed
+        with self._lock:
+            if self._container is None:
+                return
+            returncode = 0
+            try:
+                for packet in self._stream.encode(None):
+                    self._container.mux(packet)
+            except (av.error.FFmpegError, OSError) as e:
+                print(f"The pyav encoder failed to flush: {e}")
+                returncode = 1
+            self._close()
+            self._exit(returncode)
+
+    def _close(self) -> None:
+        container, self._container = self._container, None
+        if container is not None:
+            try:
+                container.close()
+            except (av.error.FFmpegError, OSError):
+                pass  # the output is gone, i.e. stdout isn't read anymore
+        if self._output is not None:
+            self._output.close()  # the end of stdout for its reader
+            self._output = None
+        if self._klv_fd >= 0:
+            os.close(self._klv_fd)
+            self._klv_fd = -1
+
+    def _exit(self, returncode: int) -> None:
+        if self.returncode is None:
+            self.returncode = returncode
+        self._exited.set()
+
+    def request_keyframe(self) -> None:
+        """
+        Encodes the next frame as an IDR, both libx264 and h264_v4l2m2m start a GOP there.
+        """
+        self._keyframe_requested = True
+
+    def poll(self) -> Optional[int]:
+        return self.returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        if not self._exited.wait(timeout):
+            raise subprocess.TimeoutExpired(self.args, timeout)  # type: ignore
+        return self.returncode  # type: ignore
+
+    def terminate(self) -> None:
+        self.kill()
+
+    def kill(self) -> None:
+        """
+        Frees the encoder now unless a write is encoding, then it is freed once that write
+        returns.
+        """
+        self._exit(-signal.SIGKILL)
+        if self._lock.acquire(blocking=False):
+            try:
+                self._close()
+            finally:
+                self._lock.release()
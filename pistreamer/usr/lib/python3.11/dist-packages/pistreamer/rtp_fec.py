@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+import select
+import socket
+import struct
+import threading
+from collections import deque
+from time import monotonic, perf_counter_ns
+from typing import Any, Deque, Dict, List, Optional, Tuple
+import numpy as np
+from constants import (
+    FEC_DECODER_HISTORY,
+    FEC_MAX_DELAY,
+    FEC_PAYLOAD_TYPE,
+    FEC_PORT_OFFSET,
+    FEC_RELAY_PORT,
+)
+
+"""
+Forward error correction for the RTP stream, as one lost packet on a lossy radio link
+corrupts the video until the next keyframe. With `fec <group_size>` the RTP encoder sends
+to FEC_RELAY_PORT on loopback and RtpFecRelay forwards each packet to the GCS unchanged,
+plus an XOR parity packet (RFC 5109 ULPFEC with one protection level) per group_size
+packets to gcs_port + FEC_PORT_OFFSET. FecDecoder rebuilds any one lost packet of a group
+at the receiver. With an interleave of d a group is every d-th packet, so a burst of up to
+d lost packets is recovered. A group still open after FEC_MAX_DELAY is closed early, which
+bounds the latency of a recovered packet.
+"""
+
+RTP_HEADER_SIZE = 12
+MTU = 1500  # the parity buffers grow for larger packets
+
+
+class _ParityGroup:
+    """
+    The XOR of the packets of one group so far, see RFC 5109 section 7.
+    """
+
+    def __init__(self) -> None:
+        self.payload = np.zeros(MTU, dtype=np.uint8)
+        self.reset()
+
+    def reset(self) -> None:
+        self.payload[:] = 0
+        self.sequence_numbers: List[int] = []
+        self.header = 0  # the first 8 bytes of the RTP headers
+        self.length = 0  # of each packet after its RTP header
+        self.size = 0  # the longest packet after its RTP header
+        self.timestamp = 0
+
+    def add(self, packet: bytes, sequence_number: int) -> None:
+        size = len(packet) - RTP_HEADER_SIZE
+        if size > len(self.payload):
+            self.payload = np.concatenate(
+                (self.payload, np.zeros(size - len(self.payload), dtype=np.uint8))
+            )
+        self.payload[:size] ^= np.frombuffer(packet, np.uint8, offset=RTP_HEADER_SIZE)
+        self.header ^= int.from_bytes(packet[:8], "big")
+        self.length ^= size
+        self.size = max(self.size, size)
+        self.timestamp = struct.unpack_from(">I", packet, 4)[0]
+        self.sequence_numbers.append(sequence_number)
+
+
+class FecEncoder:
+    def __init__(self, group_size: int = 0, interleave: int = 1) -> None:
+        self.sequence_number = 0
+        self.ssrc = 0
+        self.set_protection(group_size, interleave)
+
+    def set_protection(self, group_size: int, interleave: int = 1) -> None:
+        """
+        A parity packet per group_size packets, 0 for none.
+        """
+        self.group_size = group_size
+        self.interleave = interleave
+        self.groups = [_ParityGroup() for _ in range(interleave)]
+        self.block_start: Optional[int] = None  # the first sequence number of the block
+
+    @property
+    def is_open(self) -> bool:
+        return self.block_start is not None
+
+    def protect(self, packet: bytes) -> List[bytes]:
+        """
+        Adds an RTP packet and returns the parity packets it completes, usually none.
+        """
+        if not self.group_size or len(packet) < RTP_HEADER_SIZE:
+            return []
+        sequence_number, _, self.ssrc = struct.unpack_from(">HII", packet, 2)
+        parity = []
+        if self.block_start is None:
+            self.block_start = sequence_number
+        offset = (sequence_number - self.block_start) & 0xFFFF
+        if offset >= self.group_size * self.interleave:
+            # a new block, or a jump in the encoder's sequence numbers
+            parity = self.flush()
+            self.block_start = sequence_number
+            offset = 0
+        group = self.groups[offset % self.interleave]
+        group.add(packet, sequence_number)
+        if offset // self.interleave == self.group_size - 1:
+            parity.append(self._parity(group))
+            if offset == self.group_size * self.interleave - 1:
+                self.block_start = None
+        return parity
+
+    def flush(self) -> List[bytes]:
+        """
+        The parity packets of the groups still open.
+        """
+        parity = [
+            self._parity(group) for group in self.groups if group.sequence_numbers
+        ]
+        self.block_start = None
+        return parity
+
+    def _parity(self, group: _ParityGroup) -> bytes:
+        base = group.sequence_numbers[0]
+        mask = 0
+        for sequence_number in group.sequence_numbers:
+            mask |= 1 << (47 - ((sequence_number - base) & 0xFFFF))
+        long_mask = mask & 0xFFFFFFFF  # bits past the 16 bit mask
+        header = group.header
+        packet = (
+            struct.pack(
+                ">BBHII",
+                0x80,
+                FEC_PAYLOAD_TYPE,
+                self.sequence_number,
+                group.timestamp,
+                self.ssrc,
+            )
+            # E=0, L, then the P, X, CC, M and PT recovery bits
+            + bytes(
+                (
+                    (0x40 if long_mask else 0) | ((header >> 56) & 0x3F),
+                    (header >> 48) & 0xFF,
+                )
+            )
+            + struct.pack(">HIHH", base, header & 0xFFFFFFFF, group.length, group.size)
+            + (mask >> 32).to_bytes(2, "big")
+            + (long_mask.to_bytes(4, "big") if long_mask else b"")
+            + group.payload[: group.size].tobytes()
+        )
+        self.sequence_number = (self.sequence_number + 1) & 0xFFFF
+        group.reset()
+        return packet
+
+
+class FecDecoder:
+    """
+    The receiver of FecEncoder's packets, for the benchmark or a proxy on the GCS. Media
+    packets are returned as they are received, a lost one when its parity packet arrives.
+    """
+
+    def __init__(self, history: int = FEC_DECODER_HISTORY) -> None:
+        self.packets: Dict[int, bytes] = {}  # by sequence number
+        self.order: Deque[int] = deque()
+        self.history = history
+        self.recovered = 0
+        self.unrecoverable = 0  # groups that lost more than one packet
+
+    def receive(self, packet: bytes) -> List[bytes]:
+        sequence_number = struct.unpack_from(">H", packet, 2)[0]
+        if sequence_number in self.packets:
+            return []  # already recovered
+        self._keep(sequence_number, packet)
+        return [packet]
+
+    def receive_parity(self, packet: bytes) -> List[bytes]:
+        ssrc = packet[8:12]
+        fec = RTP_HEADER_SIZE
+        is_long_mask = packet[fec] & 0x40
+        base, timestamp, length, size = struct.unpack_from(">HIHH", packet, fec + 2)
+        mask_size = 6 if is_long_mask else 2
+        mask = int.from_bytes(packet[fec + 12 : fec + 12 + mask_size], "big")
+        mask <<= 48 - mask_size * 8
+        protected = [
+            (base + bit) & 0xFFFF for bit in range(48) if mask >> (47 - bit) & 1
+        ]
+        missing = [s for s in protected if s not in self.packets]
+        if len(missing) != 1:
+            self.unrecoverable += len(missing) > 1
+            return []
+        header = int.from_bytes(packet[fec : fec + 2], "big") << 48 | timestamp
+        payload = np.frombuffer(packet, np.uint8, size, fec + 12 + mask_size).copy()
+        for sequence_number in protected:
+            if sequence_number == missing[0]:
+                continue
+            media = self.packets[sequence_number]
+            header ^= int.from_bytes(media[:2], "big") << 48 | int.from_bytes(
+                media[4:8], "big"
+            )
+            media_size = len(media) - RTP_HEADER_SIZE
+            length ^= media_size
+            payload[:media_size] ^= np.frombuffer(
+                media, np.uint8, offset=RTP_HEADER_SIZE
+            )
+        recovered = (
+            bytes((0x80 | (header >> 56) & 0x3F, (header >> 48) & 0xFF))
+            + struct.pack(">HI", missing[0], header & 0xFFFFFFFF)
+            + ssrc
+            + payload[:length].tobytes()
+        )
+        self._keep(missing[0], recovered)
+        self.recovered += 1
+        return [recovered]
+
+    def _keep(self, sequence_number: int, packet: bytes) -> None:
+        self.packets[sequence_number] = packet
+        self.order.append(sequence_number)
+        if len(self.order) > self.history:
+            self.packets.pop(self.order.popleft(), None)
+
+
+class RtpFecRelay:
+    def __init__(
+        self,
+        group_size: int = 0,
+        interleave: int = 1,
+        relay_port: int = FEC_RELAY_PORT,
+        max_delay: float = FEC_MAX_DELAY,
+    ) -> None:
+        self.encoder = FecEncoder(group_size, interleave)
+        self.relay_port = relay_port
+        self.max_delay = max_delay
+        self.is_running = False
+        self._sockets: List[socket.socket] = []
+        self._thread: Optional[threading.Thread] = None
+        self._reset_metrics()
+
+    @property
+    def group_size(self) -> int:
+        return self.encoder.group_size
+
+    def set_protection(self, group_size: int, interleave: int = 1) -> None:
+        """
+        Takes effect when the relay is next started.
+        """
+        self.encoder.set_protection(group_size, interleave)
+
+    def _reset_metrics(self) -> None:
+        self.packets = 0
+        self.parity_packets = 0
+        self.bytes = 0
+        self.parity_bytes = 0
+        self.send_errors = 0
+        self.relay_ns = 0
+
+    def start(self, ip: str, port: int) -> None:
+        if self.is_running:
+            return
+        relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        relay.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        relay.bind(("127.0.0.1", self.relay_port))
+        output = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sockets = [relay, output]
+        self.encoder.set_protection(self.encoder.group_size, self.encoder.interleave)
+        self._reset_metrics()
+        self.is_running = True
+        self._thread = threading.Thread(
+            target=self._relay_loop,
+            args=(relay, output, (ip, port), (ip, port + FEC_PORT_OFFSET)),
+            name="rtp-fec-relay",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        if not self.is_running:
+            return
+        self.is_running = False
+        if self._thread:
+            self._thread.join(2.0)
+            self._thread = None
+        for sock in self._sockets:
+            sock.close()
+        self._sockets = []
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "group_size": self.encoder.group_size,
+            "interleave": self.encoder.interleave,
+            "packets": self.packets,
+            "parity_packets": self.parity_packets,
+            "overhead_percent": round(self.parity_bytes / max(self.bytes, 1) * 100, 1),
+            "send_errors": self.send_errors,
+            "relay_us": round(self.relay_ns / max(self.packets, 1) / 1000, 1),
+        }
+
+    def _relay_loop(
+        self,
+        relay: socket.socket,
+        output: socket.socket,
+        address: Tuple[str, int],
+        parity_address: Tuple[str, int],
+    ) -> None:
+        opened = 0.0  # when the open parity groups got their first packet
+        while self.is_running:
+            timeout = 0.5
+            if self.encoder.is_open:
+                timeout = max(opened + self.max_delay - monotonic(), 0.0)
+            try:
+                readable, _, _ = select.select([relay], [], [], timeout)
+                packet = relay.recv(65536) if readable else b""
+            except (OSError, ValueError):
+                return  # the relay was stopped
+            start_ns = perf_counter_ns()
+            parity = []
+            if packet:
+                was_open = self.encoder.is_open
+                self._send(output, packet, address)
+                parity = self.encoder.protect(packet)
+                if not was_open and self.encoder.is_open:
+                    opened = monotonic()
+                self.packets += 1
+                self.bytes += len(packet)
+            if self.encoder.is_open and monotonic() - opened >= self.max_delay:
+                parity += self.encoder.flush()
+            for parity_packet in parity:
+                self._send(output, parity_packet, parity_address)
+                self.parity_packets += 1
+                self.parity_bytes += len(parity_packet)
+            self.relay_ns += perf_counter_ns() - start_ns
+
+    def _send(self, output: socket.socket, packet: bytes, address: Any) -> None:
+        try:
+            output.sendto(packet, address)
+        except OSError:
+            # i.e. the radio link is down, the encoder carries on like without FEC
+            self.send_errors += 1
@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+
+import queue
+import random
+import select
+import socket
+import struct
+import threading
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+from constants import (
+    FRAMERATE,
+    RTSP_IDLE_TIMEOUT,
+    RTSP_MAX_CLIENTS,
+    RTSP_PORT,
+    RTSP_RELAY_PORT,
+    RTSP_SEND_TIMEOUT,
+    RTSP_SERVER_RTP_PORT,
+    RTSP_SESSION_TIMEOUT,
+    RTSP_TCP_QUEUE_PACKETS,
+)
+
+"""
+The RTSP server of `streaming_protocol rtsp`, viewers pull rtsp://<pi>:RTSP_PORT/stream
+instead of the stream being pushed to one GCS. The encoder sends RTP to RTSP_RELAY_PORT on
+loopback and each packet is relayed to every playing session, over UDP or interleaved in
+the session's RTSP connection, so all viewers share one encode. The stream loop polls
+is_wanted() and only runs the encoder from the first DESCRIBE until RTSP_IDLE_TIMEOUT after
+the last viewer left, and asks for a keyframe when a viewer starts playing. The relay gives
+the packets its own SSRC, sequence numbers and timestamps so the viewers' stream carries on
+when the encoder is restarted. A TCP viewer's packets are queued for a writer thread of
+its own, so a stalled viewer is dropped without holding up the others.
+"""
+
+RTSP_METHODS = "OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN, GET_PARAMETER"
+RTP_PAYLOAD_TYPE = 96  # ffmpeg's RTP muxer's dynamic payload type for H.264
+RTP_CLOCK_RATE = 90000  # of H.264's RTP timestamps
+
+
+class RtspSession:
+    def __init__(
+        self, session_id: str, connection: socket.socket, send_lock: threading.Lock
+    ) -> None:
+        self.session_id = session_id
+        self.connection = connection
+        self.send_lock = send_lock  # shared with the responses on the connection
+        self.address: Optional[Tuple[str, int]] = None  # the client's RTP port over UDP
+        self.channel = -1  # the interleaved RTP channel over TCP
+        self.is_playing = False
+        self.last_seen = monotonic()
+        # the interleaved packets for the writer thread over TCP, None ends it
+        self.packets: "queue.Queue[Optional[bytes]]" = queue.Queue(
+            RTSP_TCP_QUEUE_PACKETS
+        )
+
+
+class RtspServer:
+    def __init__(
+        self,
+        port: int = RTSP_PORT,
+        relay_port: int = RTSP_RELAY_PORT,
+        server_rtp_port: int = RTSP_SERVER_RTP_PORT,
+        idle_timeout: float = RTSP_IDLE_TIMEOUT,
+        session_timeout: float = RTSP_SESSION_TIMEOUT,
+    ) -> None:
+        self.port = port
+        self.relay_port = relay_port
+        self.server_rtp_port = server_rtp_port
+        self.idle_timeout = idle_timeout
+        self.session_timeout = session_timeout
+        self.framerate = FRAMERATE  # advertised in the SDP
+        self.is_running = False
+        self.sessions: Dict[str, RtspSession] = {}
+        # the playing sessions, replaced rather than changed so the relay reads it without
+        # the lock
+        self.playing: List[RtspSession] = []
+        self.last_active = 0.0  # the last DESCRIBE or PLAY, or the last viewer leaving
+        # a viewer started playing, see take_keyframe_request
+        self.keyframe_wanted = False
+        self.ssrc = random.getrandbits(32)
+        self._source_ssrc: Optional[int] = None  # of the encoder process being relayed
+        self._sequence_offset = 0
+        self._timestamp_offset = 0
+        self._sequence_number = 0  # the last relayed
+        self._timestamp = 0
+        self._last_packet_time = 0.0
+        self.viewers_total = 0
+        self.connections = 0  # served now, up to RTSP_MAX_CLIENTS
+        self.packets_relayed = 0
+        self.dropped_sessions = 0  # timed out, or a TCP viewer too slow to keep up
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._sockets: List[socket.socket] = []
+
+    def start(self) -> None:
+        if self.is_running:
+            return
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sockets = [listener, relay, rtp, rtcp]
+        try:
+            listener.bind(("0.0.0.0", self.port))
+            listener.listen(RTSP_MAX_CLIENTS)
+            relay.bind(("127.0.0.1", self.relay_port))
+            rtp.bind(("0.0.0.0", self.server_rtp_port))
+            rtcp.bind(("0.0.0.0", self.server_rtp_port + 1))
+        except OSError:
+            self._close_sockets()
+            raise
+        rtp.setblocking(False)  # a full send buffer drops the packet for that viewer
+        self.is_running = True
+        self.last_active = 0.0
+        self._threads = [
+            threading.Thread(
+                target=self._accept_loop, args=(listener,), name="rtsp-accept"
+            ),
+            threading.Thread(
+                target=self._relay_loop, args=(relay, rtp, rtcp), name="rtsp-relay"
+            ),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        print(f"RTSP server listening on rtsp://0.0.0.0:{self.port}/stream")
+
+    def stop(self) -> None:
+        if not self.is_running:
+            return
+        self.is_running = False
+        self._close_sockets()
+        with self._lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+            self.playing = []
+        for session in sessions:
+            try:
+                session.packets.put_nowait(None)
+            except queue.Full:
+                pass  # its writer returns at the next packet as the session is gone
+            self._close_connection(session.connection)
+        for thread in self._threads:
+            thread.join(1.0)
+        self._threads = []
+
+    def _close_sockets(self) -> None:
+        for sock in self._sockets:
+            self._close_connection(sock)
+        self._sockets = []
+
+    @staticmethod
+    def _close_connection(connection: socket.socket) -> None:
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # not connected or already closed
+        connection.close()
+
+    @property
+    def viewers(self) -> int:
+        return len(self.playing)
+
+    def is_wanted(self) -> bool:
+        """
+        Called from the stream loop. Whether the encoder should be running, from the first
+        DESCRIBE (so it is ready by PLAY) until RTSP_IDLE_TIMEOUT after the last viewer, so a
+        viewer reconnecting doesn't restart it.
+        """
+        if self.playing:
+            return True
+        return bool(self.last_active) and (
+            monotonic() - self.last_active < self.idle_timeout
+        )
+
+    def take_keyframe_request(self) -> bool:
+        """
+        Called from the stream loop. Whether a viewer started playing since the last call,
+        it can't decode the stream until the next keyframe.
+        """
+        with self._lock:
+            wanted, self.keyframe_wanted = self.keyframe_wanted, False
+        return wanted
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "viewers": self.viewers,
+            "sessions": len(self.sessions),
+            "connections": self.connections,
+            "viewers_total": self.viewers_total,
+            "packets_relayed": self.packets_relayed,
+            "dropped_sessions": self.dropped_sessions,
+        }
+
+    def _accept_loop(self, listener: socket.socket) -> None:
+        while self.is_running:
+            try:
+                connection, address = listener.accept()
+            except OSError:
+                return  # the server was stopped
+            with self._lock:
+                is_full = self.connections >= RTSP_MAX_CLIENTS
+                if not is_full:
+                    self.connections += 1
+            if is_full:
+                print(f"Refusing RTSP connection from {address[0]}, too many clients")
+                self._close_connection(connection)
+                continue
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection.settimeout(RTSP_SEND_TIMEOUT)
+            threading.Thread(
+                target=self._serve,
+                args=(connection, address),
+                name="rtsp-client",
+                daemon=True,
+            ).start()
+
+    def _serve(self, connection: socket.socket, address: Tuple[str, int]) -> None:
+        """
+        Handles the requests of one RTSP connection until it is closed, then ends its
+        sessions.
+        """
+        send_lock = threading.Lock()
+        session_ids: List[str] = []
+        buffer = b""
+        try:
+            while self.is_running:
+                try:
+                    data = connection.recv(4096)
+                except socket.timeout:
+                    continue
+                if not data:
+                    return
+                buffer += data
+                now = monotonic()
+                for session_id in session_ids:
+                    session = self.sessions.get(session_id)
+                    if session:
+                        session.last_seen = now  # RTCP or a request, still watching
+                while buffer:
+                    if buffer[:1] == b"$":  # interleaved RTCP from the client
+                        if len(buffer) < 4:
+                            break
+                        size = 4 + int.from_bytes(buffer[2:4], "big")
+                        if len(buffer) < size:
+                            break
+                        buffer = buffer[size:]
+                        continue
+                    head, separator, rest = buffer.partition(b"\r\n\r\n")
+                    if not separator:
+                        break
+                    lines = head.decode(errors="replace").split("\r\n")
+                    headers = {}
+                    for line in lines[1:]:
+                        name, _, value = line.partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                    body_size = int(headers.get("content-length", 0))
+                    if len(rest) < body_size:
+                        break
+                    buffer = rest[body_size:]
+                    response = self._handle(
+                        lines[0], headers, connection, send_lock, address, session_ids
+                    )
+                    with send_lock:
+                        connection.sendall(response)
+        except (OSError, ValueError) as e:
+            print(f"RTSP connection from {address[0]} closed: {e}")
+        finally:
+            for session_id in session_ids:
+                self._end_session(session_id)
+            self._close_connection(connection)
+            with self._lock:
+                self.connections -= 1
+
+    def _handle(
+        self,
+        request_line: str,
+        headers: Dict[str, str],
+        connection: socket.socket,
+        send_lock: threading.Lock,
+        address: Tuple[str, int],
+        session_ids: List[str],
+    ) -> bytes:
+        method, _, rest = request_line.partition(" ")
+        url = rest.partition(" ")[0]
+        cseq = headers.get("cseq", "0")
+        session = self.sessions.get(headers.get("session", "").partition(";")[0])
+        if session:
+            session.last_seen = monotonic()
+        if method == "OPTIONS":
+            return self._response(cseq, {"Public": RTSP_METHODS})
+        if method == "DESCRIBE":
+            self.last_active = monotonic()  # starts the encoder before PLAY
+            sdp = self._get_sdp(connection.getsockname()[0]).encode()
+            return self._response(
+                cseq,
+                {
+                    "Content-Base": f"{url.rstrip('/')}/",
+                    "Content-Type": "application/sdp",
+                    "Content-Length": str(len(sdp)),
+                },
+                sdp,
+            )
+        if method == "SETUP":
+            return self._setup(
+                cseq, headers, connection, send_lock, address, session_ids
+            )
+        if method not in ("PLAY", "TEARDOWN", "GET_PARAMETER"):
+            return self._response(
+                cseq, {"Allow": RTSP_METHODS}, status="405 Method Not Allowed"
+            )
+        if session is None:
+            return self._response(cseq, status="454 Session Not Found")
+        if method == "PLAY":
+            self._play(session)
+            return self._response(
+                cseq, {"Session": session.session_id, "Range": "npt=0.000-"}
+            )
+        if method == "TEARDOWN":
+            self._end_session(session.session_id)
+        return self._response(cseq, {"Session": session.session_id})
+
+    def _setup(
+        self,
+        cseq: str,
+        headers: Dict[str, str],
+        connection: socket.socket,
+        send_lock: threading.Lock,
+        address: Tuple[str, int],
+        session_ids: List[str],
+    ) -> bytes:
+        """
+        One track, so a SETUP makes the session. The stream is unicast over UDP, or over
+        TCP interleaved in this connection for viewers behind NAT or firewalls.
+        """
+        transport = headers.get("transport", "")
+        fields = dict(
+            field.partition("=")[::2] for field in transport.split(";") if field
+        )
+        session = RtspSession(f"{random.getrandbits(32):08X}", connection, send_lock)
+        try:
+            if transport.startswith("RTP/AVP/TCP"):
+                channel = int(fields.get("interleaved", "0-1").split("-")[0])
+                session.channel = channel
+                response_transport = (
+                    f"RTP/AVP/TCP;unicast;interleaved={channel}-{channel + 1}"
+                )
+            elif "client_port" in fields and "multicast" not in fields:
+                client_port = int(fields["client_port"].split("-")[0])
+                session.address = (address[0], client_port)
+                response_transport = (
+                    f"RTP/AVP;unicast;client_port={client_port}-{client_port + 1};"
+                    f"server_port={self.server_rtp_port}-{self.server_rtp_port + 1}"
+                )
+            else:
+                raise ValueError(transport)
+        except ValueError:
+            return self._response(cseq, status="461 Unsupported Transport")
+        with self._lock:
+            self.sessions[session.session_id] = session
+        session_ids.append(session.session_id)
+        return self._response(
+            cseq,
+            {
+                "Transport": response_transport,
+                "Session": f"{session.session_id};timeout={int(self.session_timeout)}",
+            },
+        )
+
+    def _play(self, session: RtspSession) -> None:
+        with self._lock:
+            if not session.is_playing:
+                session.is_playing = True
+                self.playing = self.playing + [session]
+                self.viewers_total += 1
+                self.keyframe_wanted = True
+                if session.channel >= 0:
+                    threading.Thread(
+                        target=self._write_loop,
+                        args=(session,),
+                        name="rtsp-writer",
+                        daemon=True,
+                    ).start()
+            self.last_active = monotonic()
+        print(f"RTSP viewer {session.session_id} playing, {self.viewers} watching")
+
+    def _end_session(self, session_id: str) -> bool:
+        """
+        Returns False if the session had already ended.
+        """
+        with self._lock:
+            session = self.sessions.pop(session_id, None)
+            if session is None:
+                return False
+            if session.is_playing:
+                self.playing = [s for s in self.playing if s is not session]
+                self.last_active = monotonic()  # the idle timeout starts now
+        try:
+            session.packets.put_nowait(None)
+        except queue.Full:
+            pass  # the writer is being dropped for falling behind, see _drop
+        print(f"RTSP session {session_id} ended, {self.viewers} watching")
+        return True
+
+    def _drop(self, session: RtspSession, reason: str) -> None:
+        """
+        Ends a viewer's session and closes its connection, which also unblocks a TCP
+        viewer's writer thread.
+        """
+        if self._end_session(session.session_id):
+            print(f"Dropping RTSP session {session.session_id}: {reason}")
+            with self._lock:
+                self.dropped_sessions += 1
+        self._close_connection(session.connection)
+
+    def _write_loop(self, session: RtspSession) -> None:
+        """
+        Sends a TCP viewer's interleaved packets, blocking for up to RTSP_SEND_TIMEOUT.
+        """
+        while True:
+            frame = session.packets.get()
+            if frame is None or session.session_id not in self.sessions:
+                return
+            try:
+                with session.send_lock:
+                    session.connection.sendall(frame)
+            except OSError as e:
+                # blocked for RTSP_SEND_TIMEOUT or disconnected
+                self._drop(session, str(e))
+                return
+
+    def _get_sdp(self, server_ip: str) -> str:
+        return (
+            "v=0\r\n"
+            f"o=- 0 0 IN IP4 {server_ip}\r\n"
+            "s=pistreamer\r\n"
+            "c=IN IP4 0.0.0.0\r\n"
+            "t=0 0\r\n"
+            "a=control:*\r\n"
+            f"m=video 0 RTP/AVP {RTP_PAYLOAD_TYPE}\r\n"
+            f"a=rtpmap:{RTP_PAYLOAD_TYPE} H264/90000\r\n"
+            # the encoders repeat the SPS and PPS with every keyframe
+            f"a=fmtp:{RTP_PAYLOAD_TYPE} packetization-mode=1\r\n"
+            f"a=framerate:{self.framerate}\r\n"
+            "a=control:trackID=0\r\n"
+        )
+
+    @staticmethod
+    def _response(
+        cseq: str,
+        headers: Optional[Dict[str, str]] = None,
+        body: bytes = b"",
+        status: str = "200 OK",
+    ) -> bytes:
+        lines = [f"RTSP/1.0 {status}", f"CSeq: {cseq}", "Server: pistreamer"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+    def _relay_loop(
+        self, relay: socket.socket, rtp: socket.socket, rtcp: socket.socket
+    ) -> None:
+        """
+        Sends each RTP packet from the encoder to every playing session. RTCP receiver
+        reports from UDP viewers keep their sessions alive.
+        """
+        last_expiry_check = monotonic()
+        while self.is_running:
+            try:
+                readable, _, _ = select.select([relay, rtcp], [], [], 1.0)
+                if rtcp in readable:
+                    _, (ip, port) = rtcp.recvfrom(2048)
+                    for session in self.playing:
+                        if session.address == (ip, port - 1):
+                            session.last_seen = monotonic()
+                if relay in readable:
+                    packet = relay.recv(65536)
+                    self._relay(self._renumber(packet), rtp)
+            except (OSError, ValueError):
+                return  # the server was stopped
+            now = monotonic()
+            if now - last_expiry_check >= 1.0:
+                last_expiry_check = now
+                # a TCP session ends with its connection, or when a send blocks
+                for session in list(self.sessions.values()):
+                    if session.channel < 0 and (
+                        now - session.last_seen > self.session_timeout
+                    ):
+                        print(f"RTSP session {session.session_id} timed out")
+                        self.dropped_sessions += 1
+                        self._end_session(session.session_id)
+
+    def _renumber(self, packet: bytes) -> bytes:
+        """
+        A restarted encoder starts a new SSRC, sequence and timestamps. Its packets follow
+        on from the last relayed packet instead, as viewers may drop a new source or wait
+        for its timestamps to catch up.
+        """
+        if len(packet) < 12:
+            return packet
+        sequence_number, timestamp, ssrc = struct.unpack_from(">HII", packet, 2)
+        now = monotonic()
+        if ssrc != self._source_ssrc:
+            if self._source_ssrc is not None:
+                elapsed = int((now - self._last_packet_time) * RTP_CLOCK_RATE)
+                self._sequence_offset = self._sequence_number + 1 - sequence_number
+                self._timestamp_offset = self._timestamp + elapsed - timestamp
+            self._source_ssrc = ssrc
+        self._sequence_number = (sequence_number + self._sequence_offset) & 0xFFFF
+        self._timestamp = (timestamp + self._timestamp_offset) & 0xFFFFFFFF
+        self._last_packet_time = now
+        renumbered = bytearray(packet)
+        struct.pack_into(
+            ">HII", renumbered, 2, self._sequence_number, self._timestamp, self.ssrc
+        )
+        return bytes(renumbered)
+
+    def _relay(self, packet: bytes, rtp: socket.socket) -> None:
+        for session in self.playing:
+            if session.address:
+                try:
+                    rtp.sendto(packet, session.address)
+                except BlockingIOError:
+                    pass  # the UDP send buffer is full, this viewer misses the packet
+                except OSError as e:
+                    self._drop(session, str(e))
+                continue
+            frame = (
+                b"$"
+                + bytes((session.channel,))
+                + len(packet).to_bytes(2, "big")
+                + packet
+            )
+            try:
+                session.packets.put_nowait(frame)
+            except queue.Full:
+                # a TCP viewer can't skip packets, it is too slow to keep up
+                self._drop(session, f"{RTSP_TCP_QUEUE_PACKETS} packets behind")
+        self.packets_relayed += 1
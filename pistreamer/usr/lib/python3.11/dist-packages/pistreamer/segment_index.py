@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+from constants import SEGMENT_INDEX_FILE
+
+"""
+The recording segments on the SD card, oldest first, saved next to them as json so the GCS
+can list and fetch recordings with the `segments` command without scanning directories, and
+so the retention can delete the oldest segments of earlier flights too. The index is only
+rewritten when a segment starts, ends or is deleted.
+"""
+
+
+class SegmentIndex:
+    def __init__(self, file_name: str = SEGMENT_INDEX_FILE) -> None:
+        self.file_name = file_name
+        self.segments: List[Dict[str, Any]] = []
+        self.load()
+
+    def load(self) -> None:
+        """
+        Segments whose files were deleted are dropped. A segment still open was cut short by
+        a power loss or crash, MPEG-TS and fragmented MP4 are readable up to the last
+        keyframe so it is kept.
+        """
+        try:
+            with open(self.file_name) as f:
+                segments = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.segments = []
+        for segment in segments:
+            try:
+                size = os.path.getsize(segment["file"])
+            except OSError:
+                continue
+            if segment["open"]:
+                segment.update(open=False, bytes=size)
+            self.segments.append(segment)
+
+    def save(self) -> None:
+        try:
+            temporary_file_name = f"{self.file_name}.tmp"
+            with open(temporary_file_name, "w") as f:
+                json.dump(self.segments, f)
+            os.replace(temporary_file_name, self.file_name)
+        except OSError as e:
+            print(f"Error saving the segment index {self.file_name}: {e}")
+
+    def add(self, file_name: str) -> None:
+        self.segments.append(
+            {
+                "file": file_name,
+                "start": round(time.time(), 3),
+                "duration": 0.0,
+                "bytes": 0,
+                "open": True,
+            }
+        )
+        self.save()
+
+    def close(self, file_name: str, size: int) -> None:
+        for segment in reversed(self.segments):
+            if segment["file"] == file_name:
+                segment.update(
+                    duration=round(time.time() - segment["start"], 3),
+                    bytes=size,
+                    open=False,
+                )
+                self.save()
+                return
+
+    def pop_oldest(self) -> Optional[Dict[str, Any]]:
+        """
+        Removes and returns the oldest segment that isn't being written.
+        """
+        for index, segment in enumerate(self.segments):
+            if not segment["open"]:
+                del self.segments[index]
+                self.save()
+                return segment
+        return None
+
+    def get_recent(self, count: int) -> List[Dict[str, Any]]:
+        return self.segments[-count:]
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
-from typing import Tuple, List
-from command_service import CommandService
+from typing import List
+from command_service import Command, CommandService
 from constants import (
     CMD_SOCKET_HOST,
     CMD_SOCKET_PORT,
@@ -20,6 +20,7 @@ status and other data is returned back to the mavlink service at a different por
 
 class SocketService(CommandService):
     def __init__(self):
+        super().__init__()
         # Create the server socket
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -80,11 +81,12 @@ class SocketService(CommandService):
         finally:
             client_socket.close()
 
-    def get_pending_commands(self) -> List[Tuple[str, str]]:
+    def get_pending_commands(self) -> List[Command]:
         """
         Returns the a list of command that has not been read yet from the socket.
         The first param in the tuple is the command type followed by the command value.
-        If no commands are ready, then an empty list is returned.
+        If no commands are ready, then an empty list is returned. They are timestamped as
+        they are read here, in the stream loop.
         """
         try:
             # Try reading from the socket
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import json
+import subprocess
+import threading
+from time import monotonic
+from typing import Any, Dict, List
+from constants import (
+    SRT_LATENCY,
+    SRT_OVERHEAD,
+    SRT_RELAY_PORT,
+    SRT_RESTART_BACKOFF,
+    SRT_STATS_PACKETS,
+    SRT_STATS_TIMEOUT,
+)
+
+"""
+`streaming_protocol srt` sends the MPEG-TS stream (KLV included) over SRT instead of plain
+UDP. SRT retransmits lost packets for up to `latency` ms, a receiver buffer of that length
+hides the retransmissions, and packets still missing after it are dropped so the stream
+doesn't fall behind. ffmpeg's SRT output doesn't report the link stats, so ffmpeg sends its
+MPEG-TS to SRT_RELAY_PORT on loopback and srt-live-transmit (from the srt-tools package)
+sends it to the GCS as the SRT caller and reports its stats as JSON lines.
+"""
+
+
+class SrtTransmitter:
+    def __init__(
+        self,
+        latency_ms: int = SRT_LATENCY,
+        overhead_percent: int = SRT_OVERHEAD,
+        relay_port: int = SRT_RELAY_PORT,
+    ) -> None:
+        self.latency_ms = latency_ms
+        self.overhead_percent = overhead_percent
+        self.relay_port = relay_port
+        self.is_running = False
+        self.process: Any = None
+        self.ip = ""
+        self.port = 0
+        self.started_time = 0.0
+        self.restarts = 0
+        self._reset_stats()
+
+    def set_arq(self, latency_ms: int, overhead_percent: int) -> None:
+        """
+        Takes effect when the transmitter is next started.
+        """
+        self.latency_ms = latency_ms
+        self.overhead_percent = overhead_percent
+
+    def _reset_stats(self) -> None:
+        self.rtt_ms = 0.0
+        self.send_rate_mbps = 0.0
+        self.buffer_ms = 0
+        self.packets = 0
+        self.retransmitted = 0
+        self.lost = 0  # reported lost by the receiver, then retransmitted
+        self.dropped = 0  # too late to send within the latency
+        self.last_stats_time = 0.0
+
+    def get_command(self, ip: str, port: int) -> List[str]:
+        # oheadbw only caps the retransmissions with maxbw=0, the input rate is measured
+        srt_options = (
+            f"mode=caller&latency={self.latency_ms}"
+            f"&maxbw=0&oheadbw={self.overhead_percent}"
+        )
+        return [
+            "srt-live-transmit",
+            f"udp://127.0.0.1:{self.relay_port}",
+            f"srt://{ip}:{port}?{srt_options}",
+            f"-s:{SRT_STATS_PACKETS}",
+            "-pf:json",
+        ]
+
+    def start(self, ip: str, port: int) -> None:
+        if self.is_running:
+            return
+        self.ip = ip
+        self.port = port
+        self._reset_stats()
+        self._spawn()
+        self.is_running = True
+
+    def _spawn(self) -> None:
+        command = self.get_command(self.ip, self.port)
+        print(f"Starting SRT transmitter {command}")
+        self.started_time = monotonic()
+        self.process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        )
+        threading.Thread(
+            target=self._read_stats,
+            args=(self.process.stdout,),
+            name="srt-stats",
+            daemon=True,
+        ).start()
+
+    def stop(self) -> None:
+        self.is_running = False
+        if self.process is None:
+            return
+        print("Stopping SRT transmitter...")
+        self.process.terminate()
+        # reaped on a thread so the stream loop doesn't wait for it to exit
+        threading.Thread(
+            target=self._reap, args=(self.process,), name="srt-stop", daemon=True
+        ).start()
+        self.process = None
+
+    @staticmethod
+    def _reap(process: Any) -> None:
+        try:
+            process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def check(self) -> None:
+        """
+        Called with the encoders' checks, restarts srt-live-transmit if it exited. It
+        reconnects by itself while the GCS is unreachable.
+        """
+        if not self.is_running or self.process is None:
+            return
+        if self.process.poll() is None:
+            return
+        if monotonic() - self.started_time < SRT_RESTART_BACKOFF:
+            return
+        print(f"SRT transmitter exited with {self.process.returncode}, restarting")
+        self.restarts += 1
+        try:
+            self._spawn()
+        except OSError as e:
+            print(f"Failed to restart the SRT transmitter: {e}")
+
+    def _read_stats(self, stdout: Any) -> None:
+        for line in stdout:
+            try:
+                stats = json.loads(line)
+            except ValueError:
+                continue  # not a stats line
+            if isinstance(stats, dict):
+                self._add_stats(stats)
+
+    def _add_stats(self, stats: Dict[str, Any]) -> None:
+        """
+        The send counters are since the last report.
+        """
+        link = stats.get("link", {})
+        send = stats.get("send", {})
+        self.rtt_ms = float(link.get("rtt", self.rtt_ms))
+        self.send_rate_mbps = float(send.get("mbitRate", self.send_rate_mbps))
+        self.buffer_ms = int(send.get("msBuf", self.buffer_ms))
+        self.packets += int(send.get("packets", 0))
+        self.retransmitted += int(send.get("packetsRetransmitted", 0))
+        self.lost += int(send.get("packetsLost", 0))
+        self.dropped += int(send.get("packetsDropped", 0))
+        self.last_stats_time = monotonic()
+
+    def metrics(self) -> Dict[str, Any]:
+        # srt-live-transmit only reports stats while it is connected
+        connected = (
+            bool(self.last_stats_time)
+            and monotonic() - self.last_stats_time < SRT_STATS_TIMEOUT
+        )
+        return {
+            "connected": self.is_running and connected,
+            "latency_ms": self.latency_ms,
+            "overhead_percent": self.overhead_percent,
+            "rtt_ms": round(self.rtt_ms, 1),
+            "send_rate_mbps": round(self.send_rate_mbps, 2),
+            "buffer_ms": self.buffer_ms,
+            "packets": self.packets,
+            "retransmitted": self.retransmitted,
+            "lost": self.lost,
+            "dropped": self.dropped,
+            "restarts": self.restarts,
+        }
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_left
+from time import perf_counter_ns
+from typing import Any, Dict, Iterable, List
+from constants import FRAMERATE, STAGE_HISTOGRAM_BUCKETS_US, FrameStage
+
+"""
+Per stage timings of the stream loop kept as fixed bucket histograms, plus a few counters
+(dropped frames, command queue depth, ...). Recording a timing is a bisect and a few list
+increments so it can stay on for every frame, the summary is only built when it is published
+or requested with the `stats` command.
+"""
+
+
+class StageStats:
+    def __init__(
+        self,
+        stages: Iterable[FrameStage] = tuple(FrameStage),
+        buckets_us: Iterable[int] = STAGE_HISTOGRAM_BUCKETS_US,
+        framerate: int = FRAMERATE,
+    ) -> None:
+        self.stages = list(stages)
+        self.buckets_us = list(buckets_us)
+        self._bounds_ns = [bucket * 1000 for bucket in self.buckets_us]
+        self._index = {stage: index for index, stage in enumerate(self.stages)}
+        self.frame_interval_ns = 1000000000 // framerate
+        self.reset()
+
+    def reset(self) -> None:
+        bucket_count = len(self._bounds_ns) + 1  # the last bucket is unbounded
+        self.histograms: List[List[int]] = [[0] * bucket_count for _ in self.stages]
+        self.counts = [0] * len(self.stages)
+        self.totals_ns = [0] * len(self.stages)
+        self.maxes_ns = [0] * len(self.stages)
+        self.counters: Dict[str, int] = {
+            "frames": 0,
+            "dropped_frames": 0,  # gaps in the sensor timestamps
+            "empty_frames": 0,
+            "decimated_frames": 0,  # frames no sink took at its frame rate
+            "klv_dropped": 0,  # KLV packets dropped because the pipe was full
+            "command_queue_depth": 0,  # commands received in the last batch
+            "command_queue_max": 0,
+        }
+        self.last_sensor_timestamp_ns = 0
+
+    def record(self, stage: FrameStage, elapsed_ns: int) -> None:
+        index = self._index[stage]
+        self.histograms[index][bisect_left(self._bounds_ns, elapsed_ns)] += 1
+        self.counts[index] += 1
+        self.totals_ns[index] += elapsed_ns
+        if elapsed_ns > self.maxes_ns[index]:
+            self.maxes_ns[index] = elapsed_ns
+
+    def lap(self, stage: FrameStage, start_ns: int) -> int:
+        """
+        Records the time since start_ns against the stage and returns the current time so
+        consecutive stages can be timed with a single clock read each.
+        """
+        now_ns = perf_counter_ns()
+        self.record(stage, now_ns - start_ns)
+        return now_ns
+
+    def increment(self, counter: str, count: int = 1) -> None:
+        self.counters[counter] += count
+
+    def count_frame(self, sensor_timestamp_ns: int) -> None:
+        """
+        Frames the camera dropped show up as gaps of more than one frame interval between
+        consecutive sensor timestamps.
+        """
+        self.counters["frames"] += 1
+        if self.last_sensor_timestamp_ns and sensor_timestamp_ns:
+            gap_ns = sensor_timestamp_ns - self.last_sensor_timestamp_ns
+            if gap_ns > self.frame_interval_ns * 3 // 2:
+                self.counters["dropped_frames"] += (
+                    round(gap_ns / self.frame_interval_ns) - 1
+                )
+        self.last_sensor_timestamp_ns = sensor_timestamp_ns
+
+    def set_queue_depth(self, depth: int) -> None:
+        self.counters["command_queue_depth"] = depth
+        if depth > self.counters["command_queue_max"]:
+            self.counters["command_queue_max"] = depth
+
+    def _percentile_us(
+        self, histogram: List[int], count: int, percentile: float
+    ) -> int:
+        """
+        Upper bound of the bucket the percentile falls in, -1 if it is the unbounded bucket.
+        """
+        target = count * percentile
+        seen = 0
+        for bucket, bucket_count in enumerate(histogram):
+            seen += bucket_count
+            if seen >= target:
+                return self.buckets_us[bucket] if bucket < len(self.buckets_us) else -1
+        return -1
+
+    def summary(self) -> Dict[str, Any]:
+        stages = {}
+        for index, stage in enumerate(self.stages):
+            count = self.counts[index]
+            if not count:
+                continue
+            histogram = self.histograms[index]
+            stages[stage.value] = {
+                "count": count,
+                "mean_us": round(self.totals_ns[index] / count / 1000, 1),
+                "max_us": round(self.maxes_ns[index] / 1000, 1),
+                "p50_us": self._percentile_us(histogram, count, 0.5),
+                "p99_us": self._percentile_us(histogram, count, 0.99),
+                "histogram": list(histogram),
+            }
+        return {
+            "buckets_us": self.buckets_us,
+            "stages": stages,
+            "counters": dict(self.counters),
+        }
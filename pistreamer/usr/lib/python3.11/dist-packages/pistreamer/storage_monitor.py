@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import os
+from time import monotonic
+from typing import Optional
+from constants import SD_CARD_MOUNTED_LOCATION, STORAGE_CHECK_INTERVAL
+
+"""
+Free space on the SD card, checked from the stream loop every STORAGE_CHECK_INTERVAL with a
+single statvfs call rather than on every write, which is enough to delete old segments well
+before the card fills at recording bitrates.
+"""
+
+
+def get_free_bytes(path: str) -> int:
+    """
+    Space available to pistreamer, not counting the blocks reserved for root.
+    """
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+class StorageMonitor:
+    def __init__(
+        self,
+        path: str = SD_CARD_MOUNTED_LOCATION,
+        interval: float = STORAGE_CHECK_INTERVAL,
+    ) -> None:
+        self.path = path
+        self.interval = interval
+        self.free_bytes = -1  # -1 until the first check
+        self.error = ""
+        self.last_check_time = 0.0
+
+    def check(self) -> Optional[int]:
+        try:
+            self.free_bytes = get_free_bytes(self.path)
+            self.error = ""
+            return self.free_bytes
+        except OSError as e:
+            self.error = str(e)  # the card was removed or isn't mounted
+            return None
+
+    def poll(self) -> Optional[int]:
+        """
+        Called from the stream loop, returns the free bytes once every interval.
+        """
+        now = monotonic()
+        if now - self.last_check_time < self.interval:
+            return None
+        self.last_check_time = now
+        return self.check()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import math
+from time import CLOCK_BOOTTIME, clock_gettime_ns
+from typing import Dict, Optional, Sequence, Tuple
+import numpy as np
+from constants import (
+    TELEMETRY_BUFFER_SIZE,
+    TELEMETRY_MAX_EXTRAPOLATION,
+    MavlinkGPSData,
+    MavlinkMiscData,
+)
+
+"""
+MAVLink data is kept as a short history of timestamped samples instead of only the latest
+message, so consumers can look up the telemetry at the time a frame was exposed. Samples are
+timestamped when the command service receives them with CLOCK_BOOTTIME, the same clock
+libcamera uses for the `SensorTimestamp` frame metadata.
+"""
+
+GPS_FIELDS: Tuple[str, ...] = (
+    "lat",
+    "lon",
+    "alt",
+    "eph",
+    "epv",
+    "vel",
+    "cog",
+    "fix_type",
+    "satellites_visible",
+    "time_usec",
+)
+ATTITUDE_FIELDS: Tuple[str, ...] = ("pitch", "roll")
+# Fields that wrap around and the period they wrap at
+GPS_ANGLE_FIELDS: Dict[str, float] = {"cog": 36000.0}  # centi-degrees
+ATTITUDE_ANGLE_FIELDS: Dict[str, float] = {"roll": 2 * math.pi}  # radians
+# Fields that are held at the newest sample rather than extrapolated
+GPS_HELD_FIELDS: Tuple[str, ...] = ("eph", "epv", "fix_type", "satellites_visible")
+
+
+def get_telemetry_timestamp_ns() -> int:
+    return clock_gettime_ns(CLOCK_BOOTTIME)
+
+
+class TelemetryRingBuffer:
+    """
+    Fixed size, NumPy backed ring buffer with one float64 row per sample. Samples arrive in
+    timestamp order so the buffer holds at most two sorted runs and a lookup is a binary
+    search, O(log n). Results are written into a reused row so lookups don't allocate.
+    """
+
+    def __init__(
+        self,
+        fields: Tuple[str, ...],
+        capacity: int = TELEMETRY_BUFFER_SIZE,
+        angle_fields: Optional[Dict[str, float]] = None,
+        held_fields: Tuple[str, ...] = (),
+        max_extrapolation: float = TELEMETRY_MAX_EXTRAPOLATION,
+    ) -> None:
+        self.fields = fields
+        self.capacity = capacity
+        self.max_extrapolation_ns = int(max_extrapolation * 1e9)
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.samples = np.zeros((capacity, len(fields)), dtype=np.float64)
+        self.head = 0  # next row to write
+        self.count = 0
+        self.angle_columns = [
+            (fields.index(name), period)
+            for name, period in (angle_fields or {}).items()
+        ]
+        self.held_columns = [fields.index(name) for name in held_fields]
+        self._row = np.zeros(len(fields), dtype=np.float64)
+
+    def append(self, values: Sequence[float], timestamp_ns: int = 0) -> None:
+        timestamp_ns = timestamp_ns or get_telemetry_timestamp_ns()
+        if self.count:
+            # Keep the runs sorted even if the caller's clock steps backwards
+            timestamp_ns = max(timestamp_ns, int(self.timestamps[self.head - 1]))
+        self.timestamps[self.head] = timestamp_ns
+        self.samples[self.head] = values
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def _physical_index(self, logical_index: int) -> int:
+        """
+        Logical index 0 is the oldest sample.
+        """
+        if self.count < self.capacity:
+            return logical_index
+        return (self.head + logical_index) % self.capacity
+
+    def _search(self, timestamp_ns: int) -> int:
+        """
+        Returns the logical index of the first sample newer than timestamp_ns.
+        """
+        if self.count < self.capacity:
+            return int(
+                np.searchsorted(
+                    self.timestamps[: self.count], timestamp_ns, side="right"
+                )
+            )
+        # Full, [head:] holds the older run and [:head] the newer run
+        older_count = self.capacity - self.head
+        if self.head and timestamp_ns >= self.timestamps[0]:
+            return older_count + int(
+                np.searchsorted(
+                    self.timestamps[: self.head], timestamp_ns, side="right"
+                )
+            )
+        return int(
+            np.searchsorted(self.timestamps[self.head :], timestamp_ns, side="right")
+        )
+
+    def latest(self) -> Optional[np.ndarray]:
+        """
+        Returns a view of the newest sample.
+        """
+        if not self.count:
+            return None
+        return self.samples[self.head - 1]
+
+    def latest_timestamp(self) -> int:
+        return int(self.timestamps[self.head - 1]) if self.count else 0
+
+    def interpolate(
+        self, timestamp_ns: int, out: Optional[np.ndarray] = None
+    ) -> Optional[np.ndarray]:
+        """
+        Linearly interpolates the sample at timestamp_ns. Timestamps after the newest sample,
+        i.e. a frame exposed before the telemetry for it has arrived, are extrapolated from
+        the newest two samples for up to max_extrapolation, and held after that. Timestamps
+        before the oldest sample are clamped to it.
+        """
+        if not self.count:
+            return None
+        out = self._row if out is None else out
+        index = self._search(timestamp_ns)
+        if index == self.count and self.count > 1:
+            timestamp_ns = min(
+                timestamp_ns, self.latest_timestamp() + self.max_extrapolation_ns
+            )
+            index = self.count - 1  # the weight is over 1
+        elif index == 0 or index == self.count:
+            out[:] = self.samples[self._physical_index(min(index, self.count - 1))]
+            return out
+
+        before = self._physical_index(index - 1)
+        after = self._physical_index(index)
+        span = int(self.timestamps[after] - self.timestamps[before])
+        weight = (timestamp_ns - int(self.timestamps[before])) / span if span else 1.0
+        np.subtract(self.samples[after], self.samples[before], out=out)
+        for column, period in self.angle_columns:
+            # interpolate the short way around i.e. 35900 -> 100 centi-degrees
+            out[column] = (out[column] + period / 2) % period - period / 2
+        out *= weight
+        out += self.samples[before]
+        for column, period in self.angle_columns:
+            out[column] %= period
+        if weight > 1.0:
+            for column in self.held_columns:
+                out[column] = self.samples[after, column]
+        return out
+
+
+class TelemetryHistory:
+    """
+    The GPS and attitude history used for geotagging photos and per frame metadata.
+    The camera model and focal length rarely change so only their latest value is kept.
+    """
+
+    def __init__(self, capacity: int = TELEMETRY_BUFFER_SIZE) -> None:
+        self.gps = TelemetryRingBuffer(
+            GPS_FIELDS, capacity, GPS_ANGLE_FIELDS, GPS_HELD_FIELDS
+        )
+        self.attitude = TelemetryRingBuffer(
+            ATTITUDE_FIELDS, capacity, ATTITUDE_ANGLE_FIELDS
+        )
+        self.camera_model = MavlinkMiscData.camera_model
+        self.focal_length = MavlinkMiscData.focal_length
+
+    def add_gps(self, values: Sequence[float], timestamp_ns: int = 0) -> None:
+        """
+        values are in GPS_FIELDS order.
+        """
+        self.gps.append(values, timestamp_ns)
+
+    def add_misc(
+        self,
+        pitch: float,
+        roll: float,
+        camera_model: str,
+        focal_length: Tuple[int, int],
+        timestamp_ns: int = 0,
+    ) -> None:
+        self.attitude.append((pitch, roll), timestamp_ns)
+        self.camera_model = camera_model
+        self.focal_length = focal_length
+
+    def covers(self, timestamp_ns: int) -> bool:
+        """
+        Whether GPS and attitude samples from after timestamp_ns have arrived, so it is
+        interpolated rather than extrapolated.
+        """
+        return (
+            self.gps.latest_timestamp() >= timestamp_ns
+            and self.attitude.latest_timestamp() >= timestamp_ns
+        )
+
+    def get_gps_data(self, timestamp_ns: Optional[int] = None) -> MavlinkGPSData:
+        """
+        Returns the GPS data at timestamp_ns or the latest if no timestamp is given.
+        """
+        row = (
+            self.gps.latest()
+            if timestamp_ns is None
+            else self.gps.interpolate(timestamp_ns)
+        )
+        if row is None:
+            return MavlinkGPSData()
+        return MavlinkGPSData(*(int(round(value)) for value in row))
+
+    def get_misc_data(self, timestamp_ns: Optional[int] = None) -> MavlinkMiscData:
+        """
+        Returns the attitude at timestamp_ns or the latest if no timestamp is given.
+        """
+        row = (
+            self.attitude.latest()
+            if timestamp_ns is None
+            else self.attitude.interpolate(timestamp_ns)
+        )
+        pitch, roll = (float(row[0]), float(row[1])) if row is not None else (0.0, 0.0)
+        if roll > math.pi:
+            roll -= 2 * math.pi
+        return MavlinkMiscData(pitch, roll, self.camera_model, self.focal_length)
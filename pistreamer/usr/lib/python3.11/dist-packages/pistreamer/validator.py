@@ -3,7 +3,26 @@ import os
 import ipaddress
 from typing import Any, Optional
 
-from constants import CommandProtocolType, RadioType, StreamingProtocolType
+from constants import (
+    FEC_MAX_INTERLEAVE,
+    FEC_MAX_SPAN,
+    FRAMERATE,
+    PRE_EVENT_MEMORY_BUDGET,
+    RECORD_BITRATE_MAX,
+    RECORD_BITRATE_MIN,
+    SECONDARY_BITRATE_MIN,
+    SRT_LATENCY_MAX,
+    SRT_LATENCY_MIN,
+    SRT_OVERHEAD_MAX,
+    SRT_OVERHEAD_MIN,
+    YUV420_WIDTH_ALIGNMENT,
+    CommandProtocolType,
+    EncoderBackend,
+    RadioType,
+    RecordProfile,
+    SinkType,
+    StreamingProtocolType,
+)
 
 
 class Validator:
@@ -23,6 +42,24 @@ class Validator:
         ret &= self.validate_streaming_protocol(self.args.streaming_protocol)
         ret &= self.validate_radio_type(self.args.radio_type)
         ret &= self.validate_command_protocol(self.args.command_protocol)
+        ret &= self.validate_record_bitrate(int(self.args.record_bitrate))
+        ret &= self.validate_record_profile(self.args.record_profile)
+        ret &= self.validate_record_resolution(
+            str(self.args.record_resolution), str(self.args.resolution)
+        )
+        ret &= self.validate_framerate(int(self.args.stream_framerate))
+        ret &= self.validate_framerate(int(self.args.record_framerate))
+        ret &= self.validate_secondary_resolution(
+            str(self.args.secondary_resolution), str(self.args.resolution)
+        )
+        ret &= self.validate_secondary_bitrate(int(self.args.secondary_bitrate))
+        ret &= self.validate_fec(
+            int(self.args.fec_group_size), int(self.args.fec_interleave)
+        )
+        ret &= self.validate_srt(
+            int(self.args.srt_latency), int(self.args.srt_overhead)
+        )
+        ret &= self.validate_encoder_backend(self.args.encoder_backend)
         return ret
 
     def validate_ip(self, ip: str) -> bool:
@@ -48,6 +85,96 @@ class Validator:
         except ValueError:
             return False
 
+    def validate_record_bitrate(self, bitrate: int) -> bool:
+        """
+        In bits per second, unlike the streaming bitrate.
+        """
+        return RECORD_BITRATE_MIN <= bitrate <= RECORD_BITRATE_MAX
+
+    def validate_record_profile(self, record_profile: str) -> bool:
+        return record_profile.lower() in [
+            RecordProfile.MPEG_TS.value,
+            RecordProfile.FMP4.value,
+        ]
+
+    def validate_record_resolution(
+        self, record_resolution: str, resolution: str
+    ) -> bool:
+        """
+        Empty to record the stream. Otherwise the ISP's main output, which can't be smaller
+        than the stream (its lores output).
+        """
+        if not record_resolution:
+            return True
+        try:
+            width, height = map(int, record_resolution.lower().split("x"))
+            stream_width, stream_height = map(int, resolution.lower().split("x"))
+        except ValueError:
+            return False
+        return (
+            width % YUV420_WIDTH_ALIGNMENT == 0
+            and width >= stream_width
+            and height >= stream_height
+        )
+
+    def validate_secondary_resolution(
+        self, secondary_resolution: str, resolution: str
+    ) -> bool:
+        """
+        Empty for no simulcast stream. Otherwise the ISP's lores output (or the stream scaled
+        down when lores is the stream), which can't be larger than the stream.
+        """
+        if not secondary_resolution:
+            return True
+        try:
+            width, height = map(int, secondary_resolution.lower().split("x"))
+            stream_width, stream_height = map(int, resolution.lower().split("x"))
+        except ValueError:
+            return False
+        return (
+            width % YUV420_WIDTH_ALIGNMENT == 0
+            and height % 2 == 0
+            and 0 < width <= stream_width
+            and 0 < height <= stream_height
+        )
+
+    def validate_secondary_bitrate(self, bitrate: int) -> bool:
+        """
+        In bits per second, up to the streaming bitrate's limit.
+        """
+        return SECONDARY_BITRATE_MIN <= bitrate <= 10000000
+
+    def validate_framerate(self, framerate: int) -> bool:
+        """
+        A sink can't run faster than the camera.
+        """
+        return 1 <= framerate <= FRAMERATE
+
+    def validate_fec(self, group_size: int, interleave: int) -> bool:
+        """
+        A parity packet covers group_size packets interleave apart, 0 for no FEC.
+        """
+        return (
+            0 <= group_size
+            and 1 <= interleave <= FEC_MAX_INTERLEAVE
+            and (group_size - 1) * interleave < FEC_MAX_SPAN
+        )
+
+    def validate_srt(self, latency_ms: int, overhead_percent: int) -> bool:
+        return (
+            SRT_LATENCY_MIN <= latency_ms <= SRT_LATENCY_MAX
+            and SRT_OVERHEAD_MIN <= overhead_percent <= SRT_OVERHEAD_MAX
+        )
+
+    def validate_sink(self, sink: str) -> bool:
+        return sink.lower() in [sink_type.value for sink_type in SinkType]
+
+    def validate_pre_event(self, seconds: float, bitrate: int) -> bool:
+        """
+        The buffer holds bitrate (bits per second) x seconds, it must fit in its budget.
+        """
+        return 0 <= seconds and seconds * bitrate / 8 <= PRE_EVENT_MEMORY_BUDGET
+
     def validate_max_zoom(self, max_zoom: float) -> bool:
         try:
             if 8.0 <= max_zoom <= 16.0:
@@ -60,8 +187,13 @@ class Validator:
         return streaming_protocol.lower() in [
             StreamingProtocolType.RTP.value,
             StreamingProtocolType.MPEG_TS.value,
+            StreamingProtocolType.RTSP.value,
+            StreamingProtocolType.SRT.value,
         ]
 
+    def validate_encoder_backend(self, encoder_backend: str) -> bool:
+        return encoder_backend.lower() in [backend.value for backend in EncoderBackend]
+
     def validate_radio_type(self, radio_type: str) -> bool:
         return radio_type.lower() in [
             RadioType.MICROHARD.value,
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
-from typing import Tuple, List
-from command_service import CommandService
+import queue
+import threading
+from typing import Dict, Tuple, List
+from command_service import Command, CommandService
 from constants import (
     CMD_SOCKET_PORT,
+    COMMAND_RECEIVE_QUEUE_SIZE,
     OUTPUT_SOCKET_PORT,
+    TELEMETRY_SEND_HWM,
 )
+from telemetry_buffer import get_telemetry_timestamp_ns
 import zmq
 
 
@@ -14,11 +19,14 @@ Commands are communicated to the pistreamer app via a dedicated socket host:port
 status and other data is returned back to the mavlink service at a different port.
 
 Unlike the socket_service.py, this service uses ZeroMQ for communication: https://zeromq.org/
+Commands are received on a thread and timestamped as they arrive, so GPS and MISC data
+sent while the stream loop is busy (i.e. taking a photo) keep the time they were sent at.
 """
 
 
 class ZeroMQService(CommandService):
     def __init__(self):
+        super().__init__()
         # Used for receiving commands
         self.receive_context = zmq.Context()
         self.receive_socket = self.receive_context.socket(zmq.PAIR)
@@ -29,34 +37,77 @@ class ZeroMQService(CommandService):
         self.receive_socket.setsockopt(
             zmq.RCVHWM, 1000
         )  # limit receiver high water mark queue size to 1000 messages
+        # (data, received_ns), a full queue holds messages back in ZeroMQ's queue
+        self.received: "queue.Queue[Tuple[str, int]]" = queue.Queue(
+            COMMAND_RECEIVE_QUEUE_SIZE
+        )
+        self.receive_thread = threading.Thread(
+            target=self._receive_loop, name="zeromq-receive", daemon=True
+        )
+        self.receive_thread.start()
 
-        # Used for sending commands
+        # Used for publishing telemetry to any number of subscribers. A PUB socket drops
+        # messages for a subscriber whose queue is full instead of blocking the stream loop.
         self.send_context = zmq.Context()
-        self.send_socket = self.send_context.socket(zmq.PAIR)
-        self.send_socket.bind(
+        self.telemetry_socket = self.send_context.socket(zmq.PUB)
+        self.telemetry_socket.setsockopt(zmq.SNDHWM, TELEMETRY_SEND_HWM)
+        self.telemetry_socket.setsockopt(zmq.LINGER, 0)
+        self.telemetry_socket.bind(
             f"tcp://*:{OUTPUT_SOCKET_PORT}"
         )  # notice we are binding here
+        self.pending_telemetry: Dict[str, str] = {}
 
+        # Used for sending command responses back over the command pair
         self.send_socket = self.receive_context.socket(zmq.PAIR)
         self.send_socket.connect(f"tcp://localhost:{CMD_SOCKET_PORT}")
         self.send_socket.setsockopt(zmq.SNDHWM, 1000)
         self.send_socket.setsockopt(zmq.RCVHWM, 1000)
 
+    def _receive_loop(self) -> None:
+        """
+        The receive socket is only used on this thread, ZeroMQ sockets aren't thread safe.
+        """
+        while True:
+            try:
+                data = self.receive_socket.recv_string()
+            except zmq.ZMQError as e:
+                print(f"Error receiving data: {e}")
+                return
+            self.received.put((data, get_telemetry_timestamp_ns()))
+
     def send_data_out(self, data: str) -> None:
         self.send_socket.send_string(data)
 
-    def get_pending_commands(self) -> List[Tuple[str, str]]:
-        commands = []
-        try:
-            # We want to get all available messages in the queue
-            while True:
-                data = self.receive_socket.recv_string(zmq.NOBLOCK)
-                # zeromq only gets 1 command at a time here
-                command = self._get_commands_from_data(data)[0]
-                commands.append(command)
-        except zmq.Again:
-            # No message available, continue processing
-            pass
-        except Exception as e:
-            print(f"Error receiving data: {e}")
-        return commands
+    def publish(self, topic: str, data: str) -> None:
+        """
+        Only the latest value of each topic is kept until the next flush, so a topic
+        updated several times within a frame is sent once.
+        """
+        self.pending_telemetry[topic] = data
+
+    def flush_telemetry(self) -> None:
+        """
+        Sends the pending value of every topic without blocking. Each message is a single
+        frame so subscribers can use ZMQ_CONFLATE on a per-topic SUB socket.
+        """
+        if not self.pending_telemetry:
+            return
+        for topic, data in self.pending_telemetry.items():
+            try:
+                self.telemetry_socket.send_string(f"{topic} {data}", zmq.NOBLOCK)
+            except zmq.Again:
+                # A newer value will be sent on the next flush
+                pass
+        self.pending_telemetry.clear()
+
+    def get_pending_commands(self) -> List[Command]:
+        commands: List[Command] = []
+        # We want to get all available messages in the queue
+        while True:
+            try:
+                data, received_ns = self.received.get_nowait()
+            except queue.Empty:
+                # No message available, continue processing
+                return commands
+            # zeromq only gets 1 command at a time here
+            commands += self._get_commands_from_data(data, received_ns)[:1]
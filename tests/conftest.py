@@ -0,0 +1,30 @@
+import os
+import sys
+import pytest
+
+"""
+The modules are flat in the package directory and import each other by name, and the
+camera and GPIO modules are replaced by the fakes so the tests run without a Pi.
+"""
+
+PACKAGE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "pistreamer",
+    "usr",
+    "lib",
+    "python3.11",
+    "dist-packages",
+    "pistreamer",
+)
+sys.path.insert(0, os.path.normpath(PACKAGE_DIR))
+
+from _fake_devices import install_fake_modules  # noqa: E402
+
+install_fake_modules()
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    config.addinivalue_line(
+        "markers", "slow: runs for minutes, deselect with -m 'not slow'"
+    )
@@ -0,0 +1,60 @@
+import json
+import socket
+from time import sleep
+import pytest
+from _fake_devices import DISPATCH_COMMANDS
+from command_service import CommandService
+from constants import CMD_SOCKET_PORT, CommandType
+from telemetry_buffer import get_telemetry_timestamp_ns
+
+GPS_JSON = dict(DISPATCH_COMMANDS)[CommandType.GPS_DATA.value]
+
+
+def test_keeps_every_telemetry_sample_and_the_newest_zoom() -> None:
+    commands = [
+        (CommandType.GPS_DATA.value, GPS_JSON, 1),
+        (CommandType.ZOOM.value, "2.0", 2),
+        (CommandType.GPS_DATA.value, GPS_JSON, 3),
+        (CommandType.ZOOM.value, "4.0", 4),
+    ]
+    assert CommandService()._coalesce_commands(commands) == [
+        commands[0],
+        commands[2],
+        commands[3],
+    ]
+
+
+def test_keyframe_requests_are_coalesced_per_stream() -> None:
+    commands = [
+        (CommandType.KEYFRAME.value, "", 1),
+        (CommandType.KEYFRAME.value, "secondary", 2),
+        (CommandType.KEYFRAME.value, "", 3),
+    ]
+    assert CommandService()._coalesce_commands(commands) == commands[1:]
+
+
+def test_commands_are_timestamped_when_received() -> None:
+    zmq = pytest.importorskip("zmq")
+    with socket.socket() as probe:
+        if probe.connect_ex(("127.0.0.1", CMD_SOCKET_PORT)) == 0:
+            pytest.skip("the command port is in use")
+    from zeromq_service import ZeroMQService
+
+    context = zmq.Context()
+    sender = context.socket(zmq.PAIR)
+    sender.bind(f"tcp://*:{CMD_SOCKET_PORT}")
+    service = ZeroMQService()
+    try:
+        sent_ns = get_telemetry_timestamp_ns()
+        sender.send_string(f"{CommandType.GPS_DATA.value} {GPS_JSON}")
+        sleep(0.5)  # the stream loop is busy
+        polled_ns = get_telemetry_timestamp_ns()
+        [(command_type, command_value, received_ns)] = service.get_pending_commands()
+    finally:
+        sender.close(0)
+        for sock in (service.telemetry_socket, service.send_socket):
+            sock.close(0)
+        context.term()
+    assert command_type == CommandType.GPS_DATA.value
+    assert json.loads(command_value) == json.loads(GPS_JSON)
+    assert sent_ns <= received_ns < polled_ns - 400000000
@@ -0,0 +1,105 @@
+from time import monotonic, sleep
+from typing import List
+from _fake_devices import SUPERVISOR_FRAMES, FakeEncoderProcess, run_supervisor_scenario
+from encoder_supervisor import EncoderSupervisor
+
+
+def test_failed_encoders_restart_while_capture_continues(tmp_path: str) -> None:
+    pi_streamer, record_sizes = run_supervisor_scenario(
+        SUPERVISOR_FRAMES, str(tmp_path)
+    )
+
+    assert pi_streamer.picam2.frames_captured == SUPERVISOR_FRAMES
+    assert all(record_sizes), record_sizes
+    for encoder in (pi_streamer.encoder_record, pi_streamer.encoder_rtp):
+        processes = [
+            process for sink, process in pi_streamer.encoders if sink == encoder.sink
+        ]
+        assert encoder.metrics()["restarts"] == 1, encoder.sink
+        assert len(processes) == 2, encoder.sink
+        assert processes[1].stdin.writes > 0, encoder.sink
+
+
+def test_stop_does_not_wait_for_a_hung_encoder() -> None:
+    processes: List[FakeEncoderProcess] = []
+
+    def _spawn() -> FakeEncoderProcess:
+        processes.append(FakeEncoderProcess(["ffmpeg"], fault=("hang", 1)))
+        return processes[-1]
+
+    encoder = EncoderSupervisor("rtp", _spawn, stop_timeout=0.5)
+    encoder.start()
+    while not encoder.is_running:
+        sleep(0.01)
+    for _ in range(3):
+        encoder.write(bytes(16))
+    sleep(0.1)  # the writer is stuck in the second write
+
+    start = monotonic()
+    encoder.stop()
+    encoder.start()
+    assert monotonic() - start < 0.1
+    assert encoder.wait(5)
+    assert encoder.is_running and len(processes) == 2
+    assert processes[0].returncode == -9
+    encoder.stop()
+    assert encoder.wait(5) and processes[1].returncode == 0
+
+
+class _InPlaceKeyframes(FakeEncoderProcess):
+    def __init__(self) -> None:
+        super().__init__(["ffmpeg"])
+        self.keyframes_requested = 0
+
+    def request_keyframe(self) -> None:
+        self.keyframes_requested += 1
+
+
+def _start(encoder: EncoderSupervisor) -> None:
+    encoder.start()
+    while not encoder.keyframe_time:
+        encoder.write(bytes(16))
+        sleep(0.01)
+
+
+def test_keyframe_requests_are_coalesced_and_forced_in_place() -> None:
+    processes: List[_InPlaceKeyframes] = []
+
+    def _spawn() -> _InPlaceKeyframes:
+        processes.append(_InPlaceKeyframes())
+        return processes[-1]
+
+    encoder = EncoderSupervisor("rtp", _spawn, keyframe_request_interval=0.2)
+    _start(encoder)
+    for _ in range(5):  # joiners arriving together, right after the first IDR
+        encoder.request_keyframe()
+    assert processes[0].keyframes_requested == 0
+    sleep(0.25)
+    encoder.write(bytes(16))
+    encoder.write(bytes(16))
+    assert processes[0].keyframes_requested == 1
+    assert len(processes) == 1 and encoder.keyframe_restarts == 0
+    encoder.stop()
+    encoder.wait(5)
+
+
+def test_ffmpeg_is_not_restarted_under_other_viewers() -> None:
+    processes: List[FakeEncoderProcess] = []
+
+    def _spawn() -> FakeEncoderProcess:
+        processes.append(FakeEncoderProcess(["ffmpeg"]))
+        return processes[-1]
+
+    encoder = EncoderSupervisor(
+        "rtsp", _spawn, keyframe_request_interval=0.1, keyframe_interval=60.0
+    )
+    _start(encoder)
+    sleep(0.15)
+    encoder.request_keyframe(restart=False)
+    assert encoder.is_running and encoder.keyframe_restarts == 0
+
+    encoder.request_keyframe()
+    assert encoder.keyframe_restarts == 1
+    assert encoder.wait(5) and encoder.is_running and len(processes) == 2
+    encoder.stop()
+    encoder.wait(5)
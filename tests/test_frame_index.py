@@ -0,0 +1,36 @@
+import os
+from frame_index import FrameIndexWriter, read_frame_index
+from telemetry_buffer import TelemetryHistory
+
+FRAMES = 300
+START_NS = 1000000000
+
+
+def test_records_read_back(tmp_path: str) -> None:
+    samples = FRAMES // 6 + 2  # ~5 Hz GPS/attitude
+    telemetry = TelemetryHistory(capacity=samples)
+    for sample in range(samples):
+        timestamp_ns = START_NS + sample * 200000000
+        telemetry.add_gps(
+            (359686990 + sample * 10, -839290440, 276000, 1, 1, 500, 9000, 3, 10, 0),
+            timestamp_ns,
+        )
+        telemetry.add_misc(0.1, 0.02, "IMX477", (50, 1), timestamp_ns)
+
+    file_name = os.path.join(tmp_path, "recording.idx")
+    writer = FrameIndexWriter(file_name, 30.0)
+    frame_timestamps = [START_NS + frame * 33333333 for frame in range(FRAMES)]
+    for timestamp_ns in frame_timestamps:
+        writer.append(
+            timestamp_ns,
+            telemetry.gps.interpolate(timestamp_ns),
+            telemetry.attitude.interpolate(timestamp_ns),
+            2.0,
+        )
+    writer.close()
+
+    framerate, records = read_frame_index(file_name)
+    assert framerate == 30.0
+    assert len(records) == FRAMES
+    assert records["sensor_timestamp_ns"][-1] == frame_timestamps[-1]
+    assert (records["lat"][1:] >= records["lat"][:-1]).all()
@@ -0,0 +1,78 @@
+import contextlib
+import io
+import os
+from typing import Any, List
+from _fake_devices import create_fake_pistreamer
+
+LAT_BEFORE = 359686990
+LAT_AFTER = 359688990
+
+
+def _gps(lat: int) -> tuple:
+    return (lat, -839290440, 276000, 1, 1, 500, 9000, 3, 10, 0)
+
+
+def test_photo_waits_for_telemetry_from_after_the_exposure(
+    monkeypatch: Any, tmp_path: str
+) -> None:
+    pi_streamer = create_fake_pistreamer("1280x720")
+    pi_streamer.picam2.realtime = True
+    import pistreamer as pistreamer_module  # imported by create_fake_pistreamer
+
+    geotags: List[Any] = []
+
+    class _RecordingEXIFService:
+        def __init__(self, gps_data: Any, misc_data: Any, file_name: str) -> None:
+            geotags.append((gps_data, misc_data, file_name))
+
+        def add_metadata(self) -> None:
+            pass
+
+    monkeypatch.setattr(pistreamer_module, "EXIFService", _RecordingEXIFService)
+    telemetry = pi_streamer.telemetry
+    file_name = os.path.join(tmp_path, "photo.jpg")
+    with contextlib.redirect_stdout(io.StringIO()):
+        pi_streamer.picam2.configure(pi_streamer.streaming_config)
+        pi_streamer.start_rtp_stream("127.0.0.1", "5600")
+        telemetry.add_gps(_gps(LAT_BEFORE), 1)
+        telemetry.add_misc(0.0, 0.0, "IMX477", (50, 1), 1)
+        pi_streamer.take_photo(file_name)
+        assert not geotags  # the newest sample is from before the exposure
+
+        [(_, sensor_timestamp, _)] = pi_streamer.pending_geotags
+        telemetry.add_gps(_gps(LAT_AFTER), 2 * sensor_timestamp - 1)
+        telemetry.add_misc(0.2, 0.0, "IMX477", (50, 1), 2 * sensor_timestamp - 1)
+        pi_streamer._write_geotags()
+        pi_streamer.stop_and_clean_all()
+    pi_streamer.command_controller.audit_log.close()
+
+    [(gps_data, misc_data, geotagged_file_name)] = geotags
+    assert geotagged_file_name == file_name
+    assert gps_data.lat == (LAT_BEFORE + LAT_AFTER) // 2
+    assert abs(misc_data.pitch - 0.1) < 1e-6
+
+
+def test_pending_photos_are_geotagged_on_stop(monkeypatch: Any, tmp_path: str) -> None:
+    pi_streamer = create_fake_pistreamer("1280x720")
+    import pistreamer as pistreamer_module
+
+    file_names: List[str] = []
+
+    class _RecordingEXIFService:
+        def __init__(self, gps_data: Any, misc_data: Any, file_name: str) -> None:
+            file_names.append(file_name)
+
+        def add_metadata(self) -> None:
+            pass
+
+    monkeypatch.setattr(pistreamer_module, "EXIFService", _RecordingEXIFService)
+    file_name = os.path.join(tmp_path, "photo.jpg")
+    with contextlib.redirect_stdout(io.StringIO()):
+        pi_streamer.picam2.configure(pi_streamer.streaming_config)
+        pi_streamer.start_rtp_stream("127.0.0.1", "5600")
+        pi_streamer.telemetry.add_gps(_gps(LAT_BEFORE), 1)
+        pi_streamer.take_photo(file_name)
+        pi_streamer.stop_and_clean_all()
+    pi_streamer.command_controller.audit_log.close()
+    assert file_names == [file_name]
+    assert not pi_streamer.pending_geotags
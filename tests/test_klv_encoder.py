@@ -0,0 +1,45 @@
+import json
+import pytest
+from _fake_devices import DISPATCH_COMMANDS
+from constants import CommandType, MavlinkGPSData
+from klv_encoder import KLVEncoder, parse_klv
+from telemetry_buffer import TelemetryHistory
+
+# expected value and the ST 0601 quantization of each field
+EXPECTED = {
+    "latitude": (35.968699, 1e-6),
+    "longitude": (-83.929044, 1e-6),
+    "altitude": (276.0, 0.31),
+    "heading": (359.5, 0.006),
+    "pitch": (5.729578, 0.001),
+    "roll": (-1.145916, 0.002),
+}
+
+
+@pytest.fixture
+def parsed() -> dict:
+    gps_data = MavlinkGPSData(
+        **json.loads(dict(DISPATCH_COMMANDS)[CommandType.GPS_DATA.value])
+    )
+    telemetry = TelemetryHistory()
+    telemetry.add_gps(
+        (359686990, -839290440, 276000, 1, 1, 1500, 35950, 3, 10, gps_data.time_usec)
+    )
+    telemetry.add_misc(0.1, -0.02, "IMX477", (50, 1))
+    packet = KLVEncoder().encode(
+        gps_data.time_usec, telemetry.gps.latest(), telemetry.attitude.latest()
+    )
+    result = parse_klv(bytes(packet))
+    result["time_usec"] = gps_data.time_usec
+    return result
+
+
+@pytest.mark.parametrize("name", EXPECTED)
+def test_roundtrip_within_quantization(parsed: dict, name: str) -> None:
+    value, tolerance = EXPECTED[name]
+    assert abs(parsed[name] - value) <= tolerance
+
+
+def test_roundtrip_timestamp_and_speed(parsed: dict) -> None:
+    assert parsed["timestamp_us"] == parsed["time_usec"]
+    assert parsed["ground_speed"] == 15
@@ -0,0 +1,30 @@
+import json
+from _fake_devices import DISPATCH_COMMANDS, StubPiStreamer
+from command_controller import CommandController
+from constants import CommandType, MavlinkGPSData, MavlinkMiscData
+from mavlink_codec import (
+    decode_gps_values,
+    decode_misc_values,
+    encode_gps_data,
+    encode_misc_data,
+)
+
+GPS_JSON = dict(DISPATCH_COMMANDS)[CommandType.GPS_DATA.value]
+MISC_JSON = dict(DISPATCH_COMMANDS)[CommandType.MISC_DATA.value]
+
+
+def test_binary_gps_decodes_like_json() -> None:
+    controller = CommandController(StubPiStreamer())  # type: ignore
+    gps_binary = encode_gps_data(MavlinkGPSData(**json.loads(GPS_JSON)))
+    assert list(decode_gps_values(gps_binary)) == controller._parse_gps(GPS_JSON)
+
+
+def test_binary_misc_roundtrip() -> None:
+    misc_data = MavlinkMiscData(**json.loads(MISC_JSON))
+    pitch, roll, camera_model, focal_length = decode_misc_values(
+        encode_misc_data(misc_data)
+    )
+    assert abs(pitch - misc_data.pitch) < 1e-6
+    assert abs(roll - misc_data.roll) < 1e-6
+    assert camera_model == misc_data.camera_model
+    assert focal_length == tuple(misc_data.focal_length)
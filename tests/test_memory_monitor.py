@@ -0,0 +1,64 @@
+import gc
+import tempfile
+import threading
+from time import monotonic, sleep
+import numpy as np
+import pytest
+from _fake_devices import SOAK_FRAMES, get_growth_per_hour, run_soak_scenario
+from memory_monitor import MemoryMonitor, count_ndarrays
+
+SOAK_MAX_RSS_KB_PER_HOUR = 4096  # ~100 MB a day of flying
+SOAK_MAX_PYTHON_BLOCKS_PER_HOUR = 3600  # one object kept a second
+SOAK_MAX_NDARRAYS_PER_HOUR = 10  # short of one array kept per recording
+
+
+def test_counts_an_array_once_from_one_object_list() -> None:
+    array = np.zeros(4096, np.uint8)
+    holders = [[array], {"array": array}, [array[:10]]]
+    objects = gc.get_objects()
+    counts = count_ndarrays(objects)
+    del objects
+    assert holders
+    # the view is counted but not its base's buffer a second time
+    assert counts["ndarrays"] >= 2 and counts["ndarray_kb"] >= 4
+
+
+def test_samples_on_its_own_thread() -> None:
+    monitor = MemoryMonitor(interval=0.05)
+    assert monitor.poll() is None
+    monitor.start()
+    try:
+        end = monotonic() + 5
+        sample = None
+        while sample is None and monotonic() < end:
+            sleep(0.01)
+            sample = monitor.poll()
+        assert sample is not None and sample["rss_kb"] and sample["gc_objects"]
+        assert any(thread.name == "memory-monitor" for thread in threading.enumerate())
+    finally:
+        monitor.stop()
+    assert monitor.latest() is monitor.history[-1]
+
+
+def test_request_sample_wakes_the_thread() -> None:
+    monitor = MemoryMonitor(interval=3600)
+    monitor.start()
+    try:
+        monitor.request_sample()
+        end = monotonic() + 5
+        while monitor.poll() is None:
+            assert monotonic() < end, "no sample was taken"
+            sleep(0.01)
+    finally:
+        monitor.stop()
+
+
+@pytest.mark.slow
+def test_memory_levels_off_over_a_simulated_hour() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        samples, _ = run_soak_scenario(SOAK_FRAMES, directory)
+    assert get_growth_per_hour(samples, "rss_kb") < SOAK_MAX_RSS_KB_PER_HOUR
+    assert (
+        get_growth_per_hour(samples, "python_blocks") < SOAK_MAX_PYTHON_BLOCKS_PER_HOUR
+    )
+    assert get_growth_per_hour(samples, "ndarrays") < SOAK_MAX_NDARRAYS_PER_HOUR
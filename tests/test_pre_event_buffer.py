@@ -0,0 +1,86 @@
+import io
+import os
+from time import monotonic, sleep
+import pytest
+from _fake_devices import FakeFragmentedMp4, FakeTransportStream
+from constants import ENCODER_READ_SIZE, FRAMERATE
+from pre_event_buffer import PreEventBuffer, _FragmentedMp4Splitter
+
+PRE_EVENT_SECONDS = 2.0
+DURATION = 10.0  # seconds of stream fed
+
+
+def _chunks(data: bytes) -> list:
+    return [
+        data[offset : offset + ENCODER_READ_SIZE]
+        for offset in range(0, len(data), ENCODER_READ_SIZE)
+    ]
+
+
+@pytest.mark.parametrize("bitrate", [2000000, 10000000])
+def test_buffers_the_pre_event_seconds(tmp_path: str, bitrate: int) -> None:
+    transport_stream = FakeTransportStream(bitrate)
+    data = b"".join(
+        transport_stream.get_frame(index) for index in range(int(DURATION * FRAMERATE))
+    )
+    byte_rate = bitrate / 8
+    position = [0.0]  # simulated seconds of stream fed
+    pre_event_buffer = PreEventBuffer(PRE_EVENT_SECONDS, clock=lambda: position[0])
+    peak_bytes = 0
+    for index, chunk in enumerate(_chunks(data)):
+        position[0] = index * ENCODER_READ_SIZE / byte_rate
+        pre_event_buffer.feed(chunk)
+        peak_bytes = max(peak_bytes, pre_event_buffer.metrics()["buffered_kb"] * 1024)
+
+    file_name = os.path.join(tmp_path, "pre_event.ts")
+    pre_event_buffer.start_recording(file_name)
+    pre_event_buffer.stop_recording()
+    assert pre_event_buffer.wait(5)
+
+    bound = byte_rate * PRE_EVENT_SECONDS
+    gop_bytes = len(transport_stream.keyframe) + len(transport_stream.frame) * (
+        transport_stream.gop - 1
+    )
+    assert peak_bytes <= bound + gop_bytes + ENCODER_READ_SIZE
+    assert os.path.getsize(file_name) >= bound
+
+
+def test_splits_fragmented_mp4_into_gops() -> None:
+    stream = FakeFragmentedMp4(2000000)
+    data = b"".join(stream.get_frame(index) for index in range(FRAMERATE * 3))
+    splitter = _FragmentedMp4Splitter()
+    pieces = [piece for chunk in _chunks(data) for piece in splitter.split(chunk)]
+    assert data.startswith(splitter.header) and data[4:8] == b"ftyp"
+    assert pieces and pieces[0][1] == 0
+    # a GOP is written once the next keyframe is encoded
+    assert splitter.frames == FRAMERATE * 2
+
+
+def test_the_recording_is_written_off_the_callers_threads(
+    tmp_path: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    class _SlowFile(io.FileIO):
+        def write(self, data: bytes) -> int:  # type: ignore
+            sleep(0.05)  # an SD card behind on its writes
+            return super().write(data)
+
+    import pre_event_buffer as module
+
+    monkeypatch.setattr(module, "open", lambda name, mode: _SlowFile(name, "w"), False)
+    data = b"".join(FakeTransportStream(2000000).get_frame(i) for i in range(90))
+    pre_event_buffer = PreEventBuffer(PRE_EVENT_SECONDS)
+    chunks = _chunks(data)
+    for chunk in chunks[: len(chunks) // 2]:
+        pre_event_buffer.feed(chunk)
+
+    file_name = os.path.join(tmp_path, "slow.ts")
+    start = monotonic()
+    pre_event_buffer.start_recording(file_name)
+    for chunk in chunks[len(chunks) // 2 :]:
+        pre_event_buffer.feed(chunk)
+    pre_event_buffer.stop_recording()
+    assert monotonic() - start < 0.05
+    assert not pre_event_buffer.wait(0)  # still writing
+
+    assert pre_event_buffer.wait(10)
+    assert pre_event_buffer.closed_files[-1] == (file_name, os.path.getsize(file_name))
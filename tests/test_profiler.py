@@ -0,0 +1,19 @@
+from time import monotonic
+from constants import ProfileMode
+from profiler import StreamProfiler
+
+
+def test_sampling_writes_collapsed_stacks(tmp_path: str) -> None:
+    profiler = StreamProfiler(directory=str(tmp_path))
+    profiler.start(ProfileMode.SAMPLE)
+    end = monotonic() + 0.5
+    while monotonic() < end:
+        sum(range(1000))
+    file_name = profiler.stop()
+
+    with open(file_name) as f:
+        lines = f.read().splitlines()
+    assert lines and profiler.sample_count
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert stack and int(count) > 0, line
@@ -0,0 +1,33 @@
+import av
+import numpy as np
+from pyav_encoder import PyAvEncoderProcess
+
+WIDTH, HEIGHT = 320, 240
+
+
+def test_request_keyframe_forces_an_idr_without_a_restart(tmp_path: str) -> None:
+    output = f"{tmp_path}/stream.ts"
+    process = PyAvEncoderProcess(
+        # the software encoder's settings, see SOFTWARE_ENCODER_OPTIONS
+        ["ffmpeg", "-f", "rawvideo", "-pix_fmt", "yuv420p"]
+        + ["-s", f"{WIDTH}x{HEIGHT}", "-r", "30", "-i", "-"]
+        + ["-c:v", "libx264", "-g", "30", "-bf", "0", "-f", "mpegts", output]
+    )
+    # a slowly moving gradient, so libx264 sees no scene cut
+    gradient = np.arange(HEIGHT * 3 // 2 * WIDTH, dtype=np.uint32)
+    for index in range(40):
+        if index == 10:
+            process.request_keyframe()
+        frame = ((gradient + index) // 64 % 256).astype(np.uint8)
+        process.stdin.write(frame.tobytes())
+    process.stdin.close()
+    assert process.wait(5) == 0
+
+    with av.open(output) as container:
+        keyframes = [
+            index
+            for index, packet in enumerate(container.demux(video=0))
+            if packet.size and packet.is_keyframe
+        ]
+    # the forced IDR starts a GOP, so the one scheduled for frame 30 moves to 40
+    assert keyframes == [0, 10]
@@ -0,0 +1,69 @@
+import contextlib
+import io
+import struct
+from typing import List
+from _fake_devices import (
+    FEC_CAPTURE_PORT,
+    capture_fec_relay,
+    create_fake_pistreamer,
+    rtp_frames,
+)
+from rtp_fec import FecDecoder, FecEncoder
+
+
+def _sequence_number(packet: bytes) -> int:
+    return struct.unpack_from(">H", packet, 2)[0]
+
+
+def test_relay_delivers_media_and_parity() -> None:
+    frames = rtp_frames(1.0)
+    media_count = sum(len(packets) for packets in frames)
+    capture, metrics = capture_fec_relay(frames, 4, 1)
+
+    media = [packet for _, packet, is_parity in capture if not is_parity]
+    assert len(media) == media_count
+    assert metrics["parity_packets"] == sum(is_parity for _, _, is_parity in capture)
+    assert metrics["parity_packets"] >= media_count // 4
+
+
+def test_decoder_recovers_one_lost_packet_per_group() -> None:
+    packets = [packet for frame in rtp_frames(0.5) for packet in frame]
+    encoder = FecEncoder(4, 1)
+    decoder = FecDecoder()
+    delivered = set()
+    for index, packet in enumerate(packets):
+        parity = encoder.protect(packet)
+        if index % 4 != 1:  # the second packet of every group is lost
+            delivered.update(map(_sequence_number, decoder.receive(packet)))
+        for parity_packet in parity:
+            recovered = decoder.receive_parity(parity_packet)
+            for recovered_packet in recovered:
+                assert recovered_packet == packets[_sequence_number(recovered_packet)]
+            delivered.update(map(_sequence_number, recovered))
+    protected = len(packets) // 4 * 4  # the last group may not be closed
+    assert set(range(protected)) <= delivered
+
+
+def test_set_fec_changes_the_protection_with_the_relay_stopped() -> None:
+    with contextlib.redirect_stdout(io.StringIO()):
+        pi_streamer = create_fake_pistreamer("640x360")
+        relay = pi_streamer.fec_relay
+        pi_streamer.set_fec(4, 1)
+        pi_streamer.start_rtp_stream("127.0.0.1", str(FEC_CAPTURE_PORT))
+        assert relay.is_running
+        running: List[bool] = []
+        set_protection = relay.set_protection
+
+        def _set_protection(group_size: int, interleave: int = 1) -> None:
+            running.append(relay.is_running)
+            set_protection(group_size, interleave)
+
+        relay.set_protection = _set_protection
+        pi_streamer.set_fec(2, 2)
+        try:
+            assert running == [False]
+            assert relay.is_running and pi_streamer.is_rtp_streaming
+            assert (relay.encoder.group_size, relay.encoder.interleave) == (2, 2)
+        finally:
+            pi_streamer.stop_rtp_stream()
+            pi_streamer.command_controller.audit_log.close()
@@ -0,0 +1,129 @@
+import contextlib
+import io
+import socket
+import struct
+import threading
+from time import monotonic, sleep
+from _fake_devices import FakeCameraExhausted, RtspClient, create_fake_pistreamer
+from constants import (
+    RTSP_MAX_CLIENTS,
+    RTSP_SEND_TIMEOUT,
+    EncoderState,
+    StreamingProtocolType,
+)
+from rtsp_server import RtspServer
+
+IDLE_TIMEOUT = 1.0  # seconds, the server's idle_timeout
+RTSP_TEST_PORT = 18554  # and the three after it for the relay, RTP and RTCP
+RTSP_TEST_PACKETS = 20000  # 28 MB, more than the loopback socket buffers take
+
+
+def test_viewers_share_an_encoder_started_on_demand() -> None:
+    pi_streamer = create_fake_pistreamer(
+        "640x360", protocol=StreamingProtocolType.RTSP.value
+    )
+    pi_streamer.picam2.realtime = True
+    server = pi_streamer.rtsp_server
+    server.idle_timeout = IDLE_TIMEOUT
+    url = f"rtsp://127.0.0.1:{server.port}/stream"
+
+    def _stream() -> None:
+        try:
+            pi_streamer.stream()
+        except FakeCameraExhausted:
+            pass
+
+    def _rtsp_encoders() -> list:
+        return [process for sink, process in pi_streamer.encoders if sink == "rtsp"]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        thread = threading.Thread(target=_stream, daemon=True)
+        thread.start()
+        try:
+            sleep(0.5)
+            assert server.is_running
+            assert not _rtsp_encoders()  # idle until the first viewer
+
+            viewers = [RtspClient(url, tcp) for tcp in (False, True)]
+            for client in viewers:
+                client.play()  # each response is checked to be a 200
+                client.receive()  # an interleaved packet starts with $ over TCP
+            assert server.viewers == 2
+            assert len(_rtsp_encoders()) == 1
+
+            for client in viewers:
+                client.close()
+            left = monotonic()
+            while pi_streamer.encoder_rtsp.state != EncoderState.STOPPED:
+                assert monotonic() - left < IDLE_TIMEOUT + 2.0
+                sleep(0.01)
+        finally:
+            pi_streamer.picam2.frame_limit = pi_streamer.picam2.frames_captured
+            thread.join(5.0)
+            pi_streamer.command_controller.audit_log.close()
+    assert not server.is_running
+
+
+def _rtp_packet(sequence_number: int) -> bytes:
+    header = struct.pack(">BBHII", 0x80, 96, sequence_number, sequence_number, 1)
+    return header + bytes(1400)
+
+
+def test_a_stalled_tcp_viewer_is_dropped_without_holding_up_the_others() -> None:
+    server = RtspServer(
+        port=RTSP_TEST_PORT,
+        relay_port=RTSP_TEST_PORT + 1,
+        server_rtp_port=RTSP_TEST_PORT + 2,
+    )
+    url = f"rtsp://127.0.0.1:{RTSP_TEST_PORT}/stream"
+    encoder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.start()
+        try:
+            stalled = RtspClient(url, True)
+            stalled.connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            stalled.play()  # and never reads the stream
+            viewer = RtspClient(url, False)
+            viewer.play()
+            gaps = []
+            last_received = monotonic()
+            for sequence_number in range(RTSP_TEST_PACKETS):
+                encoder.sendto(
+                    _rtp_packet(sequence_number), ("127.0.0.1", server.relay_port)
+                )
+                viewer.receive()
+                gaps.append(monotonic() - last_received)
+                last_received = monotonic()
+            assert max(gaps) < RTSP_SEND_TIMEOUT / 2
+            assert server.dropped_sessions == 1
+            assert server.viewers == 1
+        finally:
+            encoder.close()
+            server.stop()
+
+
+def test_connections_over_the_limit_are_closed() -> None:
+    server = RtspServer(
+        port=RTSP_TEST_PORT,
+        relay_port=RTSP_TEST_PORT + 1,
+        server_rtp_port=RTSP_TEST_PORT + 2,
+    )
+    url = f"rtsp://127.0.0.1:{RTSP_TEST_PORT}/stream"
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.start()
+        try:
+            clients = [RtspClient(url, False) for _ in range(RTSP_MAX_CLIENTS)]
+            for client in clients:
+                client.request("OPTIONS")
+            assert server.connections == RTSP_MAX_CLIENTS
+            refused = RtspClient(url, False)
+            assert refused.connection.recv(4096) == b""
+            refused.connection.close()
+            clients.pop().connection.close()
+            closed = monotonic()
+            while server.connections == RTSP_MAX_CLIENTS:
+                assert monotonic() - closed < 2.0
+                sleep(0.01)
+            RtspClient(url, False).request("OPTIONS")
+        finally:
+            server.stop()
@@ -0,0 +1,51 @@
+import os
+from _fake_devices import (
+    RECORD_PROFILE_FRAMES,
+    SEGMENT_FRAMES,
+    count_frames,
+    run_record_profile_switch,
+    run_segments_scenario,
+)
+from frame_index import get_frame_index_path, read_frame_index
+from pre_event_buffer import _FragmentedMp4Splitter
+
+
+def test_retention_keeps_whole_indexed_segments(tmp_path: str) -> None:
+    directory = str(tmp_path)
+    pi_streamer = run_segments_scenario(SEGMENT_FRAMES, directory)
+
+    segments = pi_streamer.segment_index.segments
+    recordings = {
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(".ts")
+    }
+    assert recordings == {segment["file"] for segment in segments}
+    assert os.path.exists(os.path.join(directory, "photo.jpg"))
+    created = pi_streamer.record_segment + 1
+    assert created > len(segments) > 1
+    for segment in segments:
+        frame_count, starts_on_keyframe = count_frames(segment["file"])
+        assert starts_on_keyframe, segment["file"]
+        assert segment["bytes"] == os.path.getsize(segment["file"])
+        _, records = read_frame_index(get_frame_index_path(segment["file"]))
+        if segment is not segments[-1]:  # the frames in the encoder at the stop
+            assert len(records) == frame_count, segment["file"]
+
+
+def test_profile_switch_starts_a_new_segment(tmp_path: str) -> None:
+    pi_streamer = run_record_profile_switch(RECORD_PROFILE_FRAMES, str(tmp_path))
+
+    segments = [segment["file"] for segment in pi_streamer.segment_index.segments]
+    assert [os.path.basename(file_name) for file_name in segments] == [
+        "f.ts",
+        "f_1.mp4",
+    ]
+    ts_frames, starts_on_keyframe = count_frames(segments[0])
+    assert starts_on_keyframe and ts_frames
+    with open(segments[1], "rb") as f:
+        mp4 = f.read()
+    splitter = _FragmentedMp4Splitter()
+    pieces = splitter.split(mp4)
+    assert mp4.startswith(splitter.header) and mp4[4:8] == b"ftyp"
+    assert pieces and pieces[0][1] == 0 and splitter.frames
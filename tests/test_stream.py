@@ -0,0 +1,16 @@
+import pytest
+from _fake_devices import run_stream_scenario
+
+FRAMES = 60
+
+
+@pytest.mark.parametrize(
+    "protocol, sink", [("rtp", "rtp"), ("mpegts", "mpegts"), ("srt", "mpegts")]
+)
+def test_streams_to_the_protocols_encoder(
+    tmp_path: str, protocol: str, sink: str
+) -> None:
+    scenario = {"name": protocol, "resolution": "640x360", "protocol": protocol}
+    result = run_stream_scenario(scenario, FRAMES, str(tmp_path))
+    assert result["sink_bytes"].get(sink)
+    assert result["counters"].get("decimated_frames", 0) < FRAMES // 2
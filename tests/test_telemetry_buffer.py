@@ -0,0 +1,43 @@
+from telemetry_buffer import GPS_FIELDS, TelemetryHistory
+
+SECOND_NS = 1000000000
+
+
+def _gps(lat: int, fix_type: int, time_usec: int) -> tuple:
+    return (lat, -839290440, 276000, 1, 1, 500, 9000, fix_type, 10, time_usec)
+
+
+def test_interpolates_between_samples() -> None:
+    telemetry = TelemetryHistory()
+    telemetry.add_gps(_gps(359686990, 3, 0), SECOND_NS)
+    telemetry.add_gps(_gps(359687990, 3, 1000000), 2 * SECOND_NS)
+    assert telemetry.get_gps_data(SECOND_NS + SECOND_NS // 4).lat == 359687240
+
+
+def test_extrapolates_past_the_newest_sample_for_a_while() -> None:
+    telemetry = TelemetryHistory()
+    telemetry.add_gps(_gps(359686990, 3, 0), SECOND_NS)
+    telemetry.add_gps(_gps(359687990, 2, 1000000), 2 * SECOND_NS)
+    gps_data = telemetry.get_gps_data(2 * SECOND_NS + SECOND_NS // 2)
+    assert gps_data.lat == 359688490
+    assert gps_data.time_usec == 1500000
+    assert gps_data.fix_type == 2  # held, not extrapolated
+    # held after TELEMETRY_MAX_EXTRAPOLATION
+    assert telemetry.get_gps_data(60 * SECOND_NS).lat == 359688990
+
+
+def test_clamps_before_the_oldest_sample() -> None:
+    telemetry = TelemetryHistory()
+    telemetry.add_gps(_gps(359686990, 3, 0), SECOND_NS)
+    telemetry.add_gps(_gps(359687990, 3, 1000000), 2 * SECOND_NS)
+    assert telemetry.get_gps_data(0).lat == 359686990
+
+
+def test_covers_once_both_histories_are_newer() -> None:
+    telemetry = TelemetryHistory()
+    telemetry.add_gps(_gps(359686990, 3, 0), 2 * SECOND_NS)
+    assert not telemetry.covers(SECOND_NS)  # no attitude yet
+    telemetry.add_misc(0.1, 0.02, "IMX477", (50, 1), 2 * SECOND_NS)
+    assert telemetry.covers(SECOND_NS)
+    assert not telemetry.covers(3 * SECOND_NS)
+    assert len(GPS_FIELDS) == len(_gps(0, 0, 0))